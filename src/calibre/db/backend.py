@@ -58,6 +58,7 @@
 from calibre.utils.filenames import (
     ascii_filename,
     atomic_rename,
+    clone_file,
     copyfile_using_links,
     copytree_using_links,
     get_long_path_name,
@@ -1877,8 +1878,7 @@ def copy_format_to(self, book_id, fmt, fname, path, dest,
                         return True
                     except Exception:
                         pass
-                with open(path, 'rb') as f, open(make_long_path_useable(dest), 'wb') as d:
-                    shutil.copyfileobj(f, d)
+                clone_file(path, make_long_path_useable(dest))
         return True
 
     def windows_check_if_files_in_use(self, paths):
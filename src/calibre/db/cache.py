@@ -15,10 +15,10 @@
 import weakref
 from collections import defaultdict
 from collections.abc import Iterable, Iterator, MutableSet, Set
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
-from queue import Queue
+from queue import Empty, Queue
 from threading import Lock
 from time import mktime, monotonic, sleep, time
 from typing import NamedTuple
@@ -28,7 +28,7 @@
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
-from calibre.db.categories import get_categories
+from calibre.db.categories import SortKeyCache, get_categories
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
@@ -168,6 +168,7 @@ def __init__(self, backend, library_database_instance=None):
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
         self.vls_cache_lock = Lock()
+        self.category_sort_key_cache = SortKeyCache()
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
@@ -325,6 +326,12 @@ def clear_link_map_cache(self, book_ids=None):
             for book in book_ids:
                 self.link_maps_cache.pop(book, None)
 
+    @write_api
+    def clear_category_caches(self, book_ids=None):
+        for field in self.fields.values():
+            if field.is_many:
+                field.clear_category_cache(book_ids)
+
     @write_api
     def reload_from_db(self, clear_caches=True):
         if clear_caches:
@@ -1675,6 +1682,7 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
                 self._update_path(dirtied, mark_as_dirtied=False)
             self._mark_as_dirty(dirtied)
             self._clear_link_map_cache(dirtied)
+            self._clear_category_caches(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
         return dirtied
 
@@ -2372,6 +2380,7 @@ def rename_items(self, field, item_id_to_new_name_map, change_index=True, restri
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
             self._mark_as_dirty(affected_books)
             self._clear_link_map_cache(affected_books)
+            self._clear_category_caches(affected_books)
         self.event_dispatcher(EventType.items_renamed, field, affected_books, id_map)
         return affected_books, id_map
 
@@ -2392,6 +2401,7 @@ def remove_items(self, field, item_ids, restrict_to_book_ids=None):
             else:
                 self._mark_as_dirty(affected_books)
             self._clear_link_map_cache(affected_books)
+            self._clear_category_caches(affected_books)
         self.event_dispatcher(EventType.items_removed, field, affected_books, item_ids)
         return affected_books
 
@@ -3049,70 +3059,208 @@ def user_categories_for_books(self, book_ids, proxy_metadata_map=None):
         return ans
 
     @write_api
-    def embed_metadata(self, book_ids, only_fmts=None, report_error=None, report_progress=None):
-        ''' Update metadata in all formats of the specified book_ids to current metadata in the database. '''
+    def embed_metadata(self, book_ids, only_fmts=None, report_error=None, report_progress=None, num_workers=0, skip_unchanged=False):
+        '''
+        Update metadata in all formats of the specified book_ids to current metadata in the database.
+
+        :param num_workers: If greater than zero, the metadata is embedded by
+            up to this many worker processes at a time.
+        :param skip_unchanged: If True, files are skipped if the metadata and
+            cover of their book, and the files themselves, have not changed
+            since metadata was last embedded in them.
+        :param report_progress: Called after each book with the number of
+            books processed, the total number of books and the metadata of the
+            book. When num_workers or skip_unchanged are set, it is also passed
+            a dict with the number of files that were embedded, skipped and
+            failed and the number of books processed per second.
+        '''
+        from calibre.customize.ui import can_set_metadata
+        from calibre.db.embed import EMBEDDED_METADATA, file_state, format_error, metadata_hash, set_metadata_in_stream
         field = self.fields['formats']
-        from calibre.customize.ui import apply_null_metadata
-        from calibre.ebooks.metadata.meta import set_metadata
-        from calibre.ebooks.metadata.opf2 import pretty_print
         if only_fmts:
             only_fmts = {f.lower() for f in only_fmts}
+        book_ids = tuple(book_ids)
+        records = self.backend.get_custom_book_data(EMBEDDED_METADATA, book_ids, {})
+        updated_records = {}
+        stats = {'embedded': 0, 'skipped': 0, 'failed': 0}
+        extended_progress = num_workers > 0 or skip_unchanged
+        num_done, start_time = 0, monotonic()
+
+        def book_done(mi):
+            nonlocal num_done
+            num_done += 1
+            if report_progress is not None:
+                if extended_progress:
+                    rate = num_done / max(monotonic() - start_time, 0.001)
+                    report_progress(num_done, len(book_ids), mi, dict(stats, books_per_second=rate))
+                else:
+                    report_progress(num_done, len(book_ids), mi)
 
-        def doit(fmt, mi, stream):
-            with apply_null_metadata, pretty_print:
-                set_metadata(stream, mi, stream_type=fmt, report_error=report_error)
-            stream.seek(0, os.SEEK_END)
-            return stream.tell()
+        def files_to_update(book_id, mi, path, mhash):
+            record = records.get(book_id) or {}
+            for fmt in field.table.book_col_map.get(book_id, ()):
+                if (only_fmts is not None and fmt.lower() not in only_fmts) or not can_set_metadata(fmt):
+                    continue
+                try:
+                    name = field.format_fname(book_id, fmt)
+                except Exception:
+                    continue
+                fpath = self.backend.format_abspath(book_id, fmt, name, path) if name else None
+                if not fpath:
+                    continue
+                r = record.get(fmt)
+                if skip_unchanged and r and r[0] == mhash and r[1:] == file_state(fpath):
+                    stats['skipped'] += 1
+                    continue
+                yield fmt, name, fpath
 
-        for i, book_id in enumerate(book_ids):
-            fmts = field.table.book_col_map.get(book_id, ())
-            if not fmts:
-                continue
-            mi = self._get_metadata(book_id)
-            buf = BytesIO()
-            if not self._copy_cover_to(book_id, buf):
+        def file_done(book_id, mi, path, mhash, fmt, name, new_size, errors=(), tb=None):
+            for err in errors:
+                if report_error is None:
+                    print(f'Failed to set metadata for the {fmt} format of {mi.title}:\n{err}', file=sys.stderr)
+                else:
+                    report_error(mi, fmt, err)
+            if new_size is None:
+                stats['failed'] += 1
+                if report_error is None:
+                    raise Exception(f'Failed to embed metadata in the {fmt} format of {mi.title}:\n{tb}')
+                report_error(mi, fmt, tb)
                 return
-            cdata = buf.getvalue()
-            if cdata:
-                mi.cover_data = ('jpeg', cdata)
-            try:
-                path = self._get_book_path(book_id)
-            except Exception:
-                continue
-            for fmt in fmts:
-                if only_fmts is not None and fmt.lower() not in only_fmts:
+            stats['embedded'] += 1
+            self.format_metadata_cache[book_id].get(fmt, {})['size'] = new_size
+            max_size = field.table.update_fmt(book_id, fmt, name, new_size, self.backend)
+            self.fields['size'].table.update_sizes({book_id: max_size})
+            if not errors:
+                state = file_state(self.backend.format_abspath(book_id, fmt, name, path))
+                if state:
+                    record = updated_records.setdefault(book_id, dict(records.get(book_id) or {}))
+                    record[fmt] = [mhash] + state
+
+        def embed_in_process(book_id, mi, path, mhash, fmts):
+            buf = BytesIO()
+            if self._copy_cover_to(book_id, buf):
+                mi.cover_data = ('jpeg', buf.getvalue())
+            for fmt, name, fpath in fmts:
+                errors = []
+                try:
+                    new_size = self.backend.apply_to_format(book_id, path, name, fmt, partial(
+                        set_metadata_in_stream, fmt, mi, report_error=lambda mi, fmt, tb: errors.append(tb)))
+                except Exception as e:
+                    if report_error is None:
+                        raise
+                    file_done(book_id, mi, path, mhash, fmt, name, None, errors, format_error(e))
+                else:
+                    if new_size is not None:
+                        file_done(book_id, mi, path, mhash, fmt, name, new_size, errors)
+            book_done(mi)
+
+        pool, pending, temp_files = None, {}, {}
+        if num_workers > 0:
+            from calibre.db.embed import EMBED_WORKER
+            from calibre.utils.filenames import atomic_rename
+            from calibre.utils.ipc.pool import Failure, Pool
+            from calibre.utils.serialize import msgpack_dumps
+            pool = Pool(max_workers=num_workers, name='EmbedMetadata')
+
+        def remove_temp_files(job_id):
+            for tpath in temp_files.pop(job_id, {}).values():
+                with suppress(OSError):
+                    os.remove(tpath)
+
+        def create_temp_files(job_id, fmts):
+            # The workers embed metadata in copies of the files, which are
+            # renamed over the originals only once they have been written
+            tpaths = temp_files[job_id] = {}
+            for fmt, name, fpath in fmts:
+                with PersistentTemporaryFile(suffix=f'.{fmt.lower()}', dir=os.path.dirname(fpath)) as pt:
+                    tpaths[fmt] = pt.name
+            return [(fmt, fpath, tpaths[fmt]) for fmt, name, fpath in fmts]
+
+        def wait_for_workers(max_pending):
+            while len(pending) > max_pending:
+                try:
+                    worker_result = pool.results.get(True, 0.1)
+                except Empty:
+                    if pool.failed:
+                        break
+                    continue
+                pool.results.task_done()
+                if worker_result.is_terminal_failure:
                     continue
+                book_id, mi, path, mhash, fmts = pending.pop(worker_result.id)
+                tpaths = temp_files.get(worker_result.id, {})
+                result = worker_result.result
+                if result.err is None:
+                    files = {fmt: (name, fpath) for fmt, name, fpath in fmts}
+                    for fmt, new_size, errors, tb in result.value:
+                        name, fpath = files[fmt]
+                        if new_size is not None:
+                            try:
+                                with suppress(OSError):
+                                    shutil.copymode(fpath, tpaths[fmt])
+                                atomic_rename(tpaths[fmt], fpath)
+                            except Exception as e:
+                                new_size, tb = None, format_error(e)
+                        file_done(book_id, mi, path, mhash, fmt, name, new_size, errors, tb)
+                else:
+                    for fmt, name, fpath in fmts:
+                        file_done(book_id, mi, path, mhash, fmt, name, None, (), result.err + '\n' + result.traceback)
+                remove_temp_files(worker_result.id)
+                book_done(mi)
+            if pool.failed:
+                # The book the worker crashed on fails, the other books the
+                # pool did not process are embedded in this process. Workers
+                # only write to temp files, so the books whose workers were
+                # killed when the pool was shut down are intact.
+                failure = pool.terminal_failure
+                if failure.job_id in pending:
+                    book_id, mi, path, mhash, fmts = pending.pop(failure.job_id)
+                    remove_temp_files(failure.job_id)
+                    for fmt, name, fpath in fmts:
+                        file_done(book_id, mi, path, mhash, fmt, name, None, (), failure.message + '\n' + failure.tb)
+                    book_done(mi)
+                for i in tuple(pending):
+                    remove_temp_files(i)
+                    embed_in_process(*pending.pop(i))
+
+        try:
+            for i, book_id in enumerate(book_ids):
+                mi = self._get_metadata(book_id)
                 try:
-                    name = self.fields['formats'].format_fname(book_id, fmt)
+                    path = self._get_book_path(book_id)
                 except Exception:
+                    path = None
+                fmts = mhash = None
+                if path and field.table.book_col_map.get(book_id):
+                    cover_path = self.backend.cover_abspath(book_id, path)
+                    mhash = metadata_hash(mi, cover_path)
+                    fmts = tuple(files_to_update(book_id, mi, path, mhash))
+                if not fmts:
+                    book_done(mi)
                     continue
-                if name and path:
+                files = None
+                if pool is not None and not pool.failed:
                     try:
-                        new_size = self.backend.apply_to_format(book_id, path, name, fmt, partial(doit, fmt, mi))
-                    except Exception as e:
-                        if report_error is not None:
-                            tb = traceback.format_exc()
-                            if iswindows and isinstance(e, PermissionError) and e.filename and isinstance(e.filename, str):
-                                from calibre_extensions import winutil
-                                try:
-                                    p = winutil.get_processes_using_files(e.filename)
-                                except OSError:
-                                    pass
-                                else:
-                                    path_map = {x['path']: x for x in p}
-                                    tb = _('Could not open the file: "{}". It is already opened in the following programs:').format(e.filename)
-                                    for path, x in path_map.items():
-                                        tb += '\n' + f'{x["app_name"]}: {path}'
-                            report_error(mi, fmt, tb)
-                            new_size = None
-                        else:
-                            raise
-                    if new_size is not None:
-                        self.format_metadata_cache[book_id].get(fmt, {})['size'] = new_size
-                        max_size = self.fields['formats'].table.update_fmt(book_id, fmt, name, new_size, self.backend)
-                        self.fields['size'].table.update_sizes({book_id: max_size})
-            if report_progress is not None:
-                report_progress(i+1, len(book_ids), mi)
+                        files = create_temp_files(i, fmts)
+                    except OSError:
+                        remove_temp_files(i)
+                if files is None:
+                    embed_in_process(book_id, mi, path, mhash, fmts)
+                else:
+                    pending[i] = book_id, mi, path, mhash, fmts
+                    with suppress(Failure):
+                        pool(i, *EMBED_WORKER, msgpack_dumps({'mi': mi, 'cover': cover_path, 'files': files}))
+                    wait_for_workers(2 * num_workers)
+            if pool is not None:
+                wait_for_workers(0)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+                for i in tuple(temp_files):
+                    remove_temp_files(i)
+            if updated_records:
+                self.backend.add_custom_data(EMBEDDED_METADATA, updated_records, False)
+        return stats
 
     @read_api
     def get_last_read_positions(self, book_id, fmt, user):
@@ -3190,35 +3338,43 @@ def tempfile_for_export(which: str) -> Iterator[str]:
         metadata = {'format_data':format_metadata, 'metadata.db':dbkey, 'notes.db': notesdbkey, 'total':total, 'extra_files': extra_files}
         if has_fts:
             metadata['full-text-search.db'] = ftsdbkey
-        for i, book_id in enumerate(book_ids):
-            if abort is not None and abort.is_set():
-                return
-            if progress is not None:
-                report_progress(self._field_for('title', book_id))
-            format_metadata[book_id] = fm = {}
-            for fmt in self._formats(book_id):
-                mdata = self.format_metadata(book_id, fmt)
-                key = f'{key_prefix}:{book_id}:{fmt}'
-                fm[fmt] = key
-                mtime = mdata.get('mtime')
-                if mtime is not None:
-                    mtime = timestampfromdt(mtime)
-                with exporter.start_file(key, mtime=mtime) as dest:
-                    self._copy_format_to(book_id, fmt, dest)
-            cover_key = '{}:{}:{}'.format(key_prefix, book_id, '.cover')
-            with exporter.start_file(cover_key) as dest:
-                if not self.copy_cover_to(book_id, dest):
-                    dest.discard()
-                else:
-                    fm['.cover'] = cover_key
-            bp = self._get_book_path(book_id, sep='/', unsafe=True)
-            extra_files[book_id] = ef = {}
-            if bp:
-                for (relpath, fobj, stat_result) in self.backend.iter_extra_files(book_id, bp, self.fields['formats']):
-                    key = f'{key_prefix}:{book_id}:.|{relpath}'
-                    with exporter.start_file(key, mtime=stat_result.st_mtime) as dest:
-                        shutil.copyfileobj(fobj, dest)
-                    ef[relpath] = key
+        aborted = False
+
+        def files_to_export():
+            nonlocal aborted
+            for i, book_id in enumerate(book_ids):
+                if abort is not None and abort.is_set():
+                    aborted = True
+                    return
+                if progress is not None:
+                    report_progress(self._field_for('title', book_id))
+                format_metadata[book_id] = fm = {}
+                for fmt in self._formats(book_id):
+                    mdata = self.format_metadata(book_id, fmt)
+                    key = f'{key_prefix}:{book_id}:{fmt}'
+                    fm[fmt] = key
+                    mtime = mdata.get('mtime')
+                    if mtime is not None:
+                        mtime = timestampfromdt(mtime)
+                    yield key, self._format_abspath(book_id, fmt), mtime
+                cover_path = self._format_abspath(book_id, '__COVER_INTERNAL__')
+                if cover_path:
+                    fm['.cover'] = cover_key = '{}:{}:{}'.format(key_prefix, book_id, '.cover')
+                    yield cover_key, cover_path, None
+                bp = self._get_book_path(book_id, sep='/', unsafe=True)
+                extra_files[book_id] = ef = {}
+                if bp:
+                    for (relpath, path, stat_result) in self.backend.iter_extra_files(
+                            book_id, bp, self.fields['formats'], yield_paths=True):
+                        key = f'{key_prefix}:{book_id}:.|{relpath}'
+                        ef[relpath] = key
+                        yield key, path, stat_result.st_mtime
+
+        # The files are read and hashed in parallel and identical files are
+        # only stored once, see Exporter.add_files()
+        exporter.add_files(files_to_export())
+        if aborted:
+            return
         exporter.set_metadata(library_key, metadata)
         if progress is not None:
             progress(_('Completed'), total, total)
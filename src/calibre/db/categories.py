@@ -6,7 +6,7 @@
 __docformat__ = 'restructuredtext en'
 
 import copy
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from functools import partial
 
 from calibre.ebooks.metadata import author_to_author_sort
@@ -170,12 +170,43 @@ def category_display_order(ordered_cats, all_cats):
 numeric_collation = prefs['numeric_collation']
 
 
-def sort_key_for_popularity(x, hierarchical_categories=None):
-    return (-getattr(x, 'count', 0), sort_key(x.sort or x.name))
+class SortKeyCache:
 
+    '''
+    Remembers sort keys between calls to get_categories(), as computing them
+    for every item is a large part of its cost in big libraries. Keys
+    depend only on the text being sorted, so they never need to be
+    invalidated. Only the keys used in the previous call are kept, so that
+    the cache does not keep growing as items are renamed or deleted.
+    '''
 
-def sort_key_for_rating(x, hierarchical_categories=None):
-    return (-getattr(x, 'avg_rating', 0.0), sort_key(x.sort or x.name))
+    def __init__(self):
+        self.current, self.previous = defaultdict(dict), defaultdict(dict)
+
+    def new_call(self):
+        self.previous, self.current = self.current, defaultdict(dict)
+
+    def __call__(self, func, text):
+        cache = self.current[func]
+        ans = cache.get(text)
+        if ans is None:
+            ans = self.previous[func].get(text)
+            if ans is None:
+                ans = func(text)
+            cache[text] = ans
+        return ans
+
+
+def uncached(func, text):
+    return func(text)
+
+
+def sort_key_for_popularity(x, hierarchical_categories=None, key_cache=uncached):
+    return (-getattr(x, 'count', 0), key_cache(sort_key, x.sort or x.name))
+
+
+def sort_key_for_rating(x, hierarchical_categories=None, key_cache=uncached):
+    return (-getattr(x, 'avg_rating', 0.0), key_cache(sort_key, x.sort or x.name))
 
 
 # When sorting by name, treat the period in hierarchical categories as a tab so
@@ -183,10 +214,8 @@ def sort_key_for_rating(x, hierarchical_categories=None):
 # sort above "foo a.bar". Without this substitution "foo.bar" sorts below "foo
 # a.bar" because '.' sorts higher than space.
 
-def sort_key_for_name_and_first_letter(x, hierarchical_categories=()):
-    v1 = icu_upper(x.sort or x.name)
-    if x.category in hierarchical_categories:
-        v1 = v1.replace('.', '\t')
+def first_letter_sort_key(text):
+    v1 = icu_upper(text)
     v2 = v1 or ' '
     # The idea is that '9999999999' is larger than any digit so all digits
     # will sort in front. Non-digits will sort according to their ICU first letter
@@ -195,11 +224,18 @@ def sort_key_for_name_and_first_letter(x, hierarchical_categories=()):
             collation_order(v2), sort_key(v1))
 
 
-def sort_key_for_name(x, hierarchical_categories=()):
+def sort_key_for_name_and_first_letter(x, hierarchical_categories=(), key_cache=uncached):
+    v = x.sort or x.name
+    if x.category in hierarchical_categories:
+        v = v.replace('.', '\t')
+    return key_cache(first_letter_sort_key, v)
+
+
+def sort_key_for_name(x, hierarchical_categories=(), key_cache=uncached):
     v = x.sort or x.name
     if x.category not in hierarchical_categories:
-        return sort_key(v)
-    return sort_key(v.replace('.', '\t'))
+        return key_cache(sort_key, v)
+    return key_cache(sort_key, v.replace('.', '\t'))
 
 
 category_sort_keys = {True:{}, False: {}}
@@ -216,6 +252,8 @@ def sort_key_for_name(x, hierarchical_categories=()):
 def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False, uncollapsed_categories=None):
     if sort not in CATEGORY_SORTS:
         raise ValueError('sort ' + sort + ' not a valid value')
+    key_cache = dbcache.category_sort_key_cache
+    key_cache.new_call()
 
     hierarchical_categories = frozenset(dbcache.pref('categories_using_hierarchy', ()))
     fm = dbcache.field_metadata
@@ -262,7 +300,7 @@ def get_metadata(book_id):
                 for item in cats:
                     item.sort = author_to_author_sort(item.sort)
         cats.sort(key=partial(category_sort_keys[fl_sort][sort_on],
-                              hierarchical_categories=hierarchical_categories),
+                              hierarchical_categories=hierarchical_categories, key_cache=key_cache),
                   reverse=reverse)
         categories[category] = cats
 
@@ -342,7 +380,7 @@ def get_metadata(book_id):
                 # else: do nothing, to not include nodes w zero counts
             cat_name = '@' + user_cat  # add the '@' to avoid name collision
             items.sort(key=partial(category_sort_keys[False][sort],
-                                   hierarchical_categories=hierarchical_categories))
+                                   hierarchical_categories=hierarchical_categories, key_cache=key_cache))
             categories[cat_name] = items
 
     # ### Finally, the saved searches category ####
@@ -60,6 +60,27 @@ def option_parser(get_parser, args):
         help=_('Comma-separated list of names to ignore.\n'
                'Default: all')
     )
+    parser.add_option(
+        '--checksums',
+        default=False,
+        action='store_true',
+        help=_('Read all book files and compare their checksums to the ones recorded by the previous'
+               ' check with this option, reporting files that have been silently corrupted.')
+    )
+    parser.add_option(
+        '--resume',
+        default=False,
+        action='store_true',
+        help=_('Continue an interrupted check of a large library from where it stopped,'
+               ' instead of starting over.')
+    )
+    parser.add_option(
+        '--workers',
+        default=None,
+        type=int,
+        help=_('Number of threads used to scan folders and compute checksums.'
+               ' Default: based on the number of CPUs')
+    )
     parser.add_option(
         '--vacuum-fts-db',
         default=False,
@@ -122,8 +143,10 @@ def main(opts, args, dbctx):
     prints(_('Vacuuming database...'))
     db.new_api.vacuum(opts.vacuum_fts_db)
     checker = CheckLibrary(dbctx.library_path, db)
-    checker.scan_library(names, exts)
+    checker.scan_library(names, exts, num_workers=opts.workers, verify_checksums=opts.checksums, resume=opts.resume)
     for check in checks:
         _print_check_library_results(checker, check, as_csv=opts.csv)
+    if not opts.csv:
+        prints(checker.throughput_report())
 
     return 0
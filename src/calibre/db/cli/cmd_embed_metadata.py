@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
+import sys
 
 from calibre import prints
 from calibre.db.cli import integers_from_string
@@ -36,6 +37,11 @@ def option_parser(get_parser, args):
     parser.add_option('-f', '--only-formats', action='append', default=[], help=_(
         'Only update metadata in files of the specified format. Specify it multiple'
         ' times for multiple formats. By default, all formats are updated.'))
+    parser.add_option('-i', '--incremental', default=False, action='store_true', help=_(
+        'Skip files whose metadata has not changed since it was last embedded in them.'))
+    parser.add_option('-j', '--parallel', type='int', default=0, help=_(
+        'Embed metadata in this many books at a time, using worker processes. Only'
+        ' used for libraries on this computer. By default, books are processed one at a time.'))
     return parser
 
 
@@ -53,6 +59,28 @@ def main(opts, args, dbctx):
     def progress(i, title):
         prints(_('Processed {0} ({1} of {2})').format(title, i, len(ids)))
 
+    if not dbctx.is_remote:
+        def report_progress(i, total, mi, stats=None):
+            progress(i, mi.title)
+            if stats is not None and (i % 100 == 0 or i == total):
+                prints(_('Embedded in {0} files, skipped {1} unchanged files, {2} failures, {3:.1f} books per second').format(
+                    stats['embedded'], stats['skipped'], stats['failed'], stats['books_per_second']))
+
+        def report_error(mi, fmt, tb):
+            prints(_('Failed to embed metadata in the {0} format of {1}:').format(fmt.upper(), mi.title), tb, file=sys.stderr)
+
+        db = dbctx.db.new_api
+        for book_id in ids:
+            if not db.has_id(book_id):
+                prints(_('No book with id: {}').format(book_id))
+        ids = tuple(book_id for book_id in ids if db.has_id(book_id))
+        stats = db.embed_metadata(
+            ids, only_fmts=only_fmts, report_error=report_error, report_progress=report_progress,
+            num_workers=max(0, opts.parallel), skip_unchanged=opts.incremental)
+        if stats['failed']:
+            raise SystemExit(_('Failed to embed metadata in {} files').format(stats['failed']))
+        return 0
+
     for i, book_id in enumerate(ids):
         title = dbctx.run('embed_metadata', book_id, only_fmts)
         progress(i+1, title or _('No book with id: {}').format(book_id))
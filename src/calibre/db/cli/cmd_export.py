@@ -7,7 +7,7 @@
 from calibre.db.cli import integers_from_string
 from calibre.db.constants import DATA_FILE_PATTERN
 from calibre.db.errors import NoSuchFormat
-from calibre.library.save_to_disk import config, do_save_book_to_disk, get_formats, sanitize_args
+from calibre.library.save_to_disk import config, do_save_book_to_disk, get_formats, sanitize_args, save_to_disk
 from calibre.utils.formatter_functions import load_user_template_functions
 
 readonly = True
@@ -85,6 +85,12 @@ def option_parser(get_parser, args):
         action='store_true',
         help=_('Report progress')
     )
+    parser.add_option(
+        '--parallel',
+        default=4,
+        type='int',
+        help=_('The number of books to export at a time, when exporting from a library on this computer. Default is') + ' %default'
+    )
     c = config()
     for pref in ['asciiize', 'update_metadata', 'write_opf', 'save_cover', 'save_extra_files']:
         opt = c.get_option(pref)
@@ -161,14 +167,38 @@ def main(opts, args, dbctx):
         for arg in args:
             book_ids |= set(integers_from_string(arg))
     dest = os.path.abspath(os.path.expanduser(opts.to_dir))
-    dbproxy = DBProxy(dbctx)
     dest, opts, length = sanitize_args(dest, opts)
     total = len(book_ids)
-    for i, book_id in enumerate(book_ids):
-        export(opts, dbctx, book_id, dest, dbproxy, length, i == 0)
+
+    def report_progress(num):
         if opts.progress:
-            num = i + 1
             print(f'\r  {num / total:.1%} [{num}/{total}]', end=' '*20)
+
+    if dbctx.is_remote:
+        dbproxy = DBProxy(dbctx)
+        for i, book_id in enumerate(book_ids):
+            export(opts, dbctx, book_id, dest, dbproxy, length, i == 0)
+            report_progress(i + 1)
+    else:
+        # Save several books at a time, the paths of the books are computed
+        # while the books before them are being copied
+        errors, num_done = [], 0
+        no_formats = _('Requested formats not available')
+
+        def callback(book_id, title, failed, tb):
+            nonlocal num_done
+            if failed and tb != no_formats:
+                errors.append((book_id, title, tb))
+            num_done += 1
+            report_progress(num_done)
+            return True
+
+        save_to_disk(dbctx.db, book_ids, dest, opts, callback, max_workers=max(1, opts.parallel))
+        if errors:
+            # Report the first error as the serial export did, but only after
+            # saving all the other books
+            book_id, title, tb = errors[0]
+            raise SystemExit(_('Failed to export {0} books, the first failure was for: {1} (id: {2})').format(len(errors), title, book_id) + '\n' + tb)
     if opts.progress:
         print()
     return 0
@@ -42,6 +42,17 @@ def option_parser(get_parser, args):
             'unless this option is specified.'
         )
     )
+    parser.add_option(
+        '--dry-run',
+        default=False,
+        action='store_true',
+        help=_(
+            'Only read the metadata stored in the OPF files and report any'
+            ' problems that restoring would run into, such as conflicting'
+            ' custom column definitions or books with the same id. The'
+            ' database is not changed.'
+        )
+    )
     return parser
 
 
@@ -57,7 +68,24 @@ def __call__(self, msg, step):
             prints(msg, '...', f'{int(100*(step/self.total))}%')
 
 
+def dry_run(dbctx):
+    r = Restore(dbctx.library_path, progress_callback=Progress(), dry_run=True)
+    r.run()
+    if r.tb is not None:
+        prints('Reading the metadata failed with error:')
+        prints(r.tb)
+        return 1
+    prints(f'Found {len(r.books)} books in {len(r.dirs)} folders ({r.rates[0]:.0f} books per second)')
+    if r.errors_occurred:
+        prints(r.report)
+    else:
+        prints('No problems found')
+    return 0
+
+
 def main(opts, args, dbctx):
+    if opts.dry_run:
+        return dry_run(dbctx)
     if not opts.really_do_it:
         raise SystemExit(
             _('You must provide the %s option to do a'
@@ -73,6 +101,7 @@ def main(opts, args, dbctx):
         prints(r.tb)
     else:
         prints('Restoring database succeeded')
+        prints('Read metadata at {:.0f} books per second, restored {:.0f} books per second'.format(*r.rates))
         prints('old database saved as', r.olddb)
         if r.errors_occurred:
             name = 'calibre_db_restore_report.txt'
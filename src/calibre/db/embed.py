@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Helpers for :meth:`calibre.db.cache.Cache.embed_metadata`, which embeds the
+metadata of books in their files, either in the calling process, or in worker
+processes, and remembers what was embedded, so that files that are already up
+to date can be skipped.
+'''
+
+import hashlib
+import os
+import traceback
+from contextlib import suppress
+
+from calibre.constants import iswindows
+from calibre.utils.localization import _
+from calibre.utils.serialize import msgpack_loads
+
+# The name of the custom book data that stores, for every format of a book,
+# the hash of the metadata embedded in it and the size and modification time
+# of the file after it was embedded.
+EMBEDDED_METADATA = 'embedded_metadata'
+# The module and function run in worker processes
+EMBED_WORKER = 'calibre.db.embed', 'embed_in_files'
+
+
+def metadata_hash(mi, cover_path):
+    ''' The hash of the OPF for mi and of the state of its cover file '''
+    from calibre.ebooks.metadata.opf2 import metadata_to_opf
+
+    # metadata_to_opf() fills in defaults for these, which must not be embedded
+    originals = mi.book_producer, mi.languages
+    try:
+        opf = metadata_to_opf(mi)
+    finally:
+        mi.book_producer, mi.languages = originals
+    h = hashlib.sha256(opf)
+    h.update(repr(file_state(cover_path)).encode())
+    return h.hexdigest()
+
+
+def file_state(path):
+    if path:
+        with suppress(OSError):
+            st = os.stat(path)
+            return [st.st_size, st.st_mtime_ns]
+
+
+def set_metadata_in_stream(fmt, mi, stream, report_error=None):
+    ''' Embed mi in stream, returning the new size of stream '''
+    from calibre.customize.ui import apply_null_metadata
+    from calibre.ebooks.metadata.meta import set_metadata
+    from calibre.ebooks.metadata.opf2 import pretty_print
+    with apply_null_metadata, pretty_print:
+        set_metadata(stream, mi, stream_type=fmt, report_error=report_error)
+    stream.seek(0, os.SEEK_END)
+    return stream.tell()
+
+
+def format_error(e):
+    ' The traceback of the exception e, which was raised while embedding metadata in a file '
+    tb = traceback.format_exc()
+    if iswindows and isinstance(e, PermissionError) and e.filename and isinstance(e.filename, str):
+        from calibre_extensions import winutil
+        try:
+            p = winutil.get_processes_using_files(e.filename)
+        except OSError:
+            pass
+        else:
+            path_map = {x['path']: x for x in p}
+            tb = _('Could not open the file: "{}". It is already opened in the following programs:').format(e.filename)
+            for path, x in path_map.items():
+                tb += '\n' + f'{x["app_name"]}: {path}'
+    return tb
+
+
+def embed_in_files(data):
+    '''
+    Embed the metadata of a book in its files. Runs in a worker process. data
+    is the serialized metadata of the book, the path to its cover and the
+    (format, path, temp path) triples of its files. The files in the library
+    are never changed, each one is copied to its temp path and the metadata
+    embedded in the copy, which the calling process then renames over the
+    original. That way a worker that is killed while writing cannot damage
+    the book. Returns a list of (format, new size, errors reported by the
+    metadata writer, traceback) tuples, one per file. The new size is None
+    and the traceback set, if embedding failed.
+    '''
+    from calibre.utils.filenames import clone_file
+    data = msgpack_loads(data)
+    mi = data['mi']
+    if data['cover']:
+        with suppress(OSError), open(data['cover'], 'rb') as f:
+            mi.cover_data = ('jpeg', f.read())
+    ans = []
+    for fmt, path, tpath in data['files']:
+        errors = []
+        try:
+            clone_file(path, tpath)
+            with open(tpath, 'r+b') as stream:
+                size = set_metadata_in_stream(fmt, mi, stream, lambda mi, fmt, tb: errors.append(tb))
+        except Exception as e:
+            ans.append((fmt, None, errors, format_error(e)))
+        else:
+            ans.append((fmt, size, errors, None))
+    return ans
@@ -50,6 +50,16 @@ def IDENTITY(x):
     return x
 
 
+def rating_stats(book_ids, book_rating_map):
+    ' Return the number of books, the sum of their ratings and the number of rated books '
+    total = rated = 0
+    for r in map(book_rating_map.get, book_ids):
+        if r and r > 0:
+            total += r
+            rated += 1
+    return len(book_ids), total, rated
+
+
 class InvalidLinkTable(Exception):
 
     def __init__(self, name):
@@ -115,11 +125,35 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
         self.writer = Writer(self)
         self.series_field = None
         self.get_template_functions = get_template_functions
+        # Map of item id to rating_stats() for all the books of that item
+        self.category_cache = {}
 
     @property
     def metadata(self):
         return self.table.metadata
 
+    def clear_caches(self, book_ids=None):
+        self.clear_category_cache(book_ids)
+
+    def clear_category_cache(self, book_ids=None):
+        '''
+        Forget the category data cached for items linked to the specified
+        books, or for all items if book_ids is None. Must be called whenever
+        the books linked to an item or the ratings of its books change, except
+        when only books are removed from items, which is detected
+        automatically.
+        '''
+        if book_ids is None or not self.is_many:
+            self.category_cache = {}
+            return
+        bcm, cache = self.table.book_col_map, self.category_cache
+        for book_id in book_ids:
+            item_ids = bcm.get(book_id, ())
+            if not isinstance(item_ids, tuple):
+                item_ids = (item_ids,)
+            for item_id in item_ids:
+                cache.pop(item_id, None)
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -168,6 +202,13 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         '''
         raise NotImplementedError()
 
+    def cached_rating_stats(self, item_id, item_book_ids, book_rating_map):
+        # Items whose books were only removed are detected by the changed count
+        ans = self.category_cache.get(item_id)
+        if ans is None or ans[0] != len(item_book_ids):
+            ans = self.category_cache[item_id] = rating_stats(item_book_ids, book_rating_map)
+        return ans
+
     def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
         ans = []
         if not self.is_many:
@@ -176,12 +217,20 @@ def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
         id_map = self.table.id_map
         special_sort = hasattr(self, 'category_sort_value')
         for item_id, item_book_ids in self.table.col_book_map.items():
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
+            if book_ids is None:
+                stats = self.cached_rating_stats(item_id, item_book_ids, book_rating_map)
+            else:
+                restricted = item_book_ids.intersection(book_ids)
+                if not restricted:
+                    continue
+                # The cached stats are still valid for items that have all
+                # their books in book_ids
+                stats = (self.cached_rating_stats(item_id, item_book_ids, book_rating_map) if len(restricted) == len(item_book_ids)
+                         else rating_stats(restricted, book_rating_map))
+                item_book_ids = restricted
             if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
-                                            book_id in item_book_ids) if r > 0)
-                avg = sum(ratings)/len(ratings) if ratings else 0
+                total, rated = stats[1:]
+                avg = total/rated if rated else 0
                 try:
                     name = self.category_formatter(id_map[item_id])
                 except KeyError:
@@ -776,8 +825,9 @@ class TagsField(ManyToManyField):
     def get_news_category(self, tag_class, book_ids=None):
         news_id = None
         ans = []
+        news = _('News')
         for item_id, val in self.table.id_map.items():
-            if val == _('News'):
+            if val == news:
                 news_id = item_id
                 break
         if news_id is None:
@@ -792,7 +842,7 @@ def get_news_category(self, tag_class, book_ids=None):
             item_book_ids = item_book_ids.intersection(news_books)
             if item_book_ids:
                 name = self.category_formatter(self.table.id_map[item_id])
-                if name == _('News'):
+                if name == news:
                     continue
                 c = tag_class(name, id=item_id, sort=name,
                               id_set=item_book_ids, count=len(item_book_ids))
@@ -13,9 +13,10 @@
 import traceback
 from contextlib import closing, suppress
 from operator import itemgetter
+from queue import Empty
 from threading import Thread
 
-from calibre import force_unicode, isbytestring
+from calibre import detect_ncpus, force_unicode, isbytestring
 from calibre.constants import filesystem_encoding, iswindows
 from calibre.db.backend import DB, DBPrefs
 from calibre.db.cache import Cache
@@ -23,6 +24,7 @@
 from calibre.ebooks.metadata.opf2 import OPF
 from calibre.ptempfile import TemporaryDirectory
 from calibre.utils.date import utcfromtimestamp
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
 
 NON_EBOOK_EXTENSIONS = frozenset((
     'jpg', 'jpeg', 'gif', 'png', 'bmp',
@@ -50,6 +52,57 @@ def is_ebook_file(filename):
     return True
 
 
+def read_book_dir(src_library_path, dirpath, filenames, book_id):
+    book_id = int(book_id)
+    def safe_mtime(path):
+        with suppress(OSError):
+            return os.path.getmtime(path)
+        return sys.maxsize
+
+    filenames.sort(key=lambda f: safe_mtime(os.path.join(dirpath, f)))
+    fmt_map = {}
+    fmts, formats, sizes, names = [], [], [], []
+    for x in filenames:
+        if is_ebook_file(x):
+            fmt = os.path.splitext(x)[1][1:].upper()
+            if fmt and fmt_map.setdefault(fmt, x) is x:
+                formats.append(x)
+                sizes.append(os.path.getsize(os.path.join(dirpath, x)))
+                names.append(os.path.splitext(x)[0])
+                fmts.append(fmt)
+
+    mi, timestamp, annotations = read_opf(dirpath)
+    path = os.path.relpath(dirpath, src_library_path).replace(os.sep, '/')
+    return {
+        'mi': mi,
+        'timestamp': timestamp,
+        'formats': list(zip(fmts, sizes, names)),
+        'id': book_id,
+        'dirpath': dirpath,
+        'path': path,
+        'annotations': annotations
+    }
+
+
+def read_book_dirs(src_library_path, dirs, serialize=True):
+    ''' Read the metadata for a batch of book folders. Runs in a worker
+    process, so the results are serialized with msgpack, as Metadata objects
+    cannot be pickled. '''
+    ans = []
+    for dirpath, filenames, book_id in dirs:
+        try:
+            book = read_book_dir(src_library_path, dirpath, filenames, book_id)
+        except Exception:
+            traceback.print_exc()
+            ans.append((False, (dirpath, traceback.format_exc())))
+        else:
+            if serialize:
+                # The cover path is not serialized with the metadata
+                book['cover'] = book['mi'].cover
+            ans.append((True, book))
+    return msgpack_dumps(ans) if serialize else ans
+
+
 class Restorer(Cache):
 
     def __init__(self, library_path, default_prefs=None, restore_all_prefs=False, progress_callback=lambda x, y:True):
@@ -68,7 +121,16 @@ def no_op(self, *args, **kwargs):
 
 class Restore(Thread):
 
-    def __init__(self, library_path, progress_callback=None):
+    # Number of book folders read by a single job in the worker processes
+    batch_size = 100
+
+    def __init__(self, library_path, progress_callback=None, dry_run=False, num_workers=None):
+        '''
+        :param dry_run: Only read the metadata backups and report the problems
+            that would occur when restoring, without creating a new database.
+        :param num_workers: The number of worker processes used to read the
+            metadata backups. Defaults to the number of CPUs.
+        '''
         super().__init__()
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
@@ -87,12 +149,28 @@ def __init__(self, library_path, progress_callback=None):
         self.successes = 0
         self.tb = None
         self.link_maps = {}
+        self.duplicate_ids = {}
+        self.custom_columns = {}
+        self.dry_run = dry_run
+        self.num_workers = detect_ncpus() if num_workers is None else num_workers
+        self.stats = {'scan_time': 0., 'restore_time': 0.}
 
     @property
     def errors_occurred(self):
-        return (self.failed_dirs or self.mismatched_dirs or
+        return (self.failed_dirs or self.mismatched_dirs or self.duplicate_ids or
                 self.conflicting_custom_cols or self.failed_restores or self.notes_errors)
 
+    @property
+    def rates(self):
+        ' The number of books per second read from the metadata backups and restored to the database '
+        s = self.stats
+        return (len(self.dirs) / s['scan_time'] if s['scan_time'] else 0,
+                self.successes / s['restore_time'] if s['restore_time'] else 0)
+
+    def rate_message(self, msg, num_done, start_time):
+        rate = num_done / max(time.monotonic() - start_time, 1e-3)
+        return _('{0} ({1:.0f} books per second)').format(msg, rate)
+
     @property
     def report(self):
         ans = ''
@@ -121,6 +199,14 @@ def report(self):
             for x in self.mismatched_dirs:
                 ans += '\t' + force_unicode(x, filesystem_encoding) + '\n'
 
+        if self.duplicate_ids:
+            ans += '\n\n'
+            ans += 'The following folders contain books with the same id, only one of each can be restored:\n'
+            for book_id, dirpaths in self.duplicate_ids.items():
+                ans += f'\t{book_id}:\n'
+                for x in dirpaths:
+                    ans += '\t\t' + force_unicode(x, filesystem_encoding) + '\n'
+
         if self.notes_errors:
             ans += '\n\n'
             ans += 'Failed to restore notes for the following items:\n'
@@ -129,6 +215,13 @@ def report(self):
         return ans
 
     def run(self):
+        if self.dry_run:
+            try:
+                self.scan_library()
+                self.find_custom_columns()
+            except Exception:
+                self.tb = traceback.format_exc()
+            return
         try:
             basedir = os.path.dirname(self.src_library_path)
             try:
@@ -201,48 +294,85 @@ def scan_library(self):
             del dirnames[:]
 
         self.progress_callback(None, len(self.dirs))
-        for i, (dirpath, dirnames, filenames, book_id) in enumerate(self.dirs):
-            try:
-                self.process_dir(dirpath, dirnames, filenames, book_id)
-            except Exception:
-                self.failed_dirs.append((dirpath, traceback.format_exc()))
-                traceback.print_exc()
-            self.progress_callback(_('Processed') + ' ' + dirpath, i+1)
+        st = time.monotonic()
+        jobs = [[(dirpath, filenames, book_id) for dirpath, dirnames, filenames, book_id in self.dirs[i:i+self.batch_size]]
+                for i in range(0, len(self.dirs), self.batch_size)]
+        results = [None] * len(jobs)
+        num_done = 0
+
+        def job_done(job_id, result):
+            nonlocal num_done
+            results[job_id] = result
+            num_done += len(jobs[job_id])
+            dirpath = jobs[job_id][-1][0]
+            self.progress_callback(self.rate_message(_('Processed') + ' ' + dirpath, num_done, st), num_done)
+
+        if self.num_workers > 1 and len(jobs) > 1:
+            self.read_in_pool(jobs, job_done)
+        for job_id, job in enumerate(jobs):
+            if results[job_id] is None:
+                job_done(job_id, read_book_dirs(self.src_library_path, job, serialize=False))
+
+        # Process the results in folder order, so the outcome does not
+        # depend on the order in which the worker processes finish
+        dirs_for_id = {}
+        for result in results:
+            for ok, data in result:
+                if ok:
+                    try:
+                        self.process_book(data)
+                    except Exception:
+                        self.failed_dirs.append((data['dirpath'], traceback.format_exc()))
+                        traceback.print_exc()
+                    else:
+                        dirs_for_id.setdefault(data['id'], []).append(data['dirpath'])
+                else:
+                    self.failed_dirs.append(data)
+        self.duplicate_ids = {k: v for k, v in dirs_for_id.items() if len(v) > 1}
+        self.stats['scan_time'] = time.monotonic() - st
+
+    def read_in_pool(self, jobs, job_done):
+        ''' Read the metadata backups using a pool of worker processes. If the
+        pool fails, the jobs it did not complete are left for the caller to run
+        in this process. '''
+        from calibre.utils.ipc.pool import Failure, Pool
+        pool = Pool(max_workers=min(self.num_workers, len(jobs)), name='RestoreDatabase')
+        try:
+            for job_id, job in enumerate(jobs):
+                pool(job_id, 'calibre.db.restore', 'read_book_dirs', self.src_library_path, job)
+            pending = len(jobs)
+            while pending:
+                try:
+                    worker_result = pool.results.get(True, 0.1)
+                except Empty:
+                    if pool.failed:
+                        break
+                    continue
+                pool.results.task_done()
+                pending -= 1
+                result = worker_result.result
+                if worker_result.is_terminal_failure or result.err is not None:
+                    # Let the caller read this batch in-process
+                    continue
+                result = msgpack_loads(result.value)
+                for ok, data in result:
+                    if ok:
+                        data['mi'].cover = data.pop('cover')
+                job_done(worker_result.id, result)
+        except Failure:
+            traceback.print_exc()
+        finally:
+            pool.shutdown()
 
     def process_dir(self, dirpath, dirnames, filenames, book_id):
-        book_id = int(book_id)
-        def safe_mtime(path):
-            with suppress(OSError):
-                return os.path.getmtime(path)
-            return sys.maxsize
-
-        filenames.sort(key=lambda f: safe_mtime(os.path.join(dirpath, f)))
-        fmt_map = {}
-        fmts, formats, sizes, names = [], [], [], []
-        for x in filenames:
-            if is_ebook_file(x):
-                fmt = os.path.splitext(x)[1][1:].upper()
-                if fmt and fmt_map.setdefault(fmt, x) is x:
-                    formats.append(x)
-                    sizes.append(os.path.getsize(os.path.join(dirpath, x)))
-                    names.append(os.path.splitext(x)[0])
-                    fmts.append(fmt)
-
-        mi, timestamp, annotations = read_opf(dirpath)
-        path = os.path.relpath(dirpath, self.src_library_path).replace(os.sep, '/')
-
-        if int(mi.application_id) == book_id:
-            self.books.append({
-                'mi': mi,
-                'timestamp': timestamp,
-                'formats': list(zip(fmts, sizes, names)),
-                'id': book_id,
-                'dirpath': dirpath,
-                'path': path,
-                'annotations': annotations
-            })
+        self.process_book(read_book_dir(self.src_library_path, dirpath, filenames, book_id))
+
+    def process_book(self, book):
+        mi = book['mi']
+        if int(mi.application_id) == book['id']:
+            self.books.append(book)
         else:
-            self.mismatched_dirs.append(dirpath)
+            self.mismatched_dirs.append(book['dirpath'])
 
         alm = mi.get('link_maps', {})
         for field, lmap in alm.items():
@@ -252,7 +382,7 @@ def safe_mtime(path):
                 if existing_link is None or (existing_link != link and timestamp < mi.timestamp):
                     dest[item] = link, mi.timestamp
 
-    def create_cc_metadata(self):
+    def find_custom_columns(self):
         self.books.sort(key=itemgetter('timestamp'))
         self.custom_columns = {}
         fields = ('label', 'name', 'datatype', 'is_multiple', 'is_editable',
@@ -277,6 +407,8 @@ def create_cc_metadata(self):
                             self.conflicting_custom_cols[label].append(self.custom_columns[label])
                     self.custom_columns[label] = args
 
+    def create_cc_metadata(self):
+        self.find_custom_columns()
         db = Restorer(self.library_path)
         self.progress_callback(None, len(self.custom_columns))
         if len(self.custom_columns):
@@ -296,6 +428,7 @@ def restore_books(self):
         with suppress(FileNotFoundError):
             os.remove(os.path.join(notes_dest, NOTES_DB_NAME))
         db = Restorer(self.library_path)
+        st = time.monotonic()
         with closing(db):
             with db.new_api:
                 for i, book in enumerate(self.books):
@@ -305,7 +438,8 @@ def restore_books(self):
                     except Exception:
                         self.failed_restores.append((book, traceback.format_exc()))
                         traceback.print_exc()
-                    self.progress_callback(book['mi'].title, i+1)
+                    self.progress_callback(self.rate_message(book['mi'].title, i+1, st), i+1)
+            self.stats['restore_time'] = time.monotonic() - st
 
             with db.new_api:
                 for field, lmap in self.link_maps.items():
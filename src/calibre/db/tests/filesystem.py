@@ -8,6 +8,7 @@
 import os
 import time
 import unittest
+import unittest.mock
 from io import BytesIO
 
 from calibre.constants import iswindows
@@ -242,6 +243,112 @@ def test_fname_change(self):
         fpath = cache.format_abspath(3, 'TXT')
         self.assertEqual(sorted([os.path.basename(fpath)]), sorted(os.listdir(os.path.dirname(fpath))))
 
+    def test_save_to_disk(self):
+        ' Test saving books to disk, several at a time '
+        from calibre.library.save_to_disk import PathPlanner, config, sanitize_args, save_to_disk
+        cache = self.init_cache()
+        # A book with the same path as book 2, ignoring case
+        cache.set_field('title', {3: 'title one'})
+        cache.set_field('authors', {3: ['Author One']})
+        cache.set_field('sort', {2: 'Title One', 3: 'title one'})
+        cache.add_format(3, 'FMT1', BytesIO(b'book3fmt1'))
+        opts = config().parse()
+        opts.template = '{authors}/{title}'
+        opts.update_metadata = opts.write_opf = opts.save_cover = False
+
+        def saved_files(tdir):
+            ans = {}
+            for dirpath, dirnames, filenames in os.walk(tdir):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    ans[os.path.relpath(path, tdir).replace(os.sep, '/')] = read(path, 'rb')
+            return ans
+
+        with TemporaryDirectory('save_to_disk') as tdir:
+            reported = []
+            failures = save_to_disk(cache, (1, 2, 3), tdir, opts, lambda *a: reported.append(a[0]) or True, max_workers=2)
+            self.assertEqual(failures, [])
+            self.assertEqual(sorted(reported), [1, 2, 3])
+            self.assertEqual(saved_files(tdir), {
+                'Author Two & Author One/Title Two.fmt1': b'book1fmt1', 'Author Two & Author One/Title Two.fmt2': b'book1fmt2',
+                'Author One/Title One.fmt1': b'book2fmt1', 'Author One/title one (1).fmt1': b'book3fmt1',
+            })
+            if not iswindows:
+                self.assertNotEqual(os.stat(os.path.join(tdir, 'Author One/Title One.fmt1')).st_ino, os.stat(cache.format_abspath(2, 'FMT1')).st_ino)
+
+        with TemporaryDirectory('save_to_disk') as tdir:
+            opts.formats = 'fmt2'
+            failures = save_to_disk(cache, (1, 2), tdir, opts, use_hardlinks=True)
+            self.assertEqual([x[0] for x in failures], [2])
+            self.assertEqual(list(saved_files(tdir)), ['Author Two & Author One/Title Two.fmt2'])
+            if not iswindows:
+                self.assertEqual(os.stat(os.path.join(tdir, 'Author Two & Author One/Title Two.fmt2')).st_ino, os.stat(cache.format_abspath(1, 'FMT2')).st_ino)
+
+        with TemporaryDirectory('save_to_disk') as tdir:
+            # Books that do not exist fail
+            failures = save_to_disk(cache, (999, 1), tdir, opts)
+            self.assertEqual([x[0] for x in failures], [999])
+            self.assertIn('No book with id 999 present', failures[0][2])
+            self.assertEqual(list(saved_files(tdir)), ['Author Two & Author One/Title Two.fmt2'])
+
+        # Templates are compiled only once
+        opts.template = 'program: strcat(field("title"), "/", uppercase(field("authors")))'
+        root, opts, length = sanitize_args(self.library_path, opts)
+        plan = PathPlanner(opts, length)
+        self.assertEqual(plan(cache.get_metadata(2), 2), ['Title One', 'AUTHOR ONE'])
+        self.assertEqual(plan(cache.get_metadata(3), 3), ['title one', 'AUTHOR ONE (1)'])
+        self.assertEqual(plan(cache.get_metadata(3), 3), ['title one', 'AUTHOR ONE (2)'])
+        self.assertEqual(len(plan.formatter.program_cache), 1)
+
+    def test_check_library(self):
+        'Test the checksum verification and resuming of check library'
+        from calibre.library.check_library import CHECKPOINT_FILE_NAME, CheckLibrary, forget_checksums
+        cl = self.cloned_library
+        db = self.init_legacy(cl)
+        cache = db.new_api
+        cache.add_format(1, 'TXT', BytesIO(b'some text'))
+
+        def check(**kw):
+            checker = CheckLibrary(cl, db)
+            checker.scan_library([], [], num_workers=3, **kw)
+            return checker
+        c = check(verify_checksums=True)
+        self.assertFalse(c.corrupted_formats)
+        self.assertFalse(c.failed_folders)
+        self.assertGreater(c.stats['hashed_files'], 0)
+        # Corrupt the file without changing its size or mtime
+        fpath = cache.format_abspath(1, 'TXT')
+        st = os.stat(fpath)
+        with open(fpath, 'wb') as f:
+            f.write(b'some tExt')
+        os.utime(fpath, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertFalse(check().corrupted_formats)
+        c = check(verify_checksums=True)
+        self.assertEqual([x[2] for x in c.corrupted_formats], [1])
+        self.assertEqual(len(check(verify_checksums=True).corrupted_formats), 1)
+        forget_checksums(cl, [x[1] for x in c.corrupted_formats])
+        self.assertFalse(check(verify_checksums=True).corrupted_formats)
+        # Normal changes to files are not reported
+        with open(fpath, 'wb') as f:
+            f.write(b'changed text')
+        self.assertFalse(check(verify_checksums=True).corrupted_formats)
+
+        # Resuming from a checkpoint
+        os.remove(fpath)
+        expected = check()
+        self.assertFalse(os.path.exists(os.path.join(cl, CHECKPOINT_FILE_NAME)))
+        def interrupt(num_done, total):
+            if num_done > 1:
+                raise KeyboardInterrupt()
+        with unittest.mock.patch('calibre.library.check_library.CHECKPOINT_INTERVAL', -1), self.assertRaises(KeyboardInterrupt):
+            check(report_progress=interrupt)
+        self.assertTrue(os.path.exists(os.path.join(cl, CHECKPOINT_FILE_NAME)))
+        c = check(resume=True)
+        self.assertEqual(c.stats['resumed_folders'] + c.stats['book_folders'], len(c.book_dirs))
+        self.assertGreater(c.stats['resumed_folders'], 0)
+        for attr in ('missing_formats', 'extra_files', 'extra_covers', 'missing_covers'):
+            self.assertEqual(sorted(getattr(c, attr)), sorted(getattr(expected, attr)))
+
     def test_export_import(self):
         from calibre.db.cache import import_library
         from calibre.utils.exim import Exporter, Importer
@@ -260,6 +367,30 @@ def test_export_import(self):
                         actual = f.read()
                     self.assertEqual(expected, actual, key)
                 self.assertFalse(importer.corrupted_files)
+        # Identical files are stored only once
+        with TemporaryDirectory('export_lib') as tdir, TemporaryDirectory('export_src') as sdir:
+            data = os.urandom(4096)
+            files = {'small': b'small', 'big': os.urandom(1024), 'empty': b''}
+            for key, fdata in files.items():
+                with open(os.path.join(sdir, key), 'wb') as f:
+                    f.write(fdata)
+            for part_size in (100, 1 << 20):
+                exporter = Exporter(tdir, part_size=part_size + Exporter.tail_size())
+                exporter.MAX_PREFETCH_SIZE = 512
+                exporter.add_file(BytesIO(data), 'd1')
+                exporter.add_file(BytesIO(data), 'd2')
+                exporter.add_files((f'{k}{i}', os.path.join(sdir, k), None) for i in range(3) for k in files)
+                exporter.add_files([('missing', None, None)])
+                exporter.commit()
+                if part_size > len(data):
+                    self.assertEqual(exporter.deduplicated_bytes, len(data) + 2 * sum(map(len, files.values())))
+                importer = Importer(tdir)
+                for key, expected in dict(d1=data, d2=data, missing=b'', **{f'{k}{i}': v for i in range(3) for k, v in files.items()}).items():
+                    with importer.start_file(key, key) as f:
+                        self.assertEqual(expected, f.read(), key)
+                self.assertFalse(importer.corrupted_files)
+                for x in os.listdir(tdir):
+                    os.remove(os.path.join(tdir, x))
         cache = self.init_cache()
         bookdir = os.path.dirname(cache.format_abspath(1, '__COVER_INTERNAL__'))
         with open(os.path.join(bookdir, 'exf'), 'w') as f:
@@ -313,6 +444,30 @@ def test_export_import(self):
             self.assertEqual(a, b)
             self.assertLess(abs(at-bt), 2)
 
+    def test_import_data_progress(self):
+        ' Test the progress reported when importing libraries in parallel '
+        from threading import Event, Lock
+        from types import SimpleNamespace
+
+        from calibre.utils.exim import import_data
+        abort, lock, imported, overall, current = Event(), Lock(), [], [], []
+
+        def import_library(library_key, importer, library_path, progress=None, abort=None):
+            progress('metadata.db', 0, 2)
+            with lock:
+                imported.append(library_key)
+                if len(imported) == 3:
+                    abort.set()  # skip importing the settings
+
+        with TemporaryDirectory('import_data') as tdir, unittest.mock.patch('calibre.db.cache.import_library', import_library):
+            import_data(SimpleNamespace(metadata={'libraries': {}}), {k: os.path.join(tdir, k.upper()) for k in 'abc'},
+                        progress1=lambda *a: overall.append(a), progress2=lambda *a: current.append(a), abort=abort, num_workers=2)
+            # Libraries are reported as they are started
+            self.assertEqual(sorted(x[0] for x in overall), [os.path.join(tdir, k) for k in 'ABC'])
+            self.assertEqual([x[1:] for x in overall], [(i, 4) for i in range(3)])
+        self.assertEqual(sorted(imported), list('abc'))
+        self.assertEqual(sorted(current), [(f'{k}: metadata.db', 0, 2) for k in 'ABC'])
+
     def test_find_books_in_directory(self):
         from calibre.db.adding import compile_rule, find_books_in_directory
         def strip(files):
@@ -6,9 +6,11 @@
 __docformat__ = 'restructuredtext en'
 
 import os
+import time
 from collections import namedtuple
 from functools import partial
 from io import BytesIO
+from unittest.mock import patch
 
 from calibre.db.backend import FTSQueryError
 from calibre.db.constants import RESOURCE_URL_SCHEME
@@ -18,6 +20,20 @@
 from calibre.utils.date import UNDEFINED_DATE
 
 
+def crashing_embed_in_files(data):
+    # Used in worker processes by test_embed_metadata. The worker for the book
+    # titled crash dies, while the others are killed in the middle of writing.
+    from calibre.utils.serialize import msgpack_loads
+    data = msgpack_loads(data)
+    if data['mi'].title == 'crash':
+        time.sleep(1)
+        os._exit(1)
+    for fmt, path, tpath in data['files']:
+        with open(tpath, 'wb') as f:
+            f.write(b'partial')
+    time.sleep(60)
+
+
 class WritingTest(BaseTest):
 
     # Utils {{{
@@ -409,7 +425,14 @@ def read_all_extra_files(book_id=1):
         notes_before = {cache.get_item_name('authors', aid): cache.export_note('authors', aid) for aid in authors}
         cache.close()
         from calibre.db.restore import Restore
-        restorer = Restore(cl)
+        restorer = Restore(cl, dry_run=True)
+        restorer.run()
+        self.assertIsNone(restorer.tb)
+        af(restorer.errors_occurred)
+        ae(sorted(b['id'] for b in restorer.books), sorted(book_ids))
+        # Use worker processes for reading the metadata
+        restorer = Restore(cl, num_workers=2)
+        restorer.batch_size = 1
         restorer.start()
         restorer.join(60)
         af(restorer.is_alive())
@@ -726,6 +749,35 @@ def test_invalidate():
         test_invalidate()
     # }}}
 
+    def test_category_cache(self):  # {{{
+        ' Test that the cached category counts and ratings are properly invalidated on writes '
+        cache = self.init_cache()
+
+        def as_data(categories):
+            return {k:[(t.name, t.id, t.count, t.avg_rating, sorted(t.id_set)) for t in v] for k, v in categories.items()}
+
+        def test_invalidate():
+            c = self.init_cache()
+            for book_ids in (None, {1, 2}, {3}):
+                self.assertEqual(as_data(cache.get_categories(book_ids=book_ids)), as_data(c.get_categories(book_ids=book_ids)))
+
+        test_invalidate()
+        cache.set_field('rating', {1:4, 2:10})
+        test_invalidate()
+        # Move a tag between books, so its number of books is unchanged
+        t1, t2 = cache.field_for('tags', 1), cache.field_for('tags', 2)
+        cache.set_field('tags', {1:t2, 2:t1})
+        test_invalidate()
+        cache.set_field('#rating', {3:2})
+        test_invalidate()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One'):'Tag Two'})
+        test_invalidate()
+        cache.remove_items('tags', (cache.get_item_id('tags', 'News'),), restrict_to_book_ids={1})
+        test_invalidate()
+        cache.remove_books((2,))
+        test_invalidate()
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         try:
@@ -1056,3 +1108,53 @@ def test_link_maps(self):
         self.assertEqual({}, cache.get_link_map('publisher'), 'links on publisher were not deleted')
         self.assertEqual({}, cache.get_all_link_maps_for_book(1), 'Not all links for book were deleted')
     # }}}
+
+    def test_embed_metadata(self):  # {{{
+        cache = self.init_cache()
+        for book_id in (1, 2):
+            cache.add_format(book_id, 'RTF', BytesIO(br'{\rtf1 text}'))
+
+        def rtf(book_id):
+            return cache.format(book_id, 'RTF')
+
+        progress = []
+
+        def embed(**kw):
+            del progress[:]
+            return cache.embed_metadata((1, 2, 3), report_progress=lambda *a: progress.append(a), skip_unchanged=True, **kw)
+
+        self.assertEqual(embed(), {'embedded': 2, 'skipped': 0, 'failed': 0})
+        self.assertIn(b'Title Two', rtf(1))
+        self.assertEqual([p[:2] for p in progress], [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual(progress[-1][3]['embedded'], 2)
+        self.assertGreater(progress[-1][3]['books_per_second'], 0)
+        self.assertEqual(cache.format_metadata(1, 'RTF')['size'], len(rtf(1)))
+        # Files that are up to date are skipped
+        self.assertEqual(embed(), {'embedded': 0, 'skipped': 2, 'failed': 0})
+        cache.set_field('title', {1: 'changed title'})
+        self.assertEqual(embed(), {'embedded': 1, 'skipped': 1, 'failed': 0})
+        self.assertIn(b'changed title', rtf(1))
+        cache.add_format(2, 'RTF', BytesIO(br'{\rtf1 new text}'))
+        cache.set_field('title', {1: 'title in worker'})
+        self.assertEqual(embed(num_workers=2), {'embedded': 2, 'skipped': 0, 'failed': 0})
+        self.assertIn(b'title in worker', rtf(1))
+        self.assertIn(b'Title One', rtf(2))
+        self.assertEqual(cache.format_metadata(1, 'RTF')['size'], len(rtf(1)))
+        self.assertEqual(embed(num_workers=2), {'embedded': 0, 'skipped': 2, 'failed': 0})
+        # Without skip_unchanged every file is embedded again
+        cache.embed_metadata((1, 2), report_progress=lambda *a: progress.append(a))
+        self.assertEqual(progress[-1], (2, 2, progress[-1][2]))
+        # A crashing worker does not damage the books other workers were writing
+        cache.set_field('title', {1: 'killed', 2: 'crash'})
+        original = rtf(2)
+        errors = []
+        with patch('calibre.db.embed.EMBED_WORKER', (__name__, 'crashing_embed_in_files')):
+            stats = cache.embed_metadata((1, 2), num_workers=2, report_error=lambda mi, fmt, tb: errors.append(mi.title))
+        self.assertEqual(stats, {'embedded': 1, 'skipped': 0, 'failed': 1})
+        self.assertEqual(errors, ['crash'])
+        self.assertIn(b'killed', rtf(1))
+        self.assertEqual(rtf(2), original)
+        for book_id in (1, 2):
+            bdir = os.path.dirname(cache.format_abspath(book_id, 'RTF'))
+            self.assertEqual([x for x in os.listdir(bdir) if x.endswith('.rtf')], [os.path.basename(cache.format_abspath(book_id, 'RTF'))])
+    # }}}
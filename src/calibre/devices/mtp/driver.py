@@ -174,6 +174,36 @@ def open(self, device, library_uuid):
                 import traceback
                 traceback.print_exc()
 
+    # Filesystem snapshots {{{
+    def filesystem_snapshot_policy(self, storage_id):
+        # Snapshots are only valid for the ignore policy they were taken with,
+        # as the contents of ignored folders are not enumerated
+        ignored = self.get_pref('ignored_folders').get(str(storage_id))
+        return json.dumps([self.is_kindle, sorted(ignored) if ignored is not None else None])
+
+    def load_filesystem_snapshot(self, storage_id):
+        if not self.current_serial_num:
+            return None
+        from calibre.devices.mtp.filesystem_cache import FilesystemSnapshot, snapshot_path
+        try:
+            return FilesystemSnapshot.load(snapshot_path(self.current_serial_num, storage_id), storage_id,
+                                           self.filesystem_snapshot_policy(storage_id))
+        except Exception:
+            traceback.print_exc()
+
+    def save_filesystem_snapshots(self, fs_cache):
+        if not self.current_serial_num:
+            return
+        from calibre.devices.mtp.filesystem_cache import snapshot_path
+        for storage in fs_cache.entries:
+            sid = storage.storage_id
+            try:
+                fs_cache.snapshot(sid, self.filesystem_snapshot_policy(sid)).save(snapshot_path(self.current_serial_num, sid))
+            except Exception:
+                prints(f'Failed to save filesystem snapshot for storage: {sid}')
+                traceback.print_exc()
+    # }}}
+
     def list(self, path, recurse=False):
         if path.startswith('/'):
             q = self._main_id
@@ -6,6 +6,7 @@
 __docformat__ = 'restructuredtext en'
 
 import json
+import os
 import sys
 import time
 import weakref
@@ -16,6 +17,7 @@
 
 from calibre import force_unicode, human_readable, prints
 from calibre.constants import iswindows
+from calibre.devices.mtp.base import debug
 from calibre.ebooks import BOOK_EXTENSIONS
 from calibre.utils.date import as_utc, local_tz
 from calibre.utils.icu import lower, sort_key
@@ -25,7 +27,7 @@
 
 def convert_timestamp(md):
     try:
-        if isinstance(md, tuple):
+        if isinstance(md, (tuple, list)):
             return datetime(*(list(md)+[local_tz]))
         else:
             return datetime.fromtimestamp(md, local_tz)
@@ -63,7 +65,7 @@ def __init__(self, entry, fs_cache: 'FilesystemCache', is_storage: bool = False)
             n = f'{prefix}-{self.persistent_id}'
         self.name = force_unicode(n, 'utf-8')
         self.size = entry.get('size', 0)
-        md = entry.get('modified', 0)
+        md = self.mtp_modified = entry.get('modified', 0)
         self.last_modified = convert_timestamp(md)
         self.last_mod_string = self.last_modified.strftime('%Y/%m/%d %H:%M')
         self.last_modified = as_utc(self.last_modified)
@@ -101,6 +103,7 @@ def __init__(self, entry, fs_cache: 'FilesystemCache', is_storage: bool = False)
         if self.name == 'nbk' and not (self.is_folder or self.is_storage):
             if len(self.full_path) >= 3 and self.full_path[-3] == '.notebooks':
                 nbk_name = self.full_path[-2].replace('!!notebook', '').replace('!!', ' ')
+                self.original_name = self.name
                 self.name = f'Scribe {nbk_name} Notebook.kfx'
                 self.is_ebook = True
 
@@ -229,6 +232,15 @@ def find_path(self, path):
             parent = c
         return parent
 
+    def as_entry(self):
+        ' The object as an entry dictionary of the kind returned by the device backends '
+        return {
+            'id': self.object_id, 'storage_id': self.storage_id, 'parent_id': self.parent_id,
+            'persistent_id': self.persistent_id, 'name': getattr(self, 'original_name', self.name),
+            'is_folder': self.is_folder, 'size': self.size, 'modified': self.mtp_modified,
+            'is_hidden': self.is_hidden, 'is_system': self.is_system, 'can_delete': self.can_delete,
+        }
+
     @property
     def mtp_relpath(self):
         return tuple(x.lower() for x in self.full_path[1:])
@@ -287,6 +299,17 @@ def iterebooks(self, storage_id):
                     continue  # Ignore .txt files in the root
                 yield x
 
+    def snapshot(self, storage_id, policy=''):
+        ' Return a :class:`FilesystemSnapshot` of the objects currently in the specified storage '
+        id_map = self.id_maps[storage_id]
+        entries = []
+        for x in id_map.values():
+            e = x.as_entry()
+            if x.is_folder:
+                e['child_count'] = len(x.files) + len(x.folders)
+            entries.append(e)
+        return FilesystemSnapshot(storage_id, entries, policy)
+
     def __len__(self):
         ans = len(self.id_maps)
         for id_map in self.id_maps.values():
@@ -314,3 +337,293 @@ def resolve_mtp_id_path(self, path):
             return id_map[object_id]
         except KeyError:
             raise ValueError(f'No object found with MTP path: {path}')
+
+
+# Persistent snapshots {{{
+
+SNAPSHOT_VERSION = 1
+
+
+def normalize_modified(md):
+    return list(md) if isinstance(md, (tuple, list)) else md
+
+
+def snapshot_path(serial_num, storage_id):
+    import hashlib
+
+    from calibre.constants import cache_dir
+    key = hashlib.sha1(f'{serial_num}:{storage_id}'.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), 'mtp-filesystem', key + '.json')
+
+
+class FilesystemSnapshot:
+
+    '''
+    A serialized copy of all the objects in a single storage on a device. When
+    the device is next connected, folders that contain only files and whose
+    modification time has not changed are not recursed into, their files are
+    taken from the snapshot instead. A folder's modification time only changes
+    when its direct children change, so folders that contain other folders are
+    always enumerated, to find changes deeper in the tree. Use :meth:`wrap_callback` to wrap the callback passed to the
+    backend's get_filesystem() and :meth:`merge` to add the cached objects to
+    the freshly enumerated ones. '''
+
+    def __init__(self, storage_id, entries=(), policy=''):
+        self.storage_id = storage_id
+        self.policy = policy
+        self.entries = {}
+        self.children = defaultdict(list)
+        for e in entries:
+            self.entries[e['id']] = e
+            self.children[self.normalize_parent_id(e.get('parent_id'))].append(e['id'])
+        self.reused_folders = []
+        self.fresh_ids = set()
+
+    def normalize_parent_id(self, parent_id):
+        # On windows parent_id == storage_id for objects in the root
+        return 0 if parent_id is None or parent_id == self.storage_id else parent_id
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, path, storage_id, policy=''):
+        ''' Load a snapshot from path, returning None if it does not exist or
+        is not internally consistent. '''
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            prints(f'Failed to read MTP filesystem snapshot from {path} with error: {err}')
+            return None
+        try:
+            if data['version'] != SNAPSHOT_VERSION or data['storage_id'] != storage_id or data['policy'] != policy:
+                return None
+            entries = data['entries']
+            if len(entries) != data['count']:
+                return None
+            ans = cls(storage_id, entries, policy)
+            if len(ans.entries) != len(entries):
+                return None  # duplicate object ids
+            for e in entries:
+                if e['is_folder'] and len(ans.children.get(e['id'], ())) != e.get('child_count', -1):
+                    return None
+        except Exception:
+            return None
+        return ans
+
+    def save(self, path):
+        from calibre.utils.filenames import atomic_rename
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            'version': SNAPSHOT_VERSION, 'storage_id': self.storage_id, 'policy': self.policy,
+            'count': len(self.entries), 'entries': list(self.entries.values()),
+        }
+        tpath = path + '.tmp'
+        with open(tpath, 'wb') as f:
+            f.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        atomic_rename(tpath, path)
+
+    def can_reuse(self, entry):
+        if not entry.get('is_folder', False):
+            return False
+        old = self.entries.get(entry.get('id'))
+        md = normalize_modified(entry.get('modified', 0))
+        return bool(
+            old is not None and old['is_folder'] and md and normalize_modified(old.get('modified', 0)) == md and
+            old.get('name') == entry.get('name') and
+            self.normalize_parent_id(old.get('parent_id')) == self.normalize_parent_id(entry.get('parent_id')) and
+            not any(self.entries[x]['is_folder'] for x in self.children.get(old['id'], ())))
+
+    def wrap_callback(self, callback):
+        def wrapper(entry, level):
+            recurse = callback(entry, level)
+            self.fresh_ids.add(entry.get('id'))
+            if recurse and self.can_reuse(entry):
+                self.reused_folders.append(entry['id'])
+                return False
+            return recurse
+        return wrapper
+
+    def cached_entries(self):
+        ''' The cached files in all folders that were not recursed into, or
+        None if the snapshot is inconsistent with the enumerated objects. '''
+        ans = []
+        seen = set()
+        for folder_id in self.reused_folders:
+            for child_id in self.children.get(folder_id, ()):
+                if child_id in seen or child_id in self.fresh_ids:
+                    return None
+                seen.add(child_id)
+                ans.append(dict(self.entries[child_id]))
+        return ans
+
+    def merge(self, items):
+        ''' Return items extended with the cached objects or None if a full
+        re-enumeration is needed. '''
+        cached = self.cached_entries()
+        if cached is None:
+            return None
+        debug(f'Reused {len(cached)} objects in {len(self.reused_folders)} unchanged folders from the filesystem snapshot')
+        return list(items) + cached
+# }}}
+
+
+def find_tests():
+    import tempfile
+    import unittest
+
+    class FakeDevice:
+
+        def __init__(self, storage_id, latency=0.005):
+            self.storage_id = storage_id
+            self.latency = latency
+            self.objects = {}
+            self.listings = 0
+            self.next_id = 1
+
+        def add(self, parent_id, name, is_folder=False, modified=1000):
+            oid = self.next_id
+            self.next_id += 1
+            self.objects[oid] = {
+                'id': oid, 'parent_id': parent_id, 'storage_id': self.storage_id, 'name': name,
+                'is_folder': is_folder, 'size': 0 if is_folder else 10, 'modified': modified}
+            if parent_id:
+                self.objects[parent_id]['modified'] += 1
+            return oid
+
+        def get_filesystem(self, storage_id, callback, parent_id=0, level=0):
+            # Emulates the recursive enumeration done by libmtp
+            time.sleep(self.latency)
+            self.listings += 1
+            ans = []
+            for e in tuple(self.objects.values()):
+                if e['parent_id'] == parent_id:
+                    e = dict(e)
+                    ans.append(e)
+                    if callback(e, level) and e['is_folder']:
+                        ans.extend(self.get_filesystem(storage_id, callback, e['id'], level + 1)[0])
+            return ans, []
+
+    class TestFilesystemSnapshot(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+            self.dev = FakeDevice(65537)
+            self.storage = [{'id': self.dev.storage_id, 'name': 'Internal', 'is_folder': True, 'size': 0}]
+            for i in range(20):
+                folder = self.dev.add(0, f'folder{i}', is_folder=True)
+                for j in range(5):
+                    self.dev.add(folder, f'book{j}.epub')
+                sub = self.dev.add(folder, 'sub', is_folder=True)
+                self.dev.add(sub, 'nested.epub')
+
+        def tearDown(self):
+            import shutil
+            shutil.rmtree(self.tdir)
+
+        def connect(self):
+            path = os.path.join(self.tdir, 'snapshot.json')
+            snapshot = FilesystemSnapshot.load(path, self.dev.storage_id)
+            self.dev.listings = 0
+
+            def callback(entry, level):
+                return True
+
+            if snapshot is None:
+                items = self.dev.get_filesystem(self.dev.storage_id, callback)[0]
+            else:
+                items = self.dev.get_filesystem(self.dev.storage_id, snapshot.wrap_callback(callback))[0]
+                items = snapshot.merge(items)
+                if items is None:
+                    items = self.dev.get_filesystem(self.dev.storage_id, callback)[0]
+            fs = FilesystemCache(self.storage, items)
+            fs.snapshot(self.dev.storage_id).save(path)
+            return fs
+
+        def paths(self, fs):
+            return {'/'.join(x.full_path) for x in fs.id_maps[self.dev.storage_id].values()}
+
+        def expected_paths(self):
+            return self.paths(FilesystemCache(self.storage, self.dev.get_filesystem(self.dev.storage_id, lambda e, l: True)[0]))
+
+        def test_snapshot_reuse(self):
+            fs = self.connect()
+            full_listings = self.dev.listings
+            self.assertEqual(full_listings, 41)
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            st = time.monotonic()
+            fs = self.connect()
+            # Only folders that contain other folders are enumerated
+            self.assertEqual(self.dev.listings, 21)
+            self.assertLess(time.monotonic() - st, full_listings * self.dev.latency)
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            self.assertEqual(len(fs.id_maps[self.dev.storage_id]), 20 * 8)
+            self.assertEqual(sum(1 for x in fs.iterebooks(self.dev.storage_id)), 20 * 6)
+
+            # Folders that contain other folders are always enumerated, so
+            # changes to them need no extra listings
+            self.dev.add(1, 'new.epub')
+            fs = self.connect()
+            self.assertEqual(self.dev.listings, 21)
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            self.assertIsNotNone(fs.storage(self.dev.storage_id).find_path(('folder0', 'sub', 'nested.epub')))
+            fs = self.connect()
+            self.assertEqual(self.dev.listings, 21)
+            self.assertEqual(self.paths(fs), self.expected_paths())
+
+            # Changes below an unchanged folder are found
+            sub = self.dev.objects[1]['id'] + 6
+            self.assertEqual(self.dev.objects[sub]['name'], 'sub')
+            self.dev.add(sub, 'deep-new.epub')
+            fs = self.connect()
+            self.assertEqual(self.dev.listings, 22)
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            self.assertIsNotNone(fs.storage(self.dev.storage_id).find_path(('folder0', 'sub', 'deep-new.epub')))
+            deeper = self.dev.add(sub, 'deeper', is_folder=True)
+            fs = self.connect()
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            self.dev.add(deeper, 'deepest.epub')
+            fs = self.connect()
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            self.assertIsNotNone(fs.storage(self.dev.storage_id).find_path(('folder0', 'sub', 'deeper', 'deepest.epub')))
+            del self.dev.objects[sub + 1]
+            self.dev.objects[sub]['modified'] += 1
+            fs = self.connect()
+            self.assertEqual(self.paths(fs), self.expected_paths())
+            self.assertIsNone(fs.storage(self.dev.storage_id).find_path(('folder0', 'sub', 'nested.epub')))
+
+        def test_snapshot_validation(self):
+            path = os.path.join(self.tdir, 'snapshot.json')
+            self.connect()
+            self.assertIsNotNone(FilesystemSnapshot.load(path, self.dev.storage_id))
+            self.assertIsNone(FilesystemSnapshot.load(path, self.dev.storage_id, policy='changed'))
+            self.assertIsNone(FilesystemSnapshot.load(path, 1))
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+            del data['entries'][-1]
+            data['count'] -= 1
+            with open(path, 'wb') as f:
+                f.write(json.dumps(data).encode('utf-8'))
+            self.assertIsNone(FilesystemSnapshot.load(path, self.dev.storage_id))
+            with open(path, 'wb') as f:
+                f.write(b'garbage')
+            self.assertIsNone(FilesystemSnapshot.load(path, self.dev.storage_id))
+            fs = self.connect()
+            self.assertEqual(self.dev.listings, 41)
+            self.assertEqual(self.paths(fs), self.expected_paths())
+
+            # An object that moved out of an unchanged folder forces a full re-enumeration
+            snapshot = FilesystemSnapshot.load(path, self.dev.storage_id)
+            self.dev.objects[8]['parent_id'] = 0
+            items = self.dev.get_filesystem(self.dev.storage_id, snapshot.wrap_callback(lambda e, l: True))[0]
+            self.assertIsNone(snapshot.merge(items))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestFilesystemSnapshot)
+
+
+if __name__ == '__main__':
+    from calibre.utils.run_tests import run_cli
+    run_cli(find_tests())
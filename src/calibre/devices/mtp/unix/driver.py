@@ -329,8 +329,18 @@ def filesystem_cache(self):
                         'is_folder':True, 'name':name, 'can_delete':False,
                         'is_system':True})
                     self._currently_getting_sid = str(sid)
-                    items, errs = self.dev.get_filesystem(sid,
-                            partial(self._filesystem_callback, {}))
+                    snapshot = self.load_filesystem_snapshot(sid)
+                    if snapshot is None:
+                        items, errs = self.dev.get_filesystem(sid,
+                                partial(self._filesystem_callback, {}))
+                    else:
+                        items, errs = self.dev.get_filesystem(sid,
+                                snapshot.wrap_callback(partial(self._filesystem_callback, {})))
+                        items = snapshot.merge(items)
+                        if items is None:
+                            debug('Filesystem snapshot is inconsistent with the device, re-reading all objects')
+                            items, errs = self.dev.get_filesystem(sid,
+                                    partial(self._filesystem_callback, {}))
                     all_items.extend(items), all_errs.extend(errs)
                 if not all_items and all_errs:
                     raise DeviceError(
@@ -339,6 +349,8 @@ def filesystem_cache(self):
                     prints('There were some errors while getting the '
                             f' filesystem from {self.current_friendly_name}: {self.format_errorstack(all_errs)}')
                 self._filesystem_cache = FilesystemCache(storage, all_items)
+                if not all_errs:
+                    self.save_filesystem_snapshots(self._filesystem_cache)
             debug(f'Filesystem metadata loaded in {time.time()-st:g} seconds ({len(self._filesystem_cache)} objects)')
         return self._filesystem_cache
 
@@ -281,13 +281,26 @@ def filesystem_cache(self):
                 storage = {'id':storage_id, 'size':capacity, 'name':name,
                         'is_folder':True, 'can_delete':False, 'is_system':True}
                 self._currently_getting_sid = str(storage_id)
-                id_map = self.dev.get_filesystem(storage_id, partial(
-                        self._filesystem_callback, {}))
-                for x in id_map.values():
+                snapshot = self.load_filesystem_snapshot(storage_id)
+                if snapshot is None:
+                    objects = self.dev.get_filesystem(storage_id, partial(
+                            self._filesystem_callback, {})).values()
+                else:
+                    objects = snapshot.merge(self.dev.get_filesystem(storage_id,
+                        snapshot.wrap_callback(partial(self._filesystem_callback, {}))).values())
+                    if objects is None:
+                        debug('Filesystem snapshot is inconsistent with the device, re-reading all objects')
+                        objects = self.dev.get_filesystem(storage_id, partial(
+                                self._filesystem_callback, {})).values()
+                for x in objects:
                     x['storage_id'] = storage_id
                 all_storage.append(storage)
-                items.append(id_map.values())
+                items.append(objects)
             self._filesystem_cache = FilesystemCache(all_storage, chain(*items))
+            if all(items):
+                # A storage with no objects usually means the device is locked
+                # and hid its contents, so it must not be remembered as empty
+                self.save_filesystem_snapshots(self._filesystem_cache)
             debug(f'Filesystem metadata loaded in {time.time()-st:g} seconds ({len(self._filesystem_cache)} objects)')
         return self._filesystem_cache
 
@@ -17,7 +17,9 @@
 import threading
 import time
 import traceback
+import zlib
 from collections import defaultdict
+from contextlib import closing
 from errno import EAGAIN, EINTR
 from functools import wraps
 from threading import Thread
@@ -235,6 +237,15 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
     SEND_NOOP_EVERY_NTH_PROBE   = 5
     DISCONNECT_AFTER_N_SECONDS  = 30*60  # 30 minutes
     PURGE_CACHE_ENTRIES_DAYS    = 30
+    # Rewrite the metadata cache file from scratch once it contains more than
+    # this many records per live cache entry
+    METADATA_CACHE_COMPACT_RATIO = 2
+    METADATA_CACHE_TOUCHED_KEY  = '__touched__'
+    # Maximum number of books sent in a single metadata batch
+    METADATA_BATCH_SIZE         = 100
+    METADATA_BATCH_COMPRESSIONS = ('zlib',)
+    # Number of file chunks read ahead of the network when sending books
+    READ_AHEAD_CHUNKS           = 4
 
     CURRENT_CC_VERSION          = 128
 
@@ -270,6 +281,7 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
         'SET_CALIBRE_DEVICE_INFO': 1,
         'SET_CALIBRE_DEVICE_NAME': 2,
         'TOTAL_SPACE'            : 4,
+        'BOOK_METADATA_BATCH'    : 21,
     }
     reverse_opcodes = {v: k for k, v in opcodes.items()}
 
@@ -552,20 +564,81 @@ def _json_encode(self, op, arg):
         res = {}
         for k,v in arg.items():
             if isinstance(v, (Book, Metadata)):
-                res[k] = self.json_codec.encode_book_metadata(v)
-                series = v.get('series', None)
-                if series:
-                    tsorder = tweaks['save_template_title_series_sorting']
-                    series = title_sort(series, order=tsorder)
-                else:
-                    series = ''
-                self._debug('series sort = ', series)
-                res[k]['_series_sort_'] = series
+                res[k] = self._encode_book(v)
             else:
                 res[k] = v
         from calibre.utils.config import to_json
         return json.dumps([op, res], default=to_json)
 
+    def _encode_book(self, book):
+        ans = self.json_codec.encode_book_metadata(book)
+        series = book.get('series', None)
+        if series:
+            tsorder = tweaks['save_template_title_series_sorting']
+            series = title_sort(series, order=tsorder)
+        else:
+            series = ''
+        self._debug('series sort = ', series)
+        ans['_series_sort_'] = series
+        return ans
+
+    # Batched metadata frames. Used when both sides negotiated them in
+    # GET_INITIALIZATION_INFO. A frame is a BOOK_METADATA_BATCH message whose
+    # argument gives the number of books and the length in bytes of the data
+    # that immediately follows it on the socket. The data is a, possibly
+    # compressed, JSON array with one entry per book.
+
+    def _send_metadata_batch(self, books, index, total):
+        from calibre.utils.config import to_json
+        data = as_bytes(json.dumps([self._encode_book(b) for b in books], default=to_json))
+        compression = self.client_metadata_batch_compression
+        if compression == 'zlib':
+            data = zlib.compress(data)
+        self._call_client('BOOK_METADATA_BATCH',
+                          {'index': index, 'count': len(books), 'total': total,
+                           'length': len(data), 'compression': compression,
+                           'supportsSync': (bool(self.is_read_sync_col) or
+                                            bool(self.is_read_date_sync_col))},
+                          print_debug_info=False, wait_for_response=False)
+        self._send_byte_string(self.device_socket, data)
+
+    def _read_metadata_batch(self, header):
+        from calibre.utils.config import from_json
+        length = header['length']
+        chunks = []
+        while length > 0:
+            v = self._read_binary_from_net(min(length, 1024 * 1024))
+            if not v:
+                self._close_device_socket()
+                raise ControlError(desc='Device closed the network connection')
+            chunks.append(v)
+            length -= len(v)
+        data = b''.join(chunks)
+        compression = header.get('compression')
+        if compression == 'zlib':
+            data = zlib.decompress(data)
+        elif compression:
+            self._close_device_socket()
+            raise ControlError(desc=f'Unknown metadata batch compression: {compression}')
+        ans = json.loads(data, object_hook=from_json)
+        if len(ans) != header['count']:
+            self._close_device_socket()
+            raise ControlError(desc='Device sent a metadata batch with the wrong number of books')
+        return ans
+
+    def _receive_book_records(self, count):
+        ' Yield (opcode, result) once per book, transparently unpacking metadata batches '
+        received = 0
+        while received < count:
+            opcode, result = self._receive_from_client(print_debug_info=False)
+            if opcode == 'BOOK_METADATA_BATCH':
+                for r in self._read_metadata_batch(result):
+                    received += 1
+                    yield 'OK', r
+            else:
+                received += 1
+                yield opcode, result
+
     # Network functions
 
     def _read_binary_from_net(self, length):
@@ -691,8 +764,46 @@ def _receive_from_client(self, print_debug_info=True):
             raise
         raise ControlError(desc='Device responded with incorrect information')
 
-    # Write a file to the device as a series of binary strings.
-    def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
+    def _read_ahead(self, infile, chunk_size):
+        ' Read chunks of infile in a separate thread so that disk reads overlap network writes '
+        q = queue.Queue(maxsize=self.READ_AHEAD_CHUNKS)
+        stop = threading.Event()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    b = infile.read(chunk_size)
+                    q.put(b)
+                    if not b:
+                        break
+            except Exception as e:
+                q.put(e)
+
+        t = Thread(target=reader, name='SmartDevReadAhead', daemon=True)
+        t.start()
+        try:
+            while True:
+                b = q.get()
+                if isinstance(b, Exception):
+                    raise b
+                if not b:
+                    break
+                yield b
+        finally:
+            stop.set()
+            # Unblock the reader if it is waiting on a full queue
+            while t.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    t.join(0.01)
+
+    # Write a file to the device as a series of binary strings. When pipelined
+    # is True the client has agreed to accept the next book without calibre
+    # first waiting for its response to SEND_BOOK. The client must read all
+    # the book data before responding. The responses are collected by
+    # upload_books() once all books have been sent.
+    def _put_file(self, infile, lpath, book_metadata, this_book, total_books, pipelined=False):
         close_ = False
         if not hasattr(infile, 'read'):
             infile, close_ = open(infile, 'rb'), True
@@ -707,10 +818,11 @@ def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
                                'willStreamBooks': True,
                                'willStreamBinary': True,
                                'wantsSendOkToSendbook': self.can_send_ok_to_sendbook,
+                               'willPipeline': pipelined,
                                'canSupportLpathChanges': True},
                           print_debug_info=False,
-                          wait_for_response=self.can_send_ok_to_sendbook)
-        if self.can_send_ok_to_sendbook:
+                          wait_for_response=self.can_send_ok_to_sendbook and not pipelined)
+        if self.can_send_ok_to_sendbook and not pipelined:
             if opcode == 'ERROR':
                 raise UserFeedback(msg=f'Sending book {lpath} to device failed',
                                    details=result.get('message', ''),
@@ -718,17 +830,14 @@ def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
                 return
             lpath = result.get('lpath', lpath)
             book_metadata.lpath = lpath
-        self._set_known_metadata(book_metadata)
+        if not pipelined:
+            self._set_known_metadata(book_metadata)
         pos = 0
         failed = False
-        with infile:
-            while True:
-                b = infile.read(self.max_book_packet_len)
-                blen = len(b)
-                if not b:
-                    break
+        with infile, closing(self._read_ahead(infile, self.max_book_packet_len)) as chunks:
+            for b in chunks:
                 self._send_byte_string(self.device_socket, b)
-                pos += blen
+                pos += len(b)
         self.time = None
         if close_:
             infile.close()
@@ -744,6 +853,7 @@ def _metadata_in_cache(self, uuid, ext_or_lpath, lastmod):
                 lastmod = parse_date(lastmod)
             if key in self.device_book_cache and self.device_book_cache[key]['book'].last_modified == lastmod:
                 self.device_book_cache[key]['last_used'] = now()
+                self.device_book_cache_touched.add(key)
                 return self.device_book_cache[key]['book'].deepcopy(lambda: SDBook('', ''))
         except Exception:
             traceback.print_exc()
@@ -800,22 +910,39 @@ def _read_metadata_cache(self):
         except Exception:
             pass
 
-        cache_file_name = os.path.join(cache_dir(),
-                           'wireless_device_' + self.device_uuid +
-                                '_metadata_cache.json')
+        cache_file_name = self._metadata_cache_prefix() + '.json'
         self.device_book_cache = defaultdict(dict)
         self.known_metadata = {}
+        self._reset_metadata_cache_changes()
         try:
             count = 0
             if os.path.exists(cache_file_name):
+                # The file is a journal. Later records replace earlier ones
+                # for the same key, a record with no data removes the key and
+                # the touched record updates the last used time of many keys
                 with open(cache_file_name, mode='rb') as fd:
                     while True:
                         rec_len = fd.readline()
                         if len(rec_len) != 8:
                             break
-                        raw = fd.read(int(rec_len))
+                        rec_len = int(rec_len)
+                        raw = fd.read(rec_len)
+                        if len(raw) != rec_len:
+                            break  # truncated by an interrupted write
                         book = json.loads(raw.decode('utf-8'), object_hook=from_json)
+                        count += 1
                         key = list(book.keys())[0]
+                        if key == self.METADATA_CACHE_TOUCHED_KEY:
+                            last_used = book[key]['last_used']
+                            for k in book[key]['keys']:
+                                if k in self.device_book_cache:
+                                    self.device_book_cache[k]['last_used'] = last_used
+                            continue
+                        old = self.device_book_cache.pop(key, None)
+                        if old:
+                            self.known_metadata.pop(old['book'].get('lpath'), None)
+                        if book[key] is None:
+                            continue
                         metadata = self.json_codec.raw_to_book(book[key]['book'],
                                                             SDBook, self.PREFIX)
                         book[key]['book'] = metadata
@@ -823,45 +950,80 @@ def _read_metadata_cache(self):
 
                         lpath = metadata.get('lpath')
                         self.known_metadata[lpath] = metadata
-                        count += 1
-            self._debug('loaded', count, 'cache items')
+            self.metadata_cache_records = count
+            self._debug('loaded', len(self.device_book_cache), 'cache items from', count, 'records')
         except Exception:
             traceback.print_exc()
             self.device_book_cache = defaultdict(dict)
             self.known_metadata = {}
+            self.metadata_cache_records = 0
             try:
                 if os.path.exists(cache_file_name):
                     os.remove(cache_file_name)
             except Exception:
                 traceback.print_exc()
 
+    def _reset_metadata_cache_changes(self):
+        self.device_book_cache_dirty = set()
+        self.device_book_cache_touched = set()
+
+    def _metadata_cache_prefix(self):
+        return os.path.join(cache_dir(), 'wireless_device_' + self.device_uuid + '_metadata_cache')
+
+    def _write_metadata_cache_record(self, fd, record):
+        from calibre.utils.config import to_json
+        result = as_bytes(json.dumps(record, indent=2, default=to_json))
+        fd.write(f'{len(result) + 1:007}\n'.encode('ascii'))
+        fd.write(result)
+        fd.write(b'\n')
+
     def _write_metadata_cache(self):
         self._debug()
         from calibre.utils.date import now
         now_ = now()
-        from calibre.utils.config import to_json
         try:
+            prefix = self._metadata_cache_prefix()
             purged = 0
+            for book in self.device_book_cache.values():
+                if (now_ - book['last_used']).days > self.PURGE_CACHE_ENTRIES_DAYS:
+                    purged += 1
+            live = len(self.device_book_cache) - purged
+            changes = len(self.device_book_cache_dirty) + (1 if self.device_book_cache_touched else 0)
+            if (not purged and os.path.exists(prefix + '.json') and
+                    self.metadata_cache_records + changes <= max(100, self.METADATA_CACHE_COMPACT_RATIO * live)):
+                # Only append the entries that changed since the last write
+                if not changes:
+                    return
+                with open(prefix + '.json', mode='ab') as fd:
+                    for key in self.device_book_cache_dirty:
+                        book = self.device_book_cache.get(key)
+                        record = {key: None}
+                        if book:
+                            record[key] = {'book': self.json_codec.encode_book_metadata(book['book']), 'last_used': book['last_used']}
+                        self._write_metadata_cache_record(fd, record)
+                    touched = self.device_book_cache_touched - self.device_book_cache_dirty
+                    if touched:
+                        self._write_metadata_cache_record(fd, {self.METADATA_CACHE_TOUCHED_KEY: {
+                            'keys': sorted(touched), 'last_used': now_}})
+                self.metadata_cache_records += changes
+                self._reset_metadata_cache_changes()
+                self._debug('appended', changes, 'changes')
+                return
+
             count = 0
-            prefix = os.path.join(cache_dir(),
-                        'wireless_device_' + self.device_uuid + '_metadata_cache')
             with open(prefix + '.tmp', mode='wb') as fd:
                 for key,book in self.device_book_cache.items():
                     if (now_ - book['last_used']).days > self.PURGE_CACHE_ENTRIES_DAYS:
-                        purged += 1
                         continue
-                    json_metadata = defaultdict(dict)
-                    json_metadata[key]['book'] = self.json_codec.encode_book_metadata(book['book'])
-                    json_metadata[key]['last_used'] = book['last_used']
-                    result = as_bytes(json.dumps(json_metadata, indent=2, default=to_json))
-                    fd.write(f'{len(result) + 1:007}\n'.encode('ascii'))
-                    fd.write(result)
-                    fd.write(b'\n')
+                    self._write_metadata_cache_record(fd, {key: {
+                        'book': self.json_codec.encode_book_metadata(book['book']), 'last_used': book['last_used']}})
                     count += 1
             self._debug('wrote', count, 'entries, purged', purged, 'entries')
 
             from calibre.utils.filenames import atomic_rename
             atomic_rename(fd.name, prefix + '.json')
+            self.metadata_cache_records = count
+            self._reset_metadata_cache_changes()
         except Exception:
             traceback.print_exc()
 
@@ -885,19 +1047,22 @@ def _set_known_metadata(self, book, remove=False):
             self.known_metadata.pop(lpath, None)
             if key:
                 self.device_book_cache.pop(key, None)
+                self.device_book_cache_dirty.add(key)
         else:
             # Check if we have another UUID with the same lpath. If so, remove it
             # Must try both the extension and the lpath because of the cache change
             existing_uuid = self.known_metadata.get(lpath, {}).get('uuid', None)
             if existing_uuid and existing_uuid != uuid:
-                self.device_book_cache.pop(self._make_metadata_cache_key(existing_uuid, ext), None)
-                self.device_book_cache.pop(self._make_metadata_cache_key(existing_uuid, lpath), None)
+                for k in (self._make_metadata_cache_key(existing_uuid, ext), self._make_metadata_cache_key(existing_uuid, lpath)):
+                    if self.device_book_cache.pop(k, None) is not None:
+                        self.device_book_cache_dirty.add(k)
 
             new_book = book.deepcopy()
             self.known_metadata[lpath] = new_book
             if key:
                 self.device_book_cache[key]['book'] = new_book
                 self.device_book_cache[key]['last_used'] = now()
+                self.device_book_cache_dirty.add(key)
 
     # Force close a socket. The shutdown permits the close even if data transfer
     # is in progress
@@ -1061,7 +1226,10 @@ def open(self, connected_device, library_uuid):
                     'lastModifiedFormat': tweaks['gui_last_modified_display_format'],
                     'calibre_version': numeric_version,
                     'canSupportUpdateBooks': True,
-                    'canSupportLpathChanges': True})
+                    'canSupportLpathChanges': True,
+                    'canSupportBatchedMetadata': True,
+                    'batchedMetadataCompressions': list(self.METADATA_BATCH_COMPRESSIONS),
+                    'canSupportPipelinedBooks': True})
             if opcode != 'OK':
                 # Something wrong with the return. Close the socket
                 # and continue.
@@ -1113,6 +1281,14 @@ def open(self, connected_device, library_uuid):
                                     result.get('setTempMarkWhenReadInfoSynced', False)
             self._debug('Will set temp mark when syncing read',
                                     self.set_temp_mark_when_syncing_read)
+            self.client_can_use_batched_metadata = result.get('canUseBatchedMetadata', False)
+            self._debug('Can use batched metadata', self.client_can_use_batched_metadata)
+            self.client_metadata_batch_compression = result.get('batchedMetadataCompression', '')
+            if self.client_metadata_batch_compression not in self.METADATA_BATCH_COMPRESSIONS:
+                self.client_metadata_batch_compression = ''
+            self._debug('Metadata batch compression', self.client_metadata_batch_compression)
+            self.client_can_pipeline_books = result.get('canPipelineBooks', False)
+            self._debug('Can pipeline books', self.client_can_pipeline_books)
 
             if not self.settings().extra_customization[self.OPT_USE_METADATA_CACHE]:
                 self.client_can_use_metadata_cache = False
@@ -1294,7 +1470,8 @@ def books(self, oncard=None, end_session=True):
                              'willUseCachedMetadata': self.client_can_use_metadata_cache,
                              'supportsSync': (bool(self.is_read_sync_col) or
                                               bool(self.is_read_date_sync_col)),
-                             'canSupportBookFormatSync': True})
+                             'canSupportBookFormatSync': True,
+                             'canSendBatchedMetadata': self.client_can_use_batched_metadata})
         bl = CollectionsBookList(None, self.PREFIX, self.settings)
         if opcode == 'OK':
             count = result['count']
@@ -1303,8 +1480,7 @@ def books(self, oncard=None, end_session=True):
             if will_use_cache:
                 books_on_device = []
                 self._debug('caching. count=', count)
-                for i in range(count):
-                    opcode, result = self._receive_from_client(print_debug_info=False)
+                for opcode, result in self._receive_book_records(count):
                     books_on_device.append(result)
 
                 self._debug('received all books. count=', count)
@@ -1340,6 +1516,7 @@ def books(self, oncard=None, end_session=True):
                                 if uuid is not None:
                                     key = self._make_metadata_cache_key(uuid, lpath)
                                     self.device_book_cache.pop(key, None)
+                                    self.device_book_cache_dirty.add(key)
                                     self.known_metadata.pop(lpath, None)
                                     count_of_cache_items_deleted += 1
                             except Exception:
@@ -1356,10 +1533,9 @@ def books(self, oncard=None, end_session=True):
                     self._call_client('NOOP', {'priKey':priKey},
                                   print_debug_info=False, wait_for_response=False)
 
-            for i in range(count):
+            for i, (opcode, result) in enumerate(self._receive_book_records(count)):
                 if (i % 100) == 0:
                     self._debug('getting book metadata. Done', i, 'of', count)
-                opcode, result = self._receive_from_client(print_debug_info=False)
                 if opcode == 'OK':
                     try:
                         if '_series_sort_' in result:
@@ -1428,16 +1604,23 @@ def sync_booklists(self, booklists, end_session=True):
                      wait_for_response=False)
 
         if count:
+            batch = []
             for i,book in enumerate(books_to_send):
                 self._debug('sending metadata for book', book.lpath, book.title)
                 self._set_known_metadata(book)
-                opcode, result = self._call_client(
-                        'SEND_BOOK_METADATA',
-                        {'index': i, 'count': count, 'data': book,
-                         'supportsSync': (bool(self.is_read_sync_col) or
-                                          bool(self.is_read_date_sync_col))},
-                        print_debug_info=False,
-                        wait_for_response=False)
+                if self.client_can_use_batched_metadata:
+                    batch.append(book)
+                    if len(batch) >= self.METADATA_BATCH_SIZE or i == count - 1:
+                        self._send_metadata_batch(batch, i + 1 - len(batch), count)
+                        batch = []
+                else:
+                    opcode, result = self._call_client(
+                            'SEND_BOOK_METADATA',
+                            {'index': i, 'count': count, 'data': book,
+                             'supportsSync': (bool(self.is_read_sync_col) or
+                                              bool(self.is_read_date_sync_col))},
+                            print_debug_info=False,
+                            wait_for_response=False)
 
                 if not self.have_bad_sync_columns:
                     # Update the local copy of the device's read info just in case
@@ -1484,6 +1667,8 @@ def upload_books(self, files, names, on_card=None, end_session=True,
         paths = []
         names = iter(names)
         metadata = iter(metadata)
+        pipelined = self.client_can_pipeline_books and self.can_send_ok_to_sendbook
+        sent_books = []
 
         for i, infile in enumerate(files):
             mdata, fname = next(metadata), next(names)
@@ -1492,14 +1677,33 @@ def upload_books(self, files, names, on_card=None, end_session=True,
             if not hasattr(infile, 'read'):
                 infile = USBMS.normalize_path(infile)
             book = SDBook(self.PREFIX, lpath, other=mdata)
-            length, lpath = self._put_file(infile, lpath, book, i, len(files))
+            length, lpath = self._put_file(infile, lpath, book, i, len(files), pipelined=pipelined)
             if length < 0:
                 raise ControlError(desc=f'Sending book {lpath} to device failed')
             paths.append((lpath, length))
+            sent_books.append(book)
             # No need to deal with covers. The client will get the thumbnails
             # in the mi structure
             self.report_progress((i + 1) / float(len(files)), _('Transferring books to device...'))
 
+        if pipelined:
+            # Read the replies for all books, even after an error, otherwise
+            # the remaining replies would be taken for those of later requests
+            error = None
+            for i, book in enumerate(sent_books):
+                opcode, result = self._receive_from_client(print_debug_info=False)
+                if opcode == 'ERROR':
+                    if error is None:
+                        error = UserFeedback(msg=f'Sending book {book.lpath} to device failed',
+                                             details=result.get('message', ''),
+                                             level=UserFeedback.ERROR)
+                    continue
+                book.lpath = result.get('lpath', book.lpath)
+                self._set_known_metadata(book)
+                paths[i] = (book.lpath, paths[i][1])
+            if error is not None:
+                raise error
+
         self.report_progress(1.0, _('Transferring books to device...'))
         self._debug(f'finished uploading {len(files)} books')
         return paths
@@ -1872,6 +2076,11 @@ def _startup_on_demand(self):
             self.json_codec = JsonCodec()
             self.known_metadata = {}
             self.device_book_cache = defaultdict(dict)
+            self.metadata_cache_records = 0
+            self._reset_metadata_cache_changes()
+            self.client_can_use_batched_metadata = False
+            self.client_metadata_batch_compression = ''
+            self.client_can_pipeline_books = False
             self.debug_time = time.time()
             self.debug_start_time = time.time()
             self.max_book_packet_len = 0
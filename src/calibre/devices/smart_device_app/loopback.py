@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A loopback client for the wireless device driver, talking to it over a local
+socket pair. Used to test the protocol extensions and to measure transfer
+throughput without a real device. Run as::
+
+    calibre-debug -c "from calibre.devices.smart_device_app.loopback import main; main()"
+'''
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from io import BytesIO
+from threading import Event, Thread
+
+from calibre.devices.smart_device_app.driver import SMART_DEVICE_APP, SDBook
+from calibre.ebooks.metadata.book.json_codec import JsonCodec
+from calibre.utils.date import now
+from polyglot.builtins import as_bytes
+
+
+class LoopbackClient(Thread):
+
+    ''' A minimal wireless device client. It records all book metadata and
+    book files it receives and can send back book metadata when asked for the
+    book list. Books sent with an lpath in reject_lpaths are refused. '''
+
+    def __init__(self, sock, books_on_device=(), use_batches=True, compression='zlib'):
+        Thread.__init__(self, name='LoopbackClient', daemon=True)
+        self.sock = sock
+        self.books_on_device = list(books_on_device)
+        self.use_batches = use_batches
+        self.compression = compression
+        self.received_metadata = []
+        self.received_files = {}
+        self.reject_lpaths = set()
+        self.expected_metadata = -1
+        self.metadata_done = Event()
+        self.opcodes = SMART_DEVICE_APP.opcodes
+        self.reverse_opcodes = SMART_DEVICE_APP.reverse_opcodes
+        self.buf = b''
+
+    def read_exact(self, n):
+        while len(self.buf) < n:
+            v = self.sock.recv(max(n - len(self.buf), 65536))
+            if not v:
+                raise EOFError('Connection closed')
+            self.buf += v
+        ans, self.buf = self.buf[:n], self.buf[n:]
+        return ans
+
+    def read_message(self):
+        prefix = b''
+        while True:
+            c = self.read_exact(1)
+            if c == b'[':
+                break
+            prefix += c
+        raw = b'[' + self.read_exact(int(prefix) - 1)
+        op, arg = json.loads(raw)
+        return self.reverse_opcodes[op], arg
+
+    def send(self, op, arg, data=b''):
+        s = as_bytes(json.dumps([self.opcodes[op], arg]))
+        self.sock.sendall((b'%d' % len(s)) + s + data)
+
+    def check_metadata_done(self):
+        if len(self.received_metadata) == self.expected_metadata:
+            self.metadata_done.set()
+
+    def run(self):
+        try:
+            while True:
+                op, arg = self.read_message()
+                if op == 'SEND_BOOKLISTS':
+                    self.received_metadata = []
+                    self.expected_metadata = arg['count']
+                    self.check_metadata_done()
+                elif op == 'SEND_BOOK_METADATA':
+                    self.received_metadata.append(arg['data'])
+                    self.check_metadata_done()
+                elif op == 'BOOK_METADATA_BATCH':
+                    data = self.read_exact(arg['length'])
+                    if arg['compression'] == 'zlib':
+                        data = zlib.decompress(data)
+                    self.received_metadata.extend(json.loads(data))
+                    self.check_metadata_done()
+                elif op == 'SEND_BOOK':
+                    lpath = arg['lpath']
+                    if arg['wantsSendOkToSendbook'] and not arg['willPipeline']:
+                        self.send('OK', {'lpath': lpath})
+                    self.received_files[lpath] = self.read_exact(arg['length'])
+                    if arg['willPipeline']:
+                        if lpath in self.reject_lpaths:
+                            self.send('ERROR', {'message': f'Rejected {lpath}'})
+                        else:
+                            self.send('OK', {'lpath': lpath})
+                elif op == 'GET_BOOK_COUNT':
+                    self.send_book_list(arg)
+                elif op == 'NOOP' and arg.get('ejecting'):
+                    self.send('OK', {})
+                    break
+        except (EOFError, OSError):
+            pass
+
+    def send_book_list(self, arg):
+        books = self.books_on_device
+        self.send('OK', {'count': len(books), 'willStream': True, 'willScan': True})
+        if self.use_batches and arg.get('canSendBatchedMetadata'):
+            for i in range(0, len(books), SMART_DEVICE_APP.METADATA_BATCH_SIZE):
+                batch = books[i:i+SMART_DEVICE_APP.METADATA_BATCH_SIZE]
+                data = as_bytes(json.dumps(batch))
+                if self.compression == 'zlib':
+                    data = zlib.compress(data)
+                self.send('BOOK_METADATA_BATCH', {
+                    'index': i, 'count': len(batch), 'total': len(books), 'length': len(data),
+                    'compression': self.compression}, data)
+        else:
+            for b in books:
+                self.send('OK', b)
+
+
+class LoopbackDriver(SMART_DEVICE_APP):
+
+    ''' The wireless device driver, connected to a socket instead of a listening
+    server, with settings and cache location that do not depend on the user's
+    configuration. '''
+
+    def __init__(self, sock, cache_dir, use_batches=True, compression='zlib', pipeline=True):
+        SMART_DEVICE_APP.__init__(self, None)
+        self.cache_location = cache_dir
+        self.json_codec = JsonCodec()
+        self.known_metadata = {}
+        self.device_book_cache = defaultdict(dict)
+        self.metadata_cache_records = 0
+        self._reset_metadata_cache_changes()
+        self.device_socket = sock
+        self.is_connected = True
+        self.device_uuid = 'loopback'
+        self.max_book_packet_len = 64 * 1024
+        self.noop_time = time.monotonic()
+        self.is_read_sync_col = self.is_read_date_sync_col = None
+        self.have_bad_sync_columns = False
+        self.client_can_use_metadata_cache = False
+        self.client_cache_uses_lpaths = True
+        self.can_send_ok_to_sendbook = True
+        self.client_can_use_batched_metadata = use_batches
+        self.client_metadata_batch_compression = compression
+        self.client_can_pipeline_books = pipeline
+        self.report_progress = lambda x, y: None
+
+    def settings(self):
+        class Opts:
+            extra_customization = list(self.EXTRA_CUSTOMIZATION_DEFAULT)
+            use_subdirs = False
+        ans = Opts()
+        ans.extra_customization[self.OPT_IGNORE_FREESPACE] = True
+        return ans
+
+    def _metadata_cache_prefix(self):
+        return os.path.join(self.cache_location, 'metadata_cache')
+
+    def _create_upload_path(self, mdata, fname, create_dirs=True):
+        return fname
+
+
+def create_books(count, cover_size=8 * 1024):
+    books = []
+    thumbnail = os.urandom(cover_size)
+    for i in range(count):
+        b = SDBook('', f'Author {i % 100}/Title {i}.epub')
+        b.title = f'Title {i}'
+        b.authors = [f'Author {i % 100}']
+        b.uuid = f'uuid-{i}'
+        b.tags = ['tag one', 'tag two']
+        b.comments = 'A long description of the book. ' * 20
+        b.last_modified = now()
+        b.thumbnail = (160, 120, thumbnail)
+        books.append(b)
+    return books
+
+
+class Loopback:
+
+    def __init__(self, books_on_device=(), **kw):
+        self.tdir = tempfile.mkdtemp()
+        a, b = socket.socketpair()
+        self.client = LoopbackClient(b, books_on_device, use_batches=kw.get('use_batches', True), compression=kw.get('compression', 'zlib'))
+        self.driver = LoopbackDriver(a, self.tdir, **kw)
+        self.client.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.driver.eject()
+        self.client.join(5)
+        self.client.sock.close()
+        shutil.rmtree(self.tdir)
+
+    def sync_metadata(self, books):
+        st = time.monotonic()
+        self.driver.sync_booklists([books])
+        if not self.client.metadata_done.wait(60):
+            raise TimeoutError('Client did not receive all metadata')
+        return time.monotonic() - st
+
+    def upload(self, files):
+        names = [f'book{i}.epub' for i in range(len(files))]
+        metadata = [SDBook('', n) for n in names]
+        st = time.monotonic()
+        paths = self.driver.upload_books([BytesIO(f) for f in files], names, metadata=metadata)
+        return paths, time.monotonic() - st
+
+
+def measure_throughput(num_books=2000, num_files=50, file_size=1024 * 1024):
+    ans = {}
+    for use_batches in (False, True):
+        books = create_books(num_books)
+        with Loopback(use_batches=use_batches) as lb:
+            elapsed = lb.sync_metadata(books)
+        ans['metadata_' + ('batched' if use_batches else 'unbatched')] = num_books / elapsed
+    files = [os.urandom(file_size) for i in range(num_files)]
+    for pipeline in (False, True):
+        with Loopback(pipeline=pipeline) as lb:
+            paths, elapsed = lb.upload(files)
+        ans['files_' + ('pipelined' if pipeline else 'unpipelined')] = num_files * file_size / elapsed
+    return ans
+
+
+def main():
+    for k, v in measure_throughput().items():
+        unit = 'books' if k.startswith('metadata') else 'bytes'
+        if unit == 'bytes':
+            v /= 1024 * 1024
+            unit = 'MB'
+        print(f'{k}: {v:.1f} {unit}/sec')
+
+
+def find_tests():
+    import unittest
+
+    class TestLoopback(unittest.TestCase):
+
+        def test_metadata_batches(self):
+            for use_batches in (False, True):
+                books = create_books(250, cover_size=16)
+                with Loopback(use_batches=use_batches) as lb:
+                    lb.sync_metadata(books)
+                    self.assertEqual([b['title'] for b in lb.client.received_metadata], [b.title for b in books])
+                    self.assertEqual(len(lb.driver.device_book_cache), len(books))
+                    # Unchanged books are not sent again
+                    lb.client.metadata_done.clear()
+                    lb.sync_metadata(books)
+                    self.assertEqual(lb.client.received_metadata, [])
+
+        def test_book_list_batches(self):
+            books = create_books(250, cover_size=16)
+            with Loopback(use_batches=True) as lb:
+                raw = [lb.driver._encode_book(b) for b in books]
+                for r in raw:
+                    r.pop('thumbnail', None)
+            for use_batches in (False, True):
+                for compression in ('', 'zlib'):
+                    with Loopback(books_on_device=json.loads(json.dumps(raw, default=str)), use_batches=use_batches, compression=compression) as lb:
+                        bl = lb.driver.books()
+                        self.assertEqual(sorted(b.title for b in bl), sorted(b.title for b in books))
+
+        def test_pipelined_upload(self):
+            files = [os.urandom(100 * 1024 + i) for i in range(10)]
+            for pipeline in (False, True):
+                with Loopback(pipeline=pipeline) as lb:
+                    paths, elapsed = lb.upload(files)
+                    self.assertEqual([p[1] for p in paths], [len(f) for f in files])
+                    self.assertEqual([lb.client.received_files[p[0]] for p in paths], files)
+                    self.assertEqual(set(lb.driver.known_metadata), {p[0] for p in paths})
+            # After a failed book, all replies are read, so later requests
+            # get their own replies
+            from calibre.devices.errors import UserFeedback
+            with Loopback(pipeline=True) as lb:
+                lb.client.reject_lpaths = {'book1.epub', 'book3.epub'}
+                with self.assertRaises(UserFeedback) as cm:
+                    lb.upload(files[:5])
+                self.assertIn('book1.epub', cm.exception.msg)
+                self.assertEqual(set(lb.driver.known_metadata), {'book0.epub', 'book2.epub', 'book4.epub'})
+                lb.client.reject_lpaths = set()
+                paths, elapsed = lb.upload(files)
+                self.assertEqual([lb.client.received_files[p[0]] for p in paths], files)
+
+        def test_incremental_metadata_cache(self):
+            books = create_books(150, cover_size=16)
+            with Loopback() as lb:
+                d = lb.driver
+                lb.sync_metadata(books)
+                path = d._metadata_cache_prefix() + '.json'
+                self.assertEqual(d.metadata_cache_records, len(books))
+                size = os.path.getsize(path)
+                # A single changed book only appends a single record
+                books[3].title = 'Changed title'
+                books[3].last_modified = now()
+                lb.client.metadata_done.clear()
+                lb.sync_metadata(books)
+                self.assertEqual(d.metadata_cache_records, len(books) + 1)
+                self.assertLess(os.path.getsize(path) - size, size // 50)
+                d._set_known_metadata(books[4], remove=True)
+                d._write_metadata_cache()
+                expected = {k: v['book'].title for k, v in d.device_book_cache.items()}
+                d._read_metadata_cache()
+                self.assertEqual({k: v['book'].title for k, v in d.device_book_cache.items()}, expected)
+                self.assertEqual(len(expected), len(books) - 1)
+                self.assertEqual(d.known_metadata[books[3].lpath].title, 'Changed title')
+                # The journal is compacted once it has too many stale records
+                d.METADATA_CACHE_COMPACT_RATIO = 0
+                d._set_known_metadata(books[5], remove=True)
+                d._write_metadata_cache()
+                self.assertEqual(d.metadata_cache_records, len(books) - 2)
+                d._read_metadata_cache()
+                self.assertEqual(len(d.device_book_cache), len(books) - 2)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestLoopback)
+
+
+if __name__ == '__main__':
+    main()
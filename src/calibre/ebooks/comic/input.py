@@ -6,18 +6,15 @@
 Based on ideas from comiclrf created by FangornUK.
 '''
 
+import itertools
 import os
-import time
 import traceback
-from queue import Empty
 
 from calibre import extract, prints, walk
 from calibre.constants import filesystem_encoding
 from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.icu import numeric_sort_key
-from calibre.utils.ipc.job import ParallelJob
-from calibre.utils.ipc.server import Server
 
 # If the specified screen has either dimension larger than this value, no image
 # rescaling is done (we assume that it is a tablet output profile)
@@ -245,7 +242,7 @@ def process_pages(self):
 
 def render_pages(tasks, dest, opts, notification=lambda x, y: x):
     '''
-    Entry point for the job server.
+    Render the pages in tasks, a list of (page number, path) pairs.
     '''
     failures, pages = [], []
     for num, path in tasks:
@@ -263,55 +260,76 @@ def render_pages(tasks, dest, opts, notification=lambda x, y: x):
     return pages, failures
 
 
-class Progress:
+def render_page(num, path, dest, common_data=None):
+    '''
+    Entry point for the worker pool, renders a single page. The conversion
+    options are sent to the workers only once, as common_data.
+    '''
+    return render_pages([(num, path)], dest, common_data)
 
-    def __init__(self, total, update):
-        self.total  = total
-        self.update = update
-        self.done   = 0
 
-    def __call__(self, percent, msg=''):
-        self.done += 1
-        # msg = msg%os.path.basename(job.args[0])
-        self.update(float(self.done)/self.total, msg)
+def iter_processed_pages(pages, opts, tdir, max_workers=None):
+    '''
+    Render all identified comic pages in a pool of worker processes, one page
+    per job, so that memory use per worker is bounded by the size of a single
+    page. Yields (path, rendered_pages, failed) for every page in order, as
+    soon as it and all pages before it have been rendered.
+    '''
+    from queue import Empty
+
+    from calibre import detect_ncpus
+    from calibre.utils.ipc.pool import Pool
+    if not pages:
+        return
+    num_workers = min(max_workers or detect_ncpus(), len(pages))
+    pool = Pool(max_workers=num_workers, name='ComicPages')
+
+    def failed(tb):
+        raise Exception(_('Failed to process comic: \n\n%s') % tb)
+
+    def queue_pages(count):
+        for num, path in itertools.islice(jobs, count):
+            pool(num, 'calibre.ebooks.comic.input', 'render_page', num, path, tdir)
+
+    try:
+        pool.set_common_data(opts)
+        # Queue only a few more pages than there are workers, so that pages
+        # are rendered roughly in order and can be yielded as soon as possible
+        jobs = iter(enumerate(pages))
+        queue_pages(2 * num_workers)
+        done, pos = {}, 0
+        while pos < len(pages):
+            try:
+                wr = pool.results.get(timeout=5)
+            except Empty:
+                if pool.failed or not pool.is_alive():
+                    failed(getattr(pool.terminal_failure, 'tb', None) or _('Worker pool stopped unexpectedly'))
+                continue
+            if wr.is_terminal_failure:
+                failed(getattr(pool.terminal_failure, 'tb', None) or wr.result.traceback)
+            if wr.result.err is None:
+                rendered, failures = wr.result.value
+            else:
+                rendered, failures = [], [pages[wr.id]]
+            done[wr.id] = rendered, bool(failures)
+            queue_pages(1)
+            while pos in done:
+                rendered, page_failed = done.pop(pos)
+                yield pages[pos], rendered, page_failed
+                pos += 1
+    finally:
+        pool.shutdown()
+        pool.join()
 
 
 def process_pages(pages, opts, update, tdir):
     '''
     Render all identified comic pages.
     '''
-    progress = Progress(len(pages), update)
-    server = Server()
-    jobs = []
-    tasks = [(p, os.path.join(tdir, os.path.basename(p))) for p in pages]
-    tasks = server.split(pages)
-    for task in tasks:
-        jobs.append(ParallelJob('render_pages', '', progress,
-                                args=[task, tdir, opts]))
-        server.add_job(jobs[-1])
-    while True:
-        time.sleep(1)
-        running = False
-        for job in jobs:
-            while True:
-                try:
-                    x = job.notifications.get_nowait()
-                    progress(*x)
-                except Empty:
-                    break
-            job.update()
-            if not job.is_finished:
-                running = True
-        if not running:
-            break
-    server.close()
     ans, failures = [], []
-
-    for job in jobs:
-        if job.failed or job.result is None:
-            raise Exception(_('Failed to process comic: \n\n%s')%
-                    job.log_file.read())
-        pages, failures_ = job.result
-        ans += pages
-        failures += failures_
+    for i, (path, rendered, failed) in enumerate(iter_processed_pages(pages, opts, tdir)):
+        ans.extend(rendered)
+        if failed:
+            failures.append(path)
+        update(float(i + 1) / len(pages), (_('Failed %s') if failed else _('Rendered %s')) % path)
     return ans, failures
@@ -93,51 +93,46 @@ cpalmdoc_decompress(PyObject *self, PyObject *args) {
     return ans;
 }
 
-static bool
-cpalmdoc_memcmp( Byte *a, Byte *b, Py_ssize_t len) {
-    Py_ssize_t i;
-    for (i = 0; i < len; i++) if (a[i] != b[i]) return false;
-    return true;
-}
-
+// Find the longest repeat, of 3 to 10 bytes, of the bytes at pos that starts
+// at most 2047 bytes before pos and ends before pos, using the nearest one if
+// there are several. This gives the same result as searching backwards for
+// each length from 10 to 3 in turn, but needs only a single pass over the
+// window. Returns the length of the repeat, or zero if there is none.
 static Py_ssize_t
-cpalmdoc_rfind(Byte *data, Py_ssize_t pos, Py_ssize_t chunk_length) {
-    Py_ssize_t i;
-    for (i = pos - chunk_length; i > -1; i--)
-        if (cpalmdoc_memcmp(data+i, data+pos, chunk_length)) return i;
-    return pos;
+cpalmdoc_find_repeat(Byte *data, Py_ssize_t pos, Py_ssize_t *dist) {
+    Py_ssize_t j, n, max_len, best = 0, start = MAX(0, pos - 2047);
+    for (j = pos - 3; j >= start && best < 10; j--) {
+        max_len = MIN(10, pos - j);
+        for (n = 0; n < max_len && data[j+n] == data[pos+n]; n++);
+        if (n > best && n > 2) { best = n; *dist = pos - j; }
+    }
+    return best;
 }
 
 
+// Must not use any Python APIs as it is called without holding the GIL
 static Py_ssize_t
 cpalmdoc_do_compress(buffer *b, char *output) {
-    Py_ssize_t i = 0, j, chunk_len, dist;
+    Py_ssize_t i = 0, j, chunk_len, dist = 0;
     unsigned int compound;
     Byte c, n;
-    bool found;
     char *head;
+    Byte temp_data[8];
     buffer temp;
     head = output;
-    temp.data = (Byte *)PyMem_Malloc(sizeof(Byte)*8); temp.len = 0;
-    if (temp.data == NULL) return 0;
+    temp.data = temp_data; temp.len = 0;
     while (i < b->len) {
         c = b->data[i];
         //do repeats
         if ( i > 10 && (b->len - i) > 10) {
-            found = false;
-            for (chunk_len = 10; chunk_len > 2; chunk_len--) {
-                j = cpalmdoc_rfind(b->data, i, chunk_len);
-                dist = i - j;
-                if (j < i && dist <= 2047) {
-                    found = true;
-                    compound = (unsigned int)((dist << 3) + chunk_len-3);
-                    *(output++) = CHAR(0x80 + (compound >> 8 ));
-                    *(output++) = CHAR(compound & 0xFF);
-                    i += chunk_len;
-                    break;
-                }
+            chunk_len = cpalmdoc_find_repeat(b->data, i, &dist);
+            if (chunk_len) {
+                compound = (unsigned int)((dist << 3) + chunk_len-3);
+                *(output++) = CHAR(0x80 + (compound >> 8 ));
+                *(output++) = CHAR(compound & 0xFF);
+                i += chunk_len;
+                continue;
             }
-            if (found) continue;
         }
 
         //write single character
@@ -163,7 +158,6 @@ cpalmdoc_do_compress(buffer *b, char *output) {
             for (j=0; j < temp.len; j++) *(output++) = (char)temp.data[j];
         }
     }
-    PyMem_Free(temp.data);
     return output - head;
 }
 
@@ -177,16 +171,20 @@ cpalmdoc_compress(PyObject *self, PyObject *args) {
 		return NULL;
     b.data = (Byte *)PyMem_Malloc(sizeof(Byte)*input_len);
     if (b.data == NULL) return PyErr_NoMemory();
+    b.len = input_len;
+    // Make the output buffer larger than the input as sometimes
+    // compression results in a larger block, in the worst case, a single
+    // binary byte followed by a text byte, it is 1.5 times larger
+    output = (char *)PyMem_Malloc(sizeof(char) * (2 * b.len + 8));
+    if (output == NULL) { PyMem_Free(b.data); return PyErr_NoMemory(); }
+    // The input is an immutable bytes object, so it is safe to release the
+    // GIL, allowing records to be compressed in parallel in threads
+    Py_BEGIN_ALLOW_THREADS;
     // Map chars to bytes
     for (j = 0; j < input_len; j++)
         b.data[j] = (_input[j] < 0) ? _input[j]+256 : _input[j];
-    b.len = input_len;
-    // Make the output buffer larger than the input as sometimes
-    // compression results in a larger block
-    output = (char *)PyMem_Malloc(sizeof(char) * (int)(1.25*b.len));
-    if (output == NULL) return PyErr_NoMemory();
     j = cpalmdoc_do_compress(&b, output);
-    if ( j == 0) return PyErr_NoMemory();
+    Py_END_ALLOW_THREADS;
     ans = Py_BuildValue("y#", output, j);
     PyMem_Free(output);
     PyMem_Free(b.data);
@@ -18,6 +18,25 @@ def compress_doc(data):
     return cPalmdoc.compress(data) if data else b''
 
 
+def compress_doc_records(records, max_workers=0):
+    '''
+    Compress a sequence of records, returning a list of the compressed
+    records, in order. Compression is done in parallel using threads, as it
+    does not hold the GIL.
+    '''
+    records = tuple(records)
+    if max_workers <= 0:
+        from calibre import detect_ncpus
+        max_workers = detect_ncpus()
+    # Each thread should get a reasonable amount of work
+    max_workers = min(max_workers, len(records) // 16)
+    if max_workers < 2:
+        return list(map(compress_doc, records))
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='PalmdocCompress') as executor:
+        return list(executor.map(compress_doc, records))
+
+
 def py_compress_doc(data):
     out = io.BytesIO()
     i = 0
@@ -86,5 +105,36 @@ def test_palmdoc_compression(self):
                 x = compress_doc(test)
                 self.assertEqual(py_compress_doc(test), x)
                 self.assertEqual(decompress_doc(x), test)
+            # Worst case expansion
+            test = b'\x80a' * 4096
+            self.assertEqual(decompress_doc(compress_doc(test)), test)
+
+        def test_compress_records(self):
+            import os
+            records = [os.urandom(64) + b'some text ' * 400 for i in range(100)]
+            for max_workers in (1, 4):
+                compressed = compress_doc_records(records, max_workers=max_workers)
+                self.assertEqual(compressed, list(map(compress_doc, records)))
+                self.assertEqual(list(map(decompress_doc, compressed)), records)
 
     return unittest.defaultTestLoader.loadTestsFromTestCase(Test)
+
+
+def benchmark(size=4 * 1024 * 1024, record_size=4096):
+    '''
+    Time the compression of the text of a large book, split into records, as
+    done by the MOBI writers. Run with::
+
+        calibre-debug -c "from calibre.ebooks.compression.palmdoc import benchmark; benchmark()"
+    '''
+    import random
+    import time
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for i in range(random.randint(1, 10))) for i in range(5000)]
+    text = ' '.join(random.choice(words) for i in range(size // 6)).encode('utf-8')[:size]
+    records = [text[i:i+record_size] for i in range(0, len(text), record_size)]
+    for max_workers in (1, 0):
+        st = time.monotonic()
+        compressed = compress_doc_records(records, max_workers=max_workers)
+        elapsed = time.monotonic() - st
+        print(f'{"Serial" if max_workers == 1 else "Parallel"}: compressed {len(records)} records ({len(text) / 1024**2:.1f} MB) in {elapsed:.2f}s,'
+              f' ratio: {sum(map(len, compressed)) / len(text):.2f}')
@@ -200,6 +200,7 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'transform_workers',
                      ]
                     )),
               (_('LOOK AND FEEL'), (
@@ -267,6 +268,7 @@ def add_pipeline_options(parser, plumber):
                         [
                          'verbose',
                          'debug_pipeline',
+                         'profile_stages',
                          ])),
 
               ))
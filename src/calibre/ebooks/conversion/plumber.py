@@ -129,6 +129,25 @@ def __init__(self, input, output, log, report_progress=DummyReporter(),
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='profile_stages',
+            recommended_value=None, level=OptionRecommendation.LOW,
+            help=_('Record the wall clock time, CPU time and increase in peak memory '
+                   'use of every stage of the conversion pipeline and append them, '
+                   'as a single line of JSON, to the specified file. Many '
+                   'conversions can use the same file, to find the stages that '
+                   'are slow across a large number of books.')
+        ),
+
+OptionRecommendation(name='transform_workers',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Number of worker processes to use for the work that is done '
+                   'independently for every file in the book, such as splitting '
+                   'large files and rescaling images. The default of zero processes '
+                   'every file in turn. Using more than one worker is only '
+                   'supported on platforms that can fork processes and is useful '
+                   'for books with a very large number of files.')
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1027,6 +1046,11 @@ def run(self):
         self.setup_options()
         if self.opts.verbose:
             self.log.filter_level = self.log.DEBUG
+        self.stage_profiler = None
+        if self.opts.profile_stages:
+            from calibre.ebooks.conversion.stage_profiler import StageProfiler
+            self.stage_profiler = StageProfiler()
+            self.profile_stage('setup')
         if self.for_regex_wizard and hasattr(self.opts, 'no_process'):
             self.opts.no_process = True
         self.flush()
@@ -1053,6 +1077,7 @@ def run(self):
 
         # Run any preprocess plugins
         from calibre.customize.ui import run_plugins_on_preprocess
+        self.profile_stage('preprocess plugins')
         self.input = run_plugins_on_preprocess(self.input)
 
         self.flush()
@@ -1085,6 +1110,7 @@ def run(self):
             self.input_plugin.for_viewer = True
         self.output_plugin.specialize_options(self.log, self.opts, self.input_fmt)
         with self.input_plugin:
+            self.profile_stage('input', self.input_plugin.name)
             self.oeb = self.input_plugin(stream, self.opts,
                                         self.input_fmt, self.log,
                                         accelerators, tdir)
@@ -1095,12 +1121,14 @@ def run(self):
             if self.input_fmt in ('recipe', 'downloaded_recipe'):
                 self.opts_to_mi(self.user_metadata)
             if not hasattr(self.oeb, 'manifest'):
+                self.profile_stage('parse')
                 self.oeb = create_oebbook(
                     self.log, self.oeb, self.opts,
                     encoding=self.input_plugin.output_encoding,
                     for_regex_wizard=self.for_regex_wizard, removed_items=getattr(self.input_plugin, 'removed_items_to_ignore', ()))
             if self.for_regex_wizard:
                 return
+            self.profile_stage('postprocess', self.input_plugin.name)
             self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
             self.opts.is_image_collection = self.input_plugin.is_image_collection
             pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
@@ -1121,11 +1149,14 @@ def run(self):
             if isinstance(transform_html_rules, (str, bytes)):
                 transform_html_rules = json.loads(transform_html_rules)
             from calibre.ebooks.html_transform_rules import transform_conversion_book
+            self.profile_stage('TransformHTMLRules')
             transform_conversion_book(self.oeb, self.opts, transform_html_rules)
 
         from calibre.ebooks.oeb.transforms.data_url import DataURL
+        self.profile_stage('DataURL')
         DataURL()(self.oeb, self.opts)
         from calibre.ebooks.oeb.transforms.guide import Clean
+        self.profile_stage('Clean')
         Clean()(self.oeb, self.opts)
         pr(0.1)
         self.flush()
@@ -1134,14 +1165,17 @@ def run(self):
         self.opts.dest = self.opts.output_profile
 
         from calibre.ebooks.oeb.transforms.jacket import RemoveFirstImage
+        self.profile_stage('RemoveFirstImage')
         RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
         from calibre.ebooks.oeb.transforms.metadata import MergeMetadata
+        self.profile_stage('MergeMetadata')
         MergeMetadata()(self.oeb, self.user_metadata, self.opts,
                 override_input_metadata=self.override_input_metadata)
         pr(0.2)
         self.flush()
 
         from calibre.ebooks.oeb.transforms.structure import DetectStructure
+        self.profile_stage('DetectStructure')
         DetectStructure()(self.oeb, self.opts)
         pr(0.35)
         self.flush()
@@ -1168,12 +1202,14 @@ def run(self):
                 fkey = self.opts.dest.fkey
 
         from calibre.ebooks.oeb.transforms.jacket import Jacket
+        self.profile_stage('Jacket')
         Jacket()(self.oeb, self.opts, self.user_metadata)
         pr(0.37)
         self.flush()
 
         if self.opts.add_alt_text_to_img:
             from calibre.ebooks.oeb.transforms.alt_text import AddAltText
+            self.profile_stage('AddAltText')
             AddAltText()(self.oeb, self.opts)
         pr(0.4)
         self.flush()
@@ -1199,10 +1235,12 @@ def run(self):
         if self.opts.linearize_tables and \
                 self.output_plugin.file_type not in ('mobi', 'lrf'):
             from calibre.ebooks.oeb.transforms.linearize_tables import LinearizeTables
+            self.profile_stage('LinearizeTables')
             LinearizeTables()(self.oeb, self.opts)
 
         if self.opts.unsmarten_punctuation:
             from calibre.ebooks.oeb.transforms.unsmarten import UnsmartenPunctuation
+            self.profile_stage('UnsmartenPunctuation')
             UnsmartenPunctuation()(self.oeb, self.opts)
 
         mobi_file_type = getattr(self.opts, 'mobi_file_type', 'old')
@@ -1222,6 +1260,7 @@ def run(self):
                 transform_css_rules=transform_css_rules,
                 specializer=partial(self.output_plugin.specialize_css_for_output,
                     self.log, self.opts))
+        self.profile_stage('CSSFlattener')
         flattener(self.oeb, self.opts)
         self.opts._final_base_font_size = fbase
 
@@ -1229,15 +1268,19 @@ def run(self):
         self.opts.remove_paragraph_spacing = orps
 
         from calibre.ebooks.oeb.transforms.page_margin import RemoveAdobeMargins, RemoveFakeMargins
+        self.profile_stage('RemoveFakeMargins')
         RemoveFakeMargins()(self.oeb, self.log, self.opts)
+        self.profile_stage('RemoveAdobeMargins')
         RemoveAdobeMargins()(self.oeb, self.log, self.opts)
 
         if self.opts.embed_all_fonts:
             from calibre.ebooks.oeb.transforms.embed_fonts import EmbedFonts
+            self.profile_stage('EmbedFonts')
             EmbedFonts()(self.oeb, self.log, self.opts)
 
         if self.opts.subset_embedded_fonts and self.output_plugin.file_type != 'pdf':
             from calibre.ebooks.oeb.transforms.subset import SubsetFonts
+            self.profile_stage('SubsetFonts')
             SubsetFonts()(self.oeb, self.log, self.opts)
 
         pr(0.9)
@@ -1247,8 +1290,10 @@ def run(self):
 
         self.log.info('Cleaning up manifest...')
         trimmer = ManifestTrimmer()
+        self.profile_stage('ManifestTrimmer')
         trimmer(self.oeb, self.opts)
 
+        self.profile_stage('rationalize TOC')
         self.oeb.toc.rationalize_play_orders()
         pr(1.)
         self.flush()
@@ -1263,15 +1308,37 @@ def run(self):
         self.output_plugin.report_progress = our
         our(0., _('Running %s plugin')%self.output_plugin.name)
         with self.output_plugin:
+            self.profile_stage('output', self.output_plugin.name)
             self.output_plugin.convert(self.oeb, self.output, self.input_plugin,
                 self.opts, self.log)
+        self.profile_stage('cleanup')
         self.oeb.clean_temp_files()
         self.ui_reporter(1.)
+        self.profile_stage('postprocess plugins')
         run_plugins_on_postprocess(self.output, self.output_fmt)
 
         self.log(self.output_fmt.upper(), 'output written to', self.output)
+        if self.stage_profiler is not None:
+            self.write_stage_profile()
         self.flush()
 
+    def profile_stage(self, name=None, plugin=None):
+        if self.stage_profiler is not None:
+            self.stage_profiler(name, plugin)
+
+    def write_stage_profile(self):
+        from calibre.ebooks.conversion.stage_profiler import format_stages
+        path = os.path.abspath(self.opts.profile_stages)
+        try:
+            report = self.stage_profiler.write(
+                path, input=self.input, output=self.output, input_format=self.input_fmt, output_format=self.output_fmt)
+        except OSError as err:
+            self.log.error(f'Failed to write stage profile to {path} with error: {err}')
+            return
+        self.log.info('Time taken by the stages of the conversion pipeline:')
+        self.log.info(format_stages(report['stages']))
+        self.log.info('Stage profile appended to:', path)
+
 
 # This has to be global as create_oebbook can be called from other locations
 # (for example in the html input plugin)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Record the wall clock time, CPU time and memory used by the stages of the
+conversion pipeline. Reports are appended as lines of JSON to a file, so that
+many conversions can share a single file, which can then be summarized with::
+
+    calibre-debug -c "from calibre.ebooks.conversion.stage_profiler import main; main()" report.jsonl
+'''
+
+import json
+import os
+import sys
+import time
+from collections import defaultdict, namedtuple
+
+from calibre.constants import __version__, ismacos, iswindows
+
+Snapshot = namedtuple('Snapshot', 'wall cpu children_cpu peak_rss')
+Stage = namedtuple('Stage', 'name plugin wall cpu children_cpu peak_rss_delta')
+
+
+def peak_rss():
+    ' The peak resident set size of this process, in bytes '
+    if iswindows:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except Exception:
+            return 0
+    import resource
+    ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return ans if ismacos else ans * 1024
+
+
+def snapshot():
+    t = os.times()
+    return Snapshot(time.monotonic(), t.user + t.system, t.children_user + t.children_system, peak_rss())
+
+
+class StageProfiler:
+
+    '''
+    Call with the name of a stage when it starts. The stage ends when the
+    next one starts or when called with no name.
+    '''
+
+    def __init__(self):
+        self.stages = []
+        self.current = None
+        self.started_at = time.time()
+
+    def __call__(self, name=None, plugin=None):
+        now = snapshot()
+        if self.current is not None:
+            cname, cplugin, start = self.current
+            self.stages.append(Stage(
+                cname, cplugin, now.wall - start.wall, now.cpu - start.cpu,
+                now.children_cpu - start.children_cpu, now.peak_rss - start.peak_rss))
+        self.current = None if name is None else (name, plugin, now)
+
+    def report(self, **extra):
+        self()
+        ans = {
+            'version': __version__, 'started_at': self.started_at, 'peak_rss': peak_rss(),
+            'stages': [s._asdict() for s in self.stages],
+        }
+        for k in ('wall', 'cpu', 'children_cpu'):
+            ans[k] = sum(getattr(s, k) for s in self.stages)
+        ans.update(extra)
+        return ans
+
+    def write(self, path, **extra):
+        ans = self.report(**extra)
+        # A single write in append mode so that concurrent conversions can
+        # share the same report file
+        with open(path, 'ab') as f:
+            f.write(json.dumps(ans).encode('utf-8') + b'\n')
+        return ans
+
+
+def format_stages(stages):
+    lines = [f'{"Stage":30} {"Wall (s)":>9} {"CPU (s)":>9} {"Peak RSS +MB":>13}']
+    for s in stages:
+        name = s['name'] + (f' ({s["plugin"]})' if s.get('plugin') else '')
+        lines.append(f'{name[:30]:30} {s["wall"]:9.3f} {s["cpu"] + s["children_cpu"]:9.3f} {s["peak_rss_delta"] / 1024**2:13.1f}')
+    return '\n'.join(lines)
+
+
+def read_reports(paths):
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def aggregate(reports):
+    '''
+    Summarize many reports, returning a mapping of (stage name, plugin) to the
+    count, mean, median, 95th percentile and maximum of the wall time, CPU
+    time and peak memory increase of the stage.
+    '''
+    samples = defaultdict(lambda: defaultdict(list))
+    for r in reports:
+        for s in r['stages']:
+            d = samples[(s['name'], s.get('plugin'))]
+            d['wall'].append(s['wall'])
+            d['cpu'].append(s['cpu'] + s['children_cpu'])
+            d['peak_rss_delta'].append(s['peak_rss_delta'])
+    ans = {}
+    for key, d in samples.items():
+        ans[key] = {'count': len(d['wall'])}
+        for k, values in d.items():
+            ans[key][k] = {
+                'mean': sum(values) / len(values), 'median': percentile(values, 0.5),
+                'p95': percentile(values, 0.95), 'max': max(values),
+            }
+    return ans
+
+
+def main(args=sys.argv):
+    paths = args[1:]
+    if not paths:
+        raise SystemExit(f'Usage: {args[0]} report.jsonl ...')
+    agg = aggregate(read_reports(paths))
+    print(f'{"Stage":40} {"Count":>6} {"Mean (s)":>9} {"Median":>9} {"p95":>9} {"Max":>9} {"Mean RSS +MB":>13}')
+    for (name, plugin), s in sorted(agg.items(), key=lambda x: -x[1]['wall']['mean'] * x[1]['count']):
+        if plugin:
+            name += f' ({plugin})'
+        w = s['wall']
+        print(f'{name[:40]:40} {s["count"]:6} {w["mean"]:9.3f} {w["median"]:9.3f} {w["p95"]:9.3f} {w["max"]:9.3f}'
+              f' {s["peak_rss_delta"]["mean"] / 1024**2:13.1f}')
+
+
+def find_tests():
+    import tempfile
+    import unittest
+
+    from calibre.utils.mem import get_memory
+
+    class TestStageProfiler(unittest.TestCase):
+
+        def test_stage_profiler(self):
+            p = StageProfiler()
+            p('one', 'Plugin')
+            sum(range(100000))
+            p('two')
+            # Allocate enough to go 64MB past the earlier peak, which may be
+            # well above the current memory use after other tests
+            size = max(0, peak_rss() - get_memory()) + 64 * 1024 * 1024
+            x = b'x' * size
+            p()
+            del x
+            self.assertEqual([s.name for s in p.stages], ['one', 'two'])
+            self.assertEqual(p.stages[0].plugin, 'Plugin')
+            self.assertGreater(p.stages[0].wall, 0)
+            self.assertGreaterEqual(p.stages[1].peak_rss_delta, 48 * 1024 * 1024)
+            with tempfile.TemporaryDirectory() as tdir:
+                path = os.path.join(tdir, 'report.jsonl')
+                for i in range(3):
+                    p = StageProfiler()
+                    p('one', 'Plugin')
+                    p('two')
+                    p.write(path, output_format='epub')
+                reports = list(read_reports([path]))
+                self.assertEqual(len(reports), 3)
+                self.assertEqual(reports[0]['output_format'], 'epub')
+                agg = aggregate(reports)
+                self.assertEqual(set(agg), {('one', 'Plugin'), ('two', None)})
+                self.assertEqual(agg['two', None]['count'], 3)
+                self.assertIn('two', format_stages(reports[0]['stages']))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestStageProfiler)
@@ -177,46 +177,48 @@ def fetchEXTHFields(self):
                 if rindex > 0 and rindex != 0xffffffff:
                     self.thumbnail_record = self.record(rindex + image_base)
 
-    def patch(self, off, new_record0):
-        # Save the current size of each record
-        record_sizes = [len(new_record0)]
-        for i in range(1, self.nrecs-1):
-            record_sizes.append(self.pdbrecords[i+1][0]-self.pdbrecords[i][0])
-        # And the last one
-        record_sizes.append(self.data.stop - self.pdbrecords[self.nrecs-1][0])
-
-        # pdbrecord[0] is the offset of record0.  It will not change
-        # record1 offset will be offset of record0 + len(new_record0)
-        updated_pdbrecords = [self.pdbrecords[0][0]]
-        record0_offset = self.pdbrecords[0][0]
-        updated_offset = record0_offset + len(new_record0)
-
-        for i in range(1, self.nrecs-1):
-            updated_pdbrecords.append(updated_offset)
-            updated_offset += record_sizes[i]
-        # Update the last pdbrecord
-        updated_pdbrecords.append(updated_offset)
-
-        # Read in current records 1 to last
-        data_blocks = [new_record0]
-        for i in range(1, self.nrecs):
-            data_blocks.append(self.data[self.pdbrecords[i][0]:self.pdbrecords[i][0] + record_sizes[i]])
-
-        # Rewrite the stream
-        self.record0.update(data_blocks)
-
-        # Rewrite the pdbrecords
-        self.update_pdbrecords(updated_pdbrecords)
-
-        # Truncate if necessary
-        if (updated_pdbrecords[-1] + record_sizes[-1]) < self.data.stop:
-            self.data.truncate(updated_pdbrecords[-1] + record_sizes[-1])
-        else:
-            self.data.stop = updated_pdbrecords[-1] + record_sizes[-1]
+    def move_tail(self, start, delta, chunk_size=1024*1024):
+        # Move everything from start to the end of the stream by delta bytes,
+        # a chunk at a time, so that large books are never read into memory
+        stream, stop = self.stream, self.data.stop
+        if delta > 0:
+            pos = stop
+            while pos > start:
+                size = min(chunk_size, pos - start)
+                pos -= size
+                stream.seek(pos)
+                chunk = stream.read(size)
+                stream.seek(pos + delta)
+                stream.write(chunk)
+        elif delta < 0:
+            pos = start
+            while pos < stop:
+                stream.seek(pos)
+                chunk = stream.read(min(chunk_size, stop - pos))
+                stream.seek(pos + delta)
+                stream.write(chunk)
+                pos += len(chunk)
+            self.data.truncate(stop + delta)
+        self.data.stop = stop + delta
+        self.data._len = self.data.stop - self.data.start
+
+    def replace_record(self, n, data):
+        '''
+        Replace the contents of record n with data. If the size of the record
+        changes, the records after it are moved and their offsets in the PDB
+        header updated. The bytes of all other records are left untouched.
+        '''
+        start = self.pdbrecords[n][0]
+        stop = self.pdbrecords[n+1][0] if n < self.nrecs - 1 else self.data.stop
+        delta = len(data) - (stop - start)
+        if delta:
+            self.move_tail(stop, delta)
+            self.update_pdbrecords([offset + delta if i > n else offset for i, (offset, flags, val) in enumerate(self.pdbrecords)])
+        self.stream.seek(start)
+        self.stream.write(data)
 
     def patchSection(self, section, new):
-        off = self.pdbrecords[section][0]
-        self.patch(off, new)
+        self.replace_record(section, new)
 
     def create_exth(self, new_title=None, exth=None):
         # Add an EXTH block to record 0, rewrite the stream
@@ -268,7 +270,11 @@ def create_exth(self, new_title=None, exth=None):
         trail = len(new_record0.getvalue()) % 4
         pad = b'\0' * (4 - trail)  # Always pad w/ at least 1 byte
         new_record0.write(pad)
-        new_record0.write(b'\0'*(1024*8))
+        # If the new record fits in the space used by the old one, re-use it,
+        # so that no other records need to be moved. Otherwise leave room for
+        # future updates.
+        extra = len(self.record0) - len(new_record0.getvalue())
+        new_record0.write(b'\0' * (extra if extra >= 0 else 1024*8))
 
         # Rebuild the stream, update the pdbrecords pointers
         self.patchSection(0, new_record0.getvalue())
@@ -455,19 +461,24 @@ def update_exth_record(rec):
                 pass
             else:
                 if is_image(self.cover_record):
-                    size = len(self.cover_record)
-                    cover = rescale_image(data, size)
-                    if len(cover) <= size:
-                        cover += b'\0' * (size - len(cover))
-                        self.cover_record[:] = cover
+                    self.replace_image_record(self.cover_rindex, rescale_image(data, len(self.cover_record)))
                 if is_image(self.thumbnail_record):
-                    size = len(self.thumbnail_record)
-                    thumbnail = rescale_image(data, size, dimen=MAX_THUMB_DIMEN)
-                    if len(thumbnail) <= size:
-                        thumbnail += b'\0' * (size - len(thumbnail))
-                        self.thumbnail_record[:] = thumbnail
+                    self.replace_image_record(self.thumbnail_rindex, rescale_image(data, len(self.thumbnail_record), dimen=MAX_THUMB_DIMEN))
                 return
 
+    def replace_image_record(self, rindex, data):
+        # Images that fit in the existing record are padded to its size, so
+        # that no other records need to be moved. Only images that could not
+        # be shrunk enough grow their record.
+        image_base, = unpack('>I', self.record0[108:112])
+        record = self.record(rindex + image_base)
+        if len(data) <= len(record):
+            record[:] = data + b'\0' * (len(record) - len(data))
+        else:
+            self.replace_record(rindex + image_base, data)
+        # Record offsets may have changed
+        self.fetchEXTHFields()
+
 
 def set_metadata(stream, mi):
     mu = MetadataUpdater(stream)
@@ -533,3 +544,79 @@ def get_metadata(stream):
         except Exception:
             log.exception('Failed to read MOBI cover')
     return mi
+
+
+def find_tests():
+    import unittest
+
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.mobi.reader.headers import MetadataHeader
+    from calibre.utils.logging import Log
+
+    def create_book(title=b'A title'):
+        exth = pack('>II', 100, 14) + b'Author' + pack('>II', 201, 12) + pack('>I', 0)
+        exth = b'EXTH' + pack('>II', len(exth) + 12, 2) + exth
+        title_offset = 16 + 0xe8 + len(exth)
+        header = bytearray(16 + 0xe8)
+        header[:16] = pack('>HHIHHHH', 1, 0, 8, 1, 4096, 0, 0)
+        header[16:0x20] = b'MOBI' + pack('>III', 0xe8, 2, 65001)
+        header[0x54:0x60] = pack('>III', title_offset, len(title), 9)
+        header[108:112] = pack('>I', 2)
+        header[128:132] = pack('>I', 0x40)
+        records = [bytes(header) + exth + title + b'\0\0', b'Some text', b'\xff\xd8\xff\xe0cover' + b'\0' * 100, b'GIF89aimage', b'\xe9\x8e\r\n']
+        offset = 78 + 8 * len(records) + 2
+        ans = bytearray(b'A title'.ljust(32, b'\0') + b'\0' * 28 + b'BOOKMOBI' + b'\0' * 8 + pack('>H', len(records)))
+        for i, r in enumerate(records):
+            ans += pack('>II', offset, 2 * i)
+            offset += len(r)
+        ans += b'\0\0'
+        for r in records:
+            ans += r
+        return io.BytesIO(bytes(ans))
+
+    def records(stream):
+        mu = MetadataUpdater(stream)
+        return [(offset, mu.record(i)[:]) for i, (offset, flags, val) in enumerate(mu.pdbrecords)]
+
+    class TestMOBIMetadata(unittest.TestCase):
+
+        def test_in_place_update(self):
+            stream = create_book()
+            before = records(stream)
+            size = len(stream.getvalue())
+            # The first update leaves space in record 0 for later updates
+            mi = Metadata('A new title', ['Someone Else'])
+            set_metadata(stream, mi)
+            after = records(stream)
+            delta = len(after[0][1]) - len(before[0][1])
+            self.assertGreater(delta, 0)
+            self.assertEqual(len(stream.getvalue()), size + delta)
+            for (ob, b), (oa, a) in zip(before[1:], after[1:]):
+                self.assertEqual((ob + delta, b), (oa, a))
+            mh = MetadataHeader(stream, Log())
+            self.assertEqual(mh.title, 'A new title')
+            self.assertEqual(mh.exth.mi.authors, ['Someone Else'])
+            self.assertEqual(mh.exth.cover_offset, 0)
+            # Later updates re-use it, so no other record is touched
+            before, size = after, len(stream.getvalue())
+            mi.title, mi.comments = 'Another title', 'Some comments'
+            set_metadata(stream, mi)
+            after = records(stream)
+            self.assertEqual(len(stream.getvalue()), size)
+            self.assertEqual(before[1:], after[1:])
+            self.assertEqual(MetadataHeader(stream, Log()).title, 'Another title')
+
+        def test_replace_record(self):
+            stream = create_book()
+            before = records(stream)
+            for data in (b'\xff\xd8\xff\xe0bigger cover' * 100, b'\xff\xd8\xff\xe0small'):
+                MetadataUpdater(stream).replace_record(2, data)
+                after = records(stream)
+                delta = len(data) - len(before[2][1])
+                self.assertEqual(after[2][1], data)
+                self.assertEqual(before[:2], after[:2])
+                self.assertEqual([(o + delta, r) for o, r in before[3:]], after[3:])
+                self.assertEqual(len(stream.getvalue()), after[-1][0] + len(after[-1][1]))
+            self.assertEqual(MetadataHeader(stream, Log()).title, 'A title')
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestMOBIMetadata)
@@ -27,6 +27,7 @@
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.sources.base import Option, Source, fixauthors, fixcase
+from calibre.utils.browser import ConnectionPool
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.localization import canonicalize_lang
 from calibre.utils.random_ua import accept_header_for_ua
@@ -422,7 +423,11 @@ def get_details(self):
 
         from css_selectors import Select
         self.selector = Select(root)
-        self.parse_details(raw, root)
+        try:
+            self.parse_details(raw, root)
+        except CaptchaError:
+            self.browser.discard_cached_response(self.url)
+            raise
 
     def parse_details(self, raw, root):
         asin = parse_asin(root, self.log, self.url)
@@ -1111,6 +1116,8 @@ class Amazon(Source):
     has_html_comments = True
     supports_gzip_transfer_encoding = True
     prefer_results_with_isbn = False
+    # Amazon blocks clients that make too many requests
+    max_concurrent_requests = 1
 
     AMAZON_DOMAINS = {
         'com': _('US'),
@@ -1210,6 +1217,7 @@ def browser(self):
                 ua = random_user_agent(allow_ie=False)
             # ua = 'Mozilla/5.0 (Linux; Android 8.0.0; VTR-L29; rv:63.0) Gecko/20100101 Firefox/63.0'
             self._browser = br = browser(user_agent=ua)
+            br.set_connection_pool(ConnectionPool())
             br.set_handle_gzip(True)
             if self.use_search_engine:
                 br.addheaders += [
@@ -1222,7 +1230,7 @@ def browser(self):
                     ('Upgrade-insecure-requests', '1'),
                     ('Referer', self.referrer_for_domain()),
                 ]
-        return br
+        return self.setup_http_cache(br)
 
     def save_settings(self, *args, **kwargs):
         Source.save_settings(self, *args, **kwargs)
@@ -1555,7 +1563,11 @@ def search_amazon(self, br, testing, log, abort, title, authors, identifiers, ti
                 log.exception(msg)
                 raise SearchFailed()
 
-        matches = self.parse_results_page(root, domain)
+        try:
+            matches = self.parse_results_page(root, domain)
+        except CaptchaError:
+            br.discard_cached_response(query)
+            raise
 
         return matches, query, domain, None
     # }}}
@@ -8,14 +8,31 @@
 
 import re
 import threading
+import time
+from contextlib import contextmanager
 from functools import total_ordering
 
 from calibre import browser, random_user_agent
 from calibre.customize import Plugin
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.author_mapper import cap_author_token
+from calibre.utils.browser import ConnectionPool
 from calibre.utils.localization import canonicalize_lang, get_lang
 from polyglot.builtins import cmp, iteritems
+from polyglot.queue import Queue
+
+
+class ResultQueue(Queue):
+
+    ' A queue that sets notify whenever something is put into it '
+
+    def __init__(self, notify):
+        Queue.__init__(self)
+        self.notify = notify
+
+    def put(self, *args, **kwargs):
+        Queue.put(self, *args, **kwargs)
+        self.notify.set()
 
 
 def create_log(ostream=None):
@@ -216,6 +233,11 @@ class Source(Plugin):
     #: with this source, set to False
     cached_cover_url_is_reliable = True
 
+    #: Set this to False to not cache the responses downloaded by this
+    #: plugin on disk. How long responses are cached for is controlled by
+    #: the http_cache_days preference.
+    use_http_cache = True
+
     #: A list of :class:`Option` objects. They will be used to automatically
     #: construct the configuration widget for this plugin
     options = ()
@@ -235,9 +257,20 @@ class Source(Plugin):
     #: ISBNs will be ignored
     prefer_results_with_isbn = True
 
+    #: The maximum number of calls to identify() or download_cover() of this
+    #: plugin that run at the same time, when downloading metadata for many
+    #: books at once
+    max_concurrent_requests = 2
+
+    #: The minimum time, in seconds, between the starts of calls to
+    #: identify() or download_cover() of this plugin
+    min_request_interval = 0
+
     def __init__(self, *args, **kwargs):
         Plugin.__init__(self, *args, **kwargs)
         self.running_a_test = False  # Set to True when using identify_test()
+        self.request_semaphore = threading.BoundedSemaphore(max(1, self.max_concurrent_requests))
+        self.next_request_at = 0
         self._isbn_to_identifier_cache = {}
         self._identifier_to_cover_url_cache = {}
         self.cache_lock = threading.RLock()
@@ -289,9 +322,44 @@ def user_agent(self):
     def browser(self):
         if self._browser is None:
             self._browser = browser(user_agent=self.user_agent, verify_ssl_certificates=not self.ignore_ssl_errors)
+            self._browser.set_connection_pool(ConnectionPool())
             if self.supports_gzip_transfer_encoding:
                 self._browser.set_handle_gzip(True)
-        return self._browser.clone_browser()
+        return self.setup_http_cache(self._browser.clone_browser())
+
+    def setup_http_cache(self, br):
+        '''
+        Make br use the disk cache for GET requests made with
+        br.open_novisit(). Caching is turned off when running tests.
+        '''
+        from calibre.ebooks.metadata.sources.http_cache import http_cache
+        from calibre.ebooks.metadata.sources.prefs import msprefs
+        days = 0 if self.running_a_test or not self.use_http_cache else msprefs['http_cache_days']
+        br.set_http_cache(http_cache() if days > 0 else None, days * 24 * 3600)
+        return br
+
+    @contextmanager
+    def request_slot(self, abort):
+        '''
+        Wait until this plugin is allowed to start another call to identify()
+        or download_cover(), as per max_concurrent_requests and
+        min_request_interval. Returns early if abort is set, callers must
+        check it.
+        '''
+        while not self.request_semaphore.acquire(timeout=0.1):
+            if abort.is_set():
+                yield
+                return
+        try:
+            with self.cache_lock:
+                now = time.monotonic()
+                start_at = max(now, self.next_request_at)
+                self.next_request_at = start_at + self.min_request_interval
+            if start_at > now:
+                abort.wait(start_at - now)
+            yield
+        finally:
+            self.request_semaphore.release()
 
     # }}}
 
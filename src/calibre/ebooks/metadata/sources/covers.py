@@ -11,7 +11,7 @@
 from threading import Event, Thread
 
 from calibre.customize.ui import metadata_plugins
-from calibre.ebooks.metadata.sources.base import create_log
+from calibre.ebooks.metadata.sources.base import ResultQueue, create_log
 from calibre.ebooks.metadata.sources.prefs import msprefs
 from calibre.utils.img import image_from_data, image_to_data, remove_borders_from_image, save_cover_data_to
 from calibre.utils.imghdr import identify
@@ -20,9 +20,11 @@
 
 class Worker(Thread):
 
-    def __init__(self, plugin, abort, title, authors, identifiers, timeout, rq, get_best_cover=False):
+    def __init__(self, plugin, abort, title, authors, identifiers, timeout, rq, get_best_cover=False, notify=None):
         Thread.__init__(self)
         self.daemon = True
+        self.notify = notify
+        self.started = self.done = False
 
         self.plugin = plugin
         self.abort = abort
@@ -35,6 +37,18 @@ def __init__(self, plugin, abort, title, authors, identifiers, timeout, rq, get_
         self.time_spent = None
 
     def run(self):
+        try:
+            with self.plugin.request_slot(self.abort):
+                self.started = True
+                if self.notify is not None:
+                    self.notify.set()
+                self.download()
+        finally:
+            self.done = True
+            if self.notify is not None:
+                self.notify.set()
+
+    def download(self):
         start_time = time.time()
         if not self.abort.is_set():
             try:
@@ -80,9 +94,10 @@ def process_result(log, result):
 
 
 def run_download(log, results, abort,
-        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False, plugins=None):
     '''
     Run the cover download, putting results into the queue :param:`results`.
+    The enabled cover plugins are used, unless a list of plugins is passed in.
 
     Each result is a tuple of the form:
 
@@ -94,36 +109,49 @@ def run_download(log, results, abort,
     if authors == [_('Unknown')]:
         authors = None
 
-    plugins = [p for p in metadata_plugins(['cover']) if p.is_configured()]
+    if plugins is None:
+        plugins = metadata_plugins(['cover'])
+    plugins = [p for p in plugins if p.is_configured()]
 
-    rq = Queue()
-    workers = [Worker(p, abort, title, authors, identifiers, timeout, rq, get_best_cover=get_best_cover) for p
+    notify = Event()
+    rq = ResultQueue(notify)
+    workers = [Worker(p, abort, title, authors, identifiers, timeout, rq, get_best_cover=get_best_cover, notify=notify) for p
             in plugins]
     for w in workers:
         w.start()
 
-    first_result_at = None
+    # The timeouts are counted from when every worker has been allowed to make
+    # its request, as workers wait their turn for sources that limit the
+    # number of requests at once
+    first_result_at = all_started_at = None
     wait_time = msprefs['wait_after_first_cover_result']
     found_results = {}
 
     start_time = time.time()  # Use a global timeout to workaround misbehaving plugins that hang
     while time.time() - start_time < 301:
-        time.sleep(0.1)
-        try:
-            x = rq.get_nowait()
+        # Woken up whenever a worker finds a cover, starts or finishes
+        notify.wait(1)
+        notify.clear()
+        while True:
+            try:
+                x = rq.get_nowait()
+            except Empty:
+                break
             result = process_result(log, x)
             if result is not None:
                 results.put(result)
                 found_results[result[0]] = result
-                if first_result_at is not None:
+                if first_result_at is None:
                     first_result_at = time.time()
-        except Empty:
-            pass
 
-        if not is_worker_alive(workers):
+        if all(w.done for w in workers):
             break
 
-        if first_result_at is not None and time.time() - first_result_at > wait_time:
+        if all_started_at is None and all(w.started or w.done for w in workers):
+            all_started_at = start_time = time.time()
+
+        if (first_result_at is not None and all_started_at is not None and
+                time.time() - max(first_result_at, all_started_at) > wait_time):
             log('Not waiting for any more results')
             abort.set()
 
@@ -159,7 +187,7 @@ def run_download(log, results, abort,
 
 
 def download_cover(log,
-        title=None, authors=None, identifiers={}, timeout=30):
+        title=None, authors=None, identifiers={}, timeout=30, plugins=None):
     '''
     Synchronous cover download. Returns the "best" cover as per user
     prefs/cover resolution.
@@ -172,7 +200,7 @@ def download_cover(log,
     abort = Event()
 
     run_download(log, rq, abort, title=title, authors=authors,
-            identifiers=identifiers, timeout=timeout, get_best_cover=True)
+            identifiers=identifiers, timeout=timeout, get_best_cover=True, plugins=plugins)
 
     results = []
 
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+The persistent cache of HTTP responses downloaded by metadata source plugins,
+so that downloading metadata again for the same books does not fetch every
+page again. Browsers returned by :attr:`Source.browser` use it.
+'''
+
+import os
+
+from calibre.constants import cache_dir
+from calibre.utils.http_cache import HTTPCache
+
+
+def http_cache():
+    ans = getattr(http_cache, 'ans', None)
+    if ans is None:
+        ans = http_cache.ans = HTTPCache(os.path.join(cache_dir(), 'metadata-sources-http'))
+    return ans
@@ -11,12 +11,12 @@
 from datetime import datetime
 from io import StringIO
 from operator import attrgetter
-from threading import Thread
+from threading import Event, Thread
 
 from calibre.customize.ui import all_metadata_plugins, metadata_plugins
 from calibre.ebooks.metadata import authors_to_sort_string, check_issn
 from calibre.ebooks.metadata.book.base import Metadata
-from calibre.ebooks.metadata.sources.base import create_log
+from calibre.ebooks.metadata.sources.base import ResultQueue, create_log
 from calibre.ebooks.metadata.sources.prefs import msprefs
 from calibre.ebooks.metadata.xisbn import xisbn
 from calibre.utils.date import UNDEFINED_DATE, as_utc, utc_tz
@@ -24,7 +24,7 @@
 from calibre.utils.html2text import html2text
 from calibre.utils.icu import lower, primary_sort_key
 from polyglot.builtins import as_unicode, iteritems, itervalues
-from polyglot.queue import Empty, Queue
+from polyglot.queue import Empty
 from polyglot.urllib import quote, urlparse
 
 # Download worker {{{
@@ -32,22 +32,33 @@
 
 class Worker(Thread):
 
-    def __init__(self, plugin, kwargs, abort):
+    def __init__(self, plugin, kwargs, abort, notify=None):
         Thread.__init__(self)
         self.daemon = True
 
-        self.plugin, self.kwargs, self.rq = plugin, kwargs, Queue()
+        self.notify = notify or Event()
+        self.plugin, self.kwargs, self.rq = plugin, kwargs, ResultQueue(self.notify)
         self.abort = abort
         self.buf = StringIO()
         self.log = create_log(self.buf)
+        self.time_spent = None
+        self.started = self.done = False
 
     def run(self):
-        start = time.time()
         try:
-            self.plugin.identify(self.log, self.rq, self.abort, **self.kwargs)
-        except Exception:
-            self.log.exception('Plugin', self.plugin.name, 'failed')
-        self.plugin.dl_time_spent = time.time() - start
+            with self.plugin.request_slot(self.abort):
+                self.started = True
+                self.notify.set()
+                if not self.abort.is_set():
+                    start = time.time()
+                    try:
+                        self.plugin.identify(self.log, self.rq, self.abort, **self.kwargs)
+                    except Exception:
+                        self.log.exception('Plugin', self.plugin.name, 'failed')
+                    self.time_spent = time.time() - start
+        finally:
+            self.done = True
+            self.notify.set()
 
     @property
     def name(self):
@@ -368,14 +379,21 @@ def merge_identify_results(result_map, log):
 
 
 def identify(log, abort,  # {{{
-        title=None, authors=None, identifiers={}, timeout=30, allowed_plugins=None):
+        title=None, authors=None, identifiers={}, timeout=30, allowed_plugins=None, plugins=None):
+    '''
+    Find metadata for the specified book with the enabled metadata source
+    plugins, or only those in allowed_plugins. Alternately, the plugins to use
+    can be passed in as plugins. Returns a list of results, best first.
+    '''
     if title == _('Unknown'):
         title = None
     if authors == [_('Unknown')]:
         authors = None
     start_time = time.time()
 
-    plugins = [p for p in metadata_plugins(['identify'])
+    if plugins is None:
+        plugins = metadata_plugins(['identify'])
+    plugins = [p for p in plugins
         if p.is_configured() and (allowed_plugins is None or p.name in allowed_plugins)]
 
     kwargs = {
@@ -390,7 +408,8 @@ def identify(log, abort,  # {{{
     log('Using plugins:', ', '.join(['%s %s' % (p.name, p.version) for p in plugins]))
     log('The log from individual plugins is below')
 
-    workers = [Worker(p, kwargs, abort) for p in plugins]
+    notify = Event()
+    workers = [Worker(p, kwargs, abort, notify) for p in plugins]
     for w in workers:
         w.start()
 
@@ -399,6 +418,7 @@ def identify(log, abort,  # {{{
     for p in plugins:
         results[p] = []
     logs = {w.plugin: w.buf for w in workers}
+    workers_map = {w.plugin: w for w in workers}
 
     def get_results():
         found = False
@@ -412,17 +432,39 @@ def get_results():
                 found = True
         return found
 
+    # The time to wait for more results is counted from the first result, but
+    # not before every worker has been allowed to make its request, as workers
+    # wait their turn for sources that limit the number of requests at once.
+    # A plugin call that hangs never gives up its turn, so the wait for turns
+    # is limited to the timeout of a request.
     wait_time = msprefs['wait_after_first_identify_result']
+    all_started_at = None
+
+    def stop_waiting_at():
+        if first_result_at is None:
+            return None
+        ans = first_result_at + wait_time + timeout
+        if all_started_at is not None:
+            ans = min(ans, max(first_result_at, all_started_at) + wait_time)
+        return ans
+
     while True:
-        time.sleep(0.2)
+        # Woken up whenever a worker finds a result, starts or finishes
+        stop_at = stop_waiting_at()
+        notify.wait(1 if stop_at is None else max(0, stop_at - time.time()))
+        notify.clear()
 
         if get_results() and first_result_at is None:
             first_result_at = time.time()
 
-        if not is_worker_alive(workers):
+        if all(w.done for w in workers):
             break
 
-        if (first_result_at is not None and time.time() - first_result_at > wait_time):
+        if all_started_at is None and all(w.started or w.done for w in workers):
+            all_started_at = time.time()
+
+        stop_at = stop_waiting_at()
+        if stop_at is not None and time.time() > stop_at:
             log.warn('Not waiting any longer for more results. Still running'
                     ' sources:')
             for worker in workers:
@@ -457,7 +499,7 @@ def get_results():
         plog = logs[plugin].getvalue().strip()
         log('\n'+'*'*30, plugin.name, '%s' % (plugin.version,), '*'*30)
         log('Found %d results'%len(presults))
-        time_spent = getattr(plugin, 'dl_time_spent', None)
+        time_spent = workers_map[plugin].time_spent
         if time_spent is None:
             log('Downloading was aborted')
             longest, lp = -1, plugin.name
@@ -24,6 +24,9 @@
 msprefs.defaults['series_map_rules'] = ()
 msprefs.defaults['id_link_rules'] = {}
 msprefs.defaults['keep_dups'] = False
+# Number of days for which downloaded pages and covers are cached on disk, 0
+# to turn off caching
+msprefs.defaults['http_cache_days'] = 7
 
 # Google covers are often poor quality (scans/errors) but they have high
 # resolution, so they trump covers from better sources. So make sure they
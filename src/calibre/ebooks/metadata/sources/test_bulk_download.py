@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Tests and a benchmark of the bulk metadata download scheduler, see
+:class:`calibre.ebooks.metadata.sources.worker.BulkDownload`, using local fake
+metadata sources.
+'''
+
+import os
+import time
+import unittest
+from threading import Event
+from unittest.mock import patch
+
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.opf2 import OPF, metadata_to_opf
+from calibre.ebooks.metadata.sources.base import Source
+from calibre.ebooks.metadata.sources.prefs import msprefs
+from calibre.ebooks.metadata.sources.worker import BulkDownload
+from calibre.utils.http_test_server import LocalHTTPServer
+
+
+class FakeSourceServer(LocalHTTPServer):
+
+    ' A local HTTP server standing in for a metadata source, answering after latency seconds '
+
+    def __init__(self, latency=0.05):
+        super().__init__(latency)
+
+    def respond(self, handler):
+        self.send(handler, handler.path.rpartition('/')[-1].encode('utf-8'))
+
+
+def fake_source(base_url, max_concurrent_requests=2, keep_alive=True):
+    ' A metadata source plugin that gets an identifier for every book from base_url '
+
+    class FakeSource(Source):
+        name = 'Fake source'
+        capabilities = frozenset(('identify',))
+        touched_fields = frozenset(('identifier:fake',))
+        prefer_results_with_isbn = False
+
+        @property
+        def browser(self):
+            from calibre import browser
+            from calibre.utils.browser import ConnectionPool
+            if self._browser is None:
+                self._browser = browser(user_agent='calibre-test')
+                if keep_alive:
+                    self._browser.set_connection_pool(ConnectionPool())
+            return self._browser.clone_browser()
+
+        def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+            from urllib.parse import quote
+            br = self.browser
+            for step in ('search', 'details'):
+                ans = br.open_novisit(f'{base_url}/{step}/{quote(title)}', timeout=timeout).read().decode('utf-8')
+            mi = Metadata(title, authors)
+            mi.set_identifier('fake', ans)
+            result_queue.put(mi)
+
+    FakeSource.max_concurrent_requests = max_concurrent_requests
+    return FakeSource(None)
+
+
+def instant_source():
+    ' A metadata source plugin that immediately finds every book, without an identifier '
+
+    class InstantSource(Source):
+        name = 'Instant source'
+        capabilities = frozenset(('identify',))
+        touched_fields = frozenset(('title', 'authors'))
+        prefer_results_with_isbn = False
+
+        def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+            result_queue.put(Metadata(title, authors))
+
+    return InstantSource(None)
+
+
+def hanging_source(release):
+    ' A metadata source plugin that allows one request at a time and hangs until release is set '
+
+    class HangingSource(Source):
+        name = 'Hanging source'
+        capabilities = frozenset(('identify',))
+        touched_fields = frozenset(('title', 'authors'))
+        max_concurrent_requests = 1
+
+        def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+            release.wait()
+
+    return HangingSource(None)
+
+
+def run_bulk_download(base_url, num_books, num_books_at_once, max_concurrent_requests=2, keep_alive=True, other_plugins=()):
+    import tempfile
+
+    from calibre.ptempfile import TemporaryDirectory
+    plugin = fake_source(base_url, max_concurrent_requests, keep_alive)
+    metadata = {i: metadata_to_opf(Metadata(f'Book{i}', ['Author']), default_lang='und') for i in range(num_books)}
+    with TemporaryDirectory(dir=tempfile.gettempdir()) as tdir:
+        ans = BulkDownload(True, False, None, tdir, num_books_at_once=num_books_at_once, identify_plugins=[plugin, *other_plugins])(metadata)
+        identifiers = {}
+        for i in metadata:
+            with open(os.path.join(tdir, '%d.mi'%i), 'rb') as f:
+                identifiers[i] = OPF(f, basedir=tdir, populate_spine=False).to_book_metadata().identifiers.get('fake')
+    return ans, identifiers
+
+
+def benchmark(num_books=100, latency=0.1):
+    '''
+    Compare processing books one at a time, opening a new connection for every
+    request, with the bulk download scheduler, against a local fake source.
+    Run with: calibre-debug -c "from calibre.ebooks.metadata.sources.test_bulk_download import benchmark; benchmark()"
+    '''
+    for label, num_books_at_once, keep_alive in (('One book at a time', 1, False), ('Scheduler', 8, True)):
+        with FakeSourceServer(latency) as server:
+            st = time.monotonic()
+            run_bulk_download(server.base_url, num_books, num_books_at_once, keep_alive=keep_alive)
+            t = time.monotonic() - st
+        print(f'{label}: {t:.2f} seconds, {num_books/t:.1f} books/second, {len(server.requests)} requests, {server.connections} connections')
+
+
+def short_wait_prefs():
+    prefs = {k: msprefs[k] for k in msprefs.defaults}
+    prefs['wait_after_first_identify_result'] = 0.2
+    return patch('calibre.ebooks.metadata.sources.identify.msprefs', prefs)
+
+
+class TestBulkDownload(unittest.TestCase):
+
+    def test_bulk_download(self):
+        with FakeSourceServer(0.02) as server:
+            (failed_ids, failed_covers, all_failed), identifiers = run_bulk_download(server.base_url, 24, 8, max_concurrent_requests=3)
+        self.assertFalse(failed_ids)
+        self.assertFalse(all_failed)
+        self.assertEqual(identifiers, {i: f'Book{i}' for i in range(24)})
+        self.assertEqual(len(server.requests), 48)
+        # Requests are limited by the source, not by the number of books processed at once
+        self.assertGreater(server.max_in_flight, 1)
+        self.assertLessEqual(server.max_in_flight, 3)
+        # Connections are reused
+        self.assertLessEqual(server.connections, 12)
+
+    def test_waiting_for_request_slots(self):
+        # Books waiting for their turn with a source that allows a single
+        # request at a time do not time out because another source found
+        # a result quickly
+        with FakeSourceServer(0.05) as server, short_wait_prefs():
+            (failed_ids, failed_covers, all_failed), identifiers = run_bulk_download(
+                server.base_url, 8, 8, max_concurrent_requests=1, other_plugins=(instant_source(),))
+        self.assertEqual(server.max_in_flight, 1)
+        self.assertEqual(identifiers, {i: f'Book{i}' for i in range(8)})
+
+    def test_hanging_source(self):
+        # A source that hangs while holding its only request slot does not
+        # stop later books from being identified by other sources
+        from calibre.ebooks.metadata.sources.identify import identify
+        from calibre.utils.logging import DevNull
+        release = Event()
+        plugins = [hanging_source(release), instant_source()]
+        try:
+            with short_wait_prefs():
+                for i in range(2):
+                    st = time.monotonic()
+                    results = identify(DevNull(), Event(), title=f'Book{i}', authors=['Author'], timeout=1, plugins=plugins)
+                    self.assertEqual([mi.title for mi in results], [f'Book{i}'])
+                    self.assertLess(time.monotonic() - st, 5)
+        finally:
+            release.set()
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBulkDownload)
@@ -5,7 +5,7 @@
 from collections import Counter
 from functools import wraps
 from io import BytesIO
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 
 from calibre.customize.ui import metadata_plugins
 from calibre.ebooks.metadata.book.base import Metadata
@@ -16,7 +16,6 @@
 from calibre.ebooks.metadata.sources.update import patch_plugins
 from calibre.utils.date import as_utc
 from calibre.utils.logging import GUILog
-from polyglot.builtins import iteritems
 from polyglot.queue import Empty, Queue
 
 
@@ -61,55 +60,102 @@ def wrapper(*a, **k):
     return wrapper
 
 
-@shutdown_webengine_workers
-def main(do_identify, covers, metadata, ensure_fields, tdir):
-    failed_ids = set()
-    failed_covers = set()
-    all_failed = True
-    log = GUILog()
-    patch_plugins()
+class BulkDownload:
+
+    '''
+    Download metadata and covers for many books. Up to num_books_at_once books
+    are processed at the same time, while each source limits the number of
+    requests made to it, see :meth:`Source.request_slot`. The results for every
+    book are written to tdir as soon as they are available, with the log for
+    the book written last.
+    '''
+
+    def __init__(self, do_identify, covers, ensure_fields, tdir, num_books_at_once=8, identify_plugins=None, cover_plugins=None):
+        self.do_identify, self.covers, self.ensure_fields, self.tdir = do_identify, covers, ensure_fields, tdir
+        self.num_books_at_once = num_books_at_once
+        self.identify_plugins, self.cover_plugins = identify_plugins, cover_plugins
+        self.lock = Lock()
+        self.failed_ids, self.failed_covers = set(), set()
+        self.all_failed = True
+
+    def __call__(self, metadata):
+        '''
+        Process the books in metadata, a mapping of book ids to OPF data. Returns
+        the ids of books for which metadata and covers could not be found and
+        whether nothing at all was found.
+        '''
+        items = iter(tuple(metadata.items()))
+        workers = [Thread(target=self.run, args=(items,), name=f'BulkDownload{i}', daemon=True)
+                   for i in range(max(1, min(self.num_books_at_once, len(metadata))))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return self.failed_ids, self.failed_covers, self.all_failed
+
+    def run(self, items):
+        while True:
+            with self.lock:
+                item = next(items, None)
+            if item is None:
+                break
+            self.process_book(*item)
+
+    def process_book(self, book_id, opf):
+        log = GUILog()
+        try:
+            self.download(log, book_id, opf)
+        except Exception:
+            log.exception('Failed to download metadata')
+            with self.lock:
+                self.failed_ids.add(book_id)
+        with open(os.path.join(self.tdir, '%d.log'%book_id), 'wb') as f:
+            f.write(log.plain_text.encode('utf-8'))
 
-    for book_id, mi in iteritems(metadata):
-        mi = OPF(BytesIO(mi), basedir=tdir,
+    def download(self, log, book_id, opf):
+        mi = OPF(BytesIO(opf), basedir=self.tdir,
                 populate_spine=False).to_book_metadata()
         title, authors, identifiers = mi.title, mi.authors, mi.identifiers
-        cdata = None
-        log.clear()
 
-        if do_identify:
+        if self.do_identify:
             results = []
             try:
                 results = identify(log, Event(), title=title, authors=authors,
-                    identifiers=identifiers)
+                    identifiers=identifiers, plugins=self.identify_plugins)
             except Exception:
                 pass
             if results:
-                all_failed = False
-                mi = merge_result(mi, results[0], ensure_fields=ensure_fields)
+                with self.lock:
+                    self.all_failed = False
+                mi = merge_result(mi, results[0], ensure_fields=self.ensure_fields)
                 identifiers = mi.identifiers
                 if not mi.is_null('rating'):
                     # set_metadata expects a rating out of 10
                     mi.rating *= 2
-                with open(os.path.join(tdir, '%d.mi'%book_id), 'wb') as f:
+                with open(os.path.join(self.tdir, '%d.mi'%book_id), 'wb') as f:
                     f.write(metadata_to_opf(mi, default_lang='und'))
             else:
                 log.error('Failed to download metadata for', title)
-                failed_ids.add(book_id)
+                with self.lock:
+                    self.failed_ids.add(book_id)
 
-        if covers:
+        if self.covers:
             cdata = download_cover(log, title=title, authors=authors,
-                    identifiers=identifiers)
+                    identifiers=identifiers, plugins=self.cover_plugins)
             if cdata is None:
-                failed_covers.add(book_id)
+                with self.lock:
+                    self.failed_covers.add(book_id)
             else:
-                with open(os.path.join(tdir, '%d.cover'%book_id), 'wb') as f:
+                with open(os.path.join(self.tdir, '%d.cover'%book_id), 'wb') as f:
                     f.write(cdata[-1])
-                all_failed = False
+                with self.lock:
+                    self.all_failed = False
 
-        with open(os.path.join(tdir, '%d.log'%book_id), 'wb') as f:
-            f.write(log.plain_text.encode('utf-8'))
 
-    return failed_ids, failed_covers, all_failed
+@shutdown_webengine_workers
+def main(do_identify, covers, metadata, ensure_fields, tdir):
+    patch_plugins()
+    return BulkDownload(do_identify, covers, ensure_fields, tdir)(metadata)
 
 
 @shutdown_webengine_workers
@@ -586,6 +586,26 @@ def create_text_record(text):
     return data, overlap
 
 
+def split_text_records(text, compress=False):
+    '''
+    Split text, a byte string, into Palmdoc records of size RECORD_SIZE,
+    compressing them with Palmdoc compression, in parallel, if compress is
+    True. Returns the list of records, with the overlap and its length
+    appended to each record, and the list of uncompressed record lengths.
+    '''
+    from calibre.ebooks.compression.palmdoc import compress_doc_records
+    stream = BytesIO(text)
+    parts = []
+    while stream.tell() < len(text):
+        parts.append(create_text_record(stream))
+    data = [d for d, overlap in parts]
+    lengths = list(map(len, data))
+    if compress:
+        data = compress_doc_records(data)
+    records = [d + overlap + struct.pack(b'>B', len(overlap)) for d, (_, overlap) in zip(data, parts)]
+    return records, lengths
+
+
 class CNCX:  # {{{
 
     '''
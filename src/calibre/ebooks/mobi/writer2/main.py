@@ -11,9 +11,8 @@
 from struct import pack
 
 from calibre.ebooks import normalize
-from calibre.ebooks.compression.palmdoc import compress_doc
 from calibre.ebooks.mobi.langcodes import iana2mobi
-from calibre.ebooks.mobi.utils import RECORD_SIZE, align_block, create_text_record, detect_periodical, encint, encode_trailing_data
+from calibre.ebooks.mobi.utils import RECORD_SIZE, align_block, detect_periodical, encint, encode_trailing_data, split_text_records
 from calibre.ebooks.mobi.writer2 import PALMDOC, UNCOMPRESSED
 from calibre.ebooks.mobi.writer2.indexer import Indexer
 from calibre.ebooks.mobi.writer2.serializer import Serializer
@@ -160,24 +159,14 @@ def generate_text(self):  # {{{
                 write_page_breaks_after_item=self.write_page_breaks_after_item)
         text = self.serializer()
         self.text_length = len(text)
-        text = io.BytesIO(text)
-        nrecords = 0
-        records_size = 0
 
         if self.compression != UNCOMPRESSED:
             self.oeb.logger.info('  Compressing markup content...')
 
-        while text.tell() < self.text_length:
-            data, overlap = create_text_record(text)
-            if self.compression == PALMDOC:
-                data = compress_doc(data)
-
-            data += overlap
-            data += pack(b'>B', len(overlap))
-
-            self.records.append(data)
-            records_size += len(data)
-            nrecords += 1
+        records = split_text_records(text, compress=self.compression == PALMDOC)[0]
+        self.records.extend(records)
+        nrecords = len(records)
+        records_size = sum(map(len, records))
 
         self.last_text_record_idx = nrecords
         self.first_non_text_record_idx = nrecords + 1
@@ -9,7 +9,6 @@
 import logging
 from collections import defaultdict, namedtuple
 from functools import partial
-from io import BytesIO
 from struct import pack
 
 import css_parser
@@ -17,8 +16,7 @@
 from lxml import etree
 
 from calibre import force_unicode, isbytestring
-from calibre.ebooks.compression.palmdoc import compress_doc
-from calibre.ebooks.mobi.utils import create_text_record, is_guide_ref_start, to_base
+from calibre.ebooks.mobi.utils import is_guide_ref_start, split_text_records, to_base
 from calibre.ebooks.mobi.writer8.index import ChunkIndex, GuideIndex, NCXIndex, NonLinearNCXIndex, SkelIndex
 from calibre.ebooks.mobi.writer8.mobi import KF8Book
 from calibre.ebooks.mobi.writer8.skeleton import Chunker, aid_able_tags, to_href
@@ -334,26 +332,14 @@ def create_text_records(self):
                 in self.flows]
         text = b''.join(self.flows)
         self.text_length = len(text)
-        text = BytesIO(text)
-        nrecords = 0
-        records_size = 0
-        self.uncompressed_record_lengths = []
 
         if self.compress:
             self.oeb.logger.info('\tCompressing markup...')
 
-        while text.tell() < self.text_length:
-            data, overlap = create_text_record(text)
-            self.uncompressed_record_lengths.append(len(data))
-            if self.compress:
-                data = compress_doc(data)
-
-            data += overlap
-            data += pack(b'>B', len(overlap))
-
-            self.records.append(data)
-            records_size += len(data)
-            nrecords += 1
+        records, self.uncompressed_record_lengths = split_text_records(text, compress=self.compress)
+        self.records.extend(records)
+        nrecords = len(records)
+        records_size = sum(map(len, records))
 
         self.last_text_record_idx = nrecords
         self.first_non_text_record_idx = nrecords + 1
@@ -26,7 +26,7 @@ def html_css_stylesheet(container):
     global _html_css_stylesheet
     if _html_css_stylesheet is None:
         data = P('templates/html.css', data=True).decode('utf-8')
-        _html_css_stylesheet = container.parse_css(data, 'user-agent.css')
+        _html_css_stylesheet = container.parse_css(data, 'user-agent.css', read_only=True)
     return _html_css_stylesheet
 
 
@@ -189,7 +189,7 @@ def process_sheet(sheet, sheet_name):
         if elem.tag.lower().endswith('style'):
             if not elem.text:
                 continue
-            sheet = container.parse_css(elem.text)
+            sheet = container.parse_css(elem.text, read_only=True)
             sheet_name = name
         else:
             if (elem.get('type') or 'text/css').lower() not in OEB_STYLES or \
@@ -210,7 +210,7 @@ def process_sheet(sheet, sheet_name):
     for elem in root.xpath('//*[@style]'):
         text = elem.get('style')
         if text:
-            style = container.parse_css(text, is_declaration=True)
+            style = container.parse_css(text, is_declaration=True, read_only=True)
             style_map[elem].append(StyleDeclaration(Specificity(1, 0, 0, 0, 0), normalize_style_declaration(style, name), None))
 
     for l in (style_map, pseudo_style_map):
@@ -109,7 +109,7 @@ def check_fonts(container):
         elif mt in OEB_DOCS:
             for style in container.parsed(name).xpath('//*[local-name()="style"]'):
                 if style.get('type', 'text/css') == 'text/css' and style.text:
-                    sheets.append((name, container.parse_css(style.text), style.sourceline))
+                    sheets.append((name, container.parse_css(style.text, read_only=True), style.sourceline))
 
     for name, sheet, line_offset in sheets:
         for rule in sheet.cssRules.rulesOfType(CSSRule.FONT_FACE_RULE):
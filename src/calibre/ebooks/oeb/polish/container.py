@@ -9,12 +9,14 @@
 import re
 import shutil
 import sys
+import time
 import unicodedata
 import uuid
-from collections import defaultdict
+from collections import Counter, defaultdict
 from io import BytesIO
 from itertools import count
 from math import floor
+from threading import Lock
 from urllib.parse import urlparse
 
 from css_parser import getUrls, replaceUrls
@@ -189,9 +191,9 @@ def parse_xhtml(self, data, fname='<string>', force_html5_parse=False):
             except NotHTML:
                 return self.parse_xml(data)
 
-    def parse_css(self, data, fname='<string>', is_declaration=False):
+    def parse_css(self, data, fname='<string>', is_declaration=False, read_only=False):
         return parse_css(data, fname=fname, is_declaration=is_declaration, decode=self.decode, log_level=logging.WARNING,
-                         css_preprocessor=(None if self.tweak_mode else self.css_preprocessor))
+                         css_preprocessor=(None if self.tweak_mode else self.css_preprocessor), read_only=read_only)
 # }}}
 
 
@@ -253,19 +255,17 @@ def __init__(self, rootpath=None, opfpath=None, log=default_log, clone_data=None
         # to absolute paths on filesystem with os-specific separators
         opfpath = os.path.abspath(os.path.realpath(opfpath))
         all_opf_files = []
-        for dirpath, _dirnames, filenames in os.walk(self.root):
-            for f in filenames:
-                path = join(dirpath, f)
-                name = self.abspath_to_name(path)
-                self.name_path_map[name] = path
-                self.mime_map[name] = guess_type(path)
-                # Special case if we have stumbled onto the opf
-                if path == opfpath:
-                    self.opf_name = name
-                    self.opf_dir = os.path.dirname(path)
-                    self.mime_map[name] = guess_type('a.opf')
-                if path.lower().endswith('.opf'):
-                    all_opf_files.append((name, os.path.dirname(path)))
+        for path in self.paths_in_root():
+            name = self.abspath_to_name(path)
+            self.name_path_map[name] = path
+            self.mime_map[name] = guess_type(path)
+            # Special case if we have stumbled onto the opf
+            if path == opfpath:
+                self.opf_name = name
+                self.opf_dir = os.path.dirname(path)
+                self.mime_map[name] = guess_type('a.opf')
+            if path.lower().endswith('.opf'):
+                all_opf_files.append((name, os.path.dirname(path)))
 
         if not hasattr(self, 'opf_name') and all_opf_files:
             self.opf_name, self.opf_dir = all_opf_files[0]
@@ -277,6 +277,12 @@ def __init__(self, rootpath=None, opfpath=None, log=default_log, clone_data=None
         # Update mime map with data from the OPF
         self.refresh_mime_map()
 
+    def paths_in_root(self):
+        ' The absolute paths of all files in this book, used only when the container is created '
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for f in filenames:
+                yield join(dirpath, f)
+
     def refresh_mime_map(self):
         for item in self.opf_xpath('//opf:manifest/opf:item[@href and @media-type]'):
             href = item.get('href')
@@ -522,6 +528,12 @@ def exists(self, name):
         is different from the case of the underlying filesystem file. See also :meth:`has_name`'''
         return os.path.exists(self.name_to_abspath(name))
 
+    def ensure_files_on_disk(self):
+        ''' Make sure that the files for all names in this container are
+        present in its root folder. Needed only by code that lists the files in
+        the root folder directly, instead of using the methods of this class. '''
+        pass
+
     def href_to_name(self, href, base=None):
         '''
         Convert an href (relative to base) to a name. base must be a name or
@@ -1165,9 +1177,13 @@ def __init__(self, pathtoepub=None, log=default_log, clone_data=None, tdir=None)
             super().__init__(log=log, clone_data=clone_data)
             for x in ('pathtoepub', 'obfuscated_fonts', 'is_dir'):
                 setattr(self, x, clone_data[x])
+            self.extracted_members = clone_data.get('extracted_members', {})
             return
 
         self.pathtoepub = pathtoepub
+        # Map of names to the state of files extracted from the EPUB, used to
+        # copy unchanged files without re-compression when committing
+        self.extracted_members = {}
         if tdir is None:
             tdir = PersistentTemporaryDirectory('_epub_container')
         tdir = os.path.abspath(os.path.realpath(tdir))
@@ -1184,16 +1200,7 @@ def __init__(self, pathtoepub=None, log=default_log, clone_data=None, tdir=None)
                 if fname is not None:
                     shutil.copy(os.path.join(dirpath, fname), os.path.join(base, fname))
         else:
-            with open(self.pathtoepub, 'rb') as stream:
-                try:
-                    zf = ZipFile(stream)
-                    zf.extractall(tdir)
-                except Exception:
-                    if log is not None:
-                        log.exception('EPUB appears to be invalid ZIP file, trying a more forgiving ZIP parser')
-                    from calibre.utils.localunzip import extractall
-                    stream.seek(0)
-                    extractall(stream, path=tdir)
+            self.extract_epub(tdir, log)
         try:
             os.remove(join(tdir, 'mimetype'))
         except OSError:
@@ -1232,16 +1239,71 @@ def __init__(self, pathtoepub=None, log=default_log, clone_data=None, tdir=None)
             self.process_encryption()
         self.parsed_cache['META-INF/container.xml'] = container
 
+    def extract_epub(self, tdir, log):
+        with open(self.pathtoepub, 'rb') as stream:
+            try:
+                zf = ZipFile(stream)
+                zf.extractall(tdir)
+                infolist = zf.infolist()
+                counts = Counter(zi.filename.lower() for zi in infolist)
+                for zi in infolist:
+                    if not zi.filename.endswith('/') and counts[zi.filename.lower()] == 1:
+                        self.note_extracted(zi, os.path.join(tdir, *zi.filename.split('/')))
+            except Exception:
+                self.extracted_members = {}
+                if log is not None:
+                    log.exception('EPUB appears to be invalid ZIP file, trying a more forgiving ZIP parser')
+                from calibre.utils.localunzip import extractall
+                stream.seek(0)
+                extractall(stream, path=tdir)
+
+    def note_extracted(self, zi, path):
+        ''' Remember the state of the file at path, extracted from the member
+        zi of the EPUB, so that it can be copied as is when committing, if it
+        has not been changed. '''
+        if zi.flag_bits & 0x1:
+            return  # encrypted
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if st.st_size == zi.file_size:
+            self.extracted_members[zi.filename] = zi.CRC, zi.file_size, st.st_mtime_ns
+
+    def unchanged_members(self, source):
+        ''' Return a mapping of names to ZipInfo objects in the ZipFile source
+        for all files that are the same as when they were extracted. '''
+        ans = {}
+        if not self.extracted_members:
+            return ans
+        for zi in source.infolist():
+            state = self.extracted_members.get(zi.filename)
+            path = self.name_path_map.get(zi.filename)
+            if state is None or path is None or state[:2] != (zi.CRC, zi.file_size) or zi.flag_bits & 0x1:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) == state[1:]:
+                ans[zi.filename] = zi
+        return ans
+
     def data_for_clone(self, dest_dir=None):
         ans = super().data_for_clone(dest_dir)
         ans['pathtoepub'] = self.pathtoepub
         ans['obfuscated_fonts'] = self.obfuscated_fonts.copy()
         ans['is_dir'] = self.is_dir
+        ans['extracted_members'] = self.extracted_members.copy()
         return ans
 
     def rename(self, old_name, new_name):
         is_opf = old_name == self.opf_name
         super().rename(old_name, new_name)
+        # Renaming keeps the size and mtime of the file, which must not be
+        # mistaken for an unchanged copy of the member with the new name
+        self.extracted_members.pop(old_name, None)
+        self.extracted_members.pop(new_name, None)
         if is_opf:
             for elem in self.parsed('META-INF/container.xml').xpath((
                 r'child::ocf:rootfiles/ocf:rootfile'
@@ -1276,6 +1338,7 @@ def names_that_must_not_be_changed(self):
         return super().names_that_must_not_be_changed | {'META-INF/' + x for x in self.META_INF}
 
     def remove_item(self, name, remove_from_guide=True):
+        self.extracted_members.pop(name, None)
         # Handle removal of obfuscated fonts
         if name == 'META-INF/encryption.xml':
             self.obfuscated_fonts.clear()
@@ -1428,7 +1491,24 @@ def commit_epub(self, outpath: str) -> None:
                 if not isinstance(et, bytes):
                     et = et.encode('ascii')
                 f.write(et)
-            zip_rebuilder(self.root, outpath)
+            try:
+                source = ZipFile(self.pathtoepub) if self.extracted_members else None
+            except Exception:
+                source = None
+            if source is None:
+                return zip_rebuilder(self.root, outpath)
+            # Copy unchanged files from the original EPUB without re-compressing them
+            from calibre.utils.filenames import atomic_rename
+            outpath = os.path.abspath(outpath)
+            with source, PersistentTemporaryFile(suffix='.epub', dir=os.path.dirname(outpath)) as f:
+                temp = f.name
+                try:
+                    zip_rebuilder(self.root, f, source, self.unchanged_members(source))
+                except BaseException:
+                    f.close()
+                    os.remove(temp)
+                    raise
+            atomic_rename(temp, outpath)
 
     @property
     def path_to_ebook(self):
@@ -1461,6 +1541,202 @@ def commit_epub(self, outpath: str) -> None:
             container.commit(outpath)
 
 
+class LazyEpubContainer(EpubContainer):
+
+    '''
+    An EPUB container that extracts files from the EPUB only when they are
+    first used. When committing, files that were never used are copied into
+    the new EPUB as is, without being decompressed and re-compressed. This
+    makes operations that touch only a few files in a book, such as updating
+    its metadata, much faster for large books. If the EPUB is not a ZIP file
+    that can be safely read lazily, all files are extracted up front, as for
+    :class:`EpubContainer`.
+    '''
+
+    def __init__(self, pathtoepub=None, log=default_log, clone_data=None, tdir=None):
+        # Map of names to ZipInfo objects for files not yet extracted
+        self.pending = {}
+        self.source_order = ()
+        self.source_zip = None
+        self.source_lock = Lock()
+        super().__init__(pathtoepub, log=log, clone_data=clone_data, tdir=tdir)
+
+    def __del__(self):
+        self.close_source_zip()
+
+    @staticmethod
+    def lazy_members(infolist):
+        ''' Return a mapping of names to ZipInfo objects for all files in the
+        EPUB, or None if it contains files that cannot be read lazily. '''
+        ans, seen = {}, set()
+        for zi in infolist:
+            fname = zi.filename
+            if fname.endswith('/') or fname == 'mimetype':
+                continue
+            if zi.flag_bits & 0x1:
+                return None  # encrypted
+            parts = fname.split('/')
+            if (
+                '\\' in fname or os.path.splitdrive(fname)[0] or any(x in ('', '.', '..') for x in parts)
+                or unicodedata.normalize('NFC', fname) != fname
+            ):
+                return None  # would be renamed on extraction
+            if iswindows:
+                from calibre import sanitize_file_name
+                if any(sanitize_file_name(x) != x for x in parts):
+                    return None
+            key = fname.lower()
+            if key in seen:
+                return None  # duplicates or names differing only in case
+            seen.add(key)
+            ans[fname] = zi
+        return ans
+
+    def open_source_zip(self):
+        if self.source_zip is None:
+            self.source_zip = ZipFile(self.pathtoepub)
+        return self.source_zip
+
+    def close_source_zip(self):
+        zf, self.source_zip = getattr(self, 'source_zip', None), None
+        if zf is not None:
+            zf.close()
+
+    def extract_epub(self, tdir, log):
+        try:
+            members = self.lazy_members(self.open_source_zip().infolist())
+        except Exception:
+            members = None
+        if members is None:
+            self.close_source_zip()
+            return super().extract_epub(tdir, log)
+        self.pending = members
+        self.source_order = tuple(members)
+        # The container and OPF files are always needed
+        for name in self.source_order:
+            if name.startswith('META-INF/') or name.lower().endswith('.opf'):
+                self.extract_pending(name)
+
+    def extract_pending(self, name):
+        with self.source_lock:
+            zi = self.pending.pop(name, None)
+            if zi is None:
+                return
+            path = self.name_to_abspath(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as dest:
+                dest.write(self.open_source_zip().read(zi))
+            # Use the timestamp from the EPUB, as is done for fully extracted
+            # files, so that later changes are always detected
+            try:
+                mtime = time.mktime(zi.date_time + (0, 0, -1))
+                os.utime(path, (mtime, mtime))
+            except Exception:
+                pass
+            self.note_extracted(zi, path)
+
+    def extract_all_pending(self):
+        for name in tuple(self.pending):
+            self.extract_pending(name)
+
+    def ensure_files_on_disk(self):
+        self.extract_all_pending()
+
+    def paths_in_root(self):
+        yield from super().paths_in_root()
+        for name in self.pending:
+            yield self.name_to_abspath(name)
+
+    def parsed(self, name):
+        if name in self.pending and name not in self.parsed_cache:
+            self.extract_pending(name)
+        return super().parsed(name)
+
+    def get_file_path_for_processing(self, name, allow_modification=True):
+        self.extract_pending(name)
+        return super().get_file_path_for_processing(name, allow_modification)
+
+    def commit_item(self, name, keep_parsed=False):
+        if name in self.parsed_cache and name in self.pending:
+            # Parsed object was set with replace() so the original is not needed
+            self.pending.pop(name)
+            os.makedirs(os.path.dirname(self.name_path_map[name]), exist_ok=True)
+        return super().commit_item(name, keep_parsed=keep_parsed)
+
+    def exists(self, name):
+        return name in self.pending or super().exists(name)
+
+    def filesize(self, name):
+        zi = self.pending.get(name)
+        # Files replaced with replace() are still pending, but the size of
+        # the original is no longer the size of the file
+        return super().filesize(name) if zi is None or name in self.dirtied else zi.file_size
+
+    def has_name_and_is_not_empty(self, name):
+        zi = self.pending.get(name)
+        return super().has_name_and_is_not_empty(name) if zi is None else zi.file_size > 0
+
+    def rename(self, old_name, new_name):
+        self.extract_pending(old_name)
+        return super().rename(old_name, new_name)
+
+    def remove_item(self, name, remove_from_guide=True):
+        self.pending.pop(name, None)
+        return super().remove_item(name, remove_from_guide=remove_from_guide)
+
+    def clone_data(self, dest_dir):
+        self.extract_all_pending()
+        return super().clone_data(dest_dir)
+
+    def __getstate__(self):
+        self.extract_all_pending()
+        return super().__getstate__()
+
+    def compare_to(self, other):
+        self.extract_all_pending()
+        if isinstance(other, LazyEpubContainer):
+            other.extract_all_pending()
+        return super().compare_to(other)
+
+    def commit_epub(self, outpath: str) -> None:
+        if not self.pending:
+            self.close_source_zip()
+            return super().commit_epub(outpath)
+        from calibre.ebooks.tweak import ZIP_EXCLUDED_FILES
+        from calibre.utils.filenames import atomic_rename
+        from calibre.utils.zipfile import ZIP_DEFLATED, ZIP_STORED
+        names = [name for name in self.source_order if name in self.name_path_map]
+        names += sorted(set(self.name_path_map) - set(names))
+        outpath = os.path.abspath(outpath)
+        src = self.open_source_zip()
+        unchanged = self.unchanged_members(src)
+        with PersistentTemporaryFile(suffix='.epub', dir=os.path.dirname(outpath)) as f:
+            temp = f.name
+            try:
+                with ZipFile(f, 'w', compression=ZIP_DEFLATED) as zf:
+                    zf.writestr('mimetype', guess_type('a.epub').encode('ascii'), compression=ZIP_STORED)
+                    for name in names:
+                        if name.rpartition('/')[-1] in ZIP_EXCLUDED_FILES:
+                            continue
+                        zi = self.pending.get(name) or unchanged.get(name)
+                        if zi is None:
+                            zf.write(self.name_path_map[name], name)
+                        else:
+                            zf.copy_raw(src, zi)
+            except BaseException:
+                f.close()
+                os.remove(temp)
+                raise
+        if os.path.abspath(self.pathtoepub) == outpath:
+            self.close_source_zip()
+            atomic_rename(temp, outpath)
+            # Re-read the locations of the not yet extracted files
+            infos = {zi.filename: zi for zi in self.open_source_zip().infolist()}
+            self.pending = {name: infos[name] for name in self.pending}
+        else:
+            atomic_rename(temp, outpath)
+
+
 # AZW3 {{{
 
 class InvalidMobi(InvalidBook):
@@ -1615,7 +1891,10 @@ def names_that_must_not_be_changed(self):
 # }}}
 
 
-def get_container(path, log=None, tdir=None, tweak_mode=False, ebook_cls=None) -> Container:
+def get_container(path, log=None, tdir=None, tweak_mode=False, ebook_cls=None, lazy=False) -> Container:
+    ''' Create a container for the book at path. If lazy is True and the book
+    is an EPUB file, files are extracted from it only when needed, see
+    :class:`LazyEpubContainer`. '''
     try:
         isdir = os.path.isdir(path)
     except Exception:
@@ -1629,6 +1908,8 @@ def get_container(path, log=None, tdir=None, tweak_mode=False, ebook_cls=None) -
                 ebook_cls = AZW3Container
             elif ext in {'kepub', 'original_kepub'}:
                 ebook_cls = KEPUBContainer
+            elif lazy:
+                ebook_cls = LazyEpubContainer
     if own_tdir:
         tdir = PersistentTemporaryDirectory(f'_{ebook_cls.book_type}_container')
     try:
@@ -2,7 +2,6 @@
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import os
 import re
 import shutil
 
@@ -142,9 +141,8 @@ def find_cover_image2(container, strict=False):
     largest_cover = (None, 0)
     for ref_type, name in guide_type_map.items():
         if ref_type.lower() in COVER_TYPES and is_raster_image(mm.get(name, None)):
-            path = container.name_path_map.get(name, None)
-            if path:
-                sz = os.path.getsize(path)
+            if name in container.name_path_map:
+                sz = container.filesize(name)
                 if sz > largest_cover[1]:
                     largest_cover = (name, sz)
 
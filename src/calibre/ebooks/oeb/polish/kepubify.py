@@ -542,7 +542,7 @@ def kepubify_container(container: Container, opts: Options, max_workers: int = 0
 
 
 def kepubify_path(path, outpath='', max_workers=0, allow_overwrite=False, opts: Options = Options()):
-    container = get_container(path, tweak_mode=True)
+    container = get_container(path, tweak_mode=True, lazy=True)
     kepubify_container(container, opts, max_workers=max_workers)
     base, ext = os.path.splitext(path)
     outpath = outpath or base + '.kepub'
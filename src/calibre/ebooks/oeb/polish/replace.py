@@ -288,6 +288,7 @@ def safe_listdir(x):
 
 
 def rationalize_folders(container, folder_type_map):
+    container.ensure_files_on_disk()
     all_names = set(container.mime_map)
     new_names = set()
     name_map = {}
@@ -7,12 +7,11 @@
 
 import os
 import sys
-from io import BytesIO
 
 from calibre import as_unicode, prints
 from calibre.ebooks.oeb.base import OEB_DOCS, OEB_STYLES, XPath, css_text
 from calibre.ebooks.oeb.polish.utils import OEB_FONTS
-from calibre.utils.fonts.subset import subset
+from calibre.utils.fonts.subset import cached_subset
 from calibre.utils.fonts.utils import get_font_names
 
 
@@ -62,14 +61,12 @@ def subset_all_fonts(container, font_stats, report):
             warnings = []
             report('Subsetting font: %s'%(font_name or name))
             font_type = os.path.splitext(name)[1][1:].lower()
-            output = BytesIO()
             try:
-                warnings = subset(BytesIO(raw), output, font_type, chars)
+                nraw, warnings = cached_subset(raw, font_type, chars)
             except Exception as e:
                 report(
                     f'Unsupported font: {name}, ignoring. Error: {as_unicode(e)}')
                 continue
-            nraw = output.getvalue()
             total_old += font_size
 
             for w in warnings:
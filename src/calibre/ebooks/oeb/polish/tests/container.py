@@ -6,11 +6,14 @@
 
 import os
 import pickle
+import shutil
 import subprocess
+from io import BytesIO
 from zipfile import ZipFile
 
 from calibre import CurrentDir
-from calibre.ebooks.oeb.polish.container import OCF_NS, clone_container
+from calibre.ebooks.oeb.base import OEB_DOCS, XHTML
+from calibre.ebooks.oeb.polish.container import OCF_NS, LazyEpubContainer, clone_container
 from calibre.ebooks.oeb.polish.container import get_container as _gc
 from calibre.ebooks.oeb.polish.replace import rationalize_folders, rename_files
 from calibre.ebooks.oeb.polish.split import merge, split
@@ -217,6 +220,17 @@ def test_actual_case(self):
                 self.assertEqual(name, corrected_case_for_name(c, n))
             self.assertIsNone(corrected_case_for_name(c, name+'/xx'))
 
+        # Files that have not yet been extracted from a lazily extracted book
+        book = os.path.join(self.tdir, 'lazy-case.epub')
+        shutil.copyfile(P('quick_start/eng.epub', allow_user_override=False), book)
+        c = get_container(book, lazy=True)
+        name = 'images/cover.jpg'
+        self.assertIn(name, c.pending)
+        if c.exists(name.upper()):
+            self.assertEqual(name, actual_case_for_name(c, name.upper()))
+        else:
+            self.assertEqual(name, corrected_case_for_name(c, name.upper()))
+
     def test_split_file(self):
         ' Test splitting of files '
         book = get_split_book()
@@ -276,6 +290,101 @@ def create_book(source):
                 self.assertTrue(os.path.exists('images/test-container.xyz'))
                 self.assertFalse(os.path.exists('images/cover.jpg'))
 
+    def test_lazy_container(self):
+        ' Test lazily extracted EPUB containers '
+        book = os.path.join(self.tdir, 'lazy.epub')
+        shutil.copyfile(P('quick_start/eng.epub', allow_user_override=False), book)
+        c = get_container(book, lazy=True)
+        self.assertIsInstance(c, LazyEpubContainer)
+        self.assertTrue(c.pending)
+        self.assertTrue(c.exists('images/cover.jpg'))
+        with ZipFile(book) as zf:
+            cover, cover_raw = zf.read('images/cover.jpg'), zf.getinfo('images/cover.jpg')
+            self.assertEqual(c.filesize('images/cover.jpg'), cover_raw.file_size)
+        # Replaced files that are not yet extracted have the size of their replacement
+        text = next(name for name in c.pending if c.mime_map[name] in OEB_DOCS)
+        root = get_container(book).parsed(text)
+        p = root.makeelement(XHTML('p'))
+        p.text = 'replaced ' * 100
+        root[-1].append(p)
+        c.replace(text, root)
+        self.assertEqual(c.filesize(text), len(c.raw_data(text, decode=False)))
+        c.opf_xpath('//dc:title')[0].text = 'Lazy title'
+        c.dirty(c.opf_name)
+        c.remove_item('images/cover.jpg')
+        c.add_file('images/added.png', b'xxx')
+        untouched = next(name for name in c.pending if name != 'images/cover.jpg')
+        for outpath in (os.path.join(self.tdir, 'lazy-out.epub'), book):
+            c.commit(outpath)
+            with ZipFile(outpath) as zf:
+                self.assertEqual(zf.namelist()[0], 'mimetype')
+                self.assertNotIn('images/cover.jpg', zf.namelist())
+                self.assertEqual(zf.read('images/added.png'), b'xxx')
+                self.assertIn(b'Lazy title', zf.read(c.opf_name))
+                self.assertIsNone(zf.testzip())
+            self.assertIn(untouched, c.pending)
+        # Files that are not yet extracted are read from the re-written book
+        c = get_container(book, lazy=True)
+        self.assertEqual(c.raw_data(untouched, decode=False), get_container(book).raw_data(untouched, decode=False))
+        with c.open('images/added.png', 'wb') as f:
+            f.write(cover)
+        c.commit()
+        with ZipFile(book) as zf:
+            self.assertEqual(zf.read('images/added.png'), cover)
+
+    def test_raw_copy_of_unchanged_files(self):
+        ' Test that unchanged files are copied into re-written EPUBs without re-compression '
+        from calibre.utils.zipfile import ZipFile, safe_replace
+        book = os.path.join(self.tdir, 'raw.epub')
+        shutil.copyfile(P('quick_start/eng.epub', allow_user_override=False), book)
+        with ZipFile(book) as zf:
+            raw = {zi.filename: zf.read_raw(zi) for zi in zf.infolist()}
+        for c in (get_container(book), get_container(book, lazy=True)):
+            if isinstance(c, LazyEpubContainer):
+                # Extracted but unchanged files are also copied as is
+                c.raw_data('images/cover.jpg', decode=False)
+            c.opf_xpath('//dc:title')[0].text = 'Raw title'
+            c.dirty(c.opf_name)
+            outpath = os.path.join(self.tdir, 'raw-out.epub')
+            c.commit(outpath)
+            with ZipFile(outpath) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertIn(b'Raw title', zf.read(c.opf_name))
+                for zi in zf.infolist():
+                    if zi.filename not in (c.opf_name, 'mimetype'):
+                        self.assertEqual(zf.read_raw(zi), raw[zi.filename], zi.filename)
+            # Changed files are re-compressed
+            with c.open('images/cover.jpg', 'wb') as f:
+                f.write(b'changed')
+            c.commit(outpath)
+            with ZipFile(outpath) as zf:
+                self.assertEqual(zf.read('images/cover.jpg'), b'changed')
+                self.assertIsNone(zf.testzip())
+
+        # A file renamed over a removed one with the same size and date is not
+        # mistaken for an unchanged copy of it
+        from calibre.utils.zipfile import ZipInfo
+        swap = os.path.join(self.tdir, 'swap.epub')
+        shutil.copyfile(book, swap)
+        with ZipFile(swap, 'a') as zf:
+            for name in 'ab':
+                zf.writestr(ZipInfo(f'{name}.txt', date_time=(2020, 1, 1, 0, 0, 0)), name.encode() * 64)
+        for c in (get_container(swap), get_container(swap, lazy=True)):
+            c.remove_item('b.txt')
+            c.rename('a.txt', 'b.txt')
+            outpath = os.path.join(self.tdir, 'swap-out.epub')
+            c.commit(outpath)
+            with ZipFile(outpath) as zf:
+                self.assertEqual(zf.read('b.txt'), b'a' * 64)
+                self.assertNotIn('a.txt', zf.namelist())
+
+        with open(book, 'r+b') as stream:
+            safe_replace(stream, 'images/cover.jpg', BytesIO(b'replaced'))
+        with ZipFile(book) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read('images/cover.jpg'), b'replaced')
+            self.assertEqual(zf.read_raw(c.opf_name), raw[c.opf_name])
+
     def test_folder_type_map_case(self):
         book = get_simple_book()
         c = get_container(book)
@@ -74,12 +74,12 @@ def create_epub(manifest, spine=(), guide=(), meta_cover=None, ver=3):
 
 class Structure(BaseTest):
 
-    def create_epub(self, *args, **kw):
+    def create_epub(self, *args, lazy=False, **kw):
         n = next(counter)
         ep = os.path.join(self.tdir, str(n) + 'book.epub')
         with open(ep, 'wb') as f:
             f.write(create_epub(*args, **kw).getvalue())
-        c = get_container(ep, tdir=os.path.join(self.tdir, f'container{n}'), tweak_mode=True)
+        c = get_container(ep, tdir=os.path.join(self.tdir, f'container{n}'), tweak_mode=True, lazy=lazy)
         return c
 
     def test_toc_detection(self):
@@ -182,6 +182,11 @@ def test_epub2_covers(self):
         mark_as_cover(c, 'd.jpg')
         self.assertEqual('d.jpg', find_cover_image(c))
         self.assertEqual({'cover':'d.jpg'}, c.guide_type_map)
+        # The largest of the other guide cover items, in a lazily extracted book
+        c = ce([cmi('c.jpg', b'zz'), cmi('d.jpg')], guide=[('c.jpg', 'other.ms-coverimage-standard', ''), ('d.jpg', 'other.ms-coverimage', '')],
+               lazy=True)
+        self.assertIn('c.jpg', c.pending)
+        self.assertEqual('c.jpg', find_cover_image(c))
 
         # title page
         c = ce([cmi('c.html'), cmi('a.html')])
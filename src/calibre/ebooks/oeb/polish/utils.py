@@ -7,6 +7,7 @@
 import os
 import re
 from bisect import bisect
+from functools import partial
 
 from calibre import guess_type as _guess_type
 from calibre import replace_entities
@@ -84,6 +85,7 @@ def setup_css_parser_serialization(tab_width=2):
 
 def actual_case_for_name(container, name):
     from calibre.utils.filenames import samefile
+    container.ensure_files_on_disk()
     if not container.exists(name):
         raise ValueError(f'Cannot get actual case for {name} as it does not exist')
     parts = name.split('/')
@@ -108,6 +110,7 @@ def actual_case_for_name(container, name):
 
 
 def corrected_case_for_name(container, name):
+    container.ensure_files_on_disk()
     parts = name.split('/')
     ans = []
     base = ''
@@ -217,7 +220,9 @@ def get_text(x, attr='text'):
     return ' '.join(words[:num_words])
 
 
-def parse_css(data, fname='<string>', is_declaration=False, decode=None, log_level=None, css_preprocessor=None):
+def parse_css(data, fname='<string>', is_declaration=False, decode=None, log_level=None, css_preprocessor=None, read_only=False):
+    ''' Parse the specified CSS. If read_only is True, the result may be shared
+    with other callers via the stylesheet cache and so must not be modified. '''
     if log_level is None:
         import logging
         log_level = logging.WARNING
@@ -235,10 +240,13 @@ def parse_css(data, fname='<string>', is_declaration=False, decode=None, log_lev
                         # We don't care about @import rules
                         fetcher=lambda x: (None, None), log=_css_logger)
     if is_declaration:
-        data = parser.parseStyle(data, validate=False)
+        parse = partial(parser.parseStyle, validate=False)
     else:
-        data = parser.parseString(data, href=fname, validate=False)
-    return data
+        parse = partial(parser.parseString, href=fname, validate=False)
+    if read_only:
+        from calibre.ebooks.oeb.stylesheet_cache import stylesheet_cache
+        return stylesheet_cache(data, parse, 'polish', fname, is_declaration)
+    return parse(data)
 
 
 def handle_entities(text, func):
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A process wide cache of parsed stylesheets, keyed by a hash of the CSS source
+and the options used to parse it. The same stylesheet text is typically
+parsed many times, once for every Stylizer created for an HTML file, once per
+file for inline <style> tags shared by all files in a book and so on. Parsed
+sheets are shared between all users of the cache, so they must never be
+modified.
+'''
+
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from weakref import WeakSet
+
+# The maximum total size, in characters, of the CSS source of the cached
+# stylesheets. Parsed stylesheets use considerably more memory than their
+# source, so keep this small.
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024
+
+
+class StylesheetCache:
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.shared = WeakSet()
+
+    def key(self, text, key_parts):
+        h = hashlib.sha1(text.encode('utf-8', 'surrogatepass'))
+        return h.digest(), key_parts
+
+    def __call__(self, text, parse, *key_parts):
+        '''
+        Return the parsed stylesheet for text, calling parse(text) only if it
+        is not already cached. key_parts must include everything other than
+        text that affects the result of parse().
+        '''
+        size = len(text)
+        if size > self.max_size:
+            return parse(text)
+        key = self.key(text, key_parts)
+        with self.lock:
+            ans = self.items.get(key)
+            if ans is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return ans[0]
+            self.misses += 1
+        sheet = parse(text)
+        with self.lock:
+            if key not in self.items:
+                self.items[key] = sheet, size
+                self.size += size
+                try:
+                    self.shared.add(sheet)
+                except TypeError:
+                    pass
+                while self.size > self.max_size:
+                    self.size -= self.items.popitem(last=False)[1][1]
+        return sheet
+
+    def is_shared(self, sheet):
+        ' Return True iff sheet was returned by this cache and so must not be modified '
+        try:
+            return sheet in self.shared
+        except TypeError:
+            return False
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+
+stylesheet_cache = StylesheetCache()
+
+
+def find_tests():
+    import unittest
+
+    class TestStylesheetCache(unittest.TestCase):
+
+        def test_stylesheet_cache(self):
+            from css_parser import parseString
+            c = StylesheetCache(max_size=100)
+            calls = []
+
+            def parse(text):
+                calls.append(text)
+                return parseString(text, validate=False)
+
+            a = c('a { color: red }', parse)
+            self.assertIs(c('a { color: red }', parse), a)
+            self.assertIsNot(c('a { color: red }', parse, 'other.css'), a)
+            self.assertEqual(len(calls), 2)
+            self.assertTrue(c.is_shared(a))
+            self.assertFalse(c.is_shared(parse('b {}')))
+            self.assertEqual((c.hits, c.misses), (1, 2))
+            # Least recently used sheets are evicted once the size limit is reached
+            c('x' * 90, parse)
+            self.assertEqual(len(c), 1)
+            self.assertIsNot(c('a { color: red }', parse), a)
+            # Sheets larger than the limit are never cached
+            big = 'p { margin: 0 }' * 10
+            self.assertIsNot(c(big, parse), c(big, parse))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestStylesheetCache)
@@ -11,7 +11,7 @@
 import os
 import re
 import unicodedata
-from operator import itemgetter
+from functools import partial
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
 
@@ -20,12 +20,14 @@
 from css_parser import profile as cssprofiles
 from css_parser.css import CSSFontFaceRule, CSSPageRule, CSSStyleRule, cssproperties
 from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError
+from css_selectors.parser import Class, CombinedSelector, Element, Hash, Pseudo, ascii_lower, parse
 from tinycss.media3 import CSSMedia3Parser
 
 from calibre import as_unicode, force_unicode
 from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import CSS_MIME, OEB_STYLES, SVG, XHTML, XHTML_NS, urlnormalize, xpath
 from calibre.ebooks.oeb.normalize_css import DEFAULTS, normalizers
+from calibre.ebooks.oeb.stylesheet_cache import stylesheet_cache
 from calibre.utils.resources import get_path as P
 
 css_parser_log.setLevel(logging.WARN)
@@ -44,10 +46,14 @@ def html_css_stylesheet():
     if _html_css_stylesheet is None:
         with open(P('templates/html.css'), 'rb') as f:
             html_css = f.read().decode('utf-8')
-        _html_css_stylesheet = parseString(html_css, validate=False)
+        _html_css_stylesheet = stylesheet_cache(html_css, parse_stylesheet)
     return _html_css_stylesheet
 
 
+def parse_stylesheet(text):
+    return parseString(text, validate=False)
+
+
 INHERITED = {
     'azimuth', 'border-collapse', 'border-spacing', 'caption-side', 'color',
     'cursor', 'direction', 'elevation', 'empty-cells', 'font-family',
@@ -107,6 +113,34 @@ def test_media_ok():
     assert not media_ok('screen and (device-width:10px)')
 
 
+def test_rule_matcher():
+    from lxml import etree
+    root = etree.fromstring(
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body class="Main"><div id="Top"><p class="x">a<span>b</span></p></div><p/></body></html>')
+    for text in ('p', '*', 'div > p.x', '.X', '#top', '#missing', 'p.missing', '.zz:root', 'p:not(.x)', 'blah, span', '.missing *', 'a:hover'):
+        matcher = RuleMatcher(text)
+        expected = tuple(Select(root, ignore_inappropriate_pseudo_classes=True)(text))
+        select = Select(root, ignore_inappropriate_pseudo_classes=True)
+        actual = tuple(matcher(select)) if matcher.can_match(select) else ()
+        assert expected == actual, text
+    assert not RuleMatcher('#missing').can_match(Select(root))
+    assert RuleMatcher('.zz:root').can_match(Select(root))
+
+
+def find_tests():
+    import unittest
+
+    class TestStylizer(unittest.TestCase):
+
+        def test_media_ok(self):
+            test_media_ok()
+
+        def test_rule_matcher(self):
+            test_rule_matcher()
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestStylizer)
+
+
 class style_map(dict):
 
     def __init__(self):
@@ -135,29 +169,135 @@ def cleanup_epub_prefixed_properties(style: dict[str, str]) -> None:
                 style[key] = val
 
 
+def subject_key(parsed_selector):
+    ''' Return a key for a simple selector that the element matched by
+    parsed_selector (a css_selectors Selector) must itself match: ('id', name),
+    ('class', name) or ('tag', name), in order of preference. None means the
+    selector can match any element. '''
+    node = parsed_selector.parsed_tree
+    keys = {}
+    while node is not None:
+        if isinstance(node, CombinedSelector):
+            node = node.subselector
+        elif isinstance(node, Element):
+            if node.element and node.element != '*':
+                keys['tag'] = ascii_lower(node.element)
+            break
+        elif isinstance(node, Pseudo) and node.ident == 'root':
+            # :root matches the root regardless of the rest of the selector
+            return None
+        else:
+            if isinstance(node, Hash):
+                keys.setdefault('id', ascii_lower(node.id))
+            elif isinstance(node, Class):
+                keys.setdefault('class', ascii_lower(node.class_name))
+            node = node.selector  # Attrib, Function, Negation and Pseudo nodes
+    for k in ('id', 'class', 'tag'):
+        if k in keys:
+            return k, keys[k]
+
+
+class RuleMatcher:
+
+    ''' Matches a selector from a stylesheet against trees using the
+    css_selectors engine. The selector is parsed only once and the keys
+    required of the matched elements are indexed, so that selectors that
+    cannot match anything in a tree are skipped without being evaluated. '''
+
+    __slots__ = ('error', 'keys', 'parsed', 'pseudo_class')
+    pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
+
+    def __init__(self, text):
+        fl = self.pseudo_pat.search(text)
+        self.pseudo_class = None if fl is None else fl.group(1)
+        self.error = self.keys = None
+        try:
+            self.parsed = parse(text)
+        except SelectorError as err:
+            self.error, self.parsed = err, ()
+        else:
+            keys = tuple(map(subject_key, self.parsed))
+            if None not in keys:
+                self.keys = frozenset(keys)
+
+    def can_match(self, select):
+        if self.keys is None:
+            return True
+        for typ, name in self.keys:
+            m = select.id_map if typ == 'id' else (select.class_map if typ == 'class' else select.element_map)
+            if m.get(name):
+                return True
+        return False
+
+    def __call__(self, select):
+        if self.error is not None:
+            raise self.error
+        seen = set()
+        for parsed_selector in self.parsed:
+            for item in select.iterparsedselector(parsed_selector):
+                if item not in seen:
+                    yield item
+                    seen.add(item)
+
+
+FLATTENED_SHEETS = WeakKeyDictionary()
+
+
 class StylizerRules:
 
     def __init__(self, opts, profile, stylesheets):
         self.opts, self.profile, self.stylesheets = opts, profile, stylesheets
 
         index = 0
-        self.rules = []
+        rules = []
         self.page_rule = {}
         self.font_face_rules = []
         for sheet_index, stylesheet in enumerate(stylesheets):
-            href = stylesheet.href
-            for rule in stylesheet.cssRules:
-                if rule.type == rule.MEDIA_RULE:
-                    if media_ok(rule.media.mediaText):
-                        for subrule in rule.cssRules:
-                            self.rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
-                else:
-                    self.rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
-        self.rules.sort(key=itemgetter(0))  # sort by specificity
-
-    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
+            sheet_rules, page_rule, font_face_rules, count = self.flatten_sheet(stylesheet, sheet_index == 0)
+            for rule, matcher in sheet_rules:
+                specificity = rule[0]
+                rules.append(((specificity[:-1] + (specificity[-1] + index,),) + rule[1:], matcher))
+            self.page_rule.update(page_rule)
+            self.font_face_rules.extend(font_face_rules)
+            index += count
+        rules.sort(key=lambda x: x[0][0])  # sort by specificity
+        self.rules = [r for r, m in rules]
+        self.matchers = [m for r, m in rules]
+        self.has_first_letter = any(m.pseudo_class == 'first-letter' for m in self.matchers)
+
+    def flatten_sheet(self, stylesheet, is_user_agent_sheet=False):
+        # Sheets from the stylesheet cache are never modified, so their
+        # flattened rules can be re-used by all StylizerRules with the same
+        # settings
+        cache = None
+        if stylesheet_cache.is_shared(stylesheet):
+            key = (is_user_agent_sheet, self.opts.change_justification, self.profile.fbase, tuple(sorted(self.profile.fnames.items())))
+            cache = FLATTENED_SHEETS.get(stylesheet)
+            if cache is None:
+                cache = FLATTENED_SHEETS[stylesheet] = {}
+            ans = cache.get(key)
+            if ans is not None:
+                return ans
+        index = 0
+        rules, page_rule, font_face_rules = [], {}, []
+        href = stylesheet.href
+        for rule in stylesheet.cssRules:
+            if rule.type == rule.MEDIA_RULE:
+                if media_ok(rule.media.mediaText):
+                    for subrule in rule.cssRules:
+                        rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet, page_rule, font_face_rules))
+                        index += 1
+            else:
+                rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet, page_rule, font_face_rules))
+                index = index + 1
+        ans = [(r, RuleMatcher(r[3])) for r in rules], page_rule, font_face_rules, index
+        if cache is not None:
+            cache[key] = ans
+        return ans
+
+    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False, page_rule=None, font_face_rules=None):
+        page_rule = self.page_rule if page_rule is None else page_rule
+        font_face_rules = self.font_face_rules if font_face_rules is None else font_face_rules
         results = []
         sheet_index = 0 if is_user_agent_sheet else 1
         if isinstance(rule, CSSStyleRule):
@@ -169,13 +309,13 @@ def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
                 results.append((specificity, selector, style, text, href))
         elif isinstance(rule, CSSPageRule):
             style = self.flatten_style(rule.style)
-            self.page_rule.update(style)
+            page_rule.update(style)
         elif isinstance(rule, CSSFontFaceRule):
             if rule.style.length > 1:
                 # Ignore the meaningless font face rules generated by the
                 # benighted MS Word that contain only a font-family declaration
                 # and nothing else
-                self.font_face_rules.append(rule)
+                font_face_rules.append(rule)
         return results
 
     def flatten_style(self, cssstyle):
@@ -253,7 +393,7 @@ def __init__(self, tree, path, oeb, opts, profile=None,
         cssname = os.path.splitext(basename)[0] + '.css'
         stylesheets = [html_css_stylesheet()]
         if base_css:
-            stylesheets.append(parseString(base_css, validate=False))
+            stylesheets.append(stylesheet_cache(base_css, parse_stylesheet))
         style_tags = xpath(tree, '//*[local-name()="style" or local-name()="link"]')
 
         # Add css_parser parsing profiles from output_profile
@@ -276,11 +416,10 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                         text += '\n\n' + force_unicode(t, 'utf-8')
                 if text:
                     text = oeb.css_preprocessor(text)
-                    # We handle @import rules separately
-                    parser.setFetcher(lambda x: ('utf-8', b''))
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
-                    parser.setFetcher(self._fetch_css_file)
+                    # The resolved URLs depend on the location of this file,
+                    # but only if the sheet has any
+                    stylesheet = stylesheet_cache(
+                        text, partial(self._parse_style_tag, item, cssname), cssname, item.href if 'url(' in text else None)
                     for rule in stylesheet.cssRules:
                         if rule.type == rule.IMPORT_RULE:
                             ihref = item.abshref(rule.href)
@@ -295,10 +434,6 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                                 self.logger.warn(f'CSS @import of non-CSS file {rule.href!r}')
                                 continue
                             stylesheets.append(sitem.data)
-                    # Make links to resources absolute, since these rules will
-                    # be folded into a stylesheet at the root
-                    replaceUrls(stylesheet, item.abshref,
-                            ignoreImportRules=True)
                     stylesheets.append(stylesheet)
             elif (elem.tag == XHTML('link') and elem.get('href') and elem.get(
                     'rel', 'stylesheet').lower() == 'stylesheet' and elem.get(
@@ -321,8 +456,12 @@ def __init__(self, tree, path, oeb, opts, profile=None,
             if x:
                 try:
                     text = x
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
+                    if '@import' in text:
+                        # Imported sheets are fetched from this book
+                        stylesheet = parser.parseString(text, href=cssname,
+                                validate=False)
+                    else:
+                        stylesheet = stylesheet_cache(text, partial(parser.parseString, href=cssname, validate=False), cssname)
                     stylesheets.append(stylesheet)
                 except Exception:
                     self.logger.exception(f'Failed to parse {w}, ignoring.')
@@ -340,21 +479,24 @@ def __init__(self, tree, path, oeb, opts, profile=None,
         self.flatten_style = self.oeb.stylizer_rules.flatten_style
 
         self._styles = {}
-        pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
+        fake_first_letter = getattr(self.oeb, 'plumber_output_format', '').lower() in {'mobi', 'docx'}
+        # Faking first-letter modifies the tree, which can cause later rules
+        # to match the inserted elements, so do not skip any rules
+        skip_unmatchable = not (fake_first_letter and self.oeb.stylizer_rules.has_first_letter)
 
-        for _, _, cssdict, text, _ in self.rules:
-            fl = pseudo_pat.search(text)
+        for (_, _, cssdict, text, _), matcher in zip(self.rules, self.oeb.stylizer_rules.matchers):
+            if skip_unmatchable and not matcher.can_match(select):
+                continue
             try:
-                matches = tuple(select(text))
+                matches = tuple(matcher(select))
             except SelectorError as err:
                 self.logger.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(err)})')
                 continue
 
+            fl = matcher.pseudo_class
             if fl is not None:
-                fl = fl.group(1)
-                if fl == 'first-letter' and getattr(self.oeb,
-                        'plumber_output_format', '').lower() in {'mobi', 'docx'}:
+                if fl == 'first-letter' and fake_first_letter:
                     # Fake first-letter
                     for elem in matches:
                         for x in elem.iter('*'):
@@ -408,6 +550,15 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                 if upd:
                     style._update_cssdict(upd)
 
+    def _parse_style_tag(self, item, cssname, text):
+        parser = CSSParser(fetcher=lambda x: ('utf-8', b''),  # We handle @import rules separately
+                log=logging.getLogger('calibre.css'))
+        stylesheet = parser.parseString(text, href=cssname, validate=False)
+        # Make links to resources absolute, since these rules will
+        # be folded into a stylesheet at the root
+        replaceUrls(stylesheet, item.abshref, ignoreImportRules=True)
+        return stylesheet
+
     def _fetch_css_file(self, path):
         hrefs = self.oeb.manifest.hrefs
         if path not in hrefs:
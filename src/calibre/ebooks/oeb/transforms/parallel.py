@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the work that transforms do independently for every item in the book in
+forked worker processes. Workers inherit the book from the parent process, so
+only their results need to be sent back. These must be picklable, so lxml
+trees are sent back serialized. The transform then applies the results to the
+book in the parent process, in the same order as when running serially, so
+that the output is identical.
+
+Parallel processing is opt-in, via the transform_workers conversion option,
+as forking is safe only in processes that have no other threads.
+'''
+
+from lxml import etree
+
+from calibre.utils.forked_map import forked_map, forked_map_is_supported
+from calibre.utils.xml_parse import safe_xml_fromstring
+
+# Do not bother with worker processes for fewer items than this
+MIN_ITEMS = 4
+
+
+def number_of_workers(opts, num_items):
+    ans = min(int(getattr(opts, 'transform_workers', 0) or 0), num_items)
+    if ans < 2 or num_items < MIN_ITEMS or not forked_map_is_supported:
+        return 1
+    return ans
+
+
+def map_items(fn, items, opts):
+    '''
+    Return an iterator over fn(item) for every item in items, in order. When
+    more than one worker is allowed by opts, fn is called in forked worker
+    processes. Exceptions raised by fn are re-raised in the parent process.
+    '''
+    items = tuple(items)
+    num_workers = number_of_workers(opts, len(items))
+    if num_workers < 2:
+        return map(fn, items)
+    return forked_map(fn, items, num_workers=num_workers)
+
+
+def serialize_tree(root):
+    return etree.tostring(root, encoding='utf-8')
+
+
+def parse_tree(raw):
+    return safe_xml_fromstring(raw, recover=False)
+
+
+def find_tests():
+    import pickle
+    import unittest
+
+    from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+    from calibre.ebooks.oeb.base import CSS_MIME, XHTML_MIME, OEBBook
+    from calibre.ebooks.oeb.transforms.split import Split, SplitError
+    from calibre.utils.logging import Log
+
+    def create_book():
+        oeb = OEBBook(Log(level=Log.ERROR), HTMLPreProcessor())
+        oeb.manifest.add('css', 'style.css', CSS_MIME, data='h2 { page-break-before: always }')
+        for i in range(8):
+            para = '<p>' + 'Some text, ' * 25 + '</p>'
+            body = ''.join(f'<h2 id="c{i}_{j}">Chapter {j}</h2>' + para * 10 * (i + 1) for j in range(i))
+            raw = (f'<html xmlns="http://www.w3.org/1999/xhtml"><head><link rel="stylesheet" href="style.css"/></head>'
+                   f'<body><p><a href="h{(i + 1) % 8}.html#c{(i + 1) % 8}_1">link</a></p>{body}</body></html>')
+            item = oeb.manifest.add(f'h{i}', f'h{i}.html', XHTML_MIME, data=raw)
+            oeb.spine.add(item, True)
+        return oeb
+
+    def serialize_book(oeb):
+        return sorted((item.href, serialize_tree(item.data) if etree.iselement(item.data) else str(item)) for item in oeb.manifest)
+
+    class Opts:
+        transform_workers = 0
+
+    class TestParallelTransforms(unittest.TestCase):
+
+        @unittest.skipUnless(forked_map_is_supported, 'forking not supported on this platform')
+        def test_parallel_split(self):
+            results = []
+            for workers in (0, 3):
+                Opts.transform_workers = workers
+                self.assertEqual(number_of_workers(Opts, 8), max(1, workers))
+                oeb = create_book()
+                Split(max_flow_size=20 * 1024)(oeb, Opts)
+                results.append(serialize_book(oeb))
+            self.assertGreater(len(results[0]), 20)
+            self.assertEqual(results[0], results[1])
+            e = pickle.loads(pickle.dumps(SplitError('x.html', safe_xml_fromstring('<p/>'))))
+            self.assertIsInstance(e, SplitError)
+            self.assertIn('x.html', str(e))
+
+        def test_serialization(self):
+            raw = '<html xmlns="http://www.w3.org/1999/xhtml"><head><!-- c --></head><body><p id="x">a <b>b</b> &amp; ü</p></body></html>'
+            root = safe_xml_fromstring(raw)
+            self.assertEqual(serialize_tree(parse_tree(serialize_tree(root))), serialize_tree(root))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestParallelTransforms)
@@ -19,9 +19,7 @@ def __call__(self, oeb, opts, max_size: str = 'profile'):
         self.rescale(max_size)
 
     def rescale(self, max_size: str = 'profile'):
-        from io import BytesIO
-
-        from PIL import Image
+        from calibre.ebooks.oeb.transforms.parallel import map_items
 
         is_image_collection = getattr(self.opts, 'is_image_collection', False)
 
@@ -49,48 +47,59 @@ def rescale(self, max_size: str = 'profile'):
                 page_height = no_scale_size
             if page_height <= 0:
                 page_height = no_scale_size
-        for item in self.oeb.manifest:
-            if item.media_type.startswith('image'):
-                ext = item.media_type.split('/')[-1].upper()
-                if ext == 'JPG':
-                    ext = 'JPEG'
-                if ext not in ('PNG', 'JPEG', 'GIF'):
-                    ext = 'JPEG'
-
-                raw = item.data
-                if hasattr(raw, 'xpath') or not raw:
-                    # Probably an svg image
-                    continue
-                try:
-                    img = Image.open(BytesIO(raw))
-                except Exception:
-                    continue
-                width, height = img.size
-
-                try:
-                    if self.check_colorspaces and img.mode == 'CMYK':
-                        self.log.warn(
-                            f'The image {item.href} is in the CMYK colorspace, converting it '
-                            'to RGB as Adobe Digital Editions cannot display CMYK')
-                        img = img.convert('RGB')
-                except Exception:
-                    self.log.exception(f'Failed to convert image {item.href} from CMYK to RGB')
-
-                scaled, new_width, new_height = fit_image(width, height, page_width, page_height)
-                if scaled:
-                    new_width = max(1, new_width)
-                    new_height = max(1, new_height)
-                    self.log(f'Rescaling image from {width}x{height} to {new_width}x{new_height}', item.href)
-                    try:
-                        img = img.resize((new_width, new_height))
-                    except Exception:
-                        self.log.exception(f'Failed to rescale image: {item.href}')
-                        continue
-                    buf = BytesIO()
-                    try:
-                        img.save(buf, ext)
-                    except Exception:
-                        self.log.exception(f'Failed to rescale image: {item.href}')
-                    else:
-                        item.data = buf.getvalue()
-                        item.unload_data_from_memory()
+        self.page_width, self.page_height = page_width, page_height
+        images = [item for item in self.oeb.manifest if item.media_type.startswith('image')]
+        for item, data in zip(images, map_items(self.rescale_image, images, self.opts)):
+            if data is not None:
+                item.data = data
+                item.unload_data_from_memory()
+
+    def rescale_image(self, item):
+        ''' Return the rescaled image data for item or None if it is not changed.
+        Can be run in a worker process. '''
+        from io import BytesIO
+
+        from PIL import Image
+
+        ext = item.media_type.split('/')[-1].upper()
+        if ext == 'JPG':
+            ext = 'JPEG'
+        if ext not in ('PNG', 'JPEG', 'GIF'):
+            ext = 'JPEG'
+
+        raw = item.data
+        if hasattr(raw, 'xpath') or not raw:
+            # Probably an svg image
+            return
+        try:
+            img = Image.open(BytesIO(raw))
+        except Exception:
+            return
+        width, height = img.size
+
+        try:
+            if self.check_colorspaces and img.mode == 'CMYK':
+                self.log.warn(
+                    f'The image {item.href} is in the CMYK colorspace, converting it '
+                    'to RGB as Adobe Digital Editions cannot display CMYK')
+                img = img.convert('RGB')
+        except Exception:
+            self.log.exception(f'Failed to convert image {item.href} from CMYK to RGB')
+
+        scaled, new_width, new_height = fit_image(width, height, self.page_width, self.page_height)
+        if scaled:
+            new_width = max(1, new_width)
+            new_height = max(1, new_height)
+            self.log(f'Rescaling image from {width}x{height} to {new_width}x{new_height}', item.href)
+            try:
+                img = img.resize((new_width, new_height))
+            except Exception:
+                self.log.exception(f'Failed to rescale image: {item.href}')
+                return
+            buf = BytesIO()
+            try:
+                img.save(buf, ext)
+            except Exception:
+                self.log.exception(f'Failed to rescale image: {item.href}')
+            else:
+                return buf.getvalue()
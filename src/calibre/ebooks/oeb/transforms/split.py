@@ -25,6 +25,7 @@
 from calibre.ebooks.oeb.base import OEB_STYLES, XHTML, rewrite_links, urldefrag, urlnormalize
 from calibre.ebooks.oeb.base import XPNSMAP as NAMESPACES
 from calibre.ebooks.oeb.polish.split import do_split
+from calibre.ebooks.oeb.transforms.parallel import map_items, number_of_workers, parse_tree, serialize_tree
 from polyglot.urllib import unquote
 
 XPath = functools.partial(_XPath, namespaces=NAMESPACES)
@@ -45,6 +46,16 @@ def __init__(self, path, root):
                 '%(path)s Sub-tree size: %(size)d KB')%dict(
                             path=path, size=size))
 
+    def __reduce__(self):
+        # Allow the error to be sent back from worker processes
+        return split_error_from_message, self.args
+
+
+def split_error_from_message(msg):
+    ans = SplitError.__new__(SplitError)
+    ValueError.__init__(ans, msg)
+    return ans
+
 
 class Split:
 
@@ -74,48 +85,80 @@ def is_nav(item):
             if ans:
                 self.log(f'Not splitting {self.nav_href} as it is the EPUB3 nav document')
             return ans
-        for item in list(self.oeb.manifest.items):
-            if item.spine_position is not None and etree.iselement(item.data) and not is_nav(item):
+        items = [item for item in list(self.oeb.manifest.items) if
+                 item.spine_position is not None and etree.iselement(item.data) and not is_nav(item)]
+        if number_of_workers(opts, len(items)) < 2:
+            for item in items:
                 self.split_item(item)
+        else:
+            # The page break selectors change the stylesheets, so they must
+            # be found before forking
+            if self.split_on_page_breaks and self.page_break_selectors is None:
+                self.find_page_break_selectors()
+            for item, result in zip(items, map_items(self.split_item_in_worker, items, opts)):
+                if result is not None:
+                    self.apply_split_from_worker(item, result)
 
         self.fix_links()
 
-    def split_item(self, item):
+    def flow_splitter(self, item, trees=None):
         page_breaks, page_break_ids = [], []
-        if self.split_on_page_breaks:
+        if self.split_on_page_breaks and trees is None:
             page_breaks, page_break_ids = self.find_page_breaks(item)
 
-        splitter = FlowSplitter(item, page_breaks, page_break_ids,
-                self.max_flow_size, self.oeb, self.opts)
+        return FlowSplitter(item, page_breaks, page_break_ids,
+                self.max_flow_size, self.oeb, self.opts, trees=trees)
+
+    def split_item(self, item, trees=None):
+        splitter = self.flow_splitter(item, trees)
+        splitter.commit()
         if splitter.was_split:
             am = splitter.anchor_map
             self.map[item.href] = collections.defaultdict(
                     am.default_factory, am)
 
+    def split_item_in_worker(self, item):
+        splitter = self.flow_splitter(item)
+        if splitter.was_split:
+            return [serialize_tree(tree.getroot()) for tree in splitter.trees]
+        if splitter.page_breaks or splitter.large_tree_found:
+            # The tree can be changed even if it is not split
+            return [serialize_tree(item.data)]
+
+    def apply_split_from_worker(self, item, result):
+        roots = list(map(parse_tree, result))
+        if len(roots) == 1:
+            item.data = roots[0]
+        else:
+            self.split_item(item, [root.getroottree() for root in roots])
+
+    def find_page_break_selectors(self):
+        self.page_break_selectors = set()
+        stylesheets = [x.data for x in self.oeb.manifest if x.media_type in
+                OEB_STYLES]
+        for rule in rules(stylesheets):
+            before = force_unicode(getattr(rule.style.getPropertyCSSValue(
+                'page-break-before'), 'cssText', '').strip().lower())
+            after  = force_unicode(getattr(rule.style.getPropertyCSSValue(
+                'page-break-after'), 'cssText', '').strip().lower())
+            try:
+                if before and before not in {'avoid', 'auto', 'inherit'}:
+                    self.page_break_selectors.add((rule.selectorText, True))
+                    if self.remove_css_pagebreaks:
+                        rule.style.removeProperty('page-break-before')
+            except Exception:
+                pass
+            try:
+                if after and after not in {'avoid', 'auto', 'inherit'}:
+                    self.page_break_selectors.add((rule.selectorText, False))
+                    if self.remove_css_pagebreaks:
+                        rule.style.removeProperty('page-break-after')
+            except Exception:
+                pass
+
     def find_page_breaks(self, item):
         if self.page_break_selectors is None:
-            self.page_break_selectors = set()
-            stylesheets = [x.data for x in self.oeb.manifest if x.media_type in
-                    OEB_STYLES]
-            for rule in rules(stylesheets):
-                before = force_unicode(getattr(rule.style.getPropertyCSSValue(
-                    'page-break-before'), 'cssText', '').strip().lower())
-                after  = force_unicode(getattr(rule.style.getPropertyCSSValue(
-                    'page-break-after'), 'cssText', '').strip().lower())
-                try:
-                    if before and before not in {'avoid', 'auto', 'inherit'}:
-                        self.page_break_selectors.add((rule.selectorText, True))
-                        if self.remove_css_pagebreaks:
-                            rule.style.removeProperty('page-break-before')
-                except Exception:
-                    pass
-                try:
-                    if after and after not in {'avoid', 'auto', 'inherit'}:
-                        self.page_break_selectors.add((rule.selectorText, False))
-                        if self.remove_css_pagebreaks:
-                            rule.style.removeProperty('page-break-after')
-                except Exception:
-                    pass
+            self.find_page_break_selectors()
         page_breaks = set()
         select = Select(item.data)
         if not self.page_break_selectors:
@@ -213,7 +256,7 @@ class FlowSplitter:
     'The actual splitting logic'
 
     def __init__(self, item, page_breaks, page_break_ids, max_flow_size, oeb,
-            opts):
+            opts, trees=None):
         self.item           = item
         self.oeb            = oeb
         self.opts           = opts
@@ -226,7 +269,16 @@ def __init__(self, item, page_breaks, page_break_ids, max_flow_size, oeb,
 
         base, ext = os.path.splitext(self.base)
         self.base = base.replace('%', '%%')+'_split_%.3d'+ext
+        self.large_tree_found = False
+
+        if trees is None:
+            self.split()
+        else:
+            # The trees were created by splitting in a worker process
+            self.trees = trees
+            self.was_split = len(self.trees) > 1
 
+    def split(self):
         self.trees = [self.item.data.getroottree()]
         self.splitting_on_page_breaks = True
         if self.page_breaks:
@@ -234,19 +286,18 @@ def __init__(self, item, page_breaks, page_break_ids, max_flow_size, oeb,
         self.splitting_on_page_breaks = False
 
         if self.max_flow_size > 0:
-            lt_found = False
-            self.log(f'\tLooking for large trees in {item.href}...')
+            self.log(f'\tLooking for large trees in {self.item.href}...')
             trees = list(self.trees)
             self.tree_map = {}
             for i, tree in enumerate(trees):
                 size = len(tostring(tree.getroot()))
                 if size > self.max_flow_size:
                     self.log(f'\tFound large tree #{i}')
-                    lt_found = True
+                    self.large_tree_found = True
                     self.split_trees = []
                     self.split_to_size(tree)
                     self.tree_map[tree] = self.split_trees
-            if not lt_found:
+            if not self.large_tree_found:
                 self.log('\tNo large trees found')
             self.trees = []
             for x in trees:
@@ -255,7 +306,6 @@ def __init__(self, item, page_breaks, page_break_ids, max_flow_size, oeb,
         self.was_split = len(self.trees) > 1
         if self.was_split:
             self.log(f'\tSplit into {len(self.trees)} parts')
-        self.commit()
 
     def split_on_page_breaks(self, orig_tree):
         ordered_ids = OrderedDict()
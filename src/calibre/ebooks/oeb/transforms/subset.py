@@ -7,12 +7,11 @@
 
 import os
 from collections import defaultdict
-from io import BytesIO
 
 from tinycss.fonts3 import parse_font_family
 
 from calibre.ebooks.oeb.base import css_text, urlnormalize
-from calibre.utils.fonts.subset import subset
+from calibre.utils.fonts.subset import cached_subset
 
 font_properties = ('font-family', 'src', 'font-weight', 'font-stretch', 'font-style', 'text-transform')
 
@@ -158,17 +157,16 @@ def remove(font):
                 remove(font)
                 continue
             old_raw = font['item'].data
-            output = BytesIO()
             font_type = os.path.splitext(font['item'].href)[1][1:].lower()
             try:
-                subset(BytesIO(old_raw), output, font_type, font['chars'])
+                new_raw = cached_subset(old_raw, font_type, font['chars'])[0]
             except Exception as e:
                 self.log.warn('The font {} is unsupported for subsetting. {}'.format(font['src'], e))
                 sz = len(font['item'].data)
                 totals[0] += sz
                 totals[1] += sz
             else:
-                font['item'].data = output.getvalue()
+                font['item'].data = new_raw
                 nlen = len(font['item'].data)
                 olen = len(old_raw)
                 self.log('Decreased the font {} to {:.1f}% of its original size'.format(font['src'], nlen/olen *100))
@@ -60,21 +60,36 @@ def zip_exploder(path, tdir, question=lambda x:True):
     raise Error('Invalid book: Could not find .opf')
 
 
-def zip_rebuilder(tdir, path):
+# Files that are never written into a rebuilt EPUB, other than the mimetype
+# file which is always written first
+ZIP_EXCLUDED_FILES = frozenset({'.DS_Store', 'mimetype', 'iTunesMetadata.plist'})
+
+
+def zip_rebuilder(tdir, path, source=None, unchanged=None):
+    '''
+    Create a ZIP file at path from the contents of tdir. unchanged can be a
+    mapping of names to ZipInfo objects from the ZipFile source, for files in
+    tdir that are the same as in source, these are copied from source without
+    being re-compressed.
+    '''
+    unchanged = unchanged or {}
     with ZipFile(path, 'w', compression=ZIP_DEFLATED) as zf:
         # Write mimetype
         mt = os.path.join(tdir, 'mimetype')
         if os.path.exists(mt):
             zf.write(mt, 'mimetype', compress_type=ZIP_STORED)
         # Write everything else
-        exclude_files = {'.DS_Store', 'mimetype', 'iTunesMetadata.plist'}
         for root, dirs, files in os.walk(tdir):
             for fn in files:
-                if fn in exclude_files:
+                if fn in ZIP_EXCLUDED_FILES:
                     continue
                 absfn = os.path.join(root, fn)
                 zfn = unicodedata.normalize('NFC', os.path.relpath(absfn, tdir).replace(os.sep, '/'))
-                zf.write(absfn, zfn)
+                zi = unchanged.get(zfn)
+                if zi is None:
+                    zf.write(absfn, zfn)
+                else:
+                    zf.copy_raw(source, zi)
 
 
 def docx_exploder(path, tdir, question=lambda x:True):
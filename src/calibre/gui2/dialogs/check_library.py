@@ -37,7 +37,7 @@
 from calibre import as_unicode, prints
 from calibre.gui2 import open_local_file
 from calibre.gui2.dialogs.confirm_delete import confirm
-from calibre.library.check_library import CHECKS, CheckLibrary
+from calibre.library.check_library import CHECKS, CheckLibrary, forget_checksums
 from calibre.utils.recycle_bin import delete_file, delete_tree
 
 
@@ -229,6 +229,11 @@ def __init__(self, parent, db):
         missing.</li>
         <li><b>Cover files not in database</b>: These are books that have
         cover files but are marked as not having covers in the database.</li>
+        <li><b>Corrupted book formats</b>: These are book format files whose
+        contents have changed since the previous check, even though their size and
+        modification time have not, which usually indicates disk corruption. This
+        check is only performed when <i>Verify checksums</i> is enabled.
+        Fixing them tells calibre to accept the current contents as correct.</li>
         <li><b>Folder raising exception</b>: These represent folders in the
         calibre library that could not be processed/understood by this
         tool.</li>
@@ -318,6 +323,13 @@ def __init__(self, parent, db):
             tt_ext + '</p>')
         le.setBuddy(self.ext_ignores)
         h.addWidget(self.ext_ignores)
+        self.verify_checksums = vc = QCheckBox(_('&Verify checksums'))
+        vc.setChecked(db.new_api.pref('check_library_verify_checksums', False))
+        vc.setToolTip('<p>' + _(
+            'Read all book files and compare their checksums to the ones recorded by the'
+            ' previous check, to detect files that have been silently corrupted.'
+            ' This is slow for large libraries.'))
+        h.addWidget(vc)
         self._layout.addLayout(h)
 
         self._layout.addLayout(self.bbox)
@@ -337,6 +349,7 @@ def do_exec(self):
     def accept(self):
         self.db.new_api.set_pref('check_library_ignore_extensions', str(self.ext_ignores.text()))
         self.db.new_api.set_pref('check_library_ignore_names', str(self.name_ignores.text()))
+        self.db.new_api.set_pref('check_library_verify_checksums', self.verify_checksums.isChecked())
         QDialog.accept(self)
 
     def box_to_list(self, txt):
@@ -345,7 +358,8 @@ def box_to_list(self, txt):
     def run_the_check(self):
         checker = CheckLibrary(self.db.library_path, self.db)
         checker.scan_library(self.box_to_list(str(self.name_ignores.text())),
-                             self.box_to_list(str(self.ext_ignores.text())))
+                             self.box_to_list(str(self.ext_ignores.text())),
+                             verify_checksums=self.verify_checksums.isChecked())
 
         plaintext = []
 
@@ -578,6 +592,10 @@ def fix_malformed_formats(self):
             filename = self.db.new_api.format_files(id_)[ext.upper()] +'.'+ ext.lower()
             os.rename(os.path.join(self.db.library_path, lib_path), os.path.join(self.db.library_path, book_path, filename))
 
+    def fix_corrupted_formats(self):
+        tl = self.top_level_items['corrupted_formats']
+        forget_checksums(self.db.library_path, [tl.child(i).text(2) for i in range(tl.childCount())])
+
     def fix_items(self):
         for check in CHECKS:
             attr = check[0]
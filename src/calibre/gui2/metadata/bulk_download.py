@@ -217,7 +217,9 @@ def run(self):
 
 def download(all_ids, tf, db, do_identify, covers, ensure_fields,
         log=None, abort=None, notifications=None):
-    batch_size = 10
+    # Each batch is processed by a single worker process, that downloads
+    # metadata for several books at once, so use large batches
+    batch_size = 50
     batches = split_jobs(all_ids, batch_size=batch_size)
     tdir = PersistentTemporaryDirectory('_metadata_bulk')
     heartbeat = HeartBeat(tdir)
@@ -6,21 +6,31 @@
 __docformat__ = 'restructuredtext en'
 
 import fnmatch
+import hashlib
+import json
 import os
 import re
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from calibre import isbytestring
 from calibre.constants import filesystem_encoding
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, METADATA_FILE_NAME, NOTES_DIR_NAME, TRASH_DIR_NAME
 from calibre.ebooks import BOOK_EXTENSIONS
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.localization import _
 
 EBOOK_EXTENSIONS = frozenset(BOOK_EXTENSIONS)
 NORMALS = frozenset({METADATA_FILE_NAME, COVER_FILE_NAME, DATA_DIR_NAME})
+CHECKSUMS_FILE_NAME = 'check_library_checksums.json'
+CHECKPOINT_FILE_NAME = 'check_library_checkpoint.json'
 IGNORE_AT_TOP_LEVEL = frozenset({
-    'metadata.db', 'metadata_db_prefs_backup.json', 'metadata_pre_restore.db', 'full-text-search.db', TRASH_DIR_NAME, NOTES_DIR_NAME
+    'metadata.db', 'metadata_db_prefs_backup.json', 'metadata_pre_restore.db', 'full-text-search.db', TRASH_DIR_NAME, NOTES_DIR_NAME,
+    CHECKSUMS_FILE_NAME, CHECKPOINT_FILE_NAME,
 })
+HASH_CHUNK_SIZE = 1024 * 1024
+CHECKPOINT_INTERVAL = 30  # seconds
 
 '''
 Checks fields:
@@ -42,8 +52,53 @@
           ('extra_covers',      _('Cover files not in database'), True, True),
           ('malformed_formats', _('Malformed formats'), False, True),  # need to be perform before malformed_paths
           ('malformed_paths',   _('Malformed book paths'), False, True),
+          ('corrupted_formats', _('Corrupted book formats'), False, True),
           ('failed_folders',    _('Folders raising exception'), False, False),
       ]
+# The checks whose results are produced by processing individual book folders
+# and so are saved in checkpoints
+BOOK_CHECKS = ('extra_files', 'missing_formats', 'extra_formats', 'malformed_formats',
+               'missing_covers', 'extra_covers', 'corrupted_formats', 'failed_folders')
+
+
+def hash_file(path):
+    ' Return the SHA-256 hash of the file, the same hash as used by Cache.format_hash() '
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            raw = f.read(HASH_CHUNK_SIZE)
+            sha.update(raw)
+            if len(raw) < HASH_CHUNK_SIZE:
+                break
+    return sha.hexdigest()
+
+
+def read_json_file(path, default):
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return default
+    except Exception:
+        traceback.print_exc()
+        return default
+
+
+def write_json_file(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+    atomic_rename(path + '.tmp', path)
+
+
+def forget_checksums(library_path, paths):
+    ''' Forget the recorded checksums for the specified format files (paths
+    relative to the library folder), so that their current contents are
+    accepted as correct by the next checksum scan. '''
+    cpath = os.path.join(library_path, CHECKSUMS_FILE_NAME)
+    checksums = read_json_file(cpath, {})
+    for p in paths:
+        checksums.pop(p.replace(os.sep, '/'), None)
+    write_json_file(cpath, checksums)
 
 
 class CheckLibrary:
@@ -83,7 +138,9 @@ def __init__(self, library_path, db):
         self.missing_covers = []
         self.extra_covers = []
 
+        self.corrupted_formats = []
         self.failed_folders = []
+        self.stats = {'book_folders': 0, 'files': 0, 'hashed_files': 0, 'hashed_bytes': 0, 'resumed_folders': 0, 'elapsed': 0.}
 
     def dbpath(self, id_):
         return self.db.path(id_, index_is_id=True)
@@ -99,67 +156,54 @@ def ignore_name(self, filename):
                 return True
         return False
 
-    def scan_library(self, name_ignores, extension_ignores):
+    def list_author_dir(self, auth_path):
+        ' Return (title_dir, is_dir) for all entries in the author folder '
+        with os.scandir(auth_path) as it:
+            return [(e.name, e.is_dir()) for e in it]
+
+    def scan_library(self, name_ignores, extension_ignores, num_workers=None, verify_checksums=False, resume=False, report_progress=None):
+        '''
+        Scan the library, filling in the lists named in CHECKS. Folders are
+        listed and files are hashed in a pool of num_workers threads.
+
+        :param verify_checksums: Compute the hashes of all book format files
+            and compare them to the ones recorded by the previous checksum scan.
+            Files whose contents changed while their size and modification time
+            did not are reported in corrupted_formats.
+        :param resume: Continue from the checkpoint left behind by an
+            interrupted scan with the same settings, if any.
+        :param report_progress: Called with (num_done, total) as book folders
+            are processed.
+        '''
         self.ignore_names = frozenset(name_ignores)
         self.ignore_ext = frozenset('.'+ e for e in extension_ignores)
+        st = time.monotonic()
 
         lib = self.src_library_path
-        for auth_dir in os.listdir(lib):
+        if num_workers is None:
+            num_workers = min(32, (os.cpu_count() or 1) * 4)
+        author_dirs = []
+        for auth_dir in sorted(os.listdir(lib)):
             if self.ignore_name(auth_dir) or auth_dir in IGNORE_AT_TOP_LEVEL:
                 continue
+            author_dirs.append(auth_dir)
+
+        def list_author_dir(auth_dir):
             auth_path = os.path.join(lib, auth_dir)
             # First check: author must be a directory
             if not os.path.isdir(auth_path):
-                self.invalid_authors.append((auth_dir, auth_dir, 0))
-                continue
-
-            # Look for titles in the author directories
-            found_titles = False
+                return None
             try:
-                for title_dir in os.listdir(auth_path):
-                    if self.ignore_name(title_dir):
-                        continue
-                    title_path = os.path.join(auth_path, title_dir)
-                    db_path = os.path.join(auth_dir, title_dir)
-                    m = self.db_id_regexp.search(title_dir)
-                    # Second check: title must have an ID and must be a directory
-                    if m is None or not os.path.isdir(title_path):
-                        self.invalid_titles.append((auth_dir, db_path, 0))
-                        continue
-
-                    id_ = m.group(1)
-                    # Third check: the id_ must be in the DB and the paths must match
-                    if self.is_case_sensitive:
-                        if db_path not in self.all_dbpaths:
-                            if int(id_) not in self.all_ids or os.path.exists(os.path.join(lib, self.dbpath(int(id_)))):
-                                self.extra_titles.append((title_dir, db_path, 0))
-                                continue
-                            else:
-                                self.malformed_paths.append((db_path, db_path, id_))
-                                self.malformed_paths_ids.add(int(id_))
-                    elif int(id_) not in self.all_ids or db_path.lower() not in self.all_lc_dbpaths:
-                        self.extra_titles.append((title_dir, db_path, 0))
-                        continue
-
-                    # Record the book to check its formats
-                    self.book_dirs.append((db_path, title_dir, id_))
-                    found_titles = True
-            except Exception:
+                return sorted(self.list_author_dir(auth_path))
+            except Exception as e:
                 traceback.print_exc()
-                # Sort-of check: exception processing directory
-                self.failed_folders.append((auth_dir, traceback.format_exc(), []))
-
-            # Fourth check: author directories that contain no titles
-            if not found_titles:
-                self.extra_authors.append((auth_dir, auth_dir, 0))
+                e.formatted_traceback = traceback.format_exc()
+                return e
 
-        for x in self.book_dirs:
-            try:
-                self.process_book(lib, x)
-            except Exception:
-                traceback.print_exc()
-                # Sort-of check: exception processing directory
-                self.failed_folders.append((title_path, traceback.format_exc(), []))
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='CheckLibrary') as pool:
+            for auth_dir, entries in zip(author_dirs, pool.map(list_author_dir, author_dirs)):
+                self.process_author_dir(lib, auth_dir, entries)
+            self.process_book_dirs(lib, pool, verify_checksums, resume, report_progress)
 
         # Check for formats and covers in db for book dirs that are gone
         for id_ in self.all_ids:
@@ -174,6 +218,156 @@ def scan_library(self, name_ignores, extension_ignores):
                     self.missing_formats.append((title_dir, os.path.join(path, fmt[0]+'.'+fmt[1].lower()), id_))
                 if self.db.has_cover(id_):
                     self.missing_covers.append((title_dir, os.path.join(path, COVER_FILE_NAME), id_))
+        self.stats['elapsed'] = time.monotonic() - st
+
+    def process_author_dir(self, lib, auth_dir, entries):
+        if entries is None:
+            self.invalid_authors.append((auth_dir, auth_dir, 0))
+            return
+        # Look for titles in the author directories
+        found_titles = False
+        try:
+            if isinstance(entries, Exception):
+                raise entries
+            for title_dir, is_dir in entries:
+                if self.ignore_name(title_dir):
+                    continue
+                db_path = os.path.join(auth_dir, title_dir)
+                m = self.db_id_regexp.search(title_dir)
+                # Second check: title must have an ID and must be a directory
+                if m is None or not is_dir:
+                    self.invalid_titles.append((auth_dir, db_path, 0))
+                    continue
+
+                id_ = m.group(1)
+                # Third check: the id_ must be in the DB and the paths must match
+                if self.is_case_sensitive:
+                    if db_path not in self.all_dbpaths:
+                        if int(id_) not in self.all_ids or os.path.exists(os.path.join(lib, self.dbpath(int(id_)))):
+                            self.extra_titles.append((title_dir, db_path, 0))
+                            continue
+                        else:
+                            self.malformed_paths.append((db_path, db_path, id_))
+                            self.malformed_paths_ids.add(int(id_))
+                elif int(id_) not in self.all_ids or db_path.lower() not in self.all_lc_dbpaths:
+                    self.extra_titles.append((title_dir, db_path, 0))
+                    continue
+
+                # Record the book to check its formats
+                self.book_dirs.append((db_path, title_dir, id_))
+                found_titles = True
+        except Exception:
+            # Sort-of check: exception processing directory
+            self.failed_folders.append((auth_dir, getattr(entries, 'formatted_traceback', None) or traceback.format_exc(), []))
+
+        # Fourth check: author directories that contain no titles
+        if not found_titles:
+            self.extra_authors.append((auth_dir, auth_dir, 0))
+
+    def list_book_dir(self, lib, db_path, checksums):
+        ''' Return the names of the files in the book folder along with the
+        hashes of the format files, if checksums is not None. Runs in a worker
+        thread, so must not access the database. '''
+        book_path = os.path.join(lib, db_path)
+        filenames, hashes = [], {}
+        with os.scandir(book_path) as it:
+            for e in it:
+                filenames.append(e.name)
+                if checksums is not None and e.is_file() and self.is_ebook_file(e.name):
+                    s = e.stat()
+                    key = os.path.join(db_path, e.name).replace(os.sep, '/')
+                    hashes[key] = (s.st_size, s.st_mtime_ns, hash_file(e.path))
+        return filenames, hashes
+
+    def checkpoint_settings(self, verify_checksums):
+        return {'library': self.src_library_path, 'ignore_names': sorted(self.ignore_names),
+                'ignore_ext': sorted(self.ignore_ext), 'verify_checksums': verify_checksums}
+
+    def process_book_dirs(self, lib, pool, verify_checksums, resume, report_progress):
+        checkpoint_path = os.path.join(lib, CHECKPOINT_FILE_NAME)
+        checksums_path = os.path.join(lib, CHECKSUMS_FILE_NAME)
+        settings = self.checkpoint_settings(verify_checksums)
+        checksums = read_json_file(checksums_path, {}) if verify_checksums else None
+        done = set()
+        start = {attr: len(getattr(self, attr)) for attr in BOOK_CHECKS}
+        if resume:
+            cp = read_json_file(checkpoint_path, {})
+            if cp.get('settings') == settings:
+                done = set(cp['done'])
+                for attr, items in cp['results'].items():
+                    getattr(self, attr).extend(tuple(x) for x in items)
+                self.stats['resumed_folders'] = len(done)
+
+        def save_checkpoint():
+            if checksums is not None:
+                write_json_file(checksums_path, checksums)
+            write_json_file(checkpoint_path, {
+                'settings': settings, 'done': sorted(done),
+                'results': {attr: getattr(self, attr)[start[attr]:] for attr in BOOK_CHECKS}})
+
+        todo = [x for x in self.book_dirs if x[0] not in done]
+        total = len(self.book_dirs)
+
+        def list_book_dir(x):
+            try:
+                return self.list_book_dir(lib, x[0], checksums)
+            except Exception as e:
+                traceback.print_exc()
+                e.formatted_traceback = traceback.format_exc()
+                return e
+
+        last_checkpoint = time.monotonic()
+        for x, result in zip(todo, pool.map(list_book_dir, todo)):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                filenames, hashes = result
+                self.stats['book_folders'] += 1
+                self.stats['files'] += len(filenames)
+                self.process_book(lib, x, filenames)
+                if checksums is not None:
+                    self.process_checksums(x, hashes, checksums)
+            except Exception:
+                # Sort-of check: exception processing directory
+                self.failed_folders.append((x[0], getattr(result, 'formatted_traceback', None) or traceback.format_exc(), []))
+            done.add(x[0])
+            if report_progress is not None:
+                report_progress(len(done), total)
+            if time.monotonic() - last_checkpoint > CHECKPOINT_INTERVAL:
+                save_checkpoint()
+                last_checkpoint = time.monotonic()
+        if checksums is not None:
+            write_json_file(checksums_path, checksums)
+        try:
+            os.remove(checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def process_checksums(self, book_info, hashes, checksums):
+        db_path, title_dir, book_id = book_info
+        for key, (size, mtime, h) in hashes.items():
+            self.stats['hashed_files'] += 1
+            self.stats['hashed_bytes'] += size
+            old = checksums.get(key)
+            if old is not None and old[0] == size and old[1] == mtime and old[2] != h:
+                # The contents changed without the size or modification time
+                # changing, keep the old hash so the file continues to be
+                # reported until the user accepts it
+                self.corrupted_formats.append((title_dir, key.replace('/', os.sep), int(book_id)))
+                continue
+            checksums[key] = [size, mtime, h]
+
+    def throughput_report(self):
+        s = self.stats
+        elapsed = max(s['elapsed'], 1e-6)
+        ans = _('Checked {0} book folders containing {1} files in {2:.1f} seconds ({3:.0f} folders per second)').format(
+            s['book_folders'], s['files'], s['elapsed'], s['book_folders'] / elapsed)
+        if s['hashed_files']:
+            ans += '. ' + _('Verified checksums of {0} files at {1:.1f} MB per second').format(
+                s['hashed_files'], s['hashed_bytes'] / elapsed / (1024 * 1024))
+        if s['resumed_folders']:
+            ans += '. ' + _('Resumed after {} already checked folders').format(s['resumed_folders'])
+        return ans
 
     def is_ebook_file(self, filename):
         ext = os.path.splitext(filename)[1]
@@ -185,9 +379,11 @@ def is_ebook_file(self, filename):
             return True
         return False
 
-    def process_book(self, lib, book_info):
+    def process_book(self, lib, book_info, filenames=None):
         db_path, title_dir, book_id = book_info
-        filenames = frozenset(f for f in os.listdir(os.path.join(lib, db_path))
+        if filenames is None:
+            filenames = os.listdir(os.path.join(lib, db_path))
+        filenames = frozenset(f for f in filenames
                                if not self.ignore_name(f) and (
                                    os.path.splitext(f)[1] not in self.ignore_ext or
                                    f == COVER_FILE_NAME))
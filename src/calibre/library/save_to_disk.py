@@ -8,9 +8,15 @@
 import os
 import re
 import traceback
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from functools import lru_cache
+from threading import Lock
 
 from calibre import prints, sanitize_file_name, strftime
 from calibre.constants import DEBUG, iswindows, preferred_encoding
+from calibre.db.constants import DATA_FILE_PATTERN
 from calibre.db.errors import NoSuchFormat
 from calibre.db.lazy import FormatsList
 from calibre.ebooks.metadata import fmt_sidx, title_sort
@@ -141,9 +147,33 @@ def preprocess_template(template):
 
 class Formatter(TemplateFormatter):
     '''
-    Provides a format function that substitutes '' for any missing value
+    Provides a format function that substitutes '' for any missing value.
+    If program_cache is a dict, the template programs and python templates
+    evaluated are compiled only once, and kept in it, so that evaluating the
+    same template for many books is faster.
     '''
 
+    def __init__(self, program_cache=None):
+        TemplateFormatter.__init__(self)
+        self.program_cache = program_cache
+
+    def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
+        if self.program_cache is None:
+            return TemplateFormatter._eval_program(self, val, prog, column_name, global_vars, break_reporter)
+        tree = self.program_cache.get(prog)
+        if tree is None:
+            tree = self.program_cache[prog] = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+        return self.gpm_interpreter.program(self.funcs, self, tree, val, global_vars=global_vars, break_reporter=break_reporter)
+
+    def _eval_python_template(self, template, column_name):
+        if self.program_cache is None:
+            return TemplateFormatter._eval_python_template(self, template, column_name)
+        key = 'python:' + template
+        func = self.program_cache.get(key)
+        if func is None:
+            func = self.program_cache[key] = self.compile_python_template(template)
+        return self._run_python_template(func, arguments=None)
+
     def get_value(self, key, args, kwargs):
         if not isinstance(key, str) or key == '':
             return ''
@@ -242,12 +272,13 @@ def get_component_metadata(template, mi, book_id, timefmt='%b %Y'):
 def get_components(template, mi, book_id, timefmt='%b %Y', length=250,
         sanitize_func=ascii_filename, replace_whitespace=False,
         to_lowercase=False, safe_format=True, last_has_extension=True,
-        single_dir=False):
+        single_dir=False, formatter=None):
     format_args = get_component_metadata(template, mi, book_id, timefmt)
+    formatter = formatter or Formatter()
     if safe_format:
-        components = Formatter().safe_format(template, format_args, 'G_C-EXCEPTION!', mi)
+        components = formatter.safe_format(template, format_args, 'G_C-EXCEPTION!', mi)
     else:
-        components = Formatter().unsafe_format(template, format_args, mi)
+        components = formatter.unsafe_format(template, format_args, mi)
     components = [x.strip() for x in components.split('/')]
     components = [sanitize_func(x) for x in components if x]
     if not components:
@@ -280,13 +311,13 @@ def save_book_to_disk(book_id, db, root, opts, length):
         formats, root, opts, length)
 
 
-def get_path_components(opts, mi, book_id, path_length):
+def get_path_components(opts, mi, book_id, path_length, formatter=None, sanitize_func=None):
     try:
         components = get_components(opts.template, mi, book_id, opts.timefmt, path_length,
-            ascii_filename if opts.asciiize else sanitize_file_name,
+            sanitize_func or (ascii_filename if opts.asciiize else sanitize_file_name),
             to_lowercase=opts.to_lowercase,
             replace_whitespace=opts.replace_whitespace, safe_format=False,
-            last_has_extension=False, single_dir=opts.single_dir)
+            last_has_extension=False, single_dir=opts.single_dir, formatter=formatter)
     except Exception as e:
         raise ValueError(_('Failed to calculate path for '
             'save to disk. Template: %(templ)s\n'
@@ -297,6 +328,38 @@ def get_path_components(opts, mi, book_id, path_length):
     return components
 
 
+class PathPlanner:
+
+    '''
+    Compute the paths that books are saved to, before saving them. The
+    template is compiled once and the file names made from it are cached, as
+    they repeat across books, for example, the folders of authors. Books whose
+    paths are the same, ignoring case, get a numeric suffix, so that they do
+    not overwrite each other.
+    '''
+
+    def __init__(self, opts, path_length):
+        self.opts, self.path_length = opts, path_length
+        self.formatter = Formatter(program_cache={})
+        self.sanitize = lru_cache(maxsize=4096)(ascii_filename if opts.asciiize else sanitize_file_name)
+        self.used = set()
+        self.duplicates = defaultdict(int)
+
+    def __call__(self, mi, book_id):
+        ' Return the path components for the book, as get_path_components() does '
+        components = get_path_components(self.opts, mi, book_id, self.path_length, self.formatter, self.sanitize)
+        key = orig_key = tuple(x.lower() for x in components)
+        if key in self.used:
+            base, num = components[-1], self.duplicates[orig_key]
+            while key in self.used:
+                num += 1
+                components[-1] = f'{base} ({num})'
+                key = key[:-1] + (components[-1].lower(),)
+            self.duplicates[orig_key] = num
+        self.used.add(key)
+        return components
+
+
 def update_metadata(mi, fmt, stream, plugboards, cdata, error_report=None, plugboard_cache=None):
     from calibre.ebooks.metadata.meta import set_metadata
     if error_report is not None:
@@ -325,7 +388,7 @@ def report_error(mi, fmt, tb):
 
 
 def do_save_book_to_disk(db, book_id, mi, plugboards,
-        formats, root, opts, length, extra_files=()):
+        formats, root, opts, length, extra_files=(), components=None, use_hardlink=False, metadata_lock=None):
     originals = mi.cover, mi.pubdate, mi.timestamp
     formats_written = False
     try:
@@ -334,7 +397,8 @@ def do_save_book_to_disk(db, book_id, mi, plugboards,
         if mi.timestamp:
             mi.timestamp = as_local_time(mi.timestamp)
 
-        components = get_path_components(opts, mi, book_id, length)
+        if components is None:
+            components = get_path_components(opts, mi, book_id, length)
         base_path = os.path.join(root, *components)
         base_name = os.path.basename(base_path)
         dirpath = os.path.dirname(base_path)
@@ -366,15 +430,20 @@ def do_save_book_to_disk(db, book_id, mi, plugboards,
     if not formats:
         return not formats_written, book_id, mi.title
 
+    # Linking is only safe when the saved files are not modified
+    use_hardlink = use_hardlink and not opts.update_metadata
     for fmt in formats:
         fmt_path = base_path+'.'+str(fmt)
         try:
-            db.copy_format_to(book_id, fmt, fmt_path)
+            if use_hardlink:
+                db.copy_format_to(book_id, fmt, fmt_path, use_hardlink=True)
+            else:
+                db.copy_format_to(book_id, fmt, fmt_path)
             formats_written = True
         except NoSuchFormat:
             continue
         if opts.update_metadata:
-            with open(make_long_path_useable(fmt_path), 'r+b') as stream:
+            with open(make_long_path_useable(fmt_path), 'r+b') as stream, metadata_lock(fmt) if metadata_lock else nullcontext():
                 update_metadata(mi, fmt, stream, plugboards, cdata)
 
     return not formats_written, book_id, mi.title
@@ -394,7 +463,20 @@ def sanitize_args(root, opts):
     return root, opts, length
 
 
-def save_to_disk(db, ids, root, opts=None, callback=None):
+def metadata_lock_for_plugins():
+    '''
+    Return a function that returns the context manager to use around the
+    writing of metadata to a format. Metadata is written by several threads at
+    once, except for formats written by plugins that were not builtin, which
+    modify global state, such as sys.path, when they are used.
+    '''
+    from calibre.customize.ui import metadata_writers
+    lock = Lock()
+    serial_formats = {ft for plugin in metadata_writers() if plugin.plugin_path for ft in plugin.file_types}
+    return lambda fmt: lock if fmt.lower() in serial_formats else nullcontext()
+
+
+def save_to_disk(db, ids, root, opts=None, callback=None, max_workers=4, use_hardlinks=False):
     '''
     Save books from the database ``db`` to the path specified by ``root``.
 
@@ -403,24 +485,77 @@ def save_to_disk(db, ids, root, opts=None, callback=None):
     book is processed with the arguments: id, title, failed, traceback.
     If the callback returns False, further processing is terminated and
     the function returns.
+    :param:`max_workers` is the number of books that are saved at a time.
+    Books are saved in the order in which they finish, which can differ from
+    the order of ``ids``.
+    :param:`use_hardlinks` If True, the saved files are hard links to the files
+    in the library, where possible, when their metadata is not updated.
+    Modifying the saved files then modifies the files in the library.
     :return: A list of failures. Each element of the list is a tuple
     (id, title, traceback)
     '''
     root, opts, length = sanitize_args(root, opts)
+    db = db.new_api
+    plugboards = db.pref('plugboards', {})
+    metadata_lock = metadata_lock_for_plugins() if opts.update_metadata else None
+    plan = PathPlanner(opts, length)
     failures = []
-    for x in ids:
-        tb = ''
+
+    def save(book_id, mi, components, formats, extra_files):
         try:
-            failed, id, title = save_book_to_disk(x, db, root, opts, length)
+            failed, book_id, title = do_save_book_to_disk(
+                db, book_id, mi, plugboards, formats, root, opts, length, extra_files,
+                components=components, use_hardlink=use_hardlinks, metadata_lock=metadata_lock)
             tb = _('Requested formats not available')
         except Exception:
-            failed, id, title = True, x, db.title(x, index_is_id=True)
-            tb = traceback.format_exc()
+            failed, title, tb = True, mi.title, traceback.format_exc()
+        return book_id, title, failed, tb
+
+    def report(book_id, title, failed, tb):
         if failed:
-            failures.append((id, title, tb))
-        if callable(callback):
-            if not callback(int(id), title, failed, tb):
+            failures.append((book_id, title, tb))
+        return not callable(callback) or callback(int(book_id), title, failed, tb)
+
+    pending = set()
+
+    def wait_for_saves(max_pending):
+        nonlocal pending
+        while len(pending) > max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if not report(*f.result()):
+                    return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The paths of books are computed here, in order, while the books
+        # planned before are being saved. Only a few books are planned ahead,
+        # so that the metadata of every book is not held in memory.
+        keep_going = True
+        for book_id in ids:
+            try:
+                if not db.has_id(book_id):
+                    raise KeyError(f'No book with id {book_id} present')
+                mi = db.get_metadata(book_id)
+                if mi.pubdate:
+                    mi.pubdate = as_local_time(mi.pubdate)
+                if mi.timestamp:
+                    mi.timestamp = as_local_time(mi.timestamp)
+                components = plan(mi, book_id)
+                formats = get_formats(db.formats(book_id), opts.formats)
+                extra_files = tuple(ef.relpath for ef in db.list_extra_files(book_id, pattern=DATA_FILE_PATTERN)) if opts.save_extra_files else ()
+            except Exception:
+                keep_going = report(book_id, db.field_for('title', book_id, default_value=_('Unknown')), True, traceback.format_exc())
+            else:
+                pending.add(executor.submit(save, book_id, mi, components, formats, extra_files))
+                keep_going = wait_for_saves(2 * max_workers)
+            if not keep_going:
                 break
+        if keep_going:
+            wait_for_saves(0)
+        else:
+            for f in pending:
+                f.cancel()
     return failures
 
 
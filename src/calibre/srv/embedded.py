@@ -102,7 +102,7 @@ def start(self):
                     except Exception:
                         pass
                 return
-            self.handler.set_jobs_manager(self.loop.jobs_manager)
+            self.handler.set_server_loop(self.loop)
             self.current_thread = t = Thread(
                 name='EmbeddedServer', target=self.serve_forever
             )
@@ -21,11 +21,15 @@ class Context:
     log = None
     url_for = None
     jobs_manager = None
+    # Set when running in one of several server processes, see srv/prefork.py
+    prefork = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
+        from calibre.srv.metrics import Metrics
         self.opts = opts
+        self.metrics = Metrics()
         self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(libraries)
         self.testing = testing
         self.lock = Lock()
@@ -135,7 +139,9 @@ def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
         with self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
+            is_stale = old is None or old[0] <= db.last_modified()
+            self.metrics.cache_lookup('categories', not is_stale)
+            if is_stale:
                 categories = db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
                 cache[key] = old = (utcnow(), categories)
                 if len(cache) > self.CATEGORY_CACHE_SIZE:
@@ -150,7 +156,9 @@ def get_tag_browser(self, request_data, db, opts, render, vl=''):
         with self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
+            is_stale = old is None or old[0] <= db.last_modified()
+            self.metrics.cache_lookup('tag_browser', not is_stale)
+            if is_stale:
                 categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
                 data = json.dumps(render(db, categories), ensure_ascii=False)
                 if isinstance(data, str):
@@ -176,7 +184,9 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
         with self.lock:
             cache = self.library_broker.search_caches[db.server_library_id]
             old = cache.pop(key, None)
-            if old is None or old[0] < db.clear_search_cache_count:
+            is_stale = old is None or old[0] < db.clear_search_cache_count
+            self.metrics.cache_lookup('search', not is_stale)
+            if is_stale:
                 matches = db.search(query, book_ids=restrict_to_ids)
                 cache[key] = old = (db.clear_search_cache_count, matches)
                 if len(cache) > self.SEARCH_CACHE_SIZE:
@@ -188,7 +198,7 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
             return old[1]
 
 
-SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts')
+SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts', 'metrics')
 
 
 class Handler:
@@ -216,6 +226,11 @@ def set_log(self, log):
 
     def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
+        jobs_manager.metrics = self.router.ctx.metrics
+
+    def set_server_loop(self, loop):
+        self.router.ctx.metrics.server_loop = loop
+        self.set_jobs_manager(loop.jobs_manager)
 
     def close(self):
         self.router.ctx.library_broker.close()
@@ -23,6 +23,7 @@
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.loop import WRITE
+from calibre.srv.pool import request_class_for
 from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, socket_errors_socket_closed, sort_q_values
 from calibre.utils.monotonic import monotonic
 from calibre.utils.speedups import ReadOnlyFileBuffer
@@ -449,7 +450,7 @@ def prepare_response(self, inheaders, request_body_file):
             self.remote_addr, self.remote_port, self.is_trusted_ip,
             self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
         )
-        self.queue_job(self.run_request_handler, data)
+        self.queue_job(self.run_request_handler, data, request_class=request_class_for(self.method, self.path, self.opts.url_prefix))
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
@@ -28,6 +28,7 @@ def __init__(self, start_event, events_queue):
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
+        self.function_name = f'{start_event.module}.{start_event.function}'
         self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
@@ -83,6 +84,9 @@ def read_log(self):
 
 class JobsManager:
 
+    # Set to a calibre.srv.metrics.Metrics object to record job durations
+    metrics = None
+
     def __init__(self, opts, log):
         mj = opts.max_jobs
         if mj < 1:
@@ -226,6 +230,8 @@ def job_finished(self, job_id):
                 except Exception:
                     import traceback
                     self.log.error(f'Error running callback for job: {job.name}:\n{traceback.format_exc()}')
+        if self.metrics is not None:
+            self.metrics.job_finished(job)
         self.prune_finished_jobs()
         if job.traceback and not job.was_aborted:
             logdata = job.read_log()
@@ -21,7 +21,7 @@
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
 from calibre.srv.opts import Options
-from calibre.srv.pool import PluginPool, ThreadPool
+from calibre.srv.pool import DEFAULT_REQUEST_CLASS, PluginPool, ThreadPool
 from calibre.srv.utils import (
     DESIRED_SEND_BUFFER_SIZE,
     HandleInterrupt,
@@ -350,11 +350,11 @@ def close(self):
         except OSError:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, request_class=DEFAULT_REQUEST_CLASS):
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, request_class)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -402,7 +402,10 @@ def __init__(
         log=None,
         # A calibre logging object for access logging, by default no access
         # logging is performed
-        access_log=None
+        access_log=None,
+        # An already bound and listening socket to use instead of creating
+        # one, for example, one shared by several server processes
+        pre_activated_socket=None
     ):
         self.ready = False
         self.handler = handler
@@ -425,9 +428,11 @@ def __init__(
             self.ssl_context.load_cert_chain(certfile=self.opts.ssl_certfile, keyfile=self.opts.ssl_keyfile)
             self.ssl_context.set_servername_callback(self.on_ssl_servername)
 
-        self.pre_activated_socket = None
+        self.pre_activated_socket = pre_activated_socket
         self.socket_was_preactivated = False
-        if self.opts.allow_socket_preallocation:
+        if pre_activated_socket is not None:
+            self.bind_address = pre_activated_socket.getsockname()
+        elif self.opts.allow_socket_preallocation:
             from calibre.srv.pre_activated import pre_activated_socket
             self.pre_activated_socket = pre_activated_socket()
             if self.pre_activated_socket is not None:
@@ -435,7 +440,7 @@ def __init__(
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count, min_count=self.opts.min_worker_count)
         self.plugin_pool = PluginPool(self, plugins)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Counters and latency histograms for the Content server, exposed in the
+Prometheus text format at /metrics. Recording a value costs a lock and a
+bisect, so that metrics can always be collected. When running in several
+processes (--worker-processes) every process has its own metrics.
+'''
+
+import ipaddress
+from bisect import bisect_left
+from threading import Lock
+
+from calibre import as_unicode
+from calibre.srv.errors import HTTPForbidden
+from calibre.srv.loop import is_local_address
+from calibre.srv.routes import endpoint
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+
+    __slots__ = ('buckets', 'count', 'counts', 'total')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.
+        self.count = 0
+
+    def observe(self, value):
+        # Must be called with the lock of the owning Metrics object held
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        ans, total = [], 0
+        for c in self.counts:
+            total += c
+            ans.append(total)
+        return ans
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for k, v in labels) + '}'
+
+
+def format_value(x):
+    if isinstance(x, float):
+        return repr(x)
+    return str(int(x))
+
+
+class Output:
+
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, kind, help_text):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name, value, labels=()):
+        self.lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+    def metric(self, name, kind, help_text, samples):
+        if samples:
+            self.header(name, kind, help_text)
+            for labels, value in samples:
+                self.sample(name, value, labels)
+
+    def histogram(self, name, help_text, histograms):
+        if not histograms:
+            return
+        self.header(name, 'histogram', help_text)
+        for labels, h in histograms:
+            for le, count in zip(h.buckets + ('+Inf',), h.cumulative_counts()):
+                self.sample(name + '_bucket', count, labels + (('le', le),))
+            self.sample(name + '_sum', h.total, labels)
+            self.sample(name + '_count', h.count, labels)
+
+    def __str__(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+class Metrics:
+
+    '''
+    The metrics for a single server. Requests are recorded per route, as
+    registered with the endpoint decorator, cache lookups per cache and
+    background jobs per function. The number of connections and the state of
+    the worker pool and jobs are read from the server loop when rendering.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.request_counts = {}
+        self.request_durations = {}
+        self.cache_lookups = {}
+        self.job_counts = {}
+        self.job_durations = {}
+        self.server_loop = None
+
+    def request_finished(self, endpoint_, method, status, duration):
+        route = endpoint_.route
+        key = route, method, status
+        with self.lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+            h = self.request_durations.get(route)
+            if h is None:
+                h = self.request_durations[route] = Histogram(REQUEST_BUCKETS)
+            h.observe(duration)
+
+    def cache_lookup(self, cache_name, hit):
+        key = cache_name, hit
+        with self.lock:
+            self.cache_lookups[key] = self.cache_lookups.get(key, 0) + 1
+
+    def job_finished(self, job):
+        function = job.function_name
+        key = function, 'failed' if job.failed else 'ok'
+        with self.lock:
+            self.job_counts[key] = self.job_counts.get(key, 0) + 1
+            h = self.job_durations.get(function)
+            if h is None:
+                h = self.job_durations[function] = Histogram(JOB_BUCKETS)
+            h.observe(job.end_time - job.start_time)
+
+    def copy_histograms(self, histograms):
+        ans = []
+        for label, h in sorted(histograms.items()):
+            c = Histogram(h.buckets)
+            c.counts, c.total, c.count = list(h.counts), h.total, h.count
+            ans.append((label, c))
+        return ans
+
+    def render(self):
+        with self.lock:
+            request_counts = sorted(self.request_counts.items())
+            request_durations = self.copy_histograms(self.request_durations)
+            cache_lookups = sorted(self.cache_lookups.items())
+            job_counts = sorted(self.job_counts.items())
+            job_durations = self.copy_histograms(self.job_durations)
+        out = Output()
+        out.metric('calibre_http_requests_total', 'counter', 'Number of requests, by route, method and response status', [
+            ((('route', route), ('method', method), ('status', status)), n) for (route, method, status), n in request_counts])
+        out.histogram('calibre_http_request_duration_seconds', 'Time taken to process requests, by route', [
+            ((('route', route),), h) for route, h in request_durations])
+        out.metric('calibre_cache_lookups_total', 'counter', 'Number of lookups in the server caches, by cache and result', [
+            ((('cache', name), ('result', 'hit' if hit else 'miss')), n) for (name, hit), n in cache_lookups])
+        out.metric('calibre_jobs_total', 'counter', 'Number of finished background jobs, by function and result', [
+            ((('function', function), ('result', result)), n) for (function, result), n in job_counts])
+        out.histogram('calibre_job_duration_seconds', 'Time taken by background jobs, by function', [
+            ((('function', function),), h) for function, h in job_durations])
+        loop = self.server_loop
+        if loop is not None:
+            self.render_server_loop(out, loop)
+        return str(out)
+
+    def render_server_loop(self, out, loop):
+        out.metric('calibre_open_connections', 'gauge', 'Number of open connections', [((), loop.num_active_connections)])
+        stats = loop.pool.stats()
+        out.metric('calibre_pool_workers', 'gauge', 'Number of worker threads', [((), stats['workers'])])
+        out.metric('calibre_pool_busy_workers', 'gauge', 'Number of worker threads processing requests', [((), stats['busy'])])
+        classes = sorted(stats['classes'].items())
+        for name, kind, key, help_text in (
+            ('calibre_pool_queued_requests', 'gauge', 'queued', 'Number of requests waiting for a worker thread'),
+            ('calibre_pool_running_requests', 'gauge', 'running', 'Number of requests being processed'),
+            ('calibre_pool_completed_requests_total', 'counter', 'completed', 'Number of requests processed'),
+            ('calibre_pool_rejected_requests_total', 'counter', 'rejected', 'Number of requests rejected because the queue was full'),
+            ('calibre_pool_wait_seconds_total', 'counter', 'wait_time', 'Time requests spent waiting for a worker thread'),
+            ('calibre_pool_max_wait_seconds', 'gauge', 'max_wait_time', 'Longest time a request spent waiting for a worker thread'),
+        ):
+            out.metric(name, kind, help_text + ', by request class', [((('class', cname),), s[key]) for cname, s in classes])
+        jm = loop.jobs_manager
+        with jm.lock:
+            running, waiting = len(jm.jobs), len(jm.waiting_jobs)
+        out.metric('calibre_jobs_running', 'gauge', 'Number of running background jobs', [((), running)])
+        out.metric('calibre_jobs_waiting', 'gauge', 'Number of background jobs waiting to start', [((), waiting)])
+
+
+def is_local_request(rd):
+    if rd.forwarded_for:
+        # Behind a reverse proxy every request comes from the proxy
+        return False
+    try:
+        addr = ipaddress.ip_address(as_unicode(rd.remote_addr))
+    except Exception:
+        return False
+    return is_local_address(addr)
+
+
+def is_admin(user_manager, username):
+    if not username or user_manager.is_readonly(username):
+        return False
+    r = user_manager.restrictions(username)
+    if r is None:
+        return False
+    return not r['allowed_library_names'] and not r['blocked_library_names'] and not any(r['library_restrictions'].values())
+
+
+@endpoint('/metrics', cache_control='no-cache')
+def metrics(ctx, rd):
+    '''
+    Server metrics in the Prometheus text format. Only available to requests
+    from the local computer and to users that can change all libraries.
+    '''
+    if not is_local_request(rd) and not is_admin(ctx.user_manager, rd.username):
+        raise HTTPForbidden('Server metrics are only available to administrators')
+    rd.outheaders.set('Content-Type', CONTENT_TYPE, replace_all=True)
+    return ctx.metrics.render()
@@ -65,10 +65,15 @@ def __new__(cls, *args):
     'compress_min_size', 1024,
     None,
 
-    _('Number of worker threads used to process requests'),
+    _('Maximum number of worker threads used to process requests'),
     'worker_count', 10,
     None,
 
+    _('Minimum number of worker threads used to process requests'),
+    'min_worker_count', 2,
+    _('More worker threads, up to the maximum, are started when there are many requests to'
+      ' process at the same time. They are stopped again once they have been idle for a while.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -5,18 +5,75 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
+from collections import deque
+from functools import partial
 from queue import Full, Queue
-from threading import Thread
+from threading import Condition, Thread
 
 from calibre.utils.monotonic import monotonic
 
+# Requests are divided into classes, each with its own queue. Free workers
+# take jobs from the queues in proportion to the weights of the classes, so
+# that a burst of slow requests of one class does not hold up the requests of
+# the others. The share is the fraction of the maximum number of workers that
+# requests of that class are allowed to occupy at the same time, keeping some
+# workers available for the other classes.
+REQUEST_CLASSES = {
+    # name: (weight, share)
+    'metadata': (8, 1.0),
+    'media': (3, 0.75),
+    'uploads': (2, 0.5),
+    'admin': (1, 0.5),
+}
+DEFAULT_REQUEST_CLASS = 'metadata'
+MEDIA_PATHS = frozenset((
+    'get', 'book-file', 'legacy', 'data-files', 'get-note-resource', 'reader-background',
+    'icon', 'static', 'mathjax', 'favicon.png', 'apple-touch-icon.png',
+))
+ADMIN_PATHS = frozenset(('users', 'fts', 'conversion', 'console-print'))
+
+
+def request_class_for(method, path, url_prefix=None):
+    ''' Return the request class for an HTTP request, based on its method and
+    path. The path is the one requested, including url_prefix, if any, which
+    is removed before classifying it, as is done when routing it. '''
+    if url_prefix:
+        strip_path = tuple(url_prefix.strip('/').split('/'))
+        if path[:len(strip_path)] == strip_path:
+            path = path[len(strip_path):]
+    base = path[0] if path else ''
+    if base == 'cdb' or (base == 'data-files' and method in ('POST', 'PUT')):
+        return 'uploads'
+    if base in MEDIA_PATHS:
+        return 'media'
+    if base in ADMIN_PATHS:
+        return 'admin'
+    return DEFAULT_REQUEST_CLASS
+
+
+class RequestClass:
+
+    def __init__(self, name, weight, limit):
+        self.name, self.weight, self.limit = name, weight, limit
+        self.queue = deque()
+        self.credit = self.running = self.completed = self.rejected = 0
+        self.wait_time = self.max_wait_time = self.run_time = self.max_run_time = 0.
+
+    @property
+    def stats(self):
+        return {
+            'queued': len(self.queue), 'running': self.running, 'completed': self.completed, 'rejected': self.rejected,
+            'wait_time': self.wait_time, 'max_wait_time': self.max_wait_time,
+            'run_time': self.run_time, 'max_run_time': self.max_run_time,
+        }
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
+    def __init__(self, log, notify_server, num, pool, result_queue):
+        self.pool, self.result_queue = pool, result_queue
         self.notify_server = notify_server
         self.log = log
         self.working = False
@@ -24,11 +81,12 @@ def __init__(self, log, notify_server, num, request_queue, result_queue):
 
     def run(self):
         while True:
-            x = self.request_queue.get()
+            x = self.pool.next_job(self)
             if x is None:
                 break
-            job_id, func = x
+            rc, job_id, func = x
             self.working = True
+            started = monotonic()
             try:
                 result = func()
             except Exception:
@@ -37,6 +95,7 @@ def run(self):
                 self.result_queue.put((job_id, True, result))
             finally:
                 self.working = False
+                self.pool.job_finished(rc, monotonic() - started)
             try:
                 self.notify_server()
             except Exception:
@@ -48,40 +107,128 @@ def handle_error(self, job_id):
 
 class ThreadPool:
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+    '''
+    A pool of between min_count and count worker threads. Extra workers are
+    started when jobs are queued and no worker is free, and stop after being
+    idle for idle_timeout seconds. Every request class can have up to
+    queue_size jobs waiting.
+    '''
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, min_count=None, idle_timeout=60):
+        self.log, self.notify_server = log, notify_server
+        self.max_count = max(1, count)
+        self.min_count = self.max_count if min_count is None else max(0, min(min_count, self.max_count))
+        self.queue_size, self.idle_timeout = queue_size, idle_timeout
+        self.result_queue = Queue(queue_size)
+        self.classes = {name: RequestClass(name, weight, max(1, int(self.max_count * share)))
+                        for name, (weight, share) in REQUEST_CLASSES.items()}
+        self.lock = Condition()
+        self.workers = []
+        self.started = self.stopping = False
+        self.num_queued = self.num_waiting = self.worker_num = 0
 
     def start(self):
-        for w in self.workers:
-            w.start()
+        with self.lock:
+            self.started = True
+            for i in range(self.min_count):
+                self.start_worker()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def start_worker(self):
+        w = Worker(self.log, self.notify_server, self.worker_num, self, self.result_queue)
+        self.worker_num += 1
+        self.workers.append(w)
+        w.start()
+
+    def put_nowait(self, job_id, func, request_class=DEFAULT_REQUEST_CLASS):
+        with self.lock:
+            rc = self.classes[request_class]
+            if len(rc.queue) >= self.queue_size:
+                rc.rejected += 1
+                raise Full()
+            rc.queue.append((job_id, func, monotonic()))
+            self.num_queued += 1
+            if self.started and not self.stopping and self.num_queued > self.num_waiting and len(self.workers) < self.max_count:
+                self.start_worker()
+            self.lock.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
+    def pick_class(self):
+        # Smooth weighted round robin over the classes that have jobs waiting
+        # and are below their limit of running jobs
+        best, total = None, 0
+        for rc in self.classes.values():
+            if rc.queue and rc.running < rc.limit:
+                rc.credit += rc.weight
+                total += rc.weight
+                if best is None or rc.credit > best.credit:
+                    best = rc
+        if best is not None:
+            best.credit -= total
+        return best
+
+    def next_job(self, worker):
+        timed_out = False
+        with self.lock:
+            while not self.stopping:
+                rc = self.pick_class()
+                if rc is not None:
+                    job_id, func, queued_at = rc.queue.popleft()
+                    self.num_queued -= 1
+                    rc.running += 1
+                    wait = monotonic() - queued_at
+                    rc.wait_time += wait
+                    rc.max_wait_time = max(rc.max_wait_time, wait)
+                    return rc, job_id, func
+                can_exit = len(self.workers) > self.min_count
+                if timed_out and can_exit:
+                    self.workers.remove(worker)
+                    return
+                self.num_waiting += 1
+                try:
+                    timed_out = not self.lock.wait(self.idle_timeout if can_exit else None)
+                finally:
+                    self.num_waiting -= 1
+
+    def job_finished(self, rc, run_time):
+        with self.lock:
+            rc.running -= 1
+            rc.completed += 1
+            rc.run_time += run_time
+            rc.max_run_time = max(rc.max_run_time, run_time)
+            if rc.queue and self.num_waiting:
+                # A job of this class could have been waiting for one to finish
+                self.lock.notify()
+
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+            workers = list(self.workers)
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        self.workers = [w for w in workers if w.is_alive()]
+
+    def stats(self):
+        '''
+        Return the number of worker threads and, for every request class, the
+        number of queued, running, completed and rejected jobs as well as the
+        total and maximum time jobs spent waiting in the queue and running.
+        '''
+        with self.lock:
+            return {'workers': len(self.workers), 'busy': self.busy, 'classes': {name: rc.stats for name, rc in self.classes.items()}}
 
     @property
     def busy(self):
-        return sum(int(w.working) for w in self.workers)
+        return sum(rc.running for rc in self.classes.values())
 
     @property
     def idle(self):
-        return sum(int(not w.working) for w in self.workers)
+        return max(0, len(self.workers) - self.busy)
 
 
 class PluginPool:
@@ -122,3 +269,46 @@ def stop(self, wait_till):
             else:
                 break
         self.workers = [w for w in self.workers if w.is_alive()]
+
+
+def load_test(num_media=200, num_metadata=200, media_time=0.05, metadata_time=0.002, count=10, min_count=2):
+    '''
+    Simulate a burst of slow media requests arriving together with cheap
+    metadata requests, and print the latency of each class of request, first
+    with all requests in a single FIFO queue and then with request classes.
+    Run it with: calibre-debug -c "from calibre.srv.pool import load_test; load_test()"
+    '''
+    import time
+    from queue import Empty
+
+    from calibre.utils.logging import Log
+
+    def percentile(vals, p):
+        vals = sorted(vals)
+        return vals[min(len(vals) - 1, int(len(vals) * p))] if vals else 0
+
+    for use_classes in (False, True):
+        pool = ThreadPool(Log(), lambda: None, count=count, min_count=min_count)
+        pool.start()
+        latencies = {'media': [], 'metadata': []}
+
+        def job(name, duration, queued_at):
+            time.sleep(duration)
+            latencies[name].append(monotonic() - queued_at)
+
+        # The media requests arrive first, like a burst of cover requests when scrolling
+        jobs = [('media', media_time)] * num_media + [('metadata', metadata_time)] * num_metadata
+        st = monotonic()
+        for i, (name, duration) in enumerate(jobs):
+            pool.put_nowait(i, partial(job, name, duration, monotonic()), name if use_classes else DEFAULT_REQUEST_CLASS)
+        done = 0
+        while done < len(jobs):
+            try:
+                pool.result_queue.get(timeout=0.1)
+                done += 1
+            except Empty:
+                pass
+        print('With request classes:' if use_classes else 'With a single queue:', f'total time: {monotonic() - st:.2f}s', f'max workers: {pool.max_count}')
+        for name, vals in latencies.items():
+            print(f'  {name}: median: {percentile(vals, 0.5) * 1000:.0f}ms 95th percentile: {percentile(vals, 0.95) * 1000:.0f}ms')
+        pool.stop(monotonic() + 1)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the Content server in several processes, so that requests are handled on
+more than one CPU core. A master process creates the listening socket and
+forks reader processes that all accept connections on it. Requests that make
+changes are forwarded by the readers to a single writer process, listening on
+a private socket, so that only one process ever changes a library. When a
+request changes the database of a library, the writer increments a counter
+for the library, in memory shared by all processes. Readers reload a library from disk when its
+counter has changed, the next time it is used.
+'''
+
+import hmac
+import http.client
+import json
+import mmap
+import os
+import signal
+import socket
+import time
+from contextlib import suppress
+from itertools import permutations
+from random import Random
+from threading import Lock, local
+
+from calibre.srv.errors import HTTPSimpleResponse
+from calibre.srv.library_broker import LibraryBroker, canonicalize_path
+from calibre.srv.loop import ServerLoop
+from calibre.utils.socket_inheritance import set_socket_inherit
+
+FORWARDED_HEADER = 'Calibre-Forwarded-Request'
+MAX_LIBRARIES = 512
+# Requests for these paths start background jobs whose results are shared by
+# all processes, so they must all run in the writer
+WRITER_PATHS = frozenset(('book-manifest',))
+# Headers that apply to a single connection, or that would make the writer
+# send a response the reader cannot pass on as is
+UNFORWARDED_REQUEST_HEADERS = frozenset((
+    'connection', 'keep-alive', 'transfer-encoding', 'te', 'upgrade', 'host', 'content-length',
+    'accept-encoding', 'if-none-match', 'if-modified-since', 'if-range', 'range', FORWARDED_HEADER.lower(),
+))
+UNFORWARDED_RESPONSE_HEADERS = frozenset((
+    'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'content-encoding', 'date', 'server',
+))
+
+
+class LibraryGenerations:
+
+    ' Per library counters, in memory shared with forked processes '
+
+    def __init__(self, size=MAX_LIBRARIES):
+        self.mem = mmap.mmap(-1, 8 * size)
+        self.counters = memoryview(self.mem).cast('Q')
+        self.lock = Lock()
+
+    def __getitem__(self, slot):
+        return self.counters[slot % len(self.counters)]
+
+    def increment(self, slot):
+        with self.lock:
+            self.counters[slot % len(self.counters)] += 1
+
+
+class PreforkLibraryBroker(LibraryBroker):
+
+    def __init__(self, libraries, prefork):
+        LibraryBroker.__init__(self, libraries)
+        self.prefork = prefork
+        self.library_slots = {path: i for i, path in enumerate(self.lmap.values())}
+        self.seen_generations = {}
+
+    def init_library(self, library_path, is_default_library):
+        # Read the counter before loading, so that changes made while loading are not missed
+        generation = self.prefork.generations[self.library_slots[library_path]]
+        ans = LibraryBroker.init_library(self, library_path, is_default_library)
+        self.seen_generations[library_path] = generation
+        return ans
+
+    def get(self, library_id=None):
+        ans = LibraryBroker.get(self, library_id)
+        if ans is not None:
+            path = self.lmap.get(library_id or self.default_library)
+            if path is not None:
+                self.prefork.library_used(self, path, ans)
+        return ans
+
+    def refresh_if_changed(self, library_path, db):
+        generation = self.prefork.generations[self.library_slots[library_path]]
+        if generation != self.seen_generations.get(library_path):
+            with self:
+                if generation != self.seen_generations.get(library_path):
+                    db.reload_from_db()
+                    self.seen_generations[library_path] = generation
+
+
+class Prefork:
+
+    '''
+    The state of a single reader or writer process. Readers forward requests
+    that make changes to the writer at writer_address. The secret is used by
+    the writer to recognize forwarded requests and by all processes to create
+    authentication nonces that are valid in every process.
+    '''
+
+    def __init__(self, is_writer, secret, generations, writer_address, timeout=120):
+        self.is_writer, self.secret, self.generations = is_writer, secret, generations
+        self.writer_address, self.timeout = writer_address, timeout
+        self.library_broker = None
+        self.changed_libraries = local()
+
+    def create_library_broker(self, libraries):
+        self.library_broker = PreforkLibraryBroker(libraries, self)
+        return self.library_broker
+
+    def configure_handler(self, handler):
+        handler.router.ctx.prefork = self
+        ac = handler.auth_controller
+        if ac is not None:
+            ac.secret = self.secret
+            ac.key_order = '{%d}:{%d}:{%d}' % Random(self.secret).choice(tuple(permutations((0, 1, 2))))  # noqa: UP031
+
+    # Readers {{{
+    def should_forward(self, data, endpoint):
+        if self.is_writer:
+            return False
+        return endpoint.needs_db_write or data.method not in ('GET', 'HEAD') or (data.path and data.path[0] in WRITER_PATHS)
+
+    def forward(self, data):
+        ' Make the request in the writer process and return its response '
+        identity = json.dumps({
+            'username': data.username, 'remote_addr': data.remote_addr, 'remote_port': data.remote_port,
+            'is_trusted_ip': data.is_trusted_ip, 'forwarded_for': data.forwarded_for})
+        uri = data.request_original_uri
+        if isinstance(uri, bytes):
+            uri = uri.decode('utf-8')
+        body = data.request_body_file
+        body.seek(0, os.SEEK_END)
+        body_size = body.tell()
+        body.seek(0)
+        conn = http.client.HTTPConnection(*self.writer_address, timeout=self.timeout)
+        try:
+            conn.putrequest(data.method, uri, skip_host=True, skip_accept_encoding=True)
+            for key, val in data.inheaders.items():
+                if key.lower() not in UNFORWARDED_REQUEST_HEADERS:
+                    conn.putheader(key, val)
+            conn.putheader('Host', '{}:{}'.format(*self.writer_address))
+            conn.putheader(FORWARDED_HEADER, self.secret + ' ' + identity)
+            conn.putheader('Content-Length', str(body_size))
+            conn.endheaders()
+            if body_size:
+                conn.send(body)
+            res = conn.getresponse()
+            ans = res.read()
+        except http.client.HTTPException as e:
+            # The writer process died or sent a malformed response
+            raise HTTPSimpleResponse(http.client.BAD_GATEWAY, f'Invalid response from the server process that makes changes: {e!r}')
+        except OSError as e:
+            raise HTTPSimpleResponse(http.client.SERVICE_UNAVAILABLE, f'Could not connect to the server process that makes changes: {e}')
+        finally:
+            conn.close()
+        data.status_code = res.status
+        for key, val in res.getheaders():
+            if key.lower() not in UNFORWARDED_RESPONSE_HEADERS:
+                data.outheaders[key] = val
+        return ans
+    # }}}
+
+    # Writer {{{
+    def accept_forwarded(self, data):
+        '''
+        Return True if the request was forwarded by a reader, after applying
+        the identity of the client, as authenticated by the reader, to it.
+        '''
+        raw = data.inheaders.get(FORWARDED_HEADER)
+        if not self.is_writer or not raw:
+            return False
+        secret, identity = raw.partition(' ')[::2]
+        if not hmac.compare_digest(secret.encode('utf-8'), self.secret.encode('utf-8')):
+            return False
+        identity = json.loads(identity)
+        data.username = identity['username']
+        data.remote_addr, data.remote_port = identity['remote_addr'], identity['remote_port']
+        data.is_trusted_ip, data.forwarded_for = identity['is_trusted_ip'], identity['forwarded_for']
+        return True
+
+    def call_endpoint(self, endpoint, ctx, data, args):
+        if not self.is_writer:
+            return endpoint(ctx, data, *args)
+        self.changed_libraries.paths = paths = set()
+        self.changed_libraries.used = used = {}
+        try:
+            return endpoint(ctx, data, *args)
+        finally:
+            self.changed_libraries.paths = self.changed_libraries.used = None
+            for path, (db, before) in used.items():
+                if total_changes(db) != before:
+                    paths.add(path)
+            for path in paths:
+                self.library_changed(path)
+
+    def notify_changes(self, library_path, change_event):
+        # Called for changes made by background jobs, such as conversions, as
+        # well as by requests
+        paths = getattr(self.changed_libraries, 'paths', None)
+        if paths is None:
+            self.library_changed(canonicalize_path(library_path))
+        else:
+            paths.add(canonicalize_path(library_path))
+
+    def library_changed(self, library_path):
+        slot = self.library_broker.library_slots.get(library_path)
+        if slot is not None:
+            self.generations.increment(slot)
+    # }}}
+
+    def library_used(self, broker, library_path, db):
+        if self.is_writer:
+            # Many requests forwarded to the writer only read, so a library
+            # has changed only if rows in its database changed during the request
+            used = getattr(self.changed_libraries, 'used', None)
+            if used is not None and library_path not in used:
+                used[library_path] = db, total_changes(db)
+        else:
+            broker.refresh_if_changed(library_path, db)
+
+
+def total_changes(db):
+    ' The number of rows changed in the database of the library db since it was opened '
+    return db.backend.conn.totalchanges()
+
+
+def create_listening_socket(opts, log):
+    ' Create the listening socket the same way as the server does, so all options are respected '
+    loop = ServerLoop(None, opts=opts, log=log)
+    try:
+        loop.initialize_socket()
+        if not loop.socket_was_preactivated:
+            loop.socket.listen(min(socket.SOMAXCONN, 128))
+        return loop.socket
+    finally:
+        loop.close_control_connection()
+
+
+def create_private_socket():
+    ans = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    set_socket_inherit(ans, False)
+    ans.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ans.bind(('127.0.0.1', 0))
+    ans.listen(min(socket.SOMAXCONN, 128))
+    ans.setblocking(False)
+    return ans
+
+
+class PreforkServer:
+
+    '''
+    The master process. It starts the writer and num_readers reader processes,
+    restarts them if they die and stops them when it is asked to stop.
+    run_worker(prefork, listening_socket, is_first_reader) is called in each
+    child process to run the server in it.
+    '''
+
+    def __init__(self, opts, num_readers, run_worker, log):
+        self.opts, self.num_readers, self.run_worker, self.log = opts, num_readers, run_worker, log
+        self.secret = os.urandom(32).hex()
+        self.generations = LibraryGenerations()
+        self.listening_socket = create_listening_socket(opts, log)
+        self.writer_socket = create_private_socket()
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, is_writer, num):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = is_writer, num
+            return
+        exit_code = 0
+        try:
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            prefork = Prefork(is_writer, self.secret, self.generations, self.writer_socket.getsockname(), timeout=self.opts.timeout)
+            sock, other = self.listening_socket, self.writer_socket
+            if is_writer:
+                sock, other = other, sock
+            other.close()
+            self.run_worker(prefork, sock, not is_writer and num == 0)
+        except BaseException:
+            exit_code = 1
+            with suppress(Exception):
+                self.log.exception('Server process failed')
+        finally:
+            # Do not run the cleanup handlers inherited from the master process
+            os._exit(exit_code)
+
+    def stop(self, *args):
+        self.stopping = True
+        for pid in self.children:
+            with suppress(OSError):
+                os.kill(pid, signal.SIGTERM)
+
+    def serve_forever(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self.stop)
+        self.spawn(True, 0)
+        for i in range(self.num_readers):
+            self.spawn(False, i)
+        self.log(f'Started {self.num_readers} server processes and one process for making changes')
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            role = self.children.pop(pid, None)
+            if role is not None and not self.stopping:
+                self.log.error(f'Server process {pid} exited unexpectedly with status: {status}, restarting it')
+                time.sleep(1)
+                if not self.stopping:
+                    self.spawn(*role)
@@ -571,7 +571,7 @@ def calculate_number_of_workers(names, in_process_container, max_workers):
     if max_workers:
         num_workers = min(num_workers, max_workers)
     if num_workers > 1:
-        if len(names) < 3 or sum(os.path.getsize(in_process_container.name_path_map[n]) for n in names) < 128 * 1024:
+        if len(names) < 3 or sum(in_process_container.filesize(n) for n in names) < 128 * 1024:
             num_workers = 1
     return num_workers
 
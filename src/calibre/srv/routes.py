@@ -17,6 +17,7 @@
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
 from calibre.srv.utils import http_date
+from calibre.utils.monotonic import monotonic
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 
 default_methods = frozenset(('HEAD', 'GET'))
@@ -299,12 +300,30 @@ def read_cookies(self, data):
 
     def dispatch(self, data):
         endpoint_, args = self.find_route(data.path)
+        metrics = getattr(self.ctx, 'metrics', None)
+        if metrics is None:
+            return self.call_endpoint(endpoint_, args, data)
+        start = monotonic()
+        status = http.client.INTERNAL_SERVER_ERROR
+        try:
+            ans = self.call_endpoint(endpoint_, args, data)
+            status = data.status_code
+            return ans
+        except HTTPSimpleResponse as e:
+            status = e.http_code
+            raise
+        finally:
+            metrics.request_finished(endpoint_, data.method, status, monotonic() - start)
+
+    def call_endpoint(self, endpoint_, args, data):
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(http.client.METHOD_NOT_ALLOWED)
 
         self.read_cookies(data)
 
-        if endpoint_.auth_required and self.auth_controller is not None:
+        prefork = getattr(self.ctx, 'prefork', None)
+        forwarded = prefork is not None and prefork.accept_forwarded(data)
+        if endpoint_.auth_required and self.auth_controller is not None and not forwarded:
             self.auth_controller(data, endpoint_)
 
         if endpoint_.ok_code is not None:
@@ -313,7 +332,12 @@ def dispatch(self, data):
         self.init_session(endpoint_, data)
         if endpoint_.needs_db_write:
             self.ctx.check_for_write_access(data)
-        ans = endpoint_(self.ctx, data, *args)
+        if prefork is None:
+            ans = endpoint_(self.ctx, data, *args)
+        elif prefork.should_forward(data, endpoint_):
+            return prefork.forward(data)
+        else:
+            ans = prefork.call_endpoint(endpoint_, self.ctx, data, args)
         self.finalize_session(endpoint_, data, ans)
         outheaders = data.outheaders
 
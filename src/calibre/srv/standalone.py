@@ -6,6 +6,7 @@
 import os
 import signal
 import sys
+from functools import partial
 
 from calibre import as_unicode
 from calibre.constants import is_running_from_develop, ismacos, iswindows
@@ -22,6 +23,7 @@
 from calibre.utils.config import prefs
 from calibre.utils.localization import _, localize_user_manual_link
 from calibre.utils.lock import singleinstance
+from calibre.utils.logging import ThreadSafeLog
 from calibre_extensions import speedup
 from polyglot.builtins import error_message
 
@@ -54,16 +56,27 @@ def daemonize():  # {{{
 # }}}
 
 
+def create_logs(opts):
+    log = access_log = None
+    log_size = opts.max_log_size * 1024 * 1024
+    if opts.log:
+        log = RotatingLog(opts.log, max_size=log_size)
+    if opts.access_log:
+        access_log = RotatingLog(opts.access_log, max_size=log_size)
+    return log, access_log
+
+
 class Server:
 
-    def __init__(self, libraries, opts):
-        log = access_log = None
-        log_size = opts.max_log_size * 1024 * 1024
-        if opts.log:
-            log = RotatingLog(opts.log, max_size=log_size)
-        if opts.access_log:
-            access_log = RotatingLog(opts.access_log, max_size=log_size)
-        self.handler = Handler(libraries, opts)
+    def __init__(self, libraries, opts, prefork=None, pre_activated_socket=None):
+        log, access_log = create_logs(opts)
+        notify_changes = None
+        if prefork is not None:
+            libraries = prefork.create_library_broker(libraries)
+            notify_changes = prefork.notify_changes
+        self.handler = Handler(libraries, opts, notify_changes=notify_changes)
+        if prefork is not None:
+            prefork.configure_handler(self.handler)
         if opts.custom_list_template:
             with open(os.path.expanduser(opts.custom_list_template), 'rb') as f:
                 self.handler.router.ctx.custom_list_template = json.load(f)
@@ -78,9 +91,10 @@ def __init__(self, libraries, opts):
             opts=opts,
             log=log,
             access_log=access_log,
-            plugins=plugins)
+            plugins=plugins,
+            pre_activated_socket=pre_activated_socket)
         self.handler.set_log(self.loop.log)
-        self.handler.set_jobs_manager(self.loop.jobs_manager)
+        self.handler.set_server_loop(self.loop)
         self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
@@ -135,6 +149,14 @@ def create_option_parser():
             default=False,
             action='store_true',
             help=_('Run process in background as a daemon (Linux only).'))
+        parser.add_option(
+            '--worker-processes',
+            default=0, type=int,
+            help=_(
+                'Number of processes used to handle requests (Linux only). By default, all requests'
+                ' are handled by a single process, which can use only a single CPU core. With more'
+                ' processes, the server can handle more requests at the same time. In addition to'
+                ' these processes, one more is used to handle all requests that make changes.'))
     parser.add_option(
         '--pidfile', default=None, help=_('Write process PID to the specified file'))
     parser.add_option(
@@ -226,8 +248,14 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
+    num_processes = getattr(opts, 'worker_processes', 0)
     try:
-        server = Server(libraries, opts)
+        if num_processes > 1:
+            from calibre.srv.prefork import PreforkServer
+            server = PreforkServer(
+                opts, num_processes, partial(run_server_process, libraries, opts), create_logs(opts)[0] or ThreadSafeLog(level=ThreadSafeLog.DEBUG))
+        else:
+            server = Server(libraries, opts)
     except BadIPSpec as e:
         raise SystemExit(f'{e}')
     if getattr(opts, 'daemonize', False):
@@ -239,6 +267,23 @@ def main(args=sys.argv):
     if opts.pidfile:
         with open(opts.pidfile, 'wb') as f:
             f.write(str(os.getpid()).encode('ascii'))
+    if num_processes > 1:
+        server.serve_forever()
+    else:
+        run_server(server, opts)
+
+
+def run_server_process(libraries, opts, prefork, listening_socket, is_first_reader):
+    # This is a forked copy of the master process, so changing opts is safe
+    opts.use_bonjour = opts.use_bonjour and is_first_reader
+    if prefork.is_writer:
+        # The writer listens on a private socket, only for requests forwarded
+        # by the other processes
+        opts.ssl_certfile = opts.ssl_keyfile = None
+    run_server(Server(libraries, opts, prefork=prefork, pre_activated_socket=listening_socket), opts)
+
+
+def run_server(server, opts):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
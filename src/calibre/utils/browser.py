@@ -4,14 +4,133 @@
 
 import copy
 import http.client
+import socket
 import ssl
+from collections import OrderedDict
+from functools import partial
 from http.cookiejar import CookieJar
+from threading import Lock
 
 from mechanize import Browser as B
-from mechanize import HTTPSHandler
+from mechanize import HTTPHandler, HTTPSHandler
 
+from calibre.utils.monotonic import monotonic
 
-class ModernHTTPSHandler(HTTPSHandler):
+
+class PooledResponse(http.client.HTTPResponse):
+
+    def close(self):
+        if self.fp is not None:
+            # Closed before the whole response was read, so the connection
+            # cannot be used for another request
+            self.will_close = True
+        super().close()
+
+
+class ConnectionPool:
+
+    '''
+    Idle keep-alive connections, shared by a browser and its clones, so that
+    consecutive requests to the same host do not have to open a new
+    connection and do a new TLS handshake every time.
+    '''
+
+    def __init__(self, max_per_host=4, max_idle_time=30):
+        self.max_per_host, self.max_idle_time = max_per_host, max_idle_time
+        self.lock = Lock()
+        self.connections = {}
+
+    def get(self, key):
+        ' Return an idle connection to key or None '
+        now = monotonic()
+        with self.lock:
+            entries = self.connections.get(key, ())
+            for entry in tuple(entries):
+                conn, response, last_used = entry
+                if not response.isclosed():
+                    continue  # still in use
+                entries.remove(entry)
+                if response.will_close or conn.sock is None or now - last_used > self.max_idle_time:
+                    conn.close()
+                    continue
+                return conn
+
+    def put(self, key, conn, response):
+        ' Add conn to the pool, it becomes idle once response has been read '
+        if response.will_close:
+            return
+        with self.lock:
+            entries = self.connections.setdefault(key, [])
+            # Make room by closing idle connections, never ones still in use.
+            # If all are in use, conn is simply not kept after this request.
+            for entry in tuple(entries):
+                if len(entries) < self.max_per_host:
+                    break
+                if entry[1].isclosed():
+                    entries.remove(entry)
+                    entry[0].close()
+            if len(entries) < self.max_per_host:
+                entries.append((conn, response, monotonic()))
+
+    def close(self):
+        with self.lock:
+            for entries in self.connections.values():
+                for entry in entries:
+                    entry[0].close()
+            self.connections.clear()
+
+
+class KeepAliveMixin:
+
+    connection_pool = None
+
+    def do_open(self, http_class, req):
+        pool = self.connection_pool
+        if pool is None or req._tunnel_host or self._debuglevel or not (req.data is None or isinstance(req.data, bytes)):
+            return super().do_open(http_class, req)
+        from mechanize._response import closeable_response
+        from mechanize._sockettimeout import _GLOBAL_DEFAULT_TIMEOUT
+        from mechanize._urllib2_fork import URLError, as_unicode, create_readline_wrapper
+        host_port = req.get_host()
+        if not host_port:
+            raise URLError('no host given')
+        headers = OrderedDict(req.headers)
+        headers.update(req.unredirected_hdrs)
+        headers = OrderedDict((as_unicode(k, 'iso-8859-1').title(), as_unicode(v, 'iso-8859-1')) for k, v in headers.items())
+        if self.parent.finalize_request_headers is not None:
+            self.parent.finalize_request_headers(req, headers)
+        key = req.get_type(), host_port
+        timeout = socket.getdefaulttimeout() if req.timeout is _GLOBAL_DEFAULT_TIMEOUT else req.timeout
+        while True:
+            h = pool.get(key)
+            reused = h is not None
+            if reused:
+                h.timeout = timeout
+                h.sock.settimeout(timeout)
+            else:
+                h = http_class(host_port, timeout=req.timeout)
+                h.response_class = PooledResponse
+            try:
+                h.request(str(req.get_method()), str(req.get_selector()), req.data, headers)
+                r = h.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as err:
+                h.close()
+                if reused:
+                    continue  # the server closed the idle connection
+                raise URLError(err)
+            except OSError as err:
+                h.close()
+                raise URLError(err)
+            break
+        pool.put(key, h, r)
+        return closeable_response(create_readline_wrapper(r), r.msg, req.get_full_url(), r.status, r.reason, getattr(r, 'version', None))
+
+
+class KeepAliveHTTPHandler(KeepAliveMixin, HTTPHandler):
+    pass
+
+
+class ModernHTTPSHandler(KeepAliveMixin, HTTPSHandler):
 
     ssl_context = None
 
@@ -38,7 +157,9 @@ class Browser(B):
     '''
 
     handler_classes = B.handler_classes.copy()
+    handler_classes['http'] = KeepAliveHTTPHandler
     handler_classes['https'] = ModernHTTPSHandler
+    http_cache = None
 
     def __init__(self, *args, **kwargs):
         self._clone_actions = {}
@@ -142,6 +263,51 @@ def add_proxy_password(self, *args, **kwargs):
         B.add_proxy_password(self, *args, **kwargs)
         self._clone_actions['add_proxy_password'] = ('add_proxy_password', args, kwargs)
 
+    def set_http_cache(self, cache, ttl):
+        '''
+        Use cache, a :class:`calibre.utils.http_cache.HTTPCache`, for GET
+        requests made with open_novisit(). Cached responses are used without
+        revalidation for ttl seconds, or longer if the server allows it.
+        '''
+        self.http_cache = (cache, ttl) if cache is not None else None
+        self._clone_actions['set_http_cache'] = ('set_http_cache', (cache, ttl), {})
+
+    def open_novisit(self, url_or_request, data=None, **kw):
+        if self.http_cache is None or data is not None:
+            return B.open_novisit(self, url_or_request, data, **kw)
+        cache, ttl = self.http_cache
+        return cache.open(partial(B.open_novisit, self), url_or_request, ttl, context=self.http_cache_context, **kw)
+
+    def http_cache_context(self, url):
+        '''
+        The headers this browser adds to requests for url, including its
+        cookies, so that, for example, pages downloaded while logged in are not
+        served from the cache when logged out. The user agent is left out, as
+        it is often chosen at random.
+        '''
+        from mechanize import Request
+        ans = [(k, v) for k, v in self.addheaders if k.lower() != 'user-agent']
+        rq = Request(url)
+        self.cookiejar.add_cookie_header(rq)
+        cookies = rq.get_header('Cookie')
+        if cookies:
+            ans.append(('Cookie', cookies))
+        return ans
+
+    def set_connection_pool(self, pool):
+        '''
+        Keep connections open after requests, in pool, a
+        :class:`ConnectionPool`, for use by later requests from this browser
+        or its clones.
+        '''
+        for scheme in ('http', 'https'):
+            self._ua_handlers[scheme].connection_pool = pool
+        self._clone_actions['set_connection_pool'] = ('set_connection_pool', (pool,), {})
+
+    def discard_cached_response(self, url):
+        if self.http_cache is not None:
+            self.http_cache[0].discard_response(url, self.http_cache_context(url))
+
     def clone_browser(self):
         clone = self.__class__()
         clone.https_handler.ssl_context = self.https_handler.ssl_context
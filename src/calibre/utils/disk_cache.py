@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A persistent cache of bytestrings on disk, the base of the caches of subset
+fonts and HTTP responses.
+'''
+
+import json
+import os
+from contextlib import suppress
+from threading import Lock
+
+from calibre.ptempfile import PersistentTemporaryFile
+from calibre.utils.filenames import atomic_rename
+
+
+class DiskCache:
+
+    '''
+    Entries are stored one per file, each with a small JSON serializable
+    header, in subfolders of location named for the first two characters of
+    their keys. When the cache grows larger than max_size bytes, the least
+    recently used entries are evicted, this is checked every PRUNE_EVERY
+    writes, as it means listing the whole cache. Safe to use from multiple
+    processes at once. The cache is only an optimization, so failures to read
+    or write it are ignored.
+    '''
+
+    PRUNE_EVERY = 64
+
+    def __init__(self, location, max_size):
+        self.location = location
+        self.max_size = max_size
+        self.lock = Lock()
+        self.sets_since_prune = 0
+
+    def path_for(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def get(self, key):
+        ''' Return (header, data) for key or None if not cached '''
+        path = self.path_for(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        with suppress(OSError):
+            os.utime(path)  # mark as recently used
+        return header, data
+
+    def set(self, key, header, data):
+        ''' Store data with header for key, returning False if it could not be stored '''
+        path = self.path_for(key)
+        with self.lock:
+            tpath = None
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with PersistentTemporaryFile(dir=os.path.dirname(path)) as f:
+                    tpath = f.name
+                    f.write(json.dumps(header).encode('utf-8') + b'\n')
+                    f.write(data)
+                atomic_rename(tpath, path)
+            except Exception:
+                if tpath is not None:
+                    with suppress(OSError):
+                        os.remove(tpath)
+                return False
+            self.sets_since_prune += 1
+            if self.sets_since_prune >= self.PRUNE_EVERY:
+                self.sets_since_prune = 0
+                self.prune()
+        return True
+
+    def entries(self):
+        with suppress(OSError), os.scandir(self.location) as parents:
+            for parent in parents:
+                with suppress(OSError), os.scandir(parent.path) as entries:
+                    for entry in entries:
+                        with suppress(OSError):
+                            st = entry.stat()
+                            yield st.st_mtime_ns, st.st_size, entry.path
+
+    def prune(self):
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            with suppress(OSError):
+                os.remove(path)
+                total -= size
+
+    def discard(self, key):
+        with suppress(OSError):
+            os.remove(self.path_for(key))
+
+    def clear(self):
+        for mtime, size, path in tuple(self.entries()):
+            with suppress(OSError):
+                os.remove(path)
+
+
+def find_tests():
+    import shutil
+    import tempfile
+    import unittest
+
+    class TestDiskCache(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def test_disk_cache(self):
+            cache = DiskCache(os.path.join(self.tdir, 'cache'), 1024)
+            self.assertIsNone(cache.get('abc'))
+            self.assertTrue(cache.set('abc', {'x': 1}, b'data'))
+            self.assertEqual(cache.get('abc'), ({'x': 1}, b'data'))
+            self.assertEqual(os.listdir(os.path.join(cache.location, 'ab')), ['abc'])
+            cache.discard('abc')
+            self.assertIsNone(cache.get('abc'))
+            # Unserializable headers are not stored
+            self.assertFalse(cache.set('abc', {'x': object()}, b'data'))
+            self.assertEqual(os.listdir(os.path.join(cache.location, 'ab')), [])
+            # The cache is pruned every PRUNE_EVERY writes
+            cache = DiskCache(os.path.join(self.tdir, 'pruned'), 0)
+            cache.PRUNE_EVERY = 2
+            cache.set('abc', {}, b'data')
+            self.assertEqual(len(tuple(cache.entries())), 1)
+            cache.set('abd', {}, b'data')
+            self.assertEqual(len(tuple(cache.entries())), 0)
+
+        def test_unwritable_location(self):
+            path = os.path.join(self.tdir, 'file')
+            with open(path, 'wb'):
+                pass
+            cache = DiskCache(os.path.join(path, 'cache'), 1024)
+            self.assertFalse(cache.set('abc', {}, b'data'))
+            self.assertIsNone(cache.get('abc'))
+            self.assertEqual(tuple(cache.entries()), ())
+            cache.clear()
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestDiskCache)
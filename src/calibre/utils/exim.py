@@ -13,10 +13,12 @@
 import tempfile
 import time
 import uuid
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from typing import NamedTuple
 
-from calibre import prints
+from calibre import detect_ncpus, prints
 from calibre.constants import config_dir, filesystem_encoding, iswindows
 from calibre.utils.config import JSONConfig
 from calibre.utils.config_base import StringConfig, create_global_prefs, prefs
@@ -54,6 +56,13 @@ def flush(self):
     def close(self):
         if not self._discard:
             digest = str(self.hasher.hexdigest())
+            existing = self.exporter.content_map.get((digest, self.size))
+            if existing is None:
+                self.exporter.content_map[(digest, self.size)] = self.start_part_number, self.start_pos
+            elif self.exporter.discard_since(self.start_part_number, self.start_pos):
+                # Identical data was already exported, refer to it instead
+                self.start_part_number, self.start_pos = existing
+                self.exporter.deduplicated_bytes += self.size
             self.exporter.file_metadata[self.key] = (self.start_part_number, self.start_pos, self.size, digest, self.mtime)
         del self.exporter, self.hasher
 
@@ -70,6 +79,9 @@ class Exporter:
     TAIL_FMT = b'!II?'  # part_num, version, is_last
     MDATA_SZ_FMT = b'!Q'
     EXT = '.calibre-data'
+    # Files larger than this are streamed into the export instead of being
+    # read into memory by the add_files() worker threads
+    MAX_PREFETCH_SIZE = 8 * 1024 * 1024
 
     @classmethod
     def tail_size(cls):
@@ -82,6 +94,11 @@ def __init__(self, path_to_export_dir, part_size=None):
         self.commited_parts = []
         self.current_part = None
         self.file_metadata = {}
+        # Map of (digest, size) -> (part_num, pos) used to store identical
+        # files only once. Since entries in file_metadata are only
+        # locations, the exported data remains readable by older versions.
+        self.content_map = {}
+        self.deduplicated_bytes = 0
         self.tail_sz = self.tail_size()
         self.metadata = {'file_metadata': self.file_metadata}
 
@@ -115,6 +132,14 @@ def write(self, data: bytes) -> int:
             written += w
         return written
 
+    def discard_since(self, part_num, pos):
+        ' Discard the data written after pos, if it is all in the current part. Returns True on success. '
+        if self.current_part is None or part_num != len(self.commited_parts) + 1:
+            return False
+        self.current_part.seek(pos)
+        self.current_part.truncate()
+        return True
+
     def new_part(self):
         self.commit_part()
         self.current_part = open(os.path.join(
@@ -149,24 +174,78 @@ def add_file(self, fileobj, key):
     def start_file(self, key, mtime=None):
         return FileDest(key, self, mtime=mtime)
 
+    def add_data(self, key, data, digest, mtime=None):
+        ' Add a file whose contents and SHA-1 digest are already known '
+        loc = self.content_map.get((digest, len(data)))
+        if loc is None:
+            loc = self.content_map[(digest, len(data))] = self.current_pos()
+            written = self.write(data)
+            if len(data) != written:
+                raise RuntimeError(f'Exporter failed to write all data: {len(data)} != {written}')
+        else:
+            self.deduplicated_bytes += len(data)
+        self.file_metadata[key] = loc + (len(data), digest, mtime)
+
+    def add_files(self, files, num_workers=None):
+        '''
+        Add files from the filesystem. files must be an iterable of (key, path,
+        mtime) tuples. path can be None to add an empty file and mtime can be
+        None to use the modification time of the file. Files are read and
+        hashed by a pool of threads while being written to the export in
+        order, so that reading many small files is not bound by latency.
+        '''
+        def read(path):
+            if path is None:
+                return b'', hashlib.sha1().hexdigest(), None
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                if not iswindows:
+                    raise
+                time.sleep(1)
+                f = open(path, 'rb')
+            with f:
+                st = os.fstat(f.fileno())
+                if st.st_size > self.MAX_PREFETCH_SIZE:
+                    return None, None, st.st_mtime
+                data = f.read()
+            return data, hashlib.sha1(data).hexdigest(), st.st_mtime
+
+        num_workers = num_workers or min(8, 2 * detect_ncpus())
+        pending = deque()
+        files = iter(files)
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='ExportRead') as pool:
+            def queue_more():
+                for key, path, mtime in files:
+                    pending.append((key, path, mtime, pool.submit(read, path)))
+                    if len(pending) >= 2 * num_workers:
+                        break
+            queue_more()
+            while pending:
+                key, path, mtime, future = pending.popleft()
+                data, digest, file_mtime = future.result()
+                queue_more()
+                if mtime is None:
+                    mtime = file_mtime
+                if data is None:
+                    with open(path, 'rb') as f, self.start_file(key, mtime=mtime) as dest:
+                        shutil.copyfileobj(f, dest)
+                else:
+                    self.add_data(key, data, digest, mtime)
+
     def export_dir(self, path, dir_key):
         pkey = as_hex_unicode(dir_key)
         self.metadata[dir_key] = files = []
-        for dirpath, dirnames, filenames in os.walk(path):
-            for fname in filenames:
-                fpath = os.path.join(dirpath, fname)
-                rpath = os.path.relpath(fpath, path).replace(os.sep, '/')
-                key = f'{pkey}:{rpath}'
-                try:
-                    with open(fpath, 'rb') as f:
-                        self.add_file(f, key)
-                except OSError:
-                    if not iswindows:
-                        raise
-                    time.sleep(1)
-                    with open(fpath, 'rb') as f:
-                        self.add_file(f, key)
-                files.append((key, rpath))
+
+        def iter_files():
+            for dirpath, dirnames, filenames in os.walk(path):
+                for fname in filenames:
+                    fpath = os.path.join(dirpath, fname)
+                    rpath = os.path.relpath(fpath, path).replace(os.sep, '/')
+                    key = f'{pkey}:{rpath}'
+                    files.append((key, rpath))
+                    yield key, fpath, None
+        self.add_files(iter_files())
 
 
 def all_known_libraries():
@@ -455,19 +534,22 @@ def export_config(self, base_dir, library_usage_stats):
         gprefs['library_usage_stats'] = dict(library_usage_stats)
 
 
-def import_data(importer, library_path_map, config_location=None, progress1=None, progress2=None, abort=None):
+def import_data(importer, library_path_map, config_location=None, progress1=None, progress2=None, abort=None, num_workers=None):
+    '''
+    Import the libraries in library_path_map, at most num_workers of them in
+    parallel, followed by the settings. progress1 is called as each library is
+    started. When libraries are imported in parallel, the messages passed to
+    progress2 start with the name of the folder of the library they are for.
+    '''
     from calibre.db.cache import import_library
     config_location = config_location or config_dir
     config_location = os.path.abspath(os.path.realpath(config_location))
     total = len(library_path_map) + 1
     library_usage_stats = Counter()
-    for i, (library_key, dest) in enumerate(library_path_map.items()):
-        if abort is not None and abort.is_set():
-            return
+    dests = {}
+    for library_key, dest in library_path_map.items():
         if isinstance(dest, bytes):
             dest = dest.decode(filesystem_encoding)
-        if progress1 is not None:
-            progress1(dest, i, total)
         try:
             os.makedirs(dest)
         except OSError as err:
@@ -475,7 +557,35 @@ def import_data(importer, library_path_map, config_location=None, progress1=None
                 raise
         if not os.path.isdir(dest):
             raise ValueError(f'{dest} is not a directory')
-        import_library(library_key, importer, dest, progress=progress2, abort=abort).close()
+        dests[library_key] = dest
+    # Each library is written to its own folder, so they can be imported in
+    # parallel, reading different parts of the export at the same time
+    num_workers = min(num_workers or detect_ncpus(), len(dests)) or 1
+    lock, started = Lock(), [0]
+
+    def do_import(library_key):
+        if abort is not None and abort.is_set():
+            return
+        dest = dests[library_key]
+        with lock:
+            if progress1 is not None:
+                progress1(dest, started[0], total)
+            started[0] += 1
+        progress = progress2
+        if progress2 is not None and num_workers > 1:
+            name = os.path.basename(os.path.normpath(dest))
+
+            def progress(fname, count, total):
+                progress2(f'{name}: {fname}', count, total)
+        cache = import_library(library_key, importer, dest, progress=progress, abort=abort)
+        if cache is not None:
+            cache.close()
+
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='ImportLibrary') as pool:
+        tuple(pool.map(do_import, dests))
+    if abort is not None and abort.is_set():
+        return
+    for library_key, dest in dests.items():
         stats_key = os.path.abspath(dest).replace(os.sep, '/')
         library_usage_stats[stats_key] = importer.metadata['libraries'].get(library_key, 1)
     if progress1 is not None:
@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 # License: GPLv3 Copyright: 2023, Kovid Goyal <kovid at kovidgoyal.net>
 
+import hashlib
+import json
 import os
 import sys
 from logging.handlers import QueueHandler
 from queue import Empty, SimpleQueue
 
+from calibre.constants import cache_dir
+from calibre.utils.disk_cache import DiskCache
+
+
+def unicodes_for(chars_or_text):
+    ans = {ord(x) for x in chars_or_text}
+    ans.add(ord(' '))
+    return ans
+
 
 def subset(input_file_object_or_path, output_file_object_or_path, container_type, chars_or_text=''):
     from fontTools.subset import Subsetter, load_font, log, save_font
@@ -20,9 +31,7 @@ def subset(input_file_object_or_path, output_file_object_or_path, container_type
         if 'woff' in container_type:
             s.options.flavor = 'woff2'
         font = load_font(input_file_object_or_path, s.options, dontLoadGlyphNames=False)
-        unicodes = {ord(x) for x in chars_or_text}
-        unicodes.add(ord(' '))
-        s.populate(unicodes=unicodes)
+        s.populate(unicodes=unicodes_for(chars_or_text))
         s.subset(font)
         save_font(font, output_file_object_or_path, s.options)
     finally:
@@ -36,6 +45,115 @@ def subset(input_file_object_or_path, output_file_object_or_path, container_type
     return msgs
 
 
+class SubsetCache(DiskCache):
+
+    '''
+    A persistent disk cache of subset fonts, keyed by the contents of the
+    original font, the container type and the set of characters. When the
+    cache grows larger than max_size bytes, the least recently used fonts are
+    evicted. Safe to use from multiple processes at once.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, location=None, max_size=128 * 1024 * 1024):
+        super().__init__(location or os.path.join(cache_dir(), 'font-subsets'), max_size)
+
+    def key(self, raw, container_type, chars_or_text):
+        from fontTools import version
+        h = hashlib.sha256(raw)
+        h.update(json.dumps([self.VERSION, version, container_type.lower(), sorted(unicodes_for(chars_or_text))]).encode('ascii'))
+        return h.hexdigest()
+
+    def get_subset(self, key):
+        ''' Return (font data, warnings) for key or None if not cached '''
+        ans = self.get(key)
+        if ans is not None:
+            warnings, data = ans
+            return data, warnings
+
+    def set_subset(self, key, data, warnings):
+        return self.set(key, warnings, data)
+
+
+def subset_cache():
+    ans = getattr(subset_cache, 'ans', None)
+    if ans is None:
+        ans = subset_cache.ans = SubsetCache()
+    return ans
+
+
+def cached_subset(raw, container_type, chars_or_text='', cache=None):
+    '''
+    Subset the font in the bytestring raw, returning the subset font as a
+    bytestring and a list of warnings. Results are stored in a persistent cache,
+    so the many books that embed the same fonts need them subset only once.
+    '''
+    from io import BytesIO
+    if cache is None:
+        cache = subset_cache()
+    key = cache.key(raw, container_type, chars_or_text)
+    ans = cache.get_subset(key)
+    if ans is None:
+        output = BytesIO()
+        warnings = subset(BytesIO(raw), output, container_type, chars_or_text)
+        ans = output.getvalue(), warnings
+        cache.set_subset(key, *ans)
+    return ans
+
+
+def find_tests():
+    import shutil
+    import unittest
+
+    from calibre.ptempfile import PersistentTemporaryDirectory
+
+    class TestSubsetCache(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = PersistentTemporaryDirectory('_subset_cache')
+            self.cache = SubsetCache(location=self.tdir)
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def test_subset_cache(self):
+            raw = P('fonts/calibreSymbols.otf', allow_user_override=False, data=True)
+            data, warnings = cached_subset(raw, 'otf', 'abc', cache=self.cache)
+            self.assertLess(len(data), len(raw))
+            self.assertEqual(cached_subset(raw, 'otf', 'cba', cache=self.cache), (data, warnings))
+            self.assertEqual(len(tuple(self.cache.entries())), 1)
+            cached_subset(raw, 'otf', 'abcd', cache=self.cache)
+            self.assertEqual(len(tuple(self.cache.entries())), 2)
+            self.assertIsNone(self.cache.get_subset(self.cache.key(raw, 'woff', 'abc')))
+
+        def test_unwritable_cache(self):
+            raw = P('fonts/calibreSymbols.otf', allow_user_override=False, data=True)
+            path = os.path.join(self.tdir, 'file')
+            with open(path, 'wb'):
+                pass
+            cache = SubsetCache(location=os.path.join(path, 'cache'))
+            data, warnings = cached_subset(raw, 'otf', 'abc', cache=cache)
+            self.assertEqual((data, warnings), cached_subset(raw, 'otf', 'abc', cache=self.cache))
+
+        def test_eviction(self):
+            keys = [self.cache.key(b'font%d' % i, 'ttf', 'abc') for i in range(4)]
+            for i, key in enumerate(keys):
+                self.cache.set_subset(key, b'x' * 100, [])
+                os.utime(self.cache.path_for(key), ns=(i * 10**9, i * 10**9))
+            self.assertEqual(self.cache.get_subset(keys[0]), (b'x' * 100, []))  # marks it as recently used
+            self.cache.max_size = 350
+            self.cache.prune()
+            self.assertIsNone(self.cache.get_subset(keys[1]))
+            for key in (keys[0], keys[2], keys[3]):
+                self.assertIsNotNone(self.cache.get_subset(key))
+            self.cache.max_size = 0
+            self.cache.prune()
+            self.assertFalse(tuple(self.cache.entries()))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestSubsetCache)
+
+
 if __name__ == '__main__':
     import tempfile
     src = sys.argv[-1]
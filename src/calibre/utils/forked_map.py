@@ -149,6 +149,8 @@ def forked_map(fn: Callable[[T], R], iterable: T, *iterables: T, timeout: int |
                     yield result.value
                     pos += 1
                     while res := cache.pop(pos, None):
+                        if not res.ok:
+                            raise res.value
                         yield res.value
                         pos += 1
                 else:
@@ -156,6 +158,8 @@ def forked_map(fn: Callable[[T], R], iterable: T, *iterables: T, timeout: int |
     if count < num_items:
         raise OSError(f'Forked workers exited producing only {count} out of {num_items} results')
     while r := cache.pop(pos, None):
+        if not r.ok:
+            raise r.value
         yield r.value
         pos += 1
 
@@ -179,6 +183,14 @@ def raise_error(x: int) -> None:
                 raise ReferenceError('testing')
             with self.assertRaises(ReferenceError):
                 tuple(forked_map(raise_error, range(3)))
+            def raise_in_later_chunk(x: int) -> int:
+                if x == 5:
+                    raise ValueError(f'boom {x}')
+                time.sleep(0.01 if x < 2 else 0)
+                return x
+            for num_workers in (2, 4, 8):
+                with self.assertRaisesRegex(ValueError, 'boom 5'):
+                    tuple(forked_map(raise_in_later_chunk, range(8), num_workers=num_workers))
             timings = 0, 1, 2, 3
             def echo(x: int) -> int:
                 time.sleep(0.0001 * random.choice(timings))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A persistent disk cache for HTTP responses, used by browsers for GET requests
+made with open_novisit(), see :meth:`calibre.utils.browser.Browser.set_http_cache`.
+Responses are fresh for the time to live set by the user of the cache, or for
+longer if the server allows it, after which they are revalidated with a
+conditional request, when the server sent an ETag or Last-Modified header, or
+fetched again.
+'''
+
+import hashlib
+import json
+import time
+from collections import Counter
+
+from calibre.utils.disk_cache import DiskCache
+
+# Headers that describe the connection or the encoding of the body on the
+# wire, rather than the body itself
+UNCACHED_HEADERS = frozenset((
+    'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length', 'set-cookie', 'date',
+))
+
+
+class HTTPCache(DiskCache):
+
+    '''
+    Cached responses are stored one per file, keyed by the URL, any headers
+    set on the request object and the context of the request, such as the
+    cookies sent with it. When the cache grows larger than max_size bytes,
+    the least recently used responses are evicted. Responses larger than
+    max_entry_size bytes are not cached. Safe to use from multiple processes at
+    once. The number of requests served from the cache, revalidated or
+    downloaded, and the bytes saved and downloaded are counted in stats.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, location, max_size=256 * 1024 * 1024, max_entry_size=16 * 1024 * 1024):
+        super().__init__(location, max_size)
+        self.max_entry_size = max_entry_size
+        self.stats = Counter()
+
+    def key(self, url, headers):
+        h = hashlib.sha256(json.dumps([self.VERSION, url, sorted(headers)]).encode('utf-8'))
+        return h.hexdigest()
+
+    def set(self, key, meta, data):
+        if len(data) > self.max_entry_size:
+            return False
+        return super().set(key, meta, data)
+
+    def discard_response(self, url, headers=()):
+        ' Remove the response for url, for example, when it turns out to be an error page '
+        self.discard(self.key(url, headers))
+
+    def count(self, **kw):
+        with self.lock:
+            self.stats.update(kw)
+
+    def open(self, fetch, url_or_request, ttl, context=None, **kw):
+        '''
+        Return the response for url_or_request, from the cache if a fresh
+        response is present, otherwise by calling fetch(request, **kw). Only
+        GET requests with successful responses are cached. Cached responses
+        are fresh for ttl seconds, or for as long as the Cache-Control header
+        of the response allows, if that is longer. context(url) returns the
+        headers that fetch() adds to requests for url, which are part of the
+        key, but not of the request passed to fetch().
+        '''
+        from mechanize import HTTPError, Request, make_response
+
+        def cached_response(meta, data):
+            return make_response(data, [tuple(x) for x in meta['headers']], meta['url'], meta['code'], meta['msg'])
+
+        try:
+            url = url_or_request.get_full_url()
+        except AttributeError:
+            url, headers = url_or_request, ()
+        else:
+            if url_or_request.data is not None:
+                return fetch(url_or_request, **kw)
+            headers = url_or_request.header_items()
+        if not url.startswith(('http://', 'https://')):
+            return fetch(url_or_request, **kw)
+        key = self.key(url, headers if context is None else [*headers, *context(url)])
+        cached = self.get(key)
+        now = time.time()
+        if cached is not None:
+            meta, data = cached
+            if now - meta['stored'] < max(ttl, meta.get('max_age', 0)):
+                self.count(fresh=1, bytes_saved=len(data))
+                return cached_response(meta, data)
+        rq = Request(url, headers=dict(headers))
+        if cached is not None:
+            if meta['etag']:
+                rq.add_header('If-None-Match', meta['etag'])
+            if meta['last_modified']:
+                rq.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            res = fetch(rq, **kw)
+        except HTTPError as err:
+            if err.code != 304 or cached is None:
+                raise
+            meta['stored'] = now
+            self.set(key, meta, data)
+            self.count(revalidated=1, bytes_saved=len(data))
+            return cached_response(meta, data)
+        data = res.read()
+        code, msg, info = getattr(res, 'code', 200), getattr(res, 'msg', 'OK'), res.info()
+        self.count(downloaded=1, bytes_downloaded=len(data))
+        cc = cache_control(info)
+        if code == 200 and 'no-store' not in cc:
+            meta = {
+                'url': res.geturl(), 'code': code, 'msg': msg, 'stored': now,
+                'headers': [(k, v) for k, v in info.items() if k.lower() not in UNCACHED_HEADERS],
+                'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified'),
+                'max_age': 0 if 'no-cache' in cc else parse_max_age(cc.get('max-age')),
+            }
+            self.set(key, meta, data)
+        return make_response(data, list(info.items()), res.geturl(), code, msg)
+
+
+def cache_control(headers):
+    ans = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, sep, val = directive.partition('=')
+        if name.strip():
+            ans[name.strip().lower()] = val.strip().strip('"')
+    return ans
+
+
+def parse_max_age(val):
+    try:
+        return max(0, int(val))
+    except (TypeError, ValueError):
+        return 0
+
+
+def find_tests():
+    import os
+    import shutil
+    import tempfile
+    import unittest
+
+    from mechanize import HTTPError, Request
+
+    from calibre import browser
+    from calibre.utils.http_test_server import LocalHTTPServer
+
+    class Server(LocalHTTPServer):
+
+        def __init__(self):
+            super().__init__()
+            self.pages = {'/page': b'page1', '/other': b'other', '/image': b'image', '/private': b'private'}
+            self.cache_control = {'/image': 'public, max-age=3600', '/private': 'no-store'}
+
+        def respond(self, handler):
+            if handler.command == 'POST':
+                self.send(handler, handler.rfile.read(int(handler.headers['Content-Length'])))
+                return
+            if handler.path == '/missing':
+                self.send(handler, code=404)
+                return
+            body = self.pages[handler.path]
+            etag = '"%d"' % hash(body)  # noqa: UP031
+            if handler.path == '/page':
+                if handler.headers.get('If-None-Match') == etag:
+                    self.send(handler, code=304)
+                    return
+                headers = [('ETag', etag)]
+            else:
+                headers = [('Cache-Control', self.cache_control[handler.path])] if handler.path in self.cache_control else []
+            self.send(handler, body, headers=[('Content-Type', 'text/html'), *headers])
+
+    class TestHTTPCache(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+            self.server = Server().__enter__()
+            self.base = self.server.base_url
+
+        def tearDown(self):
+            self.server.__exit__()
+            shutil.rmtree(self.tdir)
+
+        def test_http_cache(self):
+            cache = HTTPCache(self.tdir)
+            br = browser(user_agent='calibre-test')
+            br.set_http_cache(cache, 3600)
+            reqs = self.server.requests
+
+            def get(path, br=br):
+                return br.clone_browser().open_novisit(self.base + path, timeout=5).read()
+
+            # Fresh responses are served from the cache
+            self.assertEqual(get('/page'), b'page1')
+            self.assertEqual(get('/page'), b'page1')
+            self.assertEqual(len(reqs), 1)
+            res = br.open_novisit(self.base + '/page', timeout=5)
+            self.assertEqual(res.info()['Content-Type'], 'text/html')
+            self.assertEqual(res.geturl(), self.base + '/page')
+            self.assertEqual(len(reqs), 1)
+            # Headers set on request objects are part of the key
+            self.assertEqual(br.open_novisit(Request(self.base + '/page', headers={'X-Test': '1'})).read(), b'page1')
+            self.assertEqual(len(reqs), 2)
+
+            # Stale responses are revalidated
+            br.set_http_cache(cache, 0)
+            self.assertEqual(get('/page'), b'page1')
+            self.assertEqual(reqs[-1][1].get('If-None-Match'), '"%d"' % hash(b'page1'))  # noqa: UP031
+            self.server.pages['/page'] = b'page2'
+            self.assertEqual(get('/page'), b'page2')
+            br.set_http_cache(cache, 3600)
+            n = len(reqs)
+            self.assertEqual(get('/page'), b'page2')
+            self.assertEqual(len(reqs), n)
+
+            # Errors and POST requests are not cached
+            for i in range(2):
+                with self.assertRaises(HTTPError):
+                    get('/missing')
+                self.assertEqual(br.open_novisit(self.base + '/other', data=b'x').read(), b'x')
+            self.assertEqual(len(reqs), n + 4)
+
+            # Discarding and size limits
+            br.discard_cached_response(self.base + '/page')
+            self.assertEqual(get('/page'), b'page2')
+            self.assertEqual(len(reqs), n + 5)
+            get('/other')
+            cache.max_size = 1
+            cache.prune()
+            self.assertEqual(len(tuple(cache.entries())), 0)
+            cache.max_entry_size = 2
+            get('/other')
+            self.assertEqual(len(tuple(cache.entries())), 0)
+
+            # Cache-Control
+            cache.max_size = cache.max_entry_size = 1024
+            br.set_http_cache(cache, 0)
+            cache.stats.clear()
+            n = len(reqs)
+            for i in range(2):
+                self.assertEqual(get('/image'), b'image')
+                self.assertEqual(get('/private'), b'private')
+            self.assertEqual(len(reqs), n + 3)
+            self.assertEqual(cache.stats, {'downloaded': 3, 'fresh': 1, 'bytes_downloaded': 19, 'bytes_saved': 5})
+            self.assertEqual(cache_control({'Cache-Control': 'no-cache, Max-Age="10"'}), {'no-cache': '', 'max-age': '10'})
+
+            # Browsers without a cache make requests as usual
+            n = len(reqs)
+            self.assertEqual(get('/other', browser(user_agent='calibre-test')), b'other')
+            self.assertEqual(len(reqs), n + 1)
+
+        def test_request_context(self):
+            cache = HTTPCache(self.tdir)
+            br = browser(user_agent='calibre-test')
+            br.set_http_cache(cache, 3600)
+            reqs = self.server.requests
+
+            def get(br):
+                return br.open_novisit(self.base + '/page', timeout=5).read()
+
+            get(br), get(br)
+            self.assertEqual(len(reqs), 1)
+            # Responses are not shared between browsers with different cookies or headers
+            br.set_cookie('session', 'x', '127.0.0.1')
+            get(br), get(br.clone_browser())
+            self.assertEqual(len(reqs), 2)
+            br.set_current_header('Authorization', 'Bearer x')
+            get(br)
+            self.assertEqual(len(reqs), 3)
+            # The user agent is not part of the key
+            br.set_user_agent('other')
+            get(br)
+            self.assertEqual(len(reqs), 3)
+            br.discard_cached_response(self.base + '/page')
+            get(br)
+            self.assertEqual(len(reqs), 4)
+
+        def test_unwritable_location(self):
+            path = os.path.join(self.tdir, 'file')
+            with open(path, 'wb'):
+                pass
+            cache = HTTPCache(os.path.join(path, 'cache'))
+            br = browser(user_agent='calibre-test')
+            br.set_http_cache(cache, 3600)
+            # Requests fall back to the network
+            for i in range(2):
+                self.assertEqual(br.open_novisit(self.base + '/page', timeout=5).read(), b'page1')
+            self.assertEqual(len(self.server.requests), 2)
+            self.assertEqual(cache.stats['downloaded'], 2)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestHTTPCache)
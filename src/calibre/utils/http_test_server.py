@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A local HTTP server for tests and benchmarks of code that downloads things,
+such as the HTTP cache, metadata sources and news downloads.
+'''
+
+import time
+from threading import Lock, Thread
+
+
+class LocalHTTPServer:
+
+    '''
+    Serves HTTP/1.1, with connection reuse, on a random port of 127.0.0.1,
+    while used as a context manager. Every GET and POST request is answered,
+    after latency seconds, by :meth:`respond`. The path and headers of every
+    request, the number of connections and the largest number of requests
+    handled at once are recorded.
+    '''
+
+    def __init__(self, latency=0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.latency = latency
+        self.lock = Lock()
+        self.connections, self.requests = 0, []
+        self.in_flight = self.max_in_flight = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = 64 * 1024
+
+            def setup(self):
+                with server.lock:
+                    server.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                server.handle(self)
+            do_POST = do_GET
+
+            def log_message(self, *a):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]  # noqa: UP031
+
+    def handle(self, handler):
+        with self.lock:
+            self.requests.append((handler.path, handler.headers))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            self.respond(handler)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def respond(self, handler):
+        ' Send the response to the request being handled by handler, a BaseHTTPRequestHandler '
+        raise NotImplementedError()
+
+    def send(self, handler, body=b'', code=200, headers=()):
+        handler.send_response(code)
+        for name, val in headers:
+            handler.send_header(name, val)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def paths_requested(self):
+        return [path for path, headers in self.requests]
+
+    def __enter__(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *a):
+        self.httpd.shutdown()
+        self.httpd.server_close()
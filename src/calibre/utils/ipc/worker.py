@@ -42,9 +42,6 @@
     'webengine-dialog':
     ('calibre.gui_launch', 'webengine_dialog', None),
 
-    'render_pages':
-    ('calibre.ebooks.comic.input', 'render_pages', 'notification'),
-
     'gui_convert':
     ('calibre.gui2.convert.gui_conversion', 'gui_convert', 'notification'),
 
@@ -245,6 +245,8 @@ def ok(x):
         a(test(return_tests=True))
         from calibre.ebooks.html_transform_rules import test
         a(test(return_tests=True))
+        from calibre.ebooks.oeb.stylizer import find_tests
+        a(find_tests())
         from css_selectors.tests import find_tests
         a(find_tests())
     if ok('docx'):
@@ -272,6 +274,8 @@ def ok(x):
         a(find_tests())
         from calibre.ebooks.metadata.html import find_tests
         a(find_tests())
+        from calibre.ebooks.metadata.mobi import find_tests
+        a(find_tests())
         from calibre.utils.xml_parse import find_tests
         a(find_tests())
         from calibre.gui2.viewer.annotations import find_tests
@@ -318,6 +322,30 @@ def ok(x):
         a(find_tests())
         from calibre.gui2.listener import find_tests
         a(find_tests())
+        from calibre.devices.mtp.filesystem_cache import find_tests
+        a(find_tests())
+        from calibre.devices.smart_device_app.loopback import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.stylesheet_cache import find_tests
+        a(find_tests())
+        from calibre.ebooks.conversion.stage_profiler import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.transforms.parallel import find_tests
+        a(find_tests())
+        from calibre.utils.disk_cache import find_tests
+        a(find_tests())
+        from calibre.utils.fonts.subset import find_tests
+        a(find_tests())
+        from calibre.utils.http_cache import find_tests
+        a(find_tests())
+        from calibre.ebooks.metadata.sources.test_bulk_download import find_tests
+        a(find_tests())
+        from calibre.web.fetch.test_scheduler import find_tests
+        a(find_tests())
+        from calibre.web.fetch.cache import find_tests
+        a(find_tests())
+        from calibre.web.feeds.batch import find_tests
+        a(find_tests())
         if iswindows:
             from calibre.utils.windows.wintest import find_tests
             a(find_tests())
@@ -2,6 +2,7 @@
 Read and write ZIP files. Modified by Kovid Goyal to support replacing files in
 a zip archive, detecting filename encoding, updating zip files, etc.
 '''
+import copy
 import io
 import os
 import re
@@ -1405,6 +1406,60 @@ def writestr(self, zinfo_or_arcname, byts, permissions=0o600,
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def copy_raw(self, source, zinfo_or_name, arcname=None, chunk_size=1024*1024):
+        '''Copy a member of the ZipFile source into this archive without
+        decompressing and recompressing it. The compressed data, CRC, sizes and
+        other header fields are copied as is, the data is streamed in chunks of
+        chunk_size bytes. Encrypted members are copied as is as well. Returns
+        the ZipInfo of the new member.'''
+        if not self.fp:
+            raise RuntimeError(
+                  'Attempt to write to ZIP archive that was already closed')
+        if not source.fp:
+            raise RuntimeError(
+                  'Attempt to read ZIP archive that was already closed')
+        src = zinfo_or_name if isinstance(zinfo_or_name, ZipInfo) else source.getinfo(zinfo_or_name)
+        pos = src.header_offset
+        if source.pread_fd > -1:
+            def read(n):
+                nonlocal pos
+                ans = pread_all(source.pread_fd, n, pos)
+                pos += len(ans)
+                return ans
+        else:
+            source.fp.seek(pos, os.SEEK_SET)
+            def read(n):
+                return source.fp.read(n)
+
+        fheader = read(sizeFileHeader)
+        if fheader[0:4] != stringFileHeader:
+            raise BadZipfile('Bad magic number for file header')
+        fheader = struct.unpack(structFileHeader, fheader)
+        read(fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+
+        zinfo = copy.copy(src)
+        if arcname is not None:
+            zinfo.filename = zinfo.orig_filename = arcname
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader())
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            chunk = read(min(chunk_size, remaining))
+            if not chunk:
+                raise BadZipfile(f'Truncated data for member: {zinfo.filename}')
+            self.fp.write(chunk)
+            remaining -= len(chunk)
+        self.fp.flush()
+        if zinfo.flag_bits & 0x08:
+            # Write CRC and file sizes after the file data
+            self.fp.write(struct.pack('<LLL', zinfo.CRC, zinfo.compress_size,
+                  zinfo.file_size))
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+        return zinfo
+
     def add_dir(self, path, prefix='', simple_filter=lambda x:False):
         '''
         Add a directory recursively to the zip file with an optional prefix.
@@ -1576,7 +1631,7 @@ def rbytes(name):
                 ztemp.writestr(obj, rbytes(obj.filename))
                 found.add(obj.filename)
             else:
-                ztemp.writestr(obj, z.read_raw(obj), raw_bytes=True)
+                ztemp.copy_raw(z, obj)
         if add_missing:
             for name in names - found:
                 ztemp.writestr(name, rbytes(name))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Download several news sources at once, each in its own worker process. For
+example, to download a list of recipes every night::
+
+    calibre-debug -c "from calibre.web.feeds.batch import main; main()" -- -j 4 -d /path/to/output *.recipe
+
+Options after the recipes are passed on to ebook-convert.
+'''
+
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+
+from calibre.utils.filenames import ascii_filename
+from calibre.utils.localization import _
+
+
+def output_path(recipe, output_dir, output_format):
+    name = os.path.splitext(os.path.basename(recipe))[0]
+    return os.path.join(output_dir, ascii_filename(name) + '.' + output_format.lower())
+
+
+def fetch_one(recipe, output, extra_args, timeout):
+    from calibre.utils.ipc.simple_worker import WorkerError, fork_job
+    log_path = output + '.log'
+    try:
+        ret = fork_job('calibre.ebooks.conversion.cli', 'main', (['ebook-convert', recipe, output] + list(extra_args),), timeout=timeout)
+    except WorkerError as e:
+        if e.log_path and os.path.exists(e.log_path):
+            shutil.move(e.log_path, log_path)
+        return e.orig_tb or str(e)
+    shutil.move(ret['stdout_stderr'], log_path)
+    if ret['result']:
+        return f'ebook-convert failed, see {log_path}'
+
+
+def fetch_news(recipes, output_dir, output_format='epub', max_parallel=None, extra_args=(), timeout=3 * 3600, report=None):
+    '''
+    Download the news from every recipe in recipes, a list of recipe files or
+    titles of builtin recipes, into output_dir, running at most max_parallel
+    downloads at a time. The log of each download is saved next to its output.
+    report(recipe, output, error) is called, in a worker thread, as each
+    download finishes. Returns a dict mapping recipes to errors, for the
+    downloads that failed.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    max_parallel = max_parallel or min(4, os.cpu_count() or 1)
+    failures = {}
+
+    def run(recipe):
+        output = output_path(recipe, output_dir, output_format)
+        with suppress(FileNotFoundError):
+            os.remove(output)
+        error = fetch_one(recipe, output, extra_args, timeout)
+        if error is None and not os.path.exists(output):
+            error = 'No output was created'
+        if error is not None:
+            failures[recipe] = error
+        if report is not None:
+            report(recipe, output, error)
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        for f in [executor.submit(run, recipe) for recipe in recipes]:
+            f.result()
+    return failures
+
+
+def option_parser():
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage=_('''\
+%prog [options] recipe1 recipe2 ... [ebook-convert options]
+
+Download the news from several recipes at once, each in a separate process.
+Recipes can be .recipe files or titles of builtin recipes.
+'''))
+    parser.add_option('-d', '--output-dir', default='.', help=_('Directory to save the downloaded news to'))
+    parser.add_option('-f', '--output-format', default='epub', help=_('The e-book format to create, default: %default'))
+    parser.add_option('-j', '--parallel', type='int', default=0, help=_('Number of recipes to download at once, default: up to four'))
+    parser.disable_interspersed_args()
+    return parser
+
+
+def main(args=sys.argv):
+    parser = option_parser()
+    # Everything after the first recipe is a recipe or an ebook-convert option
+    opts, args = parser.parse_args(args[1:])
+    recipes = []
+    while args and not args[0].startswith('-'):
+        recipes.append(args.pop(0))
+    if not recipes:
+        parser.print_help()
+        raise SystemExit(1)
+
+    def report(recipe, output, error):
+        print(f'Failed to download: {recipe}' if error else f'Downloaded {recipe} to {output}', flush=True)
+
+    failures = fetch_news(recipes, os.path.abspath(opts.output_dir), opts.output_format, opts.parallel, args, report=report)
+    for recipe, error in failures.items():
+        print(f'\n{recipe}:\n{error}', file=sys.stderr)
+    raise SystemExit(1 if failures else 0)
+
+
+def find_tests():
+    import tempfile
+    import time
+    import unittest
+    from threading import Lock
+    from unittest.mock import patch
+
+    class TestBatch(unittest.TestCase):
+
+        def setUp(self):
+            self.tdir = tempfile.mkdtemp()
+            self.lock = Lock()
+            self.calls, self.in_flight, self.max_in_flight = [], 0, 0
+
+        def tearDown(self):
+            shutil.rmtree(self.tdir)
+
+        def fetch_one(self, recipe, output, extra_args, timeout):
+            with self.lock:
+                self.calls.append((recipe, output, tuple(extra_args)))
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                time.sleep(0.05)
+                if recipe == 'Broken':
+                    return 'Recipe failed'
+                if recipe != 'Empty':
+                    with open(output, 'wb') as f:
+                        f.write(recipe.encode('utf-8'))
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        def test_fetch_news(self):
+            recipes = [f'News {i}' for i in range(6)] + ['Broken', 'Empty', os.path.join('recipes', 'local.recipe')]
+            reports = {}
+
+            def report(recipe, output, error):
+                reports[recipe] = output, error
+
+            # A stale output from an earlier download is not mistaken for a new one
+            with open(os.path.join(self.tdir, 'Empty.mobi'), 'wb'):
+                pass
+            with patch('calibre.web.feeds.batch.fetch_one', self.fetch_one):
+                failures = fetch_news(recipes, self.tdir, 'MOBI', 3, ['--test'], report=report)
+            self.assertEqual(failures, {'Broken': 'Recipe failed', 'Empty': 'No output was created'})
+            self.assertEqual(sorted(c[0] for c in self.calls), sorted(recipes))
+            self.assertEqual({c[2] for c in self.calls}, {('--test',)})
+            self.assertEqual(self.max_in_flight, 3)
+            self.assertEqual(set(reports), set(recipes))
+            self.assertEqual(reports['Broken'][1], 'Recipe failed')
+            output, error = reports['News 1']
+            self.assertIsNone(error)
+            self.assertEqual(output, os.path.join(self.tdir, 'News 1.mobi'))
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), b'News 1')
+            self.assertEqual(reports[recipes[-1]][0], os.path.join(self.tdir, 'local.mobi'))
+
+        def test_main(self):
+            from io import StringIO
+            with patch('calibre.web.feeds.batch.fetch_one', self.fetch_one), patch('sys.stdout', StringIO()), patch('sys.stderr', StringIO()):
+                with self.assertRaises(SystemExit) as cm:
+                    main(['batch', '-d', self.tdir, '-j', '2', 'News', 'Other', '--test'])
+                self.assertEqual(cm.exception.code, 0)
+                with self.assertRaises(SystemExit) as cm:
+                    main(['batch', '-d', self.tdir, 'News', 'Broken'])
+                self.assertEqual(cm.exception.code, 1)
+            self.assertEqual(sorted(c[0] for c in self.calls[:2]), ['News', 'Other'])
+            self.assertEqual({c[2] for c in self.calls[:2]}, {('--test',)})
+            self.assertEqual(self.calls[2][2], ())
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBatch)
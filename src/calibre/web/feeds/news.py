@@ -22,6 +22,7 @@
 from calibre.ebooks.metadata.opf2 import OPFCreator
 from calibre.ebooks.metadata.toc import TOC
 from calibre.ptempfile import PersistentTemporaryFile
+from calibre.utils.browser import ConnectionPool
 from calibre.utils.date import now as nowf
 from calibre.utils.icu import numeric_sort_key
 from calibre.utils.img import add_borders_to_image, image_to_data, save_cover_data_to
@@ -30,6 +31,8 @@
 from calibre.utils.threadpool import NoResultsPending, ThreadPool, WorkRequest
 from calibre.web import Recipe
 from calibre.web.feeds import Feed, feed_from_xml, feeds_from_index, templates
+from calibre.web.fetch.cache import RecipeCache
+from calibre.web.fetch.scheduler import HostLimiter, SharedDownloads
 from calibre.web.fetch.simple import AbortArticle, RecursiveFetcher
 from calibre.web.fetch.simple import option_parser as web2disk_option_parser
 from calibre.web.fetch.utils import prepare_masthead_image
@@ -99,7 +102,8 @@ class BasicNewsRecipe(Recipe):
 
     #: The default delay between consecutive downloads in seconds. The argument may be a
     #: floating point number to indicate a more precise time. See :meth:`get_url_specific_delay`
-    #: to implement per URL delays.
+    #: to implement per URL delays. Downloads with a delay are made one at a time
+    #: from each server, downloads from other servers are not delayed.
     delay                  = 0
 
     #: Publication type
@@ -108,9 +112,22 @@ class BasicNewsRecipe(Recipe):
     publication_type = 'unknown'
 
     #: Number of simultaneous downloads. Set to 1 if the server is picky.
-    #: Automatically reduced to 1 if :attr:`BasicNewsRecipe.delay` > 0
+    #: See also :attr:`BasicNewsRecipe.simultaneous_downloads_per_host`
     simultaneous_downloads = 5
 
+    #: Maximum number of simultaneous downloads from any one server. Zero means
+    #: no limit other than :attr:`BasicNewsRecipe.simultaneous_downloads`. Use this
+    #: rather than reducing :attr:`BasicNewsRecipe.simultaneous_downloads`
+    #: when only some servers, such as the site itself but not the one serving
+    #: its images, are picky.
+    simultaneous_downloads_per_host = 0
+
+    #: Keep the pages, images and stylesheets downloaded by this recipe between
+    #: downloads, and only download them again when they have changed, which is
+    #: checked with a conditional request for every one. Set to False if the
+    #: site does not handle conditional requests correctly.
+    use_http_cache = True
+
     #: Timeout for fetching files from server in seconds
     timeout                = 120.0
 
@@ -579,6 +596,12 @@ def get_browser(self, *a, **kw):
         br.addheaders += [('Accept', '*/*')]
         if self.handle_gzip:
             br.set_handle_gzip(True)
+        pool = getattr(self, 'connection_pool', None)
+        if pool is not None:
+            br.set_connection_pool(pool)
+        cache = getattr(self, 'recipe_cache', None)
+        if cache is not None:
+            br.set_http_cache(cache.http, 0)
         return br
 
     def clone_browser(self, br):
@@ -975,6 +998,14 @@ def __init__(self, options, log, progress_reporter):
             if self.needs_subscription != 'optional':
                 raise ValueError(_('The "%s" recipe needs a username and password.')%self.title)
 
+        # Keep-alive connections shared by all browsers created by get_browser()
+        self.connection_pool = ConnectionPool(max_per_host=max(4, self.simultaneous_downloads))
+        self.recipe_cache = None
+        if self.use_http_cache:
+            try:
+                self.recipe_cache = RecipeCache(self.title)
+            except OSError:
+                self.log.exception('Failed to create the download cache, not using it')
         self.browser = self.get_browser()
         self.image_map, self.image_counter = {}, 1
         self.css_map = {}
@@ -1015,9 +1046,9 @@ def __init__(self, options, log, progress_reporter):
         self.web2disk_options.encoding = self.encoding
         self.web2disk_options.preprocess_raw_html = self.preprocess_raw_html_
         self.web2disk_options.get_delay = self.get_url_specific_delay
-
-        if self.delay > 0:
-            self.simultaneous_downloads = 1
+        self.web2disk_options.host_limiter = HostLimiter(self.simultaneous_downloads_per_host)
+        self.web2disk_options.shared_downloads = SharedDownloads()
+        self.web2disk_options.recipe_cache = self.recipe_cache
 
         self.navbar = templates.TouchscreenNavBarTemplate() if self.touchscreen else \
                       templates.NavBarTemplate()
@@ -1120,6 +1151,8 @@ def download(self):
         try:
             res = self.build_index()
             self.report_progress(1, _('Download finished'))
+            if self.recipe_cache is not None:
+                self.log(self.recipe_cache.report())
             if self.failed_downloads:
                 self.log.warning(_('Failed to download the following articles:'))
                 for feed, article, debug in self.failed_downloads:
@@ -1137,7 +1170,10 @@ def download(self):
                         self.log.debug(tb)
             return res
         finally:
-            self.cleanup()
+            try:
+                self.cleanup()
+            finally:
+                self.connection_pool.close()
 
     @property
     def lang_for_html(self):
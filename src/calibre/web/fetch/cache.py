@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+The cache a recipe keeps between downloads, so that the pages, images and
+stylesheets that have not changed since the previous download are not
+downloaded, or processed, again.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import Counter
+from contextlib import suppress
+from threading import Lock
+
+from calibre import human_readable
+from calibre.constants import cache_dir
+from calibre.utils.disk_cache import DiskCache
+from calibre.utils.http_cache import HTTPCache
+
+# Caches of recipes that have not been downloaded for this long are deleted
+UNUSED_CACHE_MAX_AGE = 30 * 24 * 3600
+
+
+def recipe_caches_dir():
+    return os.path.join(cache_dir(), 'news')
+
+
+def prune_unused_caches(base, max_age=UNUSED_CACHE_MAX_AGE):
+    now = time.time()
+    with suppress(OSError), os.scandir(base) as entries:
+        for entry in entries:
+            with suppress(OSError):
+                if entry.is_dir() and now - entry.stat().st_mtime > max_age:
+                    shutil.rmtree(entry.path)
+
+
+class RecipeCache:
+
+    '''
+    The HTTP responses downloaded by the recipe named name, revalidated with
+    conditional requests on every download, and the images it processed,
+    keyed by their contents and the processing settings.
+    '''
+
+    def __init__(self, name, location=None, max_size=64 * 1024 * 1024):
+        if location is None:
+            base = recipe_caches_dir()
+            prune_unused_caches(base)
+            location = os.path.join(base, hashlib.sha256(name.encode('utf-8')).hexdigest()[:32])
+        self.location = location
+        os.makedirs(location, exist_ok=True)
+        os.utime(location)  # mark as used
+        self.http = HTTPCache(os.path.join(location, 'http'), max_size=max_size)
+        self.images = DiskCache(os.path.join(location, 'images'), max_size // 2)
+        self.image_stats = Counter()
+        self.lock = Lock()
+
+    def processed_image(self, data, settings, process):
+        '''
+        Return the (image type, data) pair returned by process(), called with
+        data, or from the cache if an identical image was processed with the
+        same settings before.
+        '''
+        h = hashlib.sha256(data)
+        h.update(json.dumps(settings).encode('utf-8'))
+        key = h.hexdigest()
+        cached = self.images.get(key)
+        if cached is not None:
+            self.count_image(reused=1)
+            return cached[0]['type'], cached[1]
+        itype, ans = process(data)
+        self.images.set(key, {'type': itype}, ans)
+        self.count_image(processed=1)
+        return itype, ans
+
+    def count_image(self, **kw):
+        with self.lock:
+            self.image_stats.update(kw)
+
+    def report(self):
+        h, i = self.http.stats, self.image_stats
+        cached = h['fresh'] + h['revalidated']
+        return '\n'.join((
+            'Download cache: {} of {} files were not downloaded again ({} unchanged, {} still fresh)'.format(
+                cached, cached + h['downloaded'], h['revalidated'], h['fresh']),
+            f'Download cache: {human_readable(h["bytes_downloaded"])} downloaded, {human_readable(h["bytes_saved"])} saved',
+            f'Download cache: {i["reused"]} images reused and {i["processed"]} images processed',
+        ))
+
+
+def find_tests():
+    import tempfile
+    import unittest
+
+    class TestRecipeCache(unittest.TestCase):
+
+        def test_processed_images(self):
+            calls = []
+
+            def process(data):
+                calls.append(data)
+                return 'png', data.upper()
+
+            with tempfile.TemporaryDirectory() as tdir:
+                rc = RecipeCache('test', location=tdir)
+                self.assertEqual(rc.processed_image(b'abc', (('scale', 1),), process), ('png', b'ABC'))
+                self.assertEqual(RecipeCache('test', location=tdir).processed_image(b'abc', (('scale', 1),), process), ('png', b'ABC'))
+                self.assertEqual(len(calls), 1)
+                rc.processed_image(b'abc', (('scale', 2),), process)
+                self.assertEqual(len(calls), 2)
+                self.assertIn('2 images processed', rc.report())
+
+                base = os.path.join(tdir, 'caches')
+                os.makedirs(os.path.join(base, 'old'))
+                os.makedirs(os.path.join(base, 'new'))
+                os.utime(os.path.join(base, 'old'), (0, 0))
+                prune_unused_caches(base)
+                self.assertEqual(os.listdir(base), ['new'])
+
+        def test_conditional_requests(self):
+            from calibre.web.fetch.test_scheduler import FixtureServer, fetch_articles
+            with tempfile.TemporaryDirectory() as tdir, FixtureServer() as images, FixtureServer(images_from=images) as site:
+                urls = [f'{site.base_url}/article/{i}.html' for i in range(6)]
+                for i in range(2):
+                    rc = RecipeCache('test', location=os.path.join(tdir, 'cache'))
+                    results = fetch_articles(urls, os.path.join(tdir, str(i)), recipe_cache=rc)
+                    for path in results:
+                        with open(path, 'rb') as f:
+                            self.assertIn(b'<img', f.read())
+                    if i == 0:
+                        self.assertEqual(site.not_modified + images.not_modified, 0)
+                        self.assertEqual(rc.http.stats['downloaded'], 14)
+                num = len(site.requests) + len(images.requests)
+                self.assertEqual(num, 28)
+                # The second download only revalidated what it downloaded before
+                self.assertEqual(site.not_modified + images.not_modified, 14)
+                self.assertEqual(rc.http.stats['revalidated'], 14)
+                self.assertIn('14 of 14 files were not downloaded again', rc.report())
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestRecipeCache)
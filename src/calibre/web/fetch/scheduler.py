@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Coordinate the threads that download the articles of a recipe, so that each
+host is only sent as many requests, and as often, as it allows, while other
+hosts are downloaded from at full speed, and so that images and stylesheets
+shared by several articles are downloaded only once.
+'''
+
+import time
+from contextlib import contextmanager, nullcontext
+from threading import BoundedSemaphore, Event, Lock
+from urllib.parse import urlsplit
+
+
+class Host:
+
+    __slots__ = ('last_fetch_at', 'semaphore', 'serial')
+
+    def __init__(self, max_requests):
+        self.semaphore = BoundedSemaphore(max_requests) if max_requests > 0 else None
+        self.serial = Lock()
+        self.last_fetch_at = 0.
+
+
+class HostLimiter:
+
+    '''
+    Limit the requests made to every host, by all the threads using this
+    object. At most max_per_host requests are made to a host at a time, with
+    zero meaning no limit. Requests with a delay are made one at a time, at
+    least delay seconds after the previous request to the same host finished.
+    '''
+
+    def __init__(self, max_per_host=0):
+        self.max_per_host = max_per_host
+        self.lock = Lock()
+        self.hosts = {}
+
+    def host(self, url):
+        key = urlsplit(url).netloc.lower()
+        with self.lock:
+            ans = self.hosts.get(key)
+            if ans is None:
+                ans = self.hosts[key] = Host(self.max_per_host)
+        return ans
+
+    @contextmanager
+    def slot(self, url, delay=0):
+        ' Wait until a request for url can be made and make it in the with block '
+        host = self.host(url)
+        with host.semaphore or nullcontext(), host.serial if delay > 0 else nullcontext():
+            if delay > 0:
+                wait = host.last_fetch_at + delay - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                yield
+            finally:
+                host.last_fetch_at = time.monotonic()
+
+
+class SharedDownloads:
+
+    '''
+    Ensure that a resource used by several articles is downloaded only once,
+    even when the articles are downloaded at the same time.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = {}
+        # Map of the hashes of the contents of saved images to their paths
+        self.images_by_hash = {}
+
+    @contextmanager
+    def claim(self, cache, url):
+        '''
+        Yield the value stored for url in the dict cache, waiting for a
+        download of it in another thread to finish first. If there is no value,
+        yield None, in which case the caller must download the resource and
+        store it in cache in the with block.
+        '''
+        while True:
+            with self.lock:
+                if url in cache:
+                    ans = cache[url]
+                    break
+                pending = self.pending.get(url)
+                if pending is None:
+                    pending = self.pending[url] = Event()
+                    ans = None
+                    break
+            # If the download in the other thread fails, try again
+            pending.wait()
+        if ans is not None:
+            yield ans
+            return
+        try:
+            yield None
+        finally:
+            with self.lock:
+                del self.pending[url]
+            pending.set()
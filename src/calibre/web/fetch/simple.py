@@ -10,14 +10,15 @@
 '''
 
 
+import hashlib
 import os
 import re
 import socket
 import sys
-import threading
 import time
 import traceback
 from base64 import standard_b64decode
+from functools import partial
 from http.client import responses
 from urllib.error import URLError
 from urllib.parse import quote, urljoin, urlparse, urlsplit, urlunparse, urlunsplit
@@ -32,6 +33,7 @@
 from calibre.utils.imghdr import what
 from calibre.utils.localization import _
 from calibre.utils.logging import Log
+from calibre.web.fetch.scheduler import HostLimiter, SharedDownloads
 from calibre.web.fetch.utils import rescale_image
 
 
@@ -151,13 +153,13 @@ def __init__(self, options, log, image_map={}, css_map={}, job_info=None):
         self.filter_regexps = [re.compile(i, re.IGNORECASE) for i in options.filter_regexps]
         self.max_files = options.max_files
         self.delay = options.delay
-        self.last_fetch_at = 0.
+        # Shared by all the fetchers of a recipe, to coordinate their downloads
+        self.host_limiter = getattr(options, 'host_limiter', None) or HostLimiter()
+        self.shared_downloads = getattr(options, 'shared_downloads', None) or SharedDownloads()
         self.filemap = {}
         self.imagemap = image_map
-        self.imagemap_lock = threading.RLock()
         self.stylemap = css_map
         self.image_url_processor = None
-        self.stylemap_lock = threading.RLock()
         self.downloaded_paths = []
         self.current_dir = self.base_dir
         self.files = 0
@@ -178,6 +180,11 @@ def __init__(self, options, log, image_map={}, css_map={}, job_info=None):
         self.compress_news_images = getattr(options, 'compress_news_images', False)
         self.compress_news_images_auto_size = getattr(options, 'compress_news_images_auto_size', 16)
         self.scale_news_images = getattr(options, 'scale_news_images', None)
+        # Cache of responses and processed images kept between downloads, or None
+        self.recipe_cache = getattr(options, 'recipe_cache', None)
+        self.image_processing_settings = (
+            ('compress', self.compress_news_images), ('scale', repr(self.scale_news_images)),
+            ('max_size', self.compress_news_images_max_size), ('auto_size', self.compress_news_images_auto_size))
         self.get_delay = getattr(options, 'get_delay', lambda url: self.delay)
         self.download_stylesheets = not options.no_stylesheets
         self.show_progress = True
@@ -277,14 +284,11 @@ def fetch_url(self, url):
             self.log.debug(f'Fetched {url} in {time.monotonic() - st:.1f} seconds')
             return data
 
-        delta = time.monotonic() - self.last_fetch_at
         delay = self.get_delay(url)
-        if delta < delay:
-            time.sleep(delay - delta)
         url = canonicalize_url(url)
         open_func = getattr(self.browser, 'open_novisit', self.browser.open)
         try:
-            with closing(open_func(url, timeout=self.timeout)) as f:
+            with self.host_limiter.slot(url, delay), closing(open_func(url, timeout=self.timeout)) as f:
                 data = response(f.read()+f.read())
                 data.newurl = f.geturl()
         except URLError as err:
@@ -299,13 +303,11 @@ def fetch_url(self, url):
             if is_temp:  # Connection reset by peer or Name or service not known
                 self.log.debug('Temporary error, retrying in 1 second')
                 time.sleep(1)
-                with closing(open_func(url, timeout=self.timeout)) as f:
+                with self.host_limiter.slot(url, delay), closing(open_func(url, timeout=self.timeout)) as f:
                     data = response(f.read()+f.read())
                     data.newurl = f.geturl()
             else:
                 raise err
-        finally:
-            self.last_fetch_at = time.monotonic()
         self.log.debug(f'Fetched {url} in {time.monotonic() - st:f} seconds')
         return data
 
@@ -354,23 +356,17 @@ def process_stylesheets(self, soup, baseurl):
                 iurl = tag['href']
                 if not urlsplit(iurl).scheme:
                     iurl = urljoin(baseurl, iurl, False)
-                found_cached = False
-                with self.stylemap_lock:
-                    if iurl in self.stylemap:
-                        tag['href'] = self.stylemap[iurl]
-                        found_cached = True
-                if found_cached:
-                    continue
-                try:
-                    data = self.fetch_url(iurl)
-                except Exception:
-                    self.log.exception('Could not fetch stylesheet ', iurl)
-                    continue
-                stylepath = os.path.join(diskpath, 'style'+str(c)+'.css')
-                with self.stylemap_lock:
-                    self.stylemap[iurl] = stylepath
-                with open(stylepath, 'wb') as x:
-                    x.write(data)
+                with self.shared_downloads.claim(self.stylemap, iurl) as stylepath:
+                    if stylepath is None:
+                        try:
+                            data = self.fetch_url(iurl)
+                        except Exception:
+                            self.log.exception('Could not fetch stylesheet ', iurl)
+                            continue
+                        stylepath = os.path.join(diskpath, 'style'+str(c)+'.css')
+                        with open(stylepath, 'wb') as x:
+                            x.write(data)
+                        self.stylemap[iurl] = stylepath
                 tag['href'] = stylepath
             else:
                 for ns in tag.findAll(text=True):
@@ -380,24 +376,18 @@ def process_stylesheets(self, soup, baseurl):
                         iurl = m.group(1)
                         if not urlsplit(iurl).scheme:
                             iurl = urljoin(baseurl, iurl, False)
-                        found_cached = False
-                        with self.stylemap_lock:
-                            if iurl in self.stylemap:
-                                ns.replaceWith(src.replace(m.group(1), self.stylemap[iurl]))
-                                found_cached = True
-                        if found_cached:
-                            continue
-                        try:
-                            data = self.fetch_url(iurl)
-                        except Exception:
-                            self.log.exception('Could not fetch stylesheet ', iurl)
-                            continue
-                        c += 1
-                        stylepath = os.path.join(diskpath, 'style'+str(c)+'.css')
-                        with self.stylemap_lock:
-                            self.stylemap[iurl] = stylepath
-                        with open(stylepath, 'wb') as x:
-                            x.write(data)
+                        with self.shared_downloads.claim(self.stylemap, iurl) as stylepath:
+                            if stylepath is None:
+                                try:
+                                    data = self.fetch_url(iurl)
+                                except Exception:
+                                    self.log.exception('Could not fetch stylesheet ', iurl)
+                                    continue
+                                c += 1
+                                stylepath = os.path.join(diskpath, 'style'+str(c)+'.css')
+                                with open(stylepath, 'wb') as x:
+                                    x.write(data)
+                                self.stylemap[iurl] = stylepath
                         ns.replaceWith(src.replace(m.group(1), stylepath))
 
     def rescale_image(self, data):
@@ -416,6 +406,8 @@ def process_images(self, soup, baseurl):
                 except Exception:
                     self.log.exception('Failed to decode embedded image')
                     continue
+                c += 1
+                imgpath = self.save_image(data, iurl, diskpath, c)
             else:
                 if callable(self.image_url_processor):
                     iurl = self.image_url_processor(baseurl, iurl)
@@ -423,60 +415,71 @@ def process_images(self, soup, baseurl):
                         continue
                 if not urlsplit(iurl).scheme:
                     iurl = urljoin(baseurl, iurl, False)
-                found_in_cache = False
-                with self.imagemap_lock:
-                    if iurl in self.imagemap:
-                        tag['src'] = self.imagemap[iurl]
-                        found_in_cache = True
-                if found_in_cache:
-                    continue
-                try:
-                    data = self.fetch_url(iurl)
-                    if data == b'GIF89a\x01':
-                        # Skip empty GIF files as PIL errors on them anyway
-                        continue
-                except Exception:
-                    self.log.exception('Could not fetch image ', iurl)
-                    continue
-            c += 1
-            fname = ascii_filename('img'+str(c))
-            data = self.preprocess_image_ext(data, iurl) if self.preprocess_image_ext is not None else data
-            if data is None:
-                continue
-            itype = what(None, data)
-            if itype == 'svg' or (itype is None and b'<svg' in data[:1024]):
-                # SVG image
-                imgpath = os.path.join(diskpath, fname+'.svg')
-                with self.imagemap_lock:
-                    self.imagemap[iurl] = imgpath
-                with open(imgpath, 'wb') as x:
-                    x.write(data)
-                tag['src'] = imgpath
-            else:
-                from calibre.utils.img import image_from_data, image_to_data
-                try:
-                    # Ensure image is valid
-                    img = image_from_data(data)
-                    if itype not in {'png', 'jpg', 'jpeg'}:
-                        itype = 'png' if itype == 'gif' else 'jpeg'
-                        data = image_to_data(img, fmt=itype)
-                    if self.compress_news_images:
+                with self.shared_downloads.claim(self.imagemap, iurl) as imgpath:
+                    if imgpath is None:
                         try:
-                            data = self.rescale_image(data)
+                            data = self.fetch_url(iurl)
+                            if data == b'GIF89a\x01':
+                                # Skip empty GIF files as PIL errors on them anyway
+                                continue
                         except Exception:
-                            self.log.exception('failed to compress image '+iurl)
-                    # Moon+ apparently cannot handle .jpeg files
-                    if itype == 'jpeg':
-                        itype = 'jpg'
-                    imgpath = os.path.join(diskpath, fname+'.'+itype)
-                    with self.imagemap_lock:
-                        self.imagemap[iurl] = imgpath
-                    with open(imgpath, 'wb') as x:
-                        x.write(data)
-                    tag['src'] = imgpath
-                except Exception:
-                    traceback.print_exc()
-                    continue
+                            self.log.exception('Could not fetch image ', iurl)
+                            continue
+                        c += 1
+                        imgpath = self.save_image(data, iurl, diskpath, c)
+            if imgpath is not None:
+                tag['src'] = imgpath
+
+    def save_image(self, data, iurl, diskpath, c):
+        ' Save the image to diskpath and return its path, or None if it is not a valid image '
+        fname = ascii_filename('img'+str(c))
+        data = self.preprocess_image_ext(data, iurl) if self.preprocess_image_ext is not None else data
+        if data is None:
+            return
+        # Images with identical contents at different URLs are saved only once
+        digest = hashlib.sha256(data).digest()
+        imgpath = self.shared_downloads.images_by_hash.get(digest)
+        if imgpath is not None:
+            self.imagemap[iurl] = imgpath
+            return imgpath
+        itype = what(None, data)
+        if itype == 'svg' or (itype is None and b'<svg' in data[:1024]):
+            # SVG image
+            itype = 'svg'
+        else:
+            try:
+                if self.recipe_cache is None:
+                    itype, data = self.process_image(data, itype, iurl)
+                else:
+                    itype, data = self.recipe_cache.processed_image(
+                        data, self.image_processing_settings, partial(self.process_image, itype=itype, iurl=iurl))
+            except Exception:
+                traceback.print_exc()
+                return
+        imgpath = os.path.join(diskpath, fname+'.'+itype)
+        with open(imgpath, 'wb') as x:
+            x.write(data)
+        self.imagemap[iurl] = self.shared_downloads.images_by_hash[digest] = imgpath
+        return imgpath
+
+    def process_image(self, data, itype, iurl):
+        ' Return the type and data of the image converted to PNG or JPEG and compressed, raises if it is not a valid image '
+        from calibre.utils.img import image_from_data, image_to_data
+
+        # Ensure image is valid
+        img = image_from_data(data)
+        if itype not in {'png', 'jpg', 'jpeg'}:
+            itype = 'png' if itype == 'gif' else 'jpeg'
+            data = image_to_data(img, fmt=itype)
+        if self.compress_news_images:
+            try:
+                data = self.rescale_image(data)
+            except Exception:
+                self.log.exception('failed to compress image '+iurl)
+        # Moon+ apparently cannot handle .jpeg files
+        if itype == 'jpeg':
+            itype = 'jpg'
+        return itype, data
 
     def absurl(self, baseurl, tag, key, filter=True):
         iurl = tag[key]
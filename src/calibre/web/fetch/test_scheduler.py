@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Tests and a benchmark of the download scheduler of recipes, see
+:mod:`calibre.web.fetch.scheduler`, using local servers of articles.
+'''
+
+import hashlib
+import os
+import time
+import unittest
+from itertools import pairwise
+from threading import Lock, Thread
+
+from calibre.ptempfile import TemporaryDirectory
+from calibre.utils.http_test_server import LocalHTTPServer
+from calibre.web.fetch.scheduler import HostLimiter, SharedDownloads
+
+
+class FixtureServer(LocalHTTPServer):
+
+    '''
+    A local HTTP server serving articles that share a stylesheet and an image,
+    which are served by a second server, when images_from is set. Responses
+    have an ETag, so that they can be revalidated.
+    '''
+
+    def __init__(self, latency=0, images_from=None):
+        super().__init__(latency)
+        self.images_from = images_from
+        self.not_modified = 0
+
+    def respond(self, handler):
+        ctype, body = self.page(handler.path)
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if handler.headers.get('If-None-Match') == etag:
+            with self.lock:
+                self.not_modified += 1
+            self.send(handler, code=304)
+        else:
+            self.send(handler, body, headers=(('Content-Type', ctype), ('ETag', etag)))
+
+    def page(self, path):
+        if path == '/shared.css':
+            return 'text/css', b'p { margin: 0 }'
+        if path.endswith('.svg'):
+            return 'image/svg+xml', b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"/>'
+        images = (self.images_from or self).base_url
+        num = path.rpartition('/')[-1].partition('.')[0]
+        return 'text/html', (
+            '<html><head><link rel="stylesheet" type="text/css" href="/shared.css"/></head>'
+            f'<body><p>Article {num}</p><img src="{images}/logo.svg"/><img src="{images}/image{num}.svg"/></body></html>').encode('utf-8')
+
+
+def fetch_articles(urls, output_dir, num_threads=5, per_host=0, delay=0, keep_alive=True, shared=True, recipe_cache=None):
+    ' Download urls the way recipes download articles, returning the paths of the saved articles '
+    from calibre import browser
+    from calibre.utils.browser import ConnectionPool
+    from calibre.utils.logging import Log
+    from calibre.utils.threadpool import NoResultsPending, ThreadPool, WorkRequest
+    from calibre.web.fetch.simple import RecursiveFetcher
+    from calibre.web.fetch.simple import option_parser as web2disk_option_parser
+
+    opts = web2disk_option_parser().parse_args(['web2disk', '--delay', str(delay)])[0]
+    pool = ConnectionPool(max_per_host=max(4, num_threads)) if keep_alive else None
+    if shared:
+        opts.host_limiter, opts.shared_downloads = HostLimiter(per_host), SharedDownloads()
+    image_map, css_map, results = {}, {}, {}
+    log = Log(level=Log.ERROR)
+
+    def create_browser():
+        br = browser(user_agent='calibre-test')
+        if pool is not None:
+            br.set_connection_pool(pool)
+        if recipe_cache is not None:
+            br.set_http_cache(recipe_cache.http, 0)
+        return br
+
+    opts.dir, opts.browser, opts.recipe_cache = output_dir, create_browser(), recipe_cache
+
+    def fetch(i, url):
+        fetcher = RecursiveFetcher(opts, log, image_map, css_map)
+        fetcher.browser = create_browser()
+        fetcher.base_dir = fetcher.current_dir = os.path.join(output_dir, f'article_{i}')
+        os.makedirs(fetcher.base_dir)
+        fetcher.show_progress = False
+        return fetcher.start_fetch(url)
+
+    def done(req, result):
+        results[req.requestID] = result
+
+    def failed(req, tb):
+        raise Exception(f'Failed to download {urls[req.requestID]}:\n{tb}')
+
+    tp = ThreadPool(num_threads)
+    for i, url in enumerate(urls):
+        tp.putRequest(WorkRequest(fetch, (i, url), {}, i, done, failed), block=True, timeout=0)
+    while True:
+        try:
+            tp.poll()
+            time.sleep(0.01)
+        except NoResultsPending:
+            break
+    if pool is not None:
+        pool.close()
+    return [results.get(i) for i in range(len(urls))]
+
+
+def benchmark(num_articles=40, latency=0.05):
+    '''
+    Download articles, whose images are on a second server, the way recipes
+    used to, with one or five threads and a new connection for every request,
+    and with the scheduler.
+    Run with: calibre-debug -c "from calibre.web.fetch.test_scheduler import benchmark; benchmark()"
+    '''
+    for label, kw in (
+        ('One thread', {'num_threads': 1, 'keep_alive': False, 'shared': False}),
+        ('Five threads', {'keep_alive': False, 'shared': False}),
+        ('Scheduler', {}),
+    ):
+        with FixtureServer(latency) as images, FixtureServer(latency, images_from=images) as site, TemporaryDirectory() as tdir:
+            urls = [f'{site.base_url}/article/{i}.html' for i in range(num_articles)]
+            st = time.monotonic()
+            fetch_articles(urls, tdir, **kw)
+            t = time.monotonic() - st
+        print(f'{label}: {t:.2f} seconds, {len(site.requests) + len(images.requests)} requests, {site.connections + images.connections} connections')
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_host_limiter(self):
+        limiter = HostLimiter(max_per_host=2)
+        lock, times, in_flight = Lock(), [], [0, 0]
+
+        def request(url, delay):
+            with limiter.slot(url, delay):
+                with lock:
+                    times.append((url, time.monotonic()))
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                time.sleep(0.02)
+                with lock:
+                    in_flight[0] -= 1
+
+        threads = [Thread(target=request, args=('http://a.com/x', 0)) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(in_flight[1], 2)
+        del times[:]
+        threads = [Thread(target=request, args=(f'http://{h}.com/x', 0.1)) for h in 'bbbc']
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        b = sorted(at for url, at in times if '/b.com' in url)
+        c = [at for url, at in times if '/c.com' in url]
+        for x, y in pairwise(b):
+            self.assertGreaterEqual(y - x, 0.1)
+        # Other hosts are not delayed
+        self.assertLess(c[0] - b[0], 0.1)
+
+    def test_fetch_articles(self):
+        with FixtureServer(0.01) as images, FixtureServer(0.01, images_from=images) as site, TemporaryDirectory() as tdir:
+            urls = [f'{site.base_url}/article/{i}.html' for i in range(12)]
+            results = fetch_articles(urls, tdir, per_host=2)
+            for i, path in enumerate(results):
+                with open(path, 'rb') as f:
+                    raw = f.read().decode('utf-8')
+                self.assertIn(f'Article {i}', raw)
+                self.assertNotIn('http://', raw)
+        # Shared resources are downloaded only once
+        self.assertEqual(site.paths_requested().count('/shared.css'), 1)
+        self.assertEqual(images.paths_requested().count('/logo.svg'), 1)
+        self.assertEqual(len(images.requests), 13)
+        self.assertLessEqual(site.max_in_flight, 2)
+        self.assertLessEqual(images.max_in_flight, 2)
+        # Connections are reused
+        self.assertLessEqual(site.connections + images.connections, 10)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestScheduler)
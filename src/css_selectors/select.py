@@ -392,10 +392,19 @@ def select_element(cache, selector):
             yield elem
 
 
+def is_universal(selector):
+    return isinstance(selector, Element) and (selector.element or '*') == '*'
+
+
 def select_hash(cache, selector):
     'An id selector'
     items = cache.id_map[ascii_lower(selector.id)]
     if len(items) > 0:
+        if is_universal(selector.selector):
+            # Fast path, items are already in document order
+            for elem in items:
+                yield elem
+            return
         for elem in cache.iterparsedselector(selector.selector):
             if elem in items:
                 yield elem
@@ -405,6 +414,11 @@ def select_class(cache, selector):
     'A class selector'
     items = cache.class_map[ascii_lower(selector.class_name)]
     if items:
+        if is_universal(selector.selector):
+            # Fast path, items are already in document order
+            for elem in items:
+                yield elem
+            return
         for elem in cache.iterparsedselector(selector.selector):
             if elem in items:
                 yield elem